@@ -0,0 +1,78 @@
+"""
+Micro-benchmarks for repeated-phrase condensation (rosetta_condense.py) against the old
+per-phrase str.replace implementation that used to live in get_llm_response.
+
+Run from the repository root:
+    python benchmarks/bench_condense.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rosetta_condense import RepetitionCondenser, condense_repeated_phrases
+
+
+def legacy_condense(text_output):
+    # Verbatim copy of the previous implementation, for comparison
+    phrases = text_output.split(". ")
+    phrase_counts = {}
+    for phrase in phrases:
+        phrase = phrase.strip()
+        if phrase:
+            phrase_counts[phrase] = phrase_counts.get(phrase, 0) + 1
+    for phrase, count in phrase_counts.items():
+        if count > 5:
+            text_output = text_output.replace(phrase, "[REPEATED PHRASE: " + phrase + "]")
+    return text_output
+
+
+def make_corpora():
+    random.seed(7)
+    normal_sentences = [
+        f"Sentence {i} about the patient's course with labs reviewed and plan discussed" for i in range(400)
+    ]
+    return {
+        # ~32 KB (roughly the 8192-token output cap) of ordinary, non-repeating text
+        "normal_note_32k": ". ".join(normal_sentences)[:32000],
+        # One phrase looping for the whole output
+        "single_phrase_loop": "Continue to monitor closely. " * 1100,
+        # Many distinct phrases, each repeated just above the threshold: worst case for
+        # the old code (one full-text replace per phrase)
+        "many_repeated_phrases": ". ".join(
+            f"Recheck electrolyte panel number {i % 600} in the morning" for i in range(600 * 6)
+        ),
+        # A short cycle of lines with no ". " delimiters at all
+        "line_loop_no_periods": "- Monitor I/Os\n- Daily weights\n- Strict I/O\n" * 700,
+    }
+
+
+def time_call(func, text, number):
+    return min(timeit.repeat(lambda: func(text), number=number, repeat=3)) / number
+
+
+def time_to_loop_detection(text, chunk_size=64):
+    """
+    Returns how many characters a streaming consumer reads before the loop guard fires
+    (or None if it never does).
+    """
+    condenser = RepetitionCondenser()
+    for start in range(0, len(text), chunk_size):
+        if condenser.feed(text[start:start + chunk_size]):
+            return condenser.chars_consumed
+    return None
+
+
+if __name__ == "__main__":
+    print(f"{'corpus':<24} {'chars':>8} {'legacy ms':>10} {'single-pass ms':>15} {'speedup':>8} {'loop detected at':>17}")
+    for name, text in make_corpora().items():
+        number = 3 if name == "many_repeated_phrases" else 20
+        legacy_seconds = time_call(legacy_condense, text, number)
+        new_seconds = time_call(condense_repeated_phrases, text, number)
+        detected_at = time_to_loop_detection(text)
+        print(
+            f"{name:<24} {len(text):>8} {legacy_seconds * 1000:>10.2f} {new_seconds * 1000:>15.2f} "
+            f"{legacy_seconds / new_seconds:>7.1f}x {str(detected_at) if detected_at else '-':>17}"
+        )
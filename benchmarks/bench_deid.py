@@ -0,0 +1,69 @@
+"""
+De-identification benchmark against the local fake DLP server (benchmarks/fake_dlp_server.py).
+
+Compares the old path (new DlpServiceClient per request, whole text as one item) with the
+pooled, chunked and parallel DlpDeidentifier, for one large chart dump and for a batch of
+small texts. Also checks that chunked output is identical to unchunked output.
+
+Run from the repository root:
+    python benchmarks/bench_deid.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import grpc
+from google.cloud import dlp_v2
+from google.cloud.dlp_v2.services.dlp_service.transports import DlpServiceGrpcTransport
+
+from fake_dlp_server import fake_deidentify, serve
+from rosetta_deid import DlpClientPool, DlpDeidentifier, build_deidentify_request
+
+PROJECT_ID = "bench-project"
+
+
+def make_chart_dump(days=30):
+    day = (
+        "Day {d}: Mr. Smith seen on rounds. Called wife at 555-123-4567, MRN 12345678.\n"
+        "Vitals stable overnight. Labs drawn 3/{d}/2025, potassium repleted.\n"
+        "Discussed plan with Dr. Alvarez; follow-up email to team@example.org.\n\n"
+    )
+    return "".join(day.format(d=d % 28 + 1) * 20 for d in range(days))
+
+
+def old_path(endpoint, text):
+    # Fresh client + channel per request, whole text in one item (previous route behaviour)
+    client = dlp_v2.DlpServiceClient(transport=DlpServiceGrpcTransport(channel=grpc.insecure_channel(endpoint)))
+    return client.deidentify_content(request=build_deidentify_request(text, PROJECT_ID)).item.value
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<46} {(time.perf_counter() - start) * 1000:>9.1f} ms")
+    return result
+
+
+if __name__ == "__main__":
+    server, service, port = serve(0, base_latency_ms=80, per_kchar_latency_ms=4)
+    endpoint = f"127.0.0.1:{port}"
+    deidentifier = DlpDeidentifier(DlpClientPool(2, insecure_endpoint=endpoint), max_chunk_chars=20000,
+                                   max_request_chars=20000, max_parallel_requests=8)
+    deidentifier.deidentify_text("warm up", PROJECT_ID)
+
+    chart = make_chart_dump()
+    print(f"Chart dump: {len(chart)} chars")
+    expected = fake_deidentify(chart)
+    old_result = timed("old: new client, single item", lambda: old_path(endpoint, chart))
+    new_result = timed("new: pooled client, chunked + parallel", lambda: deidentifier.deidentify_text(chart, PROJECT_ID))
+    assert old_result == expected and new_result == expected, "chunked output differs from unchunked output"
+
+    small_texts = [f"Pt seen by Dr. Nguyen, callback 555-987-{i:04d}." for i in range(40)]
+    timed("old: 40 small texts, one request each", lambda: [old_path(endpoint, text) for text in small_texts])
+    calls_before = service.calls
+    results = timed("new: 40 small texts, batch (table packing)", lambda: deidentifier.deidentify_texts(small_texts, PROJECT_ID))
+    assert [text for text, _ in results] == [fake_deidentify(text) for text in small_texts]
+    print(f"DLP calls for the batch: {service.calls - calls_before}")
+    server.stop(0)
@@ -0,0 +1,114 @@
+"""
+Bandwidth and latency benchmark for conditional GET and response compression.
+
+Runs the Flask app in-process (test client) against benchmarks/fake_gemini_server.py and a
+temporary note store, and compares for each workload:
+  * identity: no validators, no Accept-Encoding (what the frontend got before)
+  * gzip / br: first fetch with Accept-Encoding (br only when the brotli package is installed)
+  * revalidate: repeat fetch with If-None-Match, as a browser does when the note dropdown
+    switches back to a note it already has (304, no body)
+
+Workloads: /get_note for notes of --note-kb sizes, and /generate_note with a reply (note +
+thoughts) of --reply-chars. Server time is measured; transfer time is modelled from the bytes
+sent at --link-mbps plus --rtt-ms (a hospital Wi-Fi or VPN link), since loopback has no
+bandwidth limit.
+
+Run from the repository root:
+    python benchmarks/bench_http_transfer.py [--note-kb 4 16 64] [--reply-chars 12000] [--link-mbps 10] [--rtt-ms 40]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_search import make_note
+from fake_gemini_server import serve
+from rosetta_compression import AVAILABLE_ENCODINGS
+
+
+def synthetic_note(kilobytes, seed=7):
+    # Daily progress notes of a long stay, one after another (as in a copied-forward note)
+    rng = random.Random(seed)
+    days = []
+    while sum(len(day) for day in days) < kilobytes * 1024:
+        days.append(f"Hospital day {len(days) + 1}\n{make_note(rng)}\n")
+    return "".join(days)
+
+
+def measure(client, method, path, repeat, headers=None, json_payload=None):
+    """
+    Returns (median server seconds, bytes sent, last response) over `repeat` requests.
+    """
+    timings, response = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.open(path, method=method, headers=headers or {}, json=json_payload)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), len(response.data), response
+
+
+def report(label, server_seconds, sent_bytes, status, baseline_bytes, link_mbps, rtt_ms):
+    transfer_ms = sent_bytes * 8 / (link_mbps * 1e6) * 1000
+    total_ms = server_seconds * 1000 + rtt_ms + transfer_ms
+    saved = 100 * (1 - sent_bytes / baseline_bytes) if baseline_bytes else 0
+    print(f"  {label:<12} {status:>4} {sent_bytes:>9} {saved:>7.1f}% {server_seconds * 1000:>9.2f} {transfer_ms:>11.2f} {total_ms:>9.2f}")
+
+
+def header():
+    print(f"  {'mode':<12} {'code':>4} {'bytes':>9} {'saved':>8} {'server ms':>9} {'transfer ms':>11} {'total ms':>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--note-kb", type=int, nargs="+", default=[4, 16, 64], help="Note sizes for /get_note")
+    parser.add_argument("--reply-chars", type=int, default=12000, help="Fake Gemini reply size for /generate_note")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--link-mbps", type=float, default=10.0)
+    parser.add_argument("--rtt-ms", type=float, default=40.0)
+    args = parser.parse_args()
+
+    _, _, port = serve(0, latency_ms=0, jitter_ms=0, reply_chars=args.reply_chars)
+    base = tempfile.mkdtemp(prefix="rosetta_http_bench_")
+    os.environ.update({
+        "BASE_NOTES_PATH": base,
+        "ROSETTA_GEMINI_ENDPOINT": f"http://127.0.0.1:{port}",
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "unused"),
+        "ROSETTA_RESPONSE_CACHE": "0",
+        "ROSETTA_JOBS": "0",
+        "ROSETTA_LOG_LEVEL": "WARNING",
+    })
+    import rosetta_backend as backend # After the environment is set
+
+    client = backend.app.test_client()
+    modes = [("identity", {})] + [(encoding, {"Accept-Encoding": encoding}) for encoding in AVAILABLE_ENCODINGS]
+    print(f"link {args.link_mbps:g} Mbps, RTT {args.rtt_ms:g} ms, {args.repeat} requests per row (median server time)")
+
+    for kilobytes in args.note_kb:
+        filename, _ = backend.note_store.create(f"rosetta_note_20250101_0800_MED_{kilobytes}kb.txt", synthetic_note(kilobytes))
+        path = f"/get_note/{filename}"
+        print(f"/get_note, {kilobytes} KB note")
+        header()
+        baseline = None
+        for label, headers in modes:
+            seconds, sent, response = measure(client, "GET", path, args.repeat, headers)
+            baseline = baseline or sent
+            report(label, seconds, sent, response.status_code, baseline, args.link_mbps, args.rtt_ms)
+        revalidate = {"If-None-Match": response.headers["ETag"], **headers}
+        seconds, sent, response = measure(client, "GET", path, args.repeat, revalidate)
+        report("revalidate", seconds, sent, response.status_code, baseline, args.link_mbps, args.rtt_ms)
+        seconds, sent, response = measure(client, "GET", path, args.repeat, {"Range": "bytes=0-2047"})
+        report("range 2 KB", seconds, sent, response.status_code, baseline, args.link_mbps, args.rtt_ms)
+
+    print(f"/generate_note, ~{args.reply_chars}-character reply (note + thoughts)")
+    header()
+    baseline = None
+    payload = {"patient_data": "67yo with heart failure exacerbation, net negative 1.2 L overnight.", "service_abbr": "CARDS"}
+    for label, headers in modes:
+        seconds, sent, response = measure(client, "POST", "/generate_note", max(5, args.repeat // 5), headers, payload)
+        baseline = baseline or sent
+        report(label, seconds, sent, response.status_code, baseline, args.link_mbps, args.rtt_ms)
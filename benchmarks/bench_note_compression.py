@@ -0,0 +1,128 @@
+"""
+Storage benchmark for compressed note files (rosetta_note_codec.py).
+
+Builds a synthetic corpus of --notes notes (benchmarks/bench_search.make_note, with a share of
+long copied-forward notes) and reports, for plain text, gzip and zstd levels, and zstd with a
+dictionary trained on a separate sample of notes:
+  * ratio: plain bytes / stored bytes, and the disk actually used (file sizes rounded up to
+    --block-bytes, since most filesystems allocate whole blocks to small files)
+  * compress / decompress throughput in MB/s of note text, and per-note read time through
+    NoteCodec.read (open + read + decode), the cost /get_note pays
+
+zstd rows need the zstandard package and are skipped without it. With --recompress, the
+`python rosetta_store.py recompress` tool is timed on a copy of the corpus as well.
+
+Run from the repository root:
+    python benchmarks/bench_note_compression.py [--notes 2000] [--dictionary-kb 64] [--recompress]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_search import make_note
+from rosetta_note_codec import CODEC_GZIP, CODEC_NONE, CODEC_ZSTD, NoteCodec, dictionary_path, train_dictionary, zstandard
+from rosetta_store import recompress_directory
+
+
+def make_corpus(count, seed):
+    rng = random.Random(seed)
+    notes = []
+    for _ in range(count):
+        if rng.random() < 0.2:
+            # Long stays: a copied-forward note with several days of progress
+            notes.append("".join(f"Hospital day {day}\n{make_note(rng)}\n" for day in range(1, rng.randint(3, 10))))
+        else:
+            notes.append(make_note(rng))
+    return notes
+
+
+def on_disk(size, block_bytes):
+    return max(1, -(-size // block_bytes)) * block_bytes
+
+
+def measure(label, codec, notes, directory, block_bytes):
+    text_bytes = sum(len(note.encode("utf-8")) for note in notes)
+    start = time.perf_counter()
+    encoded = [codec.encode(note) for note in notes]
+    compress_seconds = time.perf_counter() - start
+    encoded = [data.encode("utf-8") if isinstance(data, str) else data for data in encoded]
+    start = time.perf_counter()
+    for data in encoded:
+        codec.decode(data, codec.suffix)
+    decompress_seconds = time.perf_counter() - start
+
+    # Per-note reads from disk, as /get_note does them
+    paths = []
+    for index, data in enumerate(encoded):
+        path = os.path.join(directory, f"rosetta_note_20250101_0800_MED_{index}.txt{codec.suffix}")
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    read_times = []
+    for path in paths:
+        start = time.perf_counter()
+        codec.read(path)
+        read_times.append(time.perf_counter() - start)
+
+    stored_bytes = sum(len(data) for data in encoded)
+    disk_bytes = sum(on_disk(len(data), block_bytes) for data in encoded)
+    plain_disk = sum(on_disk(len(note.encode("utf-8")), block_bytes) for note in notes)
+    print(
+        f"{label:<22} {text_bytes / stored_bytes:>7.2f} {plain_disk / disk_bytes:>7.2f} "
+        f"{text_bytes / 1e6 / compress_seconds if compress_seconds else 0:>11.1f} "
+        f"{text_bytes / 1e6 / decompress_seconds if decompress_seconds else 0:>13.1f} "
+        f"{statistics.median(read_times) * 1e6:>9.1f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--dictionary-kb", type=int, default=64, help="Trained zstd dictionary size")
+    parser.add_argument("--training-notes", type=int, default=2000, help="Separate sample the dictionary is trained on")
+    parser.add_argument("--block-bytes", type=int, default=4096, help="Filesystem allocation unit")
+    parser.add_argument("--recompress", action="store_true", help="Also time the recompress tool")
+    args = parser.parse_args()
+
+    notes = make_corpus(args.notes, seed=7)
+    text_bytes = sum(len(note.encode("utf-8")) for note in notes)
+    root = tempfile.mkdtemp(prefix="rosetta_compression_bench_")
+    print(f"{len(notes)} notes, {text_bytes / 1e6:.2f} MB of text, median note {statistics.median(len(n) for n in notes):.0f} chars, in {root}")
+    print(f"{'codec':<22} {'ratio':>7} {'disk':>7} {'comp MB/s':>11} {'decomp MB/s':>13} {'read us':>9}")
+
+    dictionary_directory = os.path.join(root, ".dictionaries")
+    os.makedirs(dictionary_directory)
+    codecs = [("none", NoteCodec(CODEC_NONE))]
+    codecs += [(f"gzip -{level}", NoteCodec(CODEC_GZIP, level=level)) for level in (1, 6, 9)]
+    if zstandard is not None:
+        codecs += [(f"zstd -{level}", NoteCodec(CODEC_ZSTD, level=level)) for level in (3, 9, 19)]
+        dict_id, data = train_dictionary(make_corpus(args.training_notes, seed=11), args.dictionary_kb * 1024)
+        with open(dictionary_path(dictionary_directory, dict_id), "wb") as f:
+            f.write(data)
+        codecs += [
+            (f"zstd -{level} + dict", NoteCodec(CODEC_ZSTD, level=level, dictionary_directory=dictionary_directory, use_dictionary=True))
+            for level in (3, 9)
+        ]
+    else:
+        print("(zstandard is not installed: zstd rows skipped)")
+
+    for label, codec in codecs:
+        directory = os.path.join(root, label.replace(" ", "_").replace("+", "").replace("-", ""))
+        os.makedirs(directory)
+        measure(label, codec, notes, directory, args.block_bytes)
+
+    if args.recompress:
+        directory = os.path.join(root, "recompress")
+        os.makedirs(directory)
+        for index, note in enumerate(notes):
+            with open(os.path.join(directory, f"rosetta_note_20250101_0800_MED_{index}.txt"), "w", encoding="utf-8") as f:
+                f.write(note)
+        target = CODEC_ZSTD if zstandard is not None else CODEC_GZIP
+        print(f"recompress tool, plain -> {target}:")
+        recompress_directory(directory, NoteCodec(target))
@@ -0,0 +1,142 @@
+"""
+Query latency benchmark for the full-text note search (rosetta_search.py).
+
+Builds a synthetic corpus (default 100,000 notes) in a temporary SQLite note store, then
+times a mix of word, phrase, prefix, OR/NOT, service-filtered and date-filtered queries
+through SqliteNoteStore.search, and compares a few of them with a linear scan of the bodies
+(what grepping the notes directory per query amounts to).
+
+Run from the repository root:
+    python benchmarks/bench_search.py [--notes 100000] [--keep-db /tmp/search_bench.db] [--rank-window 10000]
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rosetta_search import DEFAULT_RANK_WINDOW
+from rosetta_store import SqliteNoteStore
+
+SERVICES = ["MED", "MICU", "CARDS", "NEURO", "SURG", "ONC", "GI", "ID"]
+PROBLEMS = {
+    "#Sepsis": "Blood cultures x2 pending, on vancomycin and cefepime. Lactate trending down, MAP > 65 off pressors.",
+    "#AKI": "Creatinine {cr} from baseline 1.0, likely prerenal. Hold lisinopril, IV fluids, trend BMP.",
+    "#Chest pain": "Troponin {trop} then flat, EKG without ischemic changes. Continue aspirin, statin.",
+    "#Heart failure exacerbation": "Diuresing with IV furosemide, net negative 1.2L. Daily weights, strict I/Os.",
+    "#COPD exacerbation": "On prednisone and azithromycin, duonebs q4h. Wean O2 to goal SpO2 88-92%.",
+    "#Hyperkalemia": "K {k}, EKG without peaked T waves. Lokelma, repeat BMP in 4h.",
+    "#Diabetes mellitus type 2": "A1c 8.2, basal-bolus insulin, hold metformin while inpatient.",
+    "#Pneumonia": "CXR with RLL consolidation, ceftriaxone and azithromycin day {day}.",
+    "#Alcohol withdrawal": "CIWA protocol, thiamine and folate, last drink 2 days ago.",
+    "#Atrial fibrillation": "Rate controlled on metoprolol, apixaban for anticoagulation, CHA2DS2-VASc 4.",
+    "#Cirrhosis": "MELD 18, lactulose titrated to 3 BMs daily, rifaximin, no encephalopathy.",
+    "#Stroke": "MRI with left MCA infarct, neuro checks q4h, permissive hypertension.",
+}
+# In about 1% of notes, for a selective query
+RARE_PROBLEM = "#Tumor lysis syndrome\nUric acid 11.2, rasburicase given, aggressive IV hydration, BMP q6h."
+SUBJECTIVE = [
+    "Reports improved shortness of breath overnight.",
+    "Denies chest pain, palpitations or syncope.",
+    "Tolerating diet, no nausea or vomiting.",
+    "Slept poorly, pain controlled on current regimen.",
+    "Ambulating with PT, using walker.",
+]
+# (label, query, filters)
+QUERIES = [
+    ("rare word", "rasburicase", {}),
+    ("word", "lokelma", {}),
+    ("common word", "continue", {}),
+    ("two words", "creatinine prerenal", {}),
+    ("phrase", '"blood cultures"', {}),
+    ("prefix", "diure*", {}),
+    ("short prefix", "ce*", {}),
+    ("OR", "apixaban OR warfarin", {}),
+    ("NOT", "pneumonia -copd", {}),
+    ("service filter", "sepsis", {"service": "MICU"}),
+    ("date range", "troponin", {"date_from": "2025-03", "date_to": "2025-04"}),
+    ("all filters", '"heart failure" furosemide', {"service": "CARDS", "date_from": "2025", "date_to": "2025"}),
+]
+
+
+def make_note(rng):
+    problems = rng.sample(list(PROBLEMS), rng.randint(2, 5))
+    plan = "\n\n".join(
+        f"{name}\n" + PROBLEMS[name].format(cr=round(rng.uniform(1.3, 4.0), 1), trop=round(rng.uniform(0.01, 0.5), 2),
+                                             k=round(rng.uniform(5.3, 6.8), 1), day=rng.randint(1, 7))
+        for name in problems
+    )
+    if rng.random() < 0.01:
+        plan += "\n\n" + RARE_PROBLEM
+    return (
+        f"Impression: {rng.randint(25, 95)}yo with {problems[0].lstrip('#').lower()} admitted for management.\n\n"
+        f"Subjective:\n{' '.join(rng.sample(SUBJECTIVE, 3))}\n\n"
+        f"Objective:\nT {round(rng.uniform(36.4, 38.9), 1)} HR {rng.randint(60, 120)} BP {rng.randint(95, 160)}/{rng.randint(50, 95)} "
+        f"SpO2 {rng.randint(88, 99)}% RA\n\n"
+        f"A&P:\n{plan}\n"
+    )
+
+
+def synthetic_records(count, seed):
+    rng = random.Random(seed)
+    for index in range(count):
+        service = rng.choice(SERVICES)
+        date = f"2025{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}"
+        yield {
+            "filename": f"rosetta_note_{date}_{rng.randint(0, 23):02d}{rng.randint(0, 59):02d}_{service}_{index}.txt",
+            "service": service,
+            "body": make_note(rng),
+        }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rank-window", type=int, default=DEFAULT_RANK_WINDOW, help="Newest matches ranked per query")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--keep-db", help="Build (or reuse) the corpus at this path instead of a temp file")
+    args = parser.parse_args()
+
+    db_path = args.keep_db or os.path.join(tempfile.mkdtemp(prefix="rosetta_search_bench_"), "notes.db")
+    reuse = os.path.exists(db_path)
+    store = SqliteNoteStore(db_path)
+    if not reuse:
+        start = time.perf_counter()
+        store.import_notes(synthetic_records(args.notes, args.seed))
+        elapsed = time.perf_counter() - start
+        print(f"Built {args.notes} notes (index maintained by triggers) in {elapsed:.1f}s "
+              f"-> {elapsed * 1e6 / args.notes:.0f} us/note; database {os.path.getsize(db_path) / 1e6:.0f} MB")
+    print(f"Corpus: {store.snapshot()['notes']} notes at {db_path}\n")
+
+    print(f"{'query':<16} {'hits':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    worst_p95 = 0.0
+    for label, query, filters in QUERIES:
+        store.search(query, limit=args.limit, rank_window=args.rank_window, **filters) # Warm the page cache
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results, _ = store.search(query, limit=args.limit, rank_window=args.rank_window, **filters)
+            timings.append((time.perf_counter() - start) * 1000)
+        worst_p95 = max(worst_p95, percentile(timings, 0.95))
+        print(f"{label:<16} {len(results):>6} {statistics.median(timings):>8.2f} {percentile(timings, 0.95):>8.2f} {max(timings):>8.2f}")
+    print(f"\nWorst p95: {worst_p95:.2f} ms")
+
+    # Baseline: a linear scan over every body, i.e. grep without any index
+    bodies = [row[0] for row in store._db.connection().execute("SELECT note_body(body) FROM notes")]
+    for label, pattern in [("scan: lokelma", r"lokelma"), ("scan: phrase", r"blood cultures")]:
+        regex = re.compile(pattern, re.IGNORECASE)
+        start = time.perf_counter()
+        hits = sum(1 for body in bodies if regex.search(body))
+        print(f"{label:<16} {hits:>6} {(time.perf_counter() - start) * 1000:>8.2f} ms (in-memory, no file I/O)")
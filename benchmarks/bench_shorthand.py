@@ -0,0 +1,122 @@
+"""
+Golden cases and throughput benchmark for the local shorthand engine (rosetta_shorthand.py).
+
+The golden cases pin the behaviour of overlapping glossary entries ("signs and symptoms" vs
+"symptoms", "hours" vs "hour"), case handling and protected tokens; the script exits non-zero
+if any of them fails. The benchmark then rewrites large synthetic notes and compares the
+compiled single-pass matcher with applying the glossary entry by entry (one re.sub each).
+
+Run from the repository root:
+    python benchmarks/bench_shorthand.py [--sizes-kb 10,100,1000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rosetta_prompts import GLOSSARY_APPLIED_LOCALLY_INSTRUCTION, GLOSSARY_INSTRUCTION, PREFERRED_SHORTHAND_GLOSSARY, estimate_tokens
+from rosetta_shorthand import MODE_SHN, MODE_VSHN, rewrite_shorthand
+
+# (mode, input, expected output)
+GOLDEN_CASES = [
+    # Overlapping entries: the longest entry wins
+    (MODE_SHN, "signs and symptoms of infection", "s/s of infection"),
+    (MODE_SHN, "symptoms improved", "s/s improved"),
+    (MODE_SHN, "for 3 hours, then every hour", "for 3 hrs, then every hr"),
+    (MODE_SHN, "hourly vitals", "hourly vitals"), # No match inside a longer word
+    (MODE_SHN, "nothing by mouth after midnight, meds by mouth", "NPO after midnight, meds PO"),
+    (MODE_SHN, "every other day; every day", "QOD; daily"),
+    (MODE_SHN, "diagnosis vs differential diagnosis", "Dx vs DDx"),
+    (MODE_SHN, "with and without contrast", "w/ and w/o contrast"),
+    (MODE_SHN, "continue; discontinue", "cont; d/c"),
+    (MODE_SHN, "past medical history and family history", "PMH and FHx"),
+    # Separators inside phrases
+    (MODE_SHN, "follow-up in 2 weeks, follow  up later", "f/u in 2 weeks, f/u later"),
+    (MODE_SHN, "65 year old female", "65 y/o F"),
+    (MODE_SHN, "shortness\nof breath", "shortness\nof breath"), # Phrases don't span lines
+    # Case
+    (MODE_SHN, "Patient seen. PATIENT stable. patient ok.", "Pt seen. PT stable. pt ok."),
+    (MODE_SHN, "Blood Pressure 120/80, heart rate 80", "BP 120/80, HR 80"),
+    (MODE_SHN, "Status post CABG", "S/p CABG"),
+    # Word boundaries and protected tokens
+    (MODE_SHN, "[PERSON_NAME] with history", "[PERSON_NAME] w/ hx"),
+    (MODE_SHN, "@@SECTION assessment_and_plan@@", "@@SECTION assessment_and_plan@@"),
+    (MODE_SHN, "@PATIENTNAME@ has female_patient", "@PATIENTNAME@ has female_patient"),
+    (MODE_SHN, "hypertension treatments", "hypertension treatments"),
+    # VSHN also drops lowercase articles before a word
+    (MODE_VSHN, "Continue the nebs and an echo in the morning", "Cont nebs and echo in morning"),
+    (MODE_VSHN, "Vitamin A low; hepatitis A; a) check labs", "Vitamin A low; hepatitis A; a) check labs"),
+    (MODE_VSHN, "The patient was seen", "The pt was seen"),
+]
+
+FILLER_SENTENCES = [
+    "Patient with history of hypertension and diabetes, presents with shortness of breath for 3 hours.",
+    "Blood pressure 142/88, heart rate 104, respiratory rate 22, oxygen saturation 91% on room air.",
+    "Physical exam notable for bibasilar crackles without lower extremity edema.",
+    "Review of systems positive for orthopnea, negative for chest pain or loss of consciousness.",
+    "Continue furosemide 40 mg intravenous twice a day, discontinue lisinopril, follow up BMP in the morning.",
+    "Signs and symptoms consistent with heart failure exacerbation versus pneumonia; differential diagnosis includes PE.",
+    "Nothing by mouth after midnight for echo; medications by mouth as needed for pain.",
+    "Status post CABG in 2019; past medical history otherwise significant for CKD stage 3.",
+]
+
+
+def naive_rewrite(text, glossary):
+    # Entry by entry, in glossary order, as a baseline (and "signs and symptoms" can lose to "symptoms")
+    for full, abbreviation in glossary.items():
+        text = re.sub(r"\b" + re.escape(full) + r"\b", abbreviation, text, flags=re.IGNORECASE)
+    return text
+
+
+def make_note(rng, size_bytes):
+    parts = []
+    length = 0
+    while length < size_bytes:
+        sentence = rng.choice(FILLER_SENTENCES)
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(parts)
+
+
+def run_golden_cases():
+    failures = 0
+    for mode, text, expected in GOLDEN_CASES:
+        actual, _ = rewrite_shorthand(text, mode)
+        if actual != expected:
+            failures += 1
+            print(f"FAIL [{mode}] {text!r}\n    expected {expected!r}\n    got      {actual!r}")
+    print(f"Golden cases: {len(GOLDEN_CASES) - failures}/{len(GOLDEN_CASES)} passed")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes-kb", default="10,100,1000")
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = run_golden_cases()
+    rng = random.Random(args.seed)
+
+    print(f"\nPrompt: glossary {len(GLOSSARY_INSTRUCTION)} chars (~{estimate_tokens(GLOSSARY_INSTRUCTION)} tokens) "
+          f"-> {len(GLOSSARY_APPLIED_LOCALLY_INSTRUCTION)} chars (~{estimate_tokens(GLOSSARY_APPLIED_LOCALLY_INSTRUCTION)} tokens) per SHN/VSHN request")
+
+    print(f"\n{'note size':>10} {'mode':>5} {'compiled ms':>12} {'MB/s':>7} {'replacements':>13} {'per-entry ms':>13}")
+    for size_kb in (int(value) for value in args.sizes_kb.split(",")):
+        note = make_note(rng, size_kb * 1024)
+        for mode in (MODE_SHN, MODE_VSHN):
+            start = time.perf_counter()
+            _, replacements = rewrite_shorthand(note, mode)
+            compiled = time.perf_counter() - start
+            naive = ""
+            if mode == MODE_SHN:
+                start = time.perf_counter()
+                naive_rewrite(note, PREFERRED_SHORTHAND_GLOSSARY)
+                naive = f"{(time.perf_counter() - start) * 1000:.1f}"
+            print(f"{size_kb:>8}KB {mode:>5} {compiled * 1000:>12.2f} {len(note) / compiled / 1e6:>7.1f} {replacements:>13} {naive:>13}")
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,100 @@
+"""
+Local stand-in for the Google Cloud DLP DeidentifyContent RPC, for exercising the chunked /
+pooled de-identification path without GCP credentials.
+
+    python benchmarks/fake_dlp_server.py --port 50061 --base-latency-ms 80 --per-kchar-latency-ms 4
+    ROSETTA_DLP_INSECURE_ENDPOINT=localhost:50061 python rosetta_backend.py
+
+It replaces a few easy patterns (emails, phone numbers, MRNs, dates, "Mr./Ms./Dr. Name") with
+[INFO_TYPE] tokens, handles both plain value items and table items, and sleeps for a latency
+that grows with the request size, roughly like the real service. --jitter-ms adds random
+latency, and --error-rate answers that fraction of calls with UNAVAILABLE.
+"""
+import argparse
+import random
+import re
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.cloud import dlp_v2
+
+FAKE_DETECTORS = [
+    ("EMAIL_ADDRESS", re.compile(r"\b[\w.+-]+@[\w-]+\.[\w.]+\b")),
+    ("PHONE_NUMBER", re.compile(r"\(?\b\d{3}\)?[-. ]\d{3}[-. ]\d{4}\b")),
+    ("MEDICAL_RECORD_NUMBER", re.compile(r"\bMRN:?\s*\d{6,10}\b")),
+    ("DATE", re.compile(r"\b\d{1,2}/\d{1,2}/\d{2,4}\b")),
+    ("PERSON_NAME", re.compile(r"\b(?:Mr|Ms|Mrs|Dr)\.\s+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?")),
+]
+
+
+def fake_deidentify(text):
+    for info_type, pattern in FAKE_DETECTORS:
+        text = pattern.sub(f"[{info_type}]", text)
+    return text
+
+
+class FakeDlpService:
+    def __init__(self, base_latency_ms, per_kchar_latency_ms, jitter_ms=0.0, error_rate=0.0):
+        self.base_latency_ms = base_latency_ms
+        self.per_kchar_latency_ms = per_kchar_latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors_injected = 0
+
+    def deidentify_content(self, request, context):
+        failing = random.random() < self.error_rate
+        with self.lock:
+            self.calls += 1
+            self.errors_injected += failing
+        if failing:
+            time.sleep(self.base_latency_ms / 1000)
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Injected UNAVAILABLE")
+        item = request.item
+        if item.table.rows:
+            size = sum(len(row.values[0].string_value) for row in item.table.rows)
+            table = dlp_v2.Table(
+                headers=item.table.headers,
+                rows=[dlp_v2.Table.Row(values=[dlp_v2.Value(string_value=fake_deidentify(row.values[0].string_value))])
+                      for row in item.table.rows],
+            )
+            result_item = dlp_v2.ContentItem(table=table)
+        else:
+            size = len(item.value)
+            result_item = dlp_v2.ContentItem(value=fake_deidentify(item.value))
+        time.sleep((self.base_latency_ms + self.per_kchar_latency_ms * size / 1000 + random.uniform(0, self.jitter_ms)) / 1000)
+        return dlp_v2.DeidentifyContentResponse(item=result_item)
+
+
+def serve(port, base_latency_ms, per_kchar_latency_ms, max_workers=32, jitter_ms=0.0, error_rate=0.0):
+    service = FakeDlpService(base_latency_ms, per_kchar_latency_ms, jitter_ms, error_rate)
+    handler = grpc.method_handlers_generic_handler("google.privacy.dlp.v2.DlpService", {
+        "DeidentifyContent": grpc.unary_unary_rpc_method_handler(
+            service.deidentify_content,
+            request_deserializer=dlp_v2.DeidentifyContentRequest.deserialize,
+            response_serializer=dlp_v2.DeidentifyContentResponse.serialize,
+        ),
+    })
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    server.add_generic_rpc_handlers((handler,))
+    bound_port = server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server, service, bound_port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=50061)
+    parser.add_argument("--base-latency-ms", type=float, default=80)
+    parser.add_argument("--per-kchar-latency-ms", type=float, default=4)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with UNAVAILABLE")
+    parser.add_argument("--max-workers", type=int, default=32)
+    args = parser.parse_args()
+    server, _, bound_port = serve(args.port, args.base_latency_ms, args.per_kchar_latency_ms, args.max_workers,
+                                  jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    print(f"Fake DLP server listening on 127.0.0.1:{bound_port}")
+    server.wait_for_termination()
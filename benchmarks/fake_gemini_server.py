@@ -0,0 +1,246 @@
+"""
+Local stand-in for the Gemini REST API (generateContent and streamGenerateContent), for
+exercising retries, hedging, circuit breaking and model fallback without an API key.
+
+    python benchmarks/fake_gemini_server.py --port 8089 --latency-ms 400 --error-rate 0.2
+    ROSETTA_GEMINI_ENDPOINT=http://127.0.0.1:8089 ROSETTA_LLM_FALLBACK_MODELS=gemini-2.5-flash python rosetta_backend.py
+
+Each request sleeps for a base latency plus jitter, and optionally a long tail for a fraction
+of requests (for hedging). With --latency-distribution lognormal, --latency-ms is the median
+and --latency-sigma sets the spread (0.5 puts p99 at about 3.2x the median), which is closer
+to real LLM latencies for load tests. A fraction of requests, or every request to the models listed in
+--fail-models, answers with an HTTP error in Gemini's error format (503 UNAVAILABLE by default,
+429 RESOURCE_EXHAUSTED with --error-status 429). The reply is a small note with a thoughts
+block that names the model that produced it; --reply-chars/--reply-chars-jitter vary its size.
+
+Fault settings can be changed while the server runs (e.g. by a benchmark between phases):
+    curl -X POST localhost:8089/fake/config -d '{"error_rate": 1.0, "fail_models": ["gemini-2.5-pro-preview-05-06"]}'
+    curl localhost:8089/fake/stats
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rosetta_streaming import THOUGHTS_END_DELIM, THOUGHTS_START_DELIM
+
+MODEL_PATH_PATTERN = re.compile(r"^/v1(?:beta)?/(?:models|tunedModels)/([^/:]+):(generateContent|streamGenerateContent)")
+ERROR_STATUS_NAMES = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE", 504: "DEADLINE_EXCEEDED"}
+STREAM_CHUNKS = 4
+
+DEFAULT_CONFIG = {
+    "latency_ms": 300.0,
+    "jitter_ms": 100.0,
+    "slow_rate": 0.0,          # Fraction of requests that also get slow_latency_ms
+    "slow_latency_ms": 5000.0,
+    "error_rate": 0.0,         # Fraction of requests answered with error_status
+    "error_status": 503,
+    "fail_models": [],         # Models that always answer with error_status
+    "model_latency_ms": {},    # Per-model base latency overriding latency_ms
+    "reply_chars": 0,          # Pad the reply (thoughts and plan) to about this many characters
+    "reply_chars_jitter": 0,   # ... plus or minus up to this many
+    "latency_distribution": "uniform", # "uniform": latency_ms + U(0, jitter_ms); "lognormal": median latency_ms
+    "latency_sigma": 0.5,      # Lognormal shape (sigma of the underlying normal)
+}
+LATENCY_DISTRIBUTIONS = ("uniform", "lognormal")
+
+
+def fake_note_text(model, prompt_chars, reply_chars=0):
+    # Half of any padding goes to the thoughts, half to numbered plan items
+    padding = max(0, reply_chars - 300) // 2
+    reasoning = " ".join(
+        f"Step {index}: weighed problem {index} against the labs and the overnight events." for index in range(1, padding // 75 + 1)
+    )
+    plan = "".join(
+        f"{index}. Problem {index}: stable on current regimen; trend labs, reassess in AM.\n" for index in range(2, padding // 70 + 2)
+    )
+    return (
+        f"{THOUGHTS_START_DELIM}\nFake reasoning from {model} for a {prompt_chars}-character prompt.\n{reasoning}\n{THOUGHTS_END_DELIM}\n"
+        "Subjective: Patient seen and examined; no acute events overnight.\n"
+        "Objective: Vitals stable. Labs reviewed.\n"
+        f"Assessment and Plan:\n1. Condition stable. Continue current management.\n{plan}"
+    )
+
+
+def response_payload(text, prompt_chars, finish_reason="STOP"):
+    prompt_tokens = max(1, prompt_chars // 4)
+    output_tokens = max(1, len(text) // 4)
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": finish_reason, "index": 0}],
+        "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens, "totalTokenCount": prompt_tokens + output_tokens},
+    }
+
+
+class FakeGeminiState:
+    def __init__(self, **config):
+        self.lock = threading.Lock()
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.stats = {"requests": 0, "errors_injected": 0, "slow_injected": 0, "by_model": {}}
+
+    def update(self, changes):
+        with self.lock:
+            for key, value in changes.items():
+                if key in DEFAULT_CONFIG:
+                    self.config[key] = value
+            return dict(self.config)
+
+    def plan(self, model):
+        """
+        Returns (sleep_seconds, error_status or None, reply_chars) for one request and counts it.
+        """
+        with self.lock:
+            config = self.config
+            latency_ms = float(config["model_latency_ms"].get(model, config["latency_ms"]))
+            if config["latency_distribution"] == "lognormal":
+                latency_ms *= random.lognormvariate(0, float(config["latency_sigma"]))
+            else:
+                latency_ms += random.uniform(0, config["jitter_ms"])
+            slow = random.random() < config["slow_rate"]
+            if slow:
+                latency_ms += config["slow_latency_ms"]
+            failing = model in config["fail_models"] or random.random() < config["error_rate"]
+            self.stats["requests"] += 1
+            self.stats["slow_injected"] += slow
+            self.stats["errors_injected"] += failing
+            by_model = self.stats["by_model"].setdefault(model, {"requests": 0, "errors": 0})
+            by_model["requests"] += 1
+            by_model["errors"] += failing
+            reply_chars = int(config["reply_chars"]) + random.randint(-int(config["reply_chars_jitter"]), int(config["reply_chars_jitter"]))
+            return latency_ms / 1000, (int(config["error_status"]) if failing else None), max(0, reply_chars)
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps({"config": self.config, "stats": self.stats}))
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None # Set by serve()
+
+    def log_message(self, format, *args):
+        pass # Keep benchmark output readable
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw or b"{}")
+
+    def do_GET(self):
+        if self.path.startswith("/fake/stats"):
+            self._send_json(self.state.snapshot())
+        else:
+            self._send_json({"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}}, 404)
+
+    def do_POST(self):
+        if self.path.startswith("/fake/config"):
+            self._send_json({"config": self.state.update(self._read_json())})
+            return
+        match = MODEL_PATH_PATTERN.match(self.path)
+        if not match:
+            self._send_json({"error": {"code": 404, "message": f"Unknown method {self.path}", "status": "NOT_FOUND"}}, 404)
+            return
+        model, method = match.groups()
+        request = self._read_json()
+        prompt_chars = sum(len(part.get("text", "")) for content in request.get("contents", []) for part in content.get("parts", []))
+
+        sleep_seconds, error_status, reply_chars = self.state.plan(model)
+        time.sleep(sleep_seconds)
+        if error_status is not None:
+            status_name = ERROR_STATUS_NAMES.get(error_status, "UNKNOWN")
+            self._send_json({"error": {"code": error_status, "message": f"Injected {status_name} for {model}", "status": status_name}}, error_status)
+            return
+
+        text = fake_note_text(model, prompt_chars, reply_chars)
+        if method == "generateContent":
+            self._send_json(response_payload(text, prompt_chars))
+            return
+
+        # streamGenerateContent without alt=sse: one JSON array, written chunk by chunk
+        step = -(-len(text) // STREAM_CHUNKS)
+        pieces = [text[index:index + step] for index in range(0, len(text), step)]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(b"[")
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk = response_payload(piece, prompt_chars, "STOP" if last else "FINISH_REASON_UNSPECIFIED")
+            self.wfile.write(json.dumps(chunk).encode("utf-8") + (b"]" if last else b",\n"))
+            self.wfile.flush()
+            if not last:
+                time.sleep(0.02)
+        self.close_connection = True
+
+
+def serve(port, **config):
+    """
+    Starts the fake server on a background thread. Returns (server, state, bound_port).
+    """
+    state = FakeGeminiState(**config)
+    handler = type("BoundFakeGeminiHandler", (FakeGeminiHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server, state, server.server_address[1]
+
+
+def parse_model_latencies(entries):
+    latencies = {}
+    for entry in entries or []:
+        model, _, value = entry.partition("=")
+        latencies[model.strip()] = float(value)
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_CONFIG["latency_ms"])
+    parser.add_argument("--jitter-ms", type=float, default=DEFAULT_CONFIG["jitter_ms"])
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_CONFIG["latency_sigma"], help="lognormal spread")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests that get --slow-latency-ms on top")
+    parser.add_argument("--slow-latency-ms", type=float, default=DEFAULT_CONFIG["slow_latency_ms"])
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503, choices=sorted(ERROR_STATUS_NAMES))
+    parser.add_argument("--fail-models", default="", help="comma-separated models that always fail")
+    parser.add_argument("--model-latency", action="append", metavar="MODEL=MS", help="per-model base latency (repeatable)")
+    parser.add_argument("--reply-chars", type=int, default=0, help="pad each reply to about this many characters")
+    parser.add_argument("--reply-chars-jitter", type=int, default=0, help="vary --reply-chars by up to this many")
+    args = parser.parse_args()
+    server, _, bound_port = serve(
+        args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        slow_rate=args.slow_rate,
+        slow_latency_ms=args.slow_latency_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        fail_models=[model.strip() for model in args.fail_models.split(",") if model.strip()],
+        model_latency_ms=parse_model_latencies(args.model_latency),
+        reply_chars=args.reply_chars,
+        reply_chars_jitter=args.reply_chars_jitter,
+        latency_distribution=args.latency_distribution,
+        latency_sigma=args.latency_sigma,
+    )
+    print(f"Fake Gemini server listening on http://127.0.0.1:{bound_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,531 @@
+"""
+Load test of the backend under gunicorn against local fake Gemini and DLP servers, so
+throughput and tail latency can be measured without API quota or GCP credentials.
+
+Starts benchmarks/fake_gemini_server.py and benchmarks/fake_dlp_server.py as subprocesses,
+seeds a temporary BASE_NOTES_PATH with --seed-notes notes, starts gunicorn on the app, and
+runs --clients closed-loop clients (each sends its next request when the previous one is
+answered) for --duration seconds after --warmup seconds. Each request is one of:
+  * generate: POST /generate_note (unique patient data, so the response cache never hits,
+    unless --repeat-inputs N cycles through N inputs)
+  * list:     GET /list_saved_notes?limit=50
+  * get:      GET /get_note/<a seeded note>
+  * deid:     POST /api/deidentify_text (through the fake DLP)
+picked at random with the --mix weights. Reported per request type and overall: p50/p95/p99/
+max latency, requests per second, errors and status codes; plus the resident memory (RSS,
+from /proc: Linux only) of the gunicorn master and workers, sampled during the run.
+
+Results are written as JSON (--output, default benchmarks/results/load-<commit>-<time>.json)
+with the commit, settings and fake server stats, so runs can be compared between commits:
+    python benchmarks/load_test.py --compare benchmarks/results/load-<old>.json
+    python benchmarks/load_test.py --diff OLD.json NEW.json   (no run, just the comparison)
+--fail-on-regression PCT exits with status 1 when a p95 grows or a throughput drops by more
+than PCT percent against --compare.
+
+ROSETTA_* variables in the environment are passed to the server, so settings can be
+compared, e.g. ROSETTA_NOTE_STORE=files or ROSETTA_NOTE_WRITE_BEHIND=1.
+
+Run from the repository root:
+    python benchmarks/load_test.py [--clients 16] [--duration 30] [--workers 4] [--threads 8]
+        [--mix generate=2,list=3,get=4,deid=1] [--gemini-latency-ms 1500 --gemini-distribution lognormal]
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.join(BENCHMARKS_DIRECTORY, "..")
+sys.path.insert(0, REPO_ROOT)
+
+from bench_search import make_note, synthetic_records
+
+REQUEST_KINDS = ("generate", "list", "get", "deid")
+DEFAULT_MIX = "generate=2,list=3,get=4,deid=1"
+SERVICES = ("MICU", "CARDS", "MED", "ONC", "SURG")
+PROJECT_ID = "load-test-project"
+LISTENING_PATTERN = re.compile(r"listening on (?:http://)?127\.0\.0\.1:(\d+)")
+DIFF_FIELDS = (("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("requests_per_second", True))
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise SystemExit(f"Unknown request type in --mix: {kind!r} (expected {', '.join(REQUEST_KINDS)})")
+        weights[kind] = float(weight or 1)
+    return {kind: weight for kind, weight in weights.items() if weight > 0}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+        return commit, bool(dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --- Processes ---
+
+def start_fake(script, arguments, log_path):
+    """
+    Starts a fake server script on a free port; returns (process, port).
+    """
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-u", os.path.join(BENCHMARKS_DIRECTORY, script), "--port", "0", *arguments],
+        stdout=subprocess.PIPE, stderr=log, text=True,
+    )
+    line = process.stdout.readline()
+    match = LISTENING_PATTERN.search(line)
+    if not match:
+        process.kill()
+        raise SystemExit(f"{script} did not start (see {log_path}): {line.strip()}")
+    return process, int(match.group(1))
+
+
+def stop(process, timeout=30):
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def wait_until_ready(process, port, log_path, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as f:
+                raise SystemExit(f"gunicorn exited with status {process.returncode}:\n{f.read()[-3000:]}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/list_saved_notes?limit=1")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"gunicorn did not answer within {timeout}s (see {log_path})")
+
+
+# --- Memory ---
+
+def _proc_tree(root_pid):
+    # The gunicorn master and its descendants (workers), from /proc/<pid>/stat parent pids
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(name))
+        except (OSError, IndexError, ValueError):
+            continue
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, ()))
+    return pids
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """
+    Samples the summed RSS of a process tree every `interval` seconds on a background thread.
+    """
+
+    def __init__(self, root_pid, interval=0.5):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.available = os.path.isdir("/proc")
+        self.samples = []  # (seconds since start, total bytes, processes)
+        self.worker_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def sample(self):
+        pids = _proc_tree(self.root_pid)
+        sizes = [_rss_bytes(pid) for pid in pids]
+        self.worker_peak = max([self.worker_peak] + sizes[1:])
+        return sum(sizes), len(pids)
+
+    def _run(self):
+        start = time.time()
+        while not self._stop.is_set():
+            total, processes = self.sample()
+            self.samples.append((round(time.time() - start, 2), total, processes))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.available:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        totals = [total for _, total, _ in self.samples]
+        return {
+            "start_mb": round(totals[0] / 2**20, 1),
+            "end_mb": round(totals[-1] / 2**20, 1),
+            "peak_mb": round(max(totals) / 2**20, 1),
+            "worker_peak_mb": round(self.worker_peak / 2**20, 1),
+            "processes": self.samples[-1][2],
+        }
+
+
+# --- Load ---
+
+class LoadClient:
+    """
+    One closed-loop client with a keep-alive connection (reopened when the server closes it,
+    as gunicorn's sync workers do after every response).
+    """
+
+    def __init__(self, port, seed, note_names, repeat_inputs, counter):
+        self.port = port
+        self.rng = random.Random(seed)
+        self.note_names = note_names
+        self.repeat_inputs = repeat_inputs
+        self.counter = counter
+        self.connection = None
+
+    def _request(self, method, path, payload=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.getheader("Connection", "").lower() == "close":
+            self.connection.close()
+            self.connection = None
+        return response.status
+
+    def _patient_data(self):
+        if self.repeat_inputs:
+            number = self.rng.randrange(self.repeat_inputs)
+            return f"Input {number}.\n{make_note(random.Random(number))}"
+        return f"Encounter {next(self.counter)}.\n{make_note(self.rng)}"
+
+    def send(self, kind):
+        if kind == "generate":
+            return self._request("POST", "/generate_note", {"patient_data": self._patient_data(), "service_abbr": self.rng.choice(SERVICES)})
+        if kind == "list":
+            return self._request("GET", "/list_saved_notes?limit=50")
+        if kind == "get":
+            return self._request("GET", "/get_note/" + urllib.parse.quote(self.rng.choice(self.note_names)))
+        text = f"Mr. Smith seen on rounds, MRN 12345678, call 555-123-4567 on 3/4/2025.\n{make_note(self.rng)}"
+        return self._request("POST", "/api/deidentify_text", {"text_content": text, "gcp_project_id": PROJECT_ID, "deid_mode": "dlp"})
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+def run_load(port, clients, warmup, duration, mix, note_names, repeat_inputs, seed):
+    """
+    Returns {kind: [(latency seconds, status or None)]} for requests that started after the
+    warmup and finished within the measured window, and the measured window in seconds.
+    """
+    kinds, weights = zip(*mix.items())
+    results = {kind: [] for kind in kinds}
+    lock = threading.Lock()
+    counter = iter(range(10**12))
+    start = time.perf_counter()
+    measure_from = start + warmup
+    measure_until = measure_from + duration
+
+    def client_loop(index):
+        client = LoadClient(port, seed + index, note_names, repeat_inputs, counter)
+        rng = random.Random(seed * 1000 + index)
+        own = {kind: [] for kind in kinds}
+        while time.perf_counter() < measure_until:
+            kind = rng.choices(kinds, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status = client.send(kind)
+            except (OSError, http.client.HTTPException):
+                status = None
+            finished = time.perf_counter()
+            if sent >= measure_from and finished <= measure_until:
+                own[kind].append((finished - sent, status))
+        client.close()
+        with lock:
+            for kind, samples in own.items():
+                results[kind].extend(samples)
+
+    threads = [threading.Thread(target=client_loop, args=(index,), name=f"load-client-{index}") for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, duration
+
+
+def summarize(samples, seconds):
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        key = str(status) if status is not None else "connection_error"
+        statuses[key] = statuses.get(key, 0) + 1
+    errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 400)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "requests_per_second": round(len(samples) / seconds, 2),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "status_codes": statuses,
+    }
+
+
+# --- Reporting ---
+
+def print_table(report):
+    print(f"{'request':<10} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, stats in list(report["endpoints"].items()) + [("overall", report["overall"])]:
+        cells = [stats[field] if stats[field] is not None else float("nan") for field in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(f"{kind:<10} {stats['requests']:>7} {stats['errors']:>7} {stats['requests_per_second']:>8.1f} "
+              + " ".join(f"{cell:>9.1f}" for cell in cells))
+    if report["rss"]:
+        rss = report["rss"]
+        print(f"RSS: {rss['start_mb']} MB at start, {rss['peak_mb']} MB peak, {rss['end_mb']} MB at end "
+              f"({rss['processes']} processes, largest worker {rss['worker_peak_mb']} MB)")
+
+
+def compare(baseline, current, fail_percent=None):
+    """
+    Prints the change of each endpoint's latencies and throughput against `baseline`.
+    Returns the regressions beyond `fail_percent` (p95 up or throughput down).
+    """
+    print(f"vs {baseline.get('commit') or '?'} ({baseline.get('timestamp')}):")
+    print(f"{'request':<10} " + " ".join(f"{field:>26}" for field, _ in DIFF_FIELDS))
+    regressions = []
+    rows = list(current["endpoints"].items()) + [("overall", current["overall"])]
+    for kind, stats in rows:
+        old = baseline["overall"] if kind == "overall" else baseline["endpoints"].get(kind)
+        if not old:
+            continue
+        cells = []
+        for field, higher_is_better in DIFF_FIELDS:
+            before, after = old.get(field), stats.get(field)
+            if not before or after is None:
+                cells.append(f"{'-':>26}")
+                continue
+            change = 100 * (after - before) / before
+            cells.append(f"{before:>10.1f} -> {after:>8.1f} {change:>+5.0f}%")
+            worse = -change if higher_is_better else change
+            if fail_percent is not None and field in ("p95_ms", "requests_per_second") and worse > fail_percent:
+                regressions.append(f"{kind} {field}: {before} -> {after} ({change:+.0f}%)")
+        print(f"{kind:<10} " + " ".join(cells))
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return regressions
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent closed-loop clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of load before measuring")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Request type weights")
+    parser.add_argument("--repeat-inputs", type=int, default=0, help="Cycle /generate_note through N inputs (cache hits)")
+    parser.add_argument("--seed-notes", type=int, default=2000, help="Notes saved before the run")
+    parser.add_argument("--seed", type=int, default=7)
+    # gunicorn
+    parser.add_argument("--app", default="rosetta_backend:app", help="e.g. rosetta_asgi:app with --worker-class uvicorn.workers.UvicornWorker")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="Threads per worker (gthread)")
+    parser.add_argument("--worker-class", default=None, help="Default: gthread with --threads > 1, else sync")
+    parser.add_argument("--timeout", type=int, default=120, help="gunicorn worker timeout")
+    # Fake Gemini
+    parser.add_argument("--gemini-latency-ms", type=float, default=1500.0)
+    parser.add_argument("--gemini-jitter-ms", type=float, default=500.0, help="uniform distribution only")
+    parser.add_argument("--gemini-distribution", choices=("uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--gemini-sigma", type=float, default=0.5)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-slow-rate", type=float, default=0.0)
+    parser.add_argument("--reply-chars", type=int, default=4000)
+    parser.add_argument("--reply-chars-jitter", type=int, default=2000)
+    # Fake DLP
+    parser.add_argument("--dlp-latency-ms", type=float, default=80.0)
+    parser.add_argument("--dlp-jitter-ms", type=float, default=40.0)
+    parser.add_argument("--dlp-error-rate", type=float, default=0.0)
+    # Results
+    parser.add_argument("--output", help="JSON results path (default benchmarks/results/load-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--fail-on-regression", type=float, metavar="PCT", help="Exit 1 on a p95 or throughput regression beyond PCT")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="Only compare two results files")
+    args = parser.parse_args()
+
+    if args.diff:
+        regressions = compare(load_report(args.diff[0]), load_report(args.diff[1]), args.fail_on_regression)
+        sys.exit(1 if regressions else 0)
+    mix = parse_mix(args.mix)
+    if not mix:
+        raise SystemExit("--mix selects no request types.")
+
+    base = tempfile.mkdtemp(prefix="rosetta_load_")
+    notes_directory = os.path.join(base, "rosetta_outputs")
+    os.makedirs(notes_directory)
+    note_names = []
+    for record in synthetic_records(args.seed_notes, args.seed):
+        with open(os.path.join(notes_directory, record["filename"]), "w", encoding="utf-8") as f:
+            f.write(record["body"])
+        note_names.append(record["filename"])
+
+    processes = []
+    try:
+        gemini, gemini_port = start_fake("fake_gemini_server.py", [
+            "--latency-ms", str(args.gemini_latency_ms), "--jitter-ms", str(args.gemini_jitter_ms),
+            "--latency-distribution", args.gemini_distribution, "--latency-sigma", str(args.gemini_sigma),
+            "--error-rate", str(args.gemini_error_rate), "--slow-rate", str(args.gemini_slow_rate),
+            "--reply-chars", str(args.reply_chars), "--reply-chars-jitter", str(args.reply_chars_jitter),
+        ], os.path.join(base, "fake_gemini.log"))
+        processes.append(gemini)
+        dlp, dlp_port = start_fake("fake_dlp_server.py", [
+            "--base-latency-ms", str(args.dlp_latency_ms), "--jitter-ms", str(args.dlp_jitter_ms),
+            "--error-rate", str(args.dlp_error_rate), "--max-workers", str(max(32, args.clients * 2)),
+        ], os.path.join(base, "fake_dlp.log"))
+        processes.append(dlp)
+
+        port = free_port()
+        environment = dict(os.environ)
+        environment.update({
+            "BASE_NOTES_PATH": base,
+            "ROSETTA_GEMINI_ENDPOINT": f"http://127.0.0.1:{gemini_port}",
+            "ROSETTA_DLP_INSECURE_ENDPOINT": f"127.0.0.1:{dlp_port}",
+            "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "unused"),
+            "GCP_PROJECT_ID": PROJECT_ID,
+            "ROSETTA_LOG_LEVEL": os.environ.get("ROSETTA_LOG_LEVEL", "WARNING"),
+        })
+        worker_class = args.worker_class or ("gthread" if args.threads > 1 else "sync")
+        gunicorn_log = os.path.join(base, "gunicorn.log")
+        command = [
+            sys.executable, "-m", "gunicorn", args.app, "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers),
+            "--worker-class", worker_class, "--timeout", str(args.timeout), "--log-level", "warning",
+        ]
+        if worker_class == "gthread":
+            command += ["--threads", str(args.threads)]
+        with open(gunicorn_log, "w") as log:
+            server = subprocess.Popen(command, cwd=REPO_ROOT, env=environment, stdout=log, stderr=subprocess.STDOUT)
+        processes.append(server)
+        wait_until_ready(server, port, gunicorn_log)
+
+        sampler = RssSampler(server.pid)
+        idle_rss, _ = sampler.sample() if sampler.available else (0, 0)
+        print(f"{args.clients} clients, {args.warmup:g}s warmup + {args.duration:g}s, mix {args.mix}, "
+              f"gunicorn {args.app} {args.workers}x{worker_class}" + (f"/{args.threads}" if worker_class == "gthread" else "")
+              + f", in {base}")
+        sampler.start()
+        results, seconds = run_load(port, args.clients, args.warmup, args.duration, mix, note_names, args.repeat_inputs, args.seed)
+        sampler.stop()
+
+        connection = http.client.HTTPConnection("127.0.0.1", gemini_port, timeout=10)
+        connection.request("GET", "/fake/stats")
+        gemini_stats = json.loads(connection.getresponse().read())["stats"]
+    finally:
+        for process in reversed(processes):
+            stop(process)
+
+    commit, dirty = git_commit()
+    all_samples = [sample for samples in results.values() for sample in samples]
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": vars(args),
+        "server_environment": {key: value for key, value in sorted(os.environ.items()) if key.startswith("ROSETTA_")},
+        "endpoints": {kind: summarize(samples, seconds) for kind, samples in results.items()},
+        "overall": summarize(all_samples, seconds),
+        "rss": dict(sampler.summary() or {}, idle_mb=round(idle_rss / 2**20, 1)) if sampler.samples else None,
+        "fake_gemini": gemini_stats,
+    }
+    print_table(report)
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIRECTORY, "results", f"load-{(commit or 'unknown')[:10]}{'-dirty' if dirty else ''}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results: {output}")
+
+    if args.compare:
+        regressions = compare(load_report(args.compare), report, args.fail_on_regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+import rosetta_backend as backend
+from rosetta_condense import RepetitionCondenser
+from rosetta_deid import (
+    assemble_deidentified_texts,
+    build_planned_request,
+    create_async_dlp_client,
+    plan_dlp_requests,
+    read_deidentify_response,
+)
+from rosetta_gemini import cancel_llm_stream
+from rosetta_local_deid import DEID_MODE_DLP, DEID_MODE_LOCAL
+from rosetta_logging import get_logger, payload_fields
+from rosetta_singleflight import AsyncSingleFlight, SingleFlightTimeout
+from rosetta_streaming import ThoughtsNoteSplitter, format_sse_event
+
+# --- ASGI serving mode ---
+# Run with:  uvicorn rosetta_asgi:app --workers 2
+#       or:  gunicorn -k uvicorn.workers.UvicornWorker rosetta_asgi:app
+# /generate_note and /api/deidentify_text are served natively with asyncio, so a slow Gemini
+# call only parks a coroutine instead of a whole worker. Every other route falls through to
+# the regular Flask app in rosetta_backend.py.
+
+logger = get_logger(__name__)
+
+# Upper bound on concurrent in-flight Gemini calls per process (the rest queue on the semaphore)
+MAX_CONCURRENT_LLM_CALLS = int(os.environ.get("ROSETTA_MAX_CONCURRENT_LLM_CALLS", "64"))
+
+# Identical in-flight requests within this worker's event loop share one Gemini call
+_single_flight = AsyncSingleFlight()
+_llm_semaphore = None
+_dlp_semaphore = None
+_dlp_client = None
+
+def _get_llm_semaphore():
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+    return _llm_semaphore
+
+def _get_dlp_client():
+    # Created on first use, inside the server's event loop, then reused
+    global _dlp_client, _dlp_semaphore
+    if _dlp_client is None:
+        _dlp_client = create_async_dlp_client(backend.DLP_INSECURE_ENDPOINT)
+        _dlp_semaphore = asyncio.Semaphore(backend.DLP_MAX_PARALLEL_REQUESTS)
+    return _dlp_client
+
+# --- Async helpers mirroring the sync ones in rosetta_backend.py ---
+
+async def get_llm_response_async(dynamic_prompt_from_frontend, bypass_cache=False, llm_meta=None, max_output_tokens=None):
+    """
+    Async counterpart of backend.get_llm_response. Awaits the Gemini call instead of blocking.
+    Returns the response text and any prompt feedback. Concurrent identical requests in this
+    process share one call.
+    """
+    if backend.single_flight is None:
+        return await generate_llm_response_async(dynamic_prompt_from_frontend, bypass_cache, llm_meta, max_output_tokens)
+
+    flight_key = backend.make_flight_key(dynamic_prompt_from_frontend, bypass_cache, max_output_tokens)
+
+    async def call():
+        meta = {}
+        text_output, feedback_str = await generate_llm_response_async(dynamic_prompt_from_frontend, bypass_cache, meta, max_output_tokens)
+        return text_output, feedback_str, meta
+
+    try:
+        (text_output, feedback_str, meta), coalesced = await _single_flight.do(flight_key, call, timeout=backend.SINGLE_FLIGHT_WAIT_SECONDS)
+    except SingleFlightTimeout as e:
+        backend.SINGLE_FLIGHT_REQUESTS.inc(role="timeout")
+        return f"Error: {e}", ""
+    backend.SINGLE_FLIGHT_REQUESTS.inc(role="coalesced" if coalesced else "leader")
+    if llm_meta is not None:
+        llm_meta.update(meta)
+        llm_meta["coalesced"] = coalesced
+    return text_output, feedback_str
+
+async def generate_llm_response_async(dynamic_prompt_from_frontend, bypass_cache=False, llm_meta=None, max_output_tokens=None):
+    """
+    Makes the Gemini call for get_llm_response_async (no coalescing).
+    """
+    try:
+        full_prompt_to_gemini = backend.compose_full_prompt(dynamic_prompt_from_frontend)
+        generation_config = backend.build_generation_config(max_output_tokens)
+
+        # The cache may hit its disk tier, so look it up off the event loop
+        cache_key, cached_value = await asyncio.to_thread(
+            backend.lookup_cached_response, full_prompt_to_gemini, generation_config, bypass_cache, llm_meta
+        )
+        if cached_value is not None:
+            return cached_value
+
+        logger.info("Sending prompt to Gemini (async)", model=backend.GEMINI_MODEL, **payload_fields("prompt", full_prompt_to_gemini))
+        request_prompt = backend.compose_request_prompt(dynamic_prompt_from_frontend)
+
+        async def attempt(model_name, timeout):
+            # get_model() may create/refresh the context cache (blocking API call), so run it in a thread
+            model = await asyncio.to_thread(backend.gemini_model_providers[model_name].get_model)
+            request_options = backend.llm_request_options(timeout)
+            async with _get_llm_semaphore():
+                with backend.LLM_IN_FLIGHT_CALLS.track_inprogress():
+                    if backend.LOOP_GUARD_SYNC_ENABLED:
+                        # Stream under the hood so a degenerate repetition loop can be cancelled mid-generation
+                        response = await model.generate_content_async(request_prompt, generation_config=generation_config, stream=True, request_options=request_options)
+                        stream_state = {}
+                        async for _ in iterate_llm_stream_async(response, stream_state):
+                            pass
+                        return response, stream_state
+                    return await model.generate_content_async(request_prompt, generation_config=generation_config, request_options=request_options), None
+
+        with backend.STAGE_SECONDS.time(stage="llm"):
+            (response, stream_state), call_info = await backend.llm_client.call_async(attempt, backend.LLM_DEADLINE_SECONDS)
+        if llm_meta is not None:
+            llm_meta.update(model=call_info["model"], llm_attempts=call_info["attempts"], hedged=call_info["hedged"])
+        if stream_state is not None and stream_state.get("loop_detected"):
+            backend.record_llm_response_metrics(response)
+            if llm_meta is not None:
+                llm_meta["loop_detected"] = True
+            return stream_state["condensed_output"], backend.LOOP_STOPPED_FEEDBACK
+        text_output, feedback_str = backend.interpret_llm_response(response)
+        if call_info["model"] == backend.GEMINI_MODEL:
+            await asyncio.to_thread(backend.store_cached_response, cache_key, text_output, feedback_str)
+        return text_output, feedback_str
+    except Exception as e:
+        logger.error("Error calling Google Gemini API (async)", error=str(e), error_type=type(e).__name__)
+        backend.ERRORS.inc(stage="llm", type=type(e).__name__)
+        return f"Error: Exception during API call - {str(e)}", ""
+
+async def iterate_llm_stream_async(response, stream_state):
+    """
+    Async counterpart of backend.iterate_llm_stream: yields text chunks, cancels the stream on a
+    repetition loop (when the loop guard is on) and leaves the condensed text in
+    stream_state["condensed_output"].
+    """
+    condenser = RepetitionCondenser()
+    async for chunk in response:
+        try:
+            chunk_text = chunk.text
+        except ValueError:
+            chunk_text = ""
+            if chunk.candidates:
+                stream_state["error_detail"] = f"Gemini API stream ended without content. Finish reason: {chunk.candidates[0].finish_reason}"
+        if chunk_text:
+            yield chunk_text
+            if condenser.feed(chunk_text) and backend.LOOP_GUARD_ENABLED:
+                logger.warning("Repetition loop detected; cancelling generation", chars=condenser.chars_consumed, reason=condenser.loop_reason)
+                stream_state["loop_detected"] = True
+                cancel_llm_stream(response)
+                break
+    stream_state["condensed_output"] = condenser.finish()
+
+async def stream_llm_response_async(dynamic_prompt_from_frontend, stream_state, bypass_cache=False, max_output_tokens=None):
+    """
+    Async counterpart of backend.stream_llm_response. Yields text chunks as Gemini produces them.
+    The concurrency slot is held for the whole stream.
+    """
+    full_prompt_to_gemini = backend.compose_full_prompt(dynamic_prompt_from_frontend)
+    generation_config = backend.build_generation_config(max_output_tokens)
+
+    cache_key, cached_value = await asyncio.to_thread(
+        backend.lookup_cached_response, full_prompt_to_gemini, generation_config, bypass_cache, stream_state
+    )
+    if cached_value is not None:
+        stream_state["feedback"] = cached_value[1]
+        yield cached_value[0]
+        return
+
+    logger.info("Streaming prompt to Gemini (async)", model=backend.GEMINI_MODEL, **payload_fields("prompt", full_prompt_to_gemini))
+    request_prompt = backend.compose_request_prompt(dynamic_prompt_from_frontend)
+
+    async def open_stream(model_name, timeout):
+        # Failures before the first chunk are retried; later ones end the stream
+        model = await asyncio.to_thread(backend.gemini_model_providers[model_name].get_model)
+        return await model.generate_content_async(request_prompt, generation_config=generation_config, stream=True, request_options=backend.llm_request_options(timeout))
+
+    async with _get_llm_semaphore():
+        start = time.perf_counter()
+        backend.LLM_IN_FLIGHT_CALLS.inc()
+        try:
+            response, call_info = await backend.llm_client.call_async(open_stream, backend.LLM_DEADLINE_SECONDS, hedge=False)
+            stream_state["model"] = call_info["model"]
+            async for chunk_text in iterate_llm_stream_async(response, stream_state):
+                yield chunk_text
+        except Exception as e:
+            backend.ERRORS.inc(stage="llm", type=type(e).__name__)
+            raise
+        finally:
+            backend.LLM_IN_FLIGHT_CALLS.dec()
+            backend.STAGE_SECONDS.observe(time.perf_counter() - start, stage="llm")
+    backend.record_llm_response_metrics(response)
+
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        stream_state["feedback"] = f"Prompt Feedback: {str(response.prompt_feedback)}"
+    if not stream_state.get("loop_detected") and stream_state["model"] == backend.GEMINI_MODEL:
+        await asyncio.to_thread(backend.store_cached_response, cache_key, stream_state["condensed_output"], stream_state.get("feedback", ""))
+
+async def deidentify_texts_async(texts, gcp_project_id):
+    """
+    Async counterpart of backend.dlp_deidentifier.deidentify_texts: same chunking and packing,
+    with the DLP calls awaited concurrently. Returns (deidentified_text, error) pairs.
+    """
+    dlp = _get_dlp_client()
+    chunk_owners, planned_requests = plan_dlp_requests(texts, backend.DLP_CHUNK_CHARS, backend.DLP_CHUNK_CHARS)
+
+    async def call(planned):
+        async with _dlp_semaphore:
+            response = await dlp.deidentify_content(
+                request=build_planned_request(planned, gcp_project_id), timeout=backend.DLP_REQUEST_TIMEOUT_SECONDS
+            )
+        return read_deidentify_response(response, len(planned))
+
+    with backend.STAGE_SECONDS.time(stage="dlp"):
+        outcomes = await asyncio.gather(*(call(planned) for planned in planned_requests), return_exceptions=True)
+    chunk_results = {}
+    request_errors = {}
+    for planned, outcome in zip(planned_requests, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error("Google Cloud DLP API call failed (async)", chunks=len(planned), error=str(outcome))
+            backend.ERRORS.inc(stage="dlp", type="api_error")
+            for chunk_id, _ in planned:
+                request_errors[chunk_id] = str(outcome)
+        else:
+            for (chunk_id, _), value in zip(planned, outcome):
+                chunk_results[chunk_id] = value
+    return assemble_deidentified_texts(texts, chunk_owners, chunk_results, request_errors)
+
+async def deidentify_text_async(text_to_deidentify, gcp_project_id):
+    """
+    Async counterpart of backend.dlp_deidentifier.deidentify_text.
+    Returns the de-identified text; API errors are raised to the caller.
+    """
+    deidentified_text, error = (await deidentify_texts_async([text_to_deidentify], gcp_project_id))[0]
+    if error:
+        raise RuntimeError(error)
+    return deidentified_text
+
+# --- Minimal ASGI plumbing ---
+
+RESPONSE_HEADERS = [
+    (b"access-control-allow-origin", b"*"), # Same as CORS(app) on the Flask side
+]
+
+async def _read_json_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    if not body:
+        return None
+    return json.loads(body)
+
+def _accept_encoding(scope):
+    for name, value in scope.get("headers", []):
+        if name == b"accept-encoding":
+            return value.decode("latin-1")
+    return ""
+
+async def _send_json(send, payload, status_code, accept_encoding=""):
+    body = json.dumps(payload).encode("utf-8")
+    headers = [(b"content-type", b"application/json")]
+    if backend.response_compressor is not None and 200 <= status_code < 300:
+        # Same rules as the Flask after_request hook; gzip of a note-sized body takes well under 1 ms
+        body, encoding = backend.response_compressor.compress_body(body, "application/json", accept_encoding)
+        if len(body) >= backend.response_compressor.min_bytes or encoding:
+            headers.append((b"vary", b"Accept-Encoding"))
+        if encoding:
+            headers.append((b"content-encoding", encoding.encode("ascii")))
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": RESPONSE_HEADERS + headers + [(b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_sse(send, events):
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": RESPONSE_HEADERS + [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+    async for event in events:
+        await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def _read_request_json(receive, send):
+    """
+    Returns the parsed JSON payload, or None after sending a 400 response.
+    """
+    try:
+        data = await _read_json_body(receive)
+    except Exception as e:
+        await _send_json(send, {"error": f"Error processing request JSON: {str(e)}"}, 400)
+        return None
+    if not data:
+        await _send_json(send, {"error": "Invalid JSON or no data provided"}, 400)
+        return None
+    return data
+
+# --- Async routes ---
+
+async def _local_output_chunks(local_output):
+    # A locally served note request (see backend.plan_local_reformat) streams as one chunk
+    yield local_output
+
+async def stream_note_events_async(note_request):
+    """
+    Async counterpart of backend.stream_note_events.
+    """
+    splitter = ThoughtsNoteSplitter()
+    raw_chunks = []
+    stream_state = {}
+    yield format_sse_event("start", {"filename": note_request["output_filename"]})
+    if note_request["local_output"] is not None:
+        chunks = _local_output_chunks(note_request["local_output"])
+    else:
+        chunks = stream_llm_response_async(note_request["prompt"], stream_state, note_request["bypass_cache"], note_request["max_output_tokens"])
+    try:
+        async for chunk_text in chunks:
+            raw_chunks.append(chunk_text)
+            for event_name, text in splitter.feed(chunk_text):
+                yield format_sse_event(event_name, {"text": text})
+        for event_name, text in splitter.finish():
+            yield format_sse_event(event_name, {"text": text})
+    except Exception as e:
+        logger.error("Error during streaming Gemini call (async)", error=str(e))
+        yield format_sse_event("error", {
+            "error": "Failed to get a valid response from LLM.",
+            "details": f"Error: Exception during API call - {str(e)}",
+        })
+        return
+
+    llm_raw_output = stream_state.get("condensed_output", "".join(raw_chunks))
+    if not llm_raw_output.strip():
+        llm_raw_output = f"Error: {stream_state.get('error_detail', 'Gemini API stream returned no content.')}"
+    note_request["model"] = backend.LOCAL_SHORTHAND_MODEL if note_request["local_output"] is not None else stream_state.get("model", backend.GEMINI_MODEL)
+    response_data, status_code = await asyncio.to_thread(
+        backend.finalize_note_output, llm_raw_output, stream_state.get("feedback", ""), note_request
+    )
+    response_data["status_code"] = status_code
+    response_data["model"] = note_request["model"]
+    response_data["cache_hit"] = stream_state.get("cache_hit", False)
+    response_data["loop_detected"] = stream_state.get("loop_detected", False)
+    yield format_sse_event("done" if status_code == 200 else "error", response_data)
+
+async def handle_generate_note_async(scope, receive, send):
+    data = await _read_request_json(receive, send)
+    if data is None:
+        return
+
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if backend.wants_async_job(data, query.get("async", [""])[0]):
+        # Queued for the backend's job workers (rosetta_jobs.py); the SQLite insert is blocking
+        response_payload, status_code = await asyncio.to_thread(backend.queue_note_job, data)
+        await _send_json(send, response_payload, status_code)
+        return
+
+    # Reading an existing note (update mode) is file I/O, so keep it off the event loop
+    note_request, error = await asyncio.to_thread(backend.build_note_request, data)
+    if error:
+        error_payload, status_code = error
+        await _send_json(send, error_payload, status_code)
+        return
+
+    if query.get("stream", [""])[0].lower() in ("1", "true", "yes"):
+        await _send_sse(send, stream_note_events_async(note_request))
+        return
+
+    llm_meta = {}
+    if note_request["local_output"] is not None:
+        llm_raw_output, prompt_feedback_details = note_request["local_output"], backend.LOCAL_OUTPUT_FEEDBACK
+    else:
+        llm_raw_output, prompt_feedback_details = await get_llm_response_async(
+            note_request["prompt"], note_request["bypass_cache"], llm_meta, note_request["max_output_tokens"]
+        )
+    # Saving the note is blocking I/O
+    response_data, status_code = await asyncio.to_thread(
+        backend.finish_note_response, note_request, llm_raw_output, prompt_feedback_details, llm_meta
+    )
+    await _send_json(send, response_data, status_code, _accept_encoding(scope))
+
+async def handle_deidentify_text_async(scope, receive, send):
+    data = await _read_request_json(receive, send)
+    if data is None:
+        return
+
+    text_to_deidentify = data.get('text_content')
+    if not text_to_deidentify:
+        await _send_json(send, {"deidentified_text": "", "status": "Input text was empty or missing."}, 200)
+        return
+    mode, gcp_project_id, error = backend.resolve_deid_request(data)
+    if error:
+        error_payload, status_code = error
+        await _send_json(send, error_payload, status_code)
+        return
+
+    try:
+        # The local engine is pure CPU (microseconds per KB), so it runs inline
+        if mode != DEID_MODE_DLP:
+            with backend.STAGE_SECONDS.time(stage="local_deid"):
+                text_to_deidentify = backend.local_deidentifier.deidentify(text_to_deidentify)
+        if mode != DEID_MODE_LOCAL:
+            text_to_deidentify = await deidentify_text_async(text_to_deidentify, gcp_project_id)
+    except Exception as e:
+        logger.error("De-identification failed (async)", mode=mode, error=str(e))
+        await _send_json(send, {"error": backend.deid_error_message(mode), "details": str(e)}, 500)
+        return
+    await _send_json(
+        send, {"deidentified_text": text_to_deidentify, "status": "De-identification successful.", "deid_mode": mode}, 200, _accept_encoding(scope)
+    )
+
+ASYNC_ROUTES = {
+    ("POST", "/generate_note"): handle_generate_note_async,
+    ("POST", "/api/deidentify_text"): handle_deidentify_text_async,
+}
+
+flask_asgi_app = WsgiToAsgi(backend.app)
+
+async def _instrumented(handler, scope, receive, send):
+    # Same request metrics as backend.instrument_route, with the status taken from the response start
+    endpoint = scope["path"]
+    status = {"code": 500}
+    async def send_and_record(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+        await send(message)
+
+    backend.IN_FLIGHT_REQUESTS.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        await handler(scope, receive, send_and_record)
+    except Exception as e:
+        backend.ERRORS.inc(stage="request", type=type(e).__name__)
+        raise
+    finally:
+        backend.IN_FLIGHT_REQUESTS.dec(endpoint=endpoint)
+        backend.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        backend.REQUESTS.inc(endpoint=endpoint, status=str(status["code"]))
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point. Async routes are handled here; everything else
+    (including CORS preflight requests) is delegated to the Flask app.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(backend.ensure_job_runner)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] == "http":
+        handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if handler:
+            await _instrumented(handler, scope, receive, send)
+            return
+
+    await flask_asgi_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    logger.info("Starting Rosetta ASGI server on http://127.0.0.1:5000", max_concurrent_llm_calls=MAX_CONCURRENT_LLM_CALLS)
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -1,12 +1,48 @@
 import os
 import datetime
+import functools
+import hashlib
 import time # For sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import google.generativeai as genai
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
+from rosetta_budget import DEFAULT_POLICIES as DEFAULT_COMPACTION_POLICIES, PromptBudgeter, parse_output_profiles
+from rosetta_cache import ResponseCache, make_cache_key
+from rosetta_compression import ResponseCompressor, strip_encoding_suffix
+from rosetta_condense import RepetitionCondenser, condense_repeated_phrases
+from rosetta_deid import DlpClientPool, DlpDeidentifier
+from rosetta_jobs import JobNotFound, JobQueue, JobRunner, JobStateError, parse_priority, parse_service_limits
+from rosetta_llm_client import BREAKER_STATE_VALUES, ResilientLLMClient
+from rosetta_logging import configure_logging, get_logger, payload_fields, set_drop_hook
+from rosetta_local_deid import DEID_MODE_DLP, DEID_MODE_LOCAL, LocalDeidentifier, load_name_dictionary, normalize_deid_mode
+from rosetta_metrics import TOKEN_BUCKETS, MetricsRegistry
+from rosetta_note_codec import DICTIONARY_DIRECTORY, NoteCodec
+from rosetta_gemini import GeminiModelProvider, cancel_llm_stream
+from rosetta_sections import (
+    PREAMBLE_SECTION_ID,
+    build_section_update_prompt,
+    merge_section_update,
+    parse_note_sections,
+    parse_section_update,
+    select_sections_for_update,
+)
+from rosetta_shorthand import rewrite_shorthand, shorthand_mode_for_options
+from rosetta_singleflight import FileFlightCoordinator, SingleFlight, SingleFlightError, SingleFlightTimeout
+from rosetta_store import STORE_FILES, NoteVersionConflict, atomic_write_text, create_note_store
+from rosetta_writebehind import WriteBehindNoteStore
+from rosetta_templates import TemplateRegistry, content_etag
+from rosetta_streaming import (
+    THOUGHTS_START_DELIM,
+    THOUGHTS_END_DELIM,
+    ThoughtsNoteSplitter,
+    format_sse_event,
+)
+
 # Import the make_default_options_response function
-from flask import make_response, send_from_directory
+from flask import make_response
 import werkzeug # For filename sanitization
 
 # --- Configuration ---
@@ -18,251 +54,745 @@ OUTPUT_NOTES_DIRECTORY = os.path.join(BASE_NOTES_PATH, "rosetta_outputs") # Save
 
 # INPUT_FILE_EXTENSION is no longer used for watching
 
+# Saved-note index (see rosetta_note_index.py). Listings are served from memory and the
+# directory is only rescanned when its mtime changes.
+NOTE_INDEX_REVALIDATE_SECONDS = float(os.environ.get("ROSETTA_NOTE_INDEX_REVALIDATE_SECONDS", "2"))
+# Optional: write new notes to rosetta_outputs/YYYYMM/ so individual directories stay small
+NOTES_SHARDED = os.environ.get("ROSETTA_NOTES_SHARDED", "0") == "1"
+# Note storage (see rosetta_store.py): "sqlite" (one WAL-mode database with metadata and version
+# history; seeded from rosetta_outputs on first start) or "files" (one .txt per note, the original layout)
+NOTE_STORE = os.environ.get("ROSETTA_NOTE_STORE", "sqlite").strip().lower()
+NOTE_STORE_PATH = os.environ.get("ROSETTA_NOTE_STORE_PATH", os.path.join(BASE_NOTES_PATH, "rosetta_notes.db"))
+NOTE_STORE_MAX_VERSIONS = int(os.environ.get("ROSETTA_NOTE_STORE_MAX_VERSIONS", "50")) # Old versions kept per note (SQLite)
+# Full-text search (see rosetta_search.py). The SQLite store keeps its index in the note
+# database; the file store mirrors notes into this separate index database.
+NOTE_SEARCH_INDEX_PATH = os.environ.get("ROSETTA_NOTE_SEARCH_INDEX_PATH", os.path.join(BASE_NOTES_PATH, "rosetta_search.db"))
+# Note files are written atomically (temp file + rename); ROSETTA_NOTES_FSYNC=0 skips the fsyncs
+# that make them survive a power loss (faster on slow disks, still never partial after a crash)
+NOTES_FSYNC = os.environ.get("ROSETTA_NOTES_FSYNC", "1") == "1"
+# Optional write-behind for new notes (see rosetta_writebehind.py): /generate_note answers once
+# the note is in an fsynced journal and a writer thread saves it to the store. The queue holds up
+# to ROSETTA_NOTE_WRITE_QUEUE_SIZE notes per process; when full, requests wait up to
+# ROSETTA_NOTE_WRITE_ENQUEUE_TIMEOUT_SECONDS for room and then save synchronously.
+NOTE_WRITE_BEHIND = os.environ.get("ROSETTA_NOTE_WRITE_BEHIND", "0") == "1"
+NOTE_WRITE_QUEUE_SIZE = int(os.environ.get("ROSETTA_NOTE_WRITE_QUEUE_SIZE", "256"))
+NOTE_WRITE_ENQUEUE_TIMEOUT_SECONDS = float(os.environ.get("ROSETTA_NOTE_WRITE_ENQUEUE_TIMEOUT_SECONDS", "5"))
+NOTE_WRITE_SPOOL_DIRECTORY = os.environ.get("ROSETTA_NOTE_WRITE_SPOOL_DIR", os.path.join(BASE_NOTES_PATH, "rosetta_write_behind"))
+# Compressed note storage (see rosetta_note_codec.py): "none", "gzip" or "zstd" (needs the
+# zstandard package, else gzip), for note files, SQLite note bodies and the file store's search
+# mirror. Only new notes are written compressed; existing notes are read in any format, and note
+# files are converted with `python rosetta_store.py recompress`.
+# ROSETTA_NOTES_COMPRESSION_DICTIONARY=1 uses the newest dictionary from `train-dictionary`.
+NOTES_COMPRESSION = os.environ.get("ROSETTA_NOTES_COMPRESSION", "none")
+NOTES_COMPRESSION_LEVEL = int(os.environ["ROSETTA_NOTES_COMPRESSION_LEVEL"]) if os.environ.get("ROSETTA_NOTES_COMPRESSION_LEVEL") else None # Default: gzip 6, zstd 9
+NOTES_COMPRESSION_DICTIONARY = os.environ.get("ROSETTA_NOTES_COMPRESSION_DICTIONARY", "0") == "1"
+SEARCH_MAX_LIMIT = int(os.environ.get("ROSETTA_SEARCH_MAX_LIMIT", "100"))
+# Broad queries are ranked among their newest N matches, keeping latency flat as notes accumulate
+SEARCH_RANK_WINDOW = int(os.environ.get("ROSETTA_SEARCH_RANK_WINDOW", "10000"))
+
+# Smartphrase templates are served from an in-memory registry (see rosetta_templates.py); the
+# template directory is re-scanned for out-of-band edits at most this often
+TEMPLATE_REVALIDATE_SECONDS = float(os.environ.get("ROSETTA_TEMPLATE_REVALIDATE_SECONDS", "2"))
+
+# LLM response cache (see rosetta_cache.py). Identical prompts with the same model and
+# generation config are answered from the cache instead of calling Gemini again.
+RESPONSE_CACHE_ENABLED = os.environ.get("ROSETTA_RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("ROSETTA_RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("ROSETTA_RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_DISK_ENABLED = os.environ.get("ROSETTA_RESPONSE_CACHE_DISK", "0") == "1" # Optional on-disk tier
+
+# HTTP response compression (see rosetta_compression.py): text and JSON responses of at least
+# ROSETTA_COMPRESSION_MIN_BYTES are gzip-encoded (brotli when the brotli package is installed)
+# for clients that accept it. Streams and byte-range responses are sent as is.
+RESPONSE_COMPRESSION_ENABLED = os.environ.get("ROSETTA_COMPRESSION", "1") == "1"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("ROSETTA_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_COMPRESSION_GZIP_LEVEL = int(os.environ.get("ROSETTA_COMPRESSION_GZIP_LEVEL", "6"))
+RESPONSE_COMPRESSION_BROTLI_QUALITY = int(os.environ.get("ROSETTA_COMPRESSION_BROTLI_QUALITY", "5"))
+RESPONSE_CACHE_DIRECTORY = os.path.join(BASE_NOTES_PATH, "rosetta_cache")
+
+# Gemini context caching: upload the static instructions once as a cached context instead of
+# sending them with every request (see rosetta_gemini.py). Off by default.
+GEMINI_CONTEXT_CACHE_ENABLED = os.environ.get("ROSETTA_GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("ROSETTA_GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+# Repetition-loop guard (see rosetta_condense.py). Streaming requests cancel a looping
+# generation early; with ROSETTA_LOOP_GUARD_SYNC=1 regular requests also stream under the hood
+# so they can be cancelled too.
+LOOP_GUARD_ENABLED = os.environ.get("ROSETTA_LOOP_GUARD", "1") == "1"
+LOOP_GUARD_SYNC_ENABLED = LOOP_GUARD_ENABLED and os.environ.get("ROSETTA_LOOP_GUARD_SYNC", "0") == "1"
+
+# DLP de-identification (see rosetta_deid.py). Inputs longer than ROSETTA_DLP_CHUNK_CHARS are
+# split on paragraph/line/sentence boundaries and the chunks are de-identified concurrently.
+DLP_CHUNK_CHARS = int(os.environ.get("ROSETTA_DLP_CHUNK_CHARS", "20000"))
+DLP_MAX_PARALLEL_REQUESTS = int(os.environ.get("ROSETTA_DLP_MAX_PARALLEL_REQUESTS", "8"))
+DLP_CLIENT_POOL_SIZE = int(os.environ.get("ROSETTA_DLP_CLIENT_POOL_SIZE", "2"))
+DLP_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("ROSETTA_DLP_REQUEST_TIMEOUT_SECONDS", "60"))
+DLP_BATCH_MAX_TEXTS = int(os.environ.get("ROSETTA_DLP_BATCH_MAX_TEXTS", "100"))
+# "dlp" (Cloud DLP only), "local" (offline engine in rosetta_local_deid.py, no GCP needed) or
+# "local_then_dlp" (local pre-pass, then Cloud DLP). Requests may override with "deid_mode".
+DEID_MODE = normalize_deid_mode(os.environ.get("ROSETTA_DEID_MODE"))
+LOCAL_DEID_NAMES_FILE = os.environ.get("ROSETTA_LOCAL_DEID_NAMES_FILE") # Optional extra names, one per line
+# Optional "host:port" of a plaintext gRPC DLP stub (e.g. benchmarks/fake_dlp_server.py) for local testing
+DLP_INSECURE_ENDPOINT = os.environ.get("ROSETTA_DLP_INSECURE_ENDPOINT")
+
+# Batch generation (/generate_notes_batch): Gemini calls run concurrently on a bounded pool
+BATCH_MAX_WORKERS = int(os.environ.get("ROSETTA_BATCH_MAX_WORKERS", "8"))
+BATCH_MAX_ITEMS = int(os.environ.get("ROSETTA_BATCH_MAX_ITEMS", "50"))
+BATCH_ITEM_TIMEOUT_SECONDS = float(os.environ.get("ROSETTA_BATCH_ITEM_TIMEOUT_SECONDS", "300"))
+
+# Section-level updates: send only the affected sections of an existing note and merge the
+# returned ones (rosetta_sections.py). Shorter notes are still rewritten whole.
+SECTION_UPDATES_ENABLED = os.environ.get("ROSETTA_SECTION_UPDATES", "1") == "1"
+SECTION_UPDATE_MIN_CHARS = int(os.environ.get("ROSETTA_SECTION_UPDATE_MIN_CHARS", "1500"))
+
+# Local shorthand engine (rosetta_shorthand.py): SHN/VSHN output gets the preferred glossary
+# applied by the backend instead of shipping the glossary in the prompt, and SHN
+# reformat-only requests of an existing note are served without a model call.
+LOCAL_SHORTHAND_ENABLED = os.environ.get("ROSETTA_LOCAL_SHORTHAND", "1") == "1"
+# Options a local reformat can honour; any other checked option needs the model. VSHN asks for
+# the note to be distilled (detail dropped), which glossary substitution cannot do.
+LOCAL_REFORMAT_OPTIONS = frozenset(["genSHN"])
+# Recorded as the "model" of notes served by a local reformat (response and version history)
+LOCAL_SHORTHAND_MODEL = "local-shorthand"
+
+# Prompt token budget (rosetta_budget.py): when the assembled prompt is estimated above
+# ROSETTA_PROMPT_TOKEN_BUDGET tokens (0 = unlimited), the compaction policies run in order
+# until it fits. max_output_tokens defaults to ROSETTA_MAX_OUTPUT_TOKENS and is lowered per
+# option profile ("genAandPOnly=4096,genVSHN=6144").
+PROMPT_TOKEN_BUDGET = int(os.environ.get("ROSETTA_PROMPT_TOKEN_BUDGET", "60000"))
+PROMPT_COMPACTION_POLICIES = [name.strip() for name in os.environ.get("ROSETTA_PROMPT_COMPACTION_POLICIES", ",".join(DEFAULT_COMPACTION_POLICIES)).split(",")]
+MAX_OUTPUT_TOKENS = int(os.environ.get("ROSETTA_MAX_OUTPUT_TOKENS", "8192"))
+OUTPUT_TOKEN_PROFILES = parse_output_profiles(os.environ["ROSETTA_OUTPUT_TOKEN_PROFILES"]) if "ROSETTA_OUTPUT_TOKEN_PROFILES" in os.environ else None
+
+# Single-flight coalescing (rosetta_singleflight.py): concurrent identical generation requests
+# share one Gemini call. Waiters give up after the request's own timeout, or
+# ROSETTA_SINGLE_FLIGHT_WAIT_SECONDS. With ROSETTA_SINGLE_FLIGHT_DIR (a local directory shared by
+# the gunicorn workers), identical requests in different workers share a call too.
+SINGLE_FLIGHT_ENABLED = os.environ.get("ROSETTA_SINGLE_FLIGHT", "1") == "1"
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.environ.get("ROSETTA_SINGLE_FLIGHT_WAIT_SECONDS", "300"))
+SINGLE_FLIGHT_DIR = os.environ.get("ROSETTA_SINGLE_FLIGHT_DIR")
+
+# Resilient Gemini calls (rosetta_llm_client.py): transient errors (429/5xx/timeouts) are retried
+# with jittered exponential backoff within ROSETTA_LLM_DEADLINE_SECONDS, each attempt bounded by
+# ROSETTA_LLM_ATTEMPT_TIMEOUT_SECONDS. Optional: a hedged second call after
+# ROSETTA_LLM_HEDGE_AFTER_SECONDS (0 = off; doubles cost for slow calls) and a fallback chain
+# ("gemini-2.5-flash") used while GEMINI_MODEL's circuit breaker is open or its recent latency
+# exceeds ROSETTA_LLM_LATENCY_SLO_SECONDS (0 = off).
+LLM_DEADLINE_SECONDS = float(os.environ.get("ROSETTA_LLM_DEADLINE_SECONDS", "300"))
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get("ROSETTA_LLM_ATTEMPT_TIMEOUT_SECONDS", "120"))
+LLM_MAX_ATTEMPTS = int(os.environ.get("ROSETTA_LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.environ.get("ROSETTA_LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.environ.get("ROSETTA_LLM_BACKOFF_MAX_SECONDS", "8"))
+LLM_HEDGE_AFTER_SECONDS = float(os.environ.get("ROSETTA_LLM_HEDGE_AFTER_SECONDS", "0"))
+LLM_LATENCY_SLO_SECONDS = float(os.environ.get("ROSETTA_LLM_LATENCY_SLO_SECONDS", "0"))
+LLM_FALLBACK_MODELS = [name.strip() for name in os.environ.get("ROSETTA_LLM_FALLBACK_MODELS", "").split(",") if name.strip()]
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("ROSETTA_LLM_BREAKER_FAILURE_THRESHOLD", "5")) # 0 = no breaker
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get("ROSETTA_LLM_BREAKER_RESET_SECONDS", "30"))
+# Optional base URL of a Gemini-compatible REST endpoint (e.g. benchmarks/fake_gemini_server.py)
+GEMINI_ENDPOINT = os.environ.get("ROSETTA_GEMINI_ENDPOINT")
+
+# Asynchronous note jobs (rosetta_jobs.py): /generate_note?async=1 (or "async": true in the
+# payload) stores the request in a SQLite queue and answers 202 with a job ID at once. Each
+# process runs ROSETTA_JOB_WORKERS background threads that build the prompt, call Gemini and save
+# the note; clients poll /jobs/<id> (?wait=N long-polls). Jobs left running by a process that
+# died are picked up again after restart. ROSETTA_JOB_SERVICE_LIMITS caps concurrent jobs per
+# service across all workers ("MICU=2,*=4"). Opt-in with ROSETTA_JOBS=1; the queue is opened and
+# the workers started by the first request a process serves, never on import.
+JOBS_ENABLED = os.environ.get("ROSETTA_JOBS", "0") == "1"
+JOB_QUEUE_PATH = os.environ.get("ROSETTA_JOB_QUEUE_PATH", os.path.join(BASE_NOTES_PATH, "rosetta_jobs.db"))
+JOB_WORKERS = int(os.environ.get("ROSETTA_JOB_WORKERS", "4")) # Per process
+JOB_SERVICE_LIMITS = parse_service_limits(os.environ.get("ROSETTA_JOB_SERVICE_LIMITS", ""))
+JOB_LEASE_SECONDS = float(os.environ.get("ROSETTA_JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("ROSETTA_JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_SECONDS = float(os.environ.get("ROSETTA_JOB_RETENTION_SECONDS", "86400")) # Finished jobs are deleted after this
+JOB_MAX_WAIT_SECONDS = float(os.environ.get("ROSETTA_JOB_MAX_WAIT_SECONDS", "60")) # Longest /jobs/<id>?wait= long-poll
+
+# Prometheus metrics at /metrics (see rosetta_metrics.py). Under gunicorn (or whenever
+# ROSETTA_METRICS_DIR is set) each worker writes its values to the metrics directory every
+# ROSETTA_METRICS_FLUSH_SECONDS and /metrics adds up all workers of the server.
+METRICS_DIR = os.environ.get("ROSETTA_METRICS_DIR")
+METRICS_MULTIPROCESS = bool(METRICS_DIR) or os.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn") # Set by the gunicorn master
+METRICS_DIR = METRICS_DIR or os.path.join(BASE_NOTES_PATH, "rosetta_metrics")
+METRICS_FLUSH_SECONDS = float(os.environ.get("ROSETTA_METRICS_FLUSH_SECONDS", "1"))
+
+# Structured logging (see rosetta_logging.py): one JSON object per line on stdout, written by a
+# background thread so slow log ingestion never blocks a request. Prompts and notes are logged as
+# length + hash; ROSETTA_LOG_FULL_PAYLOADS=1 logs them in full (debugging only: they contain PHI).
+LOG_LEVEL = os.environ.get("ROSETTA_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("ROSETTA_LOG_FORMAT", "json") # "json" or "text"
+LOG_FULL_PAYLOADS = os.environ.get("ROSETTA_LOG_FULL_PAYLOADS", "0").lower() in ("1", "true", "yes")
+LOG_MAX_FIELD_CHARS = int(os.environ.get("ROSETTA_LOG_MAX_FIELD_CHARS", "1000"))
+# Fraction of DEBUG records kept (1 = all); INFO and above are never sampled
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("ROSETTA_LOG_DEBUG_SAMPLE_RATE", "1"))
+# Records waiting for the writer thread; beyond this new records are dropped (and counted)
+LOG_QUEUE_SIZE = int(os.environ.get("ROSETTA_LOG_QUEUE_SIZE", "10000"))
+
+configure_logging(
+    level=LOG_LEVEL,
+    output_format=LOG_FORMAT,
+    full_payloads=LOG_FULL_PAYLOADS,
+    max_field_chars=LOG_MAX_FIELD_CHARS,
+    debug_sample_rate=LOG_DEBUG_SAMPLE_RATE,
+    queue_size=LOG_QUEUE_SIZE,
+)
+logger = get_logger(__name__)
+
 # Load API Key from environment variable
 # Try 'GEMINI_API_KEY' first, then 'GOOGLE_API_KEY' as a fallback based on error message
 API_KEY_TO_USE = os.environ.get("GEMINI_API_KEY")
 if not API_KEY_TO_USE:
-    print("GEMINI_API_KEY environment variable not found. Trying GOOGLE_API_KEY...")
+    logger.info("GEMINI_API_KEY environment variable not found. Trying GOOGLE_API_KEY...")
     API_KEY_TO_USE = os.environ.get("GOOGLE_API_KEY")
 
 if not API_KEY_TO_USE:
-    print("CRITICAL ERROR: Neither GEMINI_API_KEY nor GOOGLE_API_KEY environment variable is set.")
-    print("Please set one of these environment variables before running the script.")
+    logger.critical("Neither GEMINI_API_KEY nor GOOGLE_API_KEY environment variable is set. Set one of them before running the server.")
     # For Flask, genai.configure will fail if API_KEY_TO_USE is None, leading to an error on first API call.
-    # This print is for startup diagnostics.
+    # Logged for startup diagnostics.
 
 # Configure the Gemini API client
-genai.configure(api_key=API_KEY_TO_USE)
-
-# --- Preferred Shorthand Glossary ---
-PREFERRED_SHORTHAND_GLOSSARY = {
-    "patient": "pt",
-    "history": "hx",
-    "chief complaint": "CC",
-    "medication": "med",
-    "prescription": "Rx",
-    "diagnosis": "Dx",
-    "treatment": "Tx",
-    "symptoms": "s/s",
-    "signs and symptoms": "s/s",
-    "no known allergies": "NKA",
-    "as needed": "prn",
-    "by mouth": "PO",
-    "twice a day": "BID",
-    "three times a day": "TID",
-    "four times a day": "QID",
-    "every day": "daily", # Changed from QD for clarity, QD can be ambiguous
-    "every other day": "QOD",
-    "hour": "hr",
-    "hours": "hrs",
-    "immediately": "stat",
-    "complains of": "c/o",
-    "year old": "y/o",
-    "male": "M",
-    "female": "F",
-    "blood pressure": "BP",
-    "heart rate": "HR",
-    "temperature": "T",
-    "in the setting of": "iso",
-    "respiratory rate": "RR",
-    "oxygen saturation": "O2 sat",
-    "physical exam": "PE",
-    "review of systems": "ROS",
-    "past medical history": "PMH",
-    "family history": "FHx",
-    "social history": "SHx",
-    "assessment and plan": "A/P",
-    "differential diagnosis": "DDx",
-    "follow up": "f/u",
-    "range of motion": "ROM",
-    "activities of daily living": "ADLs",
-    "shortness of breath": "SOB",
-    "loss of consciousness": "LOC",
-    "motor vehicle accident": "MVA",
-    "gunshot wound": "GSW",
-    "intravenous": "IV",
-    "intramuscular": "IM",
-    "subcutaneous": "SQ",
-    "nothing by mouth": "NPO",
-    "with": "w/",
-    "without": "w/o",
-    "approximately": "approx",
-    "continue": "cont",
-    "discontinue": "d/c",
-    "evaluate": "eval",
-    "management": "mgmt",
-    "negative": "neg",
-    "positive": "pos",
-    "previous": "prev",
-    "significant": "sig",
-    "status post": "s/p",
-    "versus": "vs",
-    "within normal limits": "WNL",
-}
-
-# Core Rosetta Instructions - To be prepended by the backend
-ROSETTA_SYSTEM_INSTRUCTION = """You are Rosetta, an attending physician AI assistant. Generate clinically precise, concise medical notes mimicking human attending physicians. Output plaintext only—no markdown, unless explicitly required by a user-provided template (e.g., EPIC SmartPhrases).
-
-Key Directives:
-
-Ensure accuracy and clinical realism. Do not fabricate or assume data. Explicitly state 'unknown' if data is missing or cannot be reasonably inferred from the provided context. If making a clinical inference, briefly state the basis for that inference.
-
-Prioritize PII redaction (names, MRNs, dates -> relative time).
-
-Follow user-specified formatting (SHN, VSHN, SOAP, H&P, etc.). Prioritize user-provided templates over standard formats if a template is given.
-
-Adhere to relevant clinical guidelines and pathophysiology when requested. Integrate guideline recommendations into the plan where appropriate, citing sources if possible (e.g., PMID, calculator name).
-
-Validate compliance with standard documentation norms (e.g., Joint Commission, CMS) where applicable.
-
-If input is ambiguous or inconsistent, identify the ambiguity/inconsistency and state how you have chosen to interpret it for the note, or if necessary, indicate that clarification is needed."""
-
-ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS = """For each request:
-
-New Patient: Generate questions in the form: Plan to ask about [X] to assess [Y]. Provide Impression & A&P.
-
-Updates: Integrate new data into appropriate note sections. Synthesize new data with existing information, commenting on the significance of key findings (e.g., abnormal labs, relevant physical exam findings) in the context of the patient's condition.
-
-Missing Data: Use phrases like Indicated to obtain [test] due to [reason] or Plan to further assess [symptom]. Explicitly state when information for a standard section (e.g., Allergies, Family History) is not available in the provided data.
-
-Note Structure:
-
-Impression: Provide a concise summary statement.
-
-Subjective: HPI, PMH, SHx, FHx, ROS. Qualify information based on source (e.g., "Patient reports...", "Per family...").
-
-Objective: Vitals, PE, Labs, Imaging. Include relevant positive and negative findings.
-
-Assessment & Plan (A&P):
-- Structure the A&P by problem if requested. Otherwise, group related issues logically.
-- For each problem/assessment:
-    - State the likely diagnosis or differential.
-    - Briefly justify the assessment based on subjective and objective findings.
-    - If requested, include relevant pathophysiology connected to the patient's case.
-- Plan:
-    - Use hyphenated lists (e.g., - Recommendation) for all plan actions.
-    - Ensure plans are specific, actionable, and appropriate (e.g., specify medication dosage/route/frequency if inferable, specify type of imaging/lab).
-    - Include follow-up plans and patient education points where relevant.
-    - Consider including brief contingency plans or warning signs to monitor for.
-
-IMPORTANT PREAMBLE (for the model's internal thoughts): Before generating the medical note, provide your analytical thoughts. This should include identifying key diagnostic anchors, potential red flags, significant positive and negative findings, and any critical missing information that impacts your assessment and plan. Delimit this section clearly with the specified markers."""
+if GEMINI_ENDPOINT:
+    # REST transport against a local/alternative endpoint; "http://" URLs are honoured
+    genai.configure(api_key=API_KEY_TO_USE or "unused", transport="rest", client_options={"api_endpoint": GEMINI_ENDPOINT})
+    logger.info("Using custom Gemini endpoint", endpoint=GEMINI_ENDPOINT)
+else:
+    genai.configure(api_key=API_KEY_TO_USE)
+
+# Glossary and instruction text live in the prompt compiler (rosetta_prompts.py)
+from rosetta_prompts import (
+    ROSETTA_SYSTEM_INSTRUCTION,
+    ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS,
+    compose_full_prompt,
+    compose_request_prompt,
+    ROSETTA_MODEL_SYSTEM_INSTRUCTION,
+    compile_options_section,
+    prompt_section_stats,
+    options_cache_info,
+    estimate_tokens,
+    STATIC_PROMPT_PREFIX,
+)
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app) # Enable CORS for all routes, allowing requests from your GitHub Pages site
 
-# Imports for DLP
-from google.cloud import dlp_v2
-
 # Ensure essential directories exist at startup (good practice)
 base_notes_path = os.environ.get("BASE_NOTES_PATH", ".")
 output_notes_directory = os.path.join(base_notes_path, "rosetta_outputs")
 if not os.path.exists(output_notes_directory):
     try:
         os.makedirs(output_notes_directory)
-        print(f"Created output directory at startup: {output_notes_directory}")
+        logger.info("Created output directory at startup", directory=output_notes_directory)
     except OSError as e:
-        print(f"Error creating output directory {output_notes_directory} at startup: {e}")
+        logger.error("Error creating output directory at startup", directory=output_notes_directory, error=str(e))
+
+note_store = create_note_store(
+    NOTE_STORE,
+    OUTPUT_NOTES_DIRECTORY,
+    NOTE_STORE_PATH,
+    sharded=NOTES_SHARDED,
+    revalidate_seconds=NOTE_INDEX_REVALIDATE_SECONDS,
+    max_versions=NOTE_STORE_MAX_VERSIONS,
+    search_index_path=NOTE_SEARCH_INDEX_PATH,
+    fsync=NOTES_FSYNC,
+    codec=NoteCodec(
+        NOTES_COMPRESSION,
+        level=NOTES_COMPRESSION_LEVEL,
+        dictionary_directory=os.path.join(OUTPUT_NOTES_DIRECTORY, DICTIONARY_DIRECTORY),
+        use_dictionary=NOTES_COMPRESSION_DICTIONARY,
+    ),
+)
+
+response_cache = None
+if RESPONSE_CACHE_ENABLED:
+    response_cache = ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        disk_directory=RESPONSE_CACHE_DIRECTORY if RESPONSE_CACHE_DISK_ENABLED else None,
+    )
 
-# --- Helper Functions (largely same as before) ---
+dlp_deidentifier = DlpDeidentifier(
+    DlpClientPool(DLP_CLIENT_POOL_SIZE, insecure_endpoint=DLP_INSECURE_ENDPOINT),
+    max_chunk_chars=DLP_CHUNK_CHARS,
+    max_request_chars=DLP_CHUNK_CHARS,
+    max_parallel_requests=DLP_MAX_PARALLEL_REQUESTS,
+    request_timeout=DLP_REQUEST_TIMEOUT_SECONDS,
+)
+
+local_deidentifier = LocalDeidentifier(load_name_dictionary(LOCAL_DEID_NAMES_FILE))
+
+# Long-lived model client with the static instructions as its system_instruction
+gemini_models = GeminiModelProvider(
+    GEMINI_MODEL,
+    ROSETTA_MODEL_SYSTEM_INSTRUCTION,
+    use_context_cache=GEMINI_CONTEXT_CACHE_ENABLED,
+    context_cache_ttl_seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+)
+# Fallback models get their own provider (same instructions) so each reuses its client
+gemini_model_providers = {GEMINI_MODEL: gemini_models}
+for fallback_model in LLM_FALLBACK_MODELS:
+    gemini_model_providers.setdefault(fallback_model, GeminiModelProvider(
+        fallback_model,
+        ROSETTA_MODEL_SYSTEM_INSTRUCTION,
+        use_context_cache=GEMINI_CONTEXT_CACHE_ENABLED,
+        context_cache_ttl_seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+    ))
+
+single_flight = None
+if SINGLE_FLIGHT_ENABLED:
+    single_flight = SingleFlight(FileFlightCoordinator(SINGLE_FLIGHT_DIR) if SINGLE_FLIGHT_DIR else None)
+
+prompt_budgeter = PromptBudgeter(
+    PROMPT_TOKEN_BUDGET,
+    policies=PROMPT_COMPACTION_POLICIES,
+    default_max_output_tokens=MAX_OUTPUT_TOKENS,
+    output_token_profiles=OUTPUT_TOKEN_PROFILES,
+)
+
+metrics = MetricsRegistry(METRICS_DIR if METRICS_MULTIPROCESS else None, flush_interval_seconds=METRICS_FLUSH_SECONDS)
+STAGE_SECONDS = metrics.histogram(
+    "rosetta_stage_duration_seconds",
+    "Time spent per request stage: prompt_assembly, llm, parse, save, dlp, local_deid.",
+    ["stage"],
+)
+REQUEST_SECONDS = metrics.histogram("rosetta_request_duration_seconds", "End-to-end request latency (streams: until the last event).", ["endpoint"])
+REQUESTS = metrics.counter("rosetta_requests_total", "Requests by endpoint and HTTP status.", ["endpoint", "status"])
+IN_FLIGHT_REQUESTS = metrics.gauge("rosetta_in_flight_requests", "Requests currently being served.", ["endpoint"])
+LLM_IN_FLIGHT_CALLS = metrics.gauge("rosetta_llm_in_flight_calls", "Gemini calls currently in progress.")
+LLM_TOKENS = metrics.histogram(
+    "rosetta_llm_tokens", "Tokens per Gemini call from the response usage metadata (prompt, response, cached).", ["kind"], buckets=TOKEN_BUCKETS
+)
+LLM_TOKENS_TOTAL = metrics.counter("rosetta_llm_tokens_total", "Tokens used by Gemini calls (prompt, response, cached).", ["kind"])
+LLM_FINISH_REASONS = metrics.counter("rosetta_llm_finish_reasons_total", "Gemini finish reasons.", ["reason"])
+CACHE_LOOKUPS = metrics.counter("rosetta_response_cache_lookups_total", "LLM response cache lookups (hit, miss, bypass).", ["result"])
+ERRORS = metrics.counter("rosetta_errors_total", "Errors by stage and type.", ["stage", "type"])
+SINGLE_FLIGHT_REQUESTS = metrics.counter(
+    "rosetta_single_flight_requests_total",
+    "Generation requests by single-flight role: leader (made the Gemini call), coalesced (shared another's call; one call saved), timeout, error.",
+    ["role"],
+)
+PROMPT_COMPACTIONS = metrics.counter("rosetta_prompt_compactions_total", "Prompt compaction policies applied to fit the token budget.", ["policy"])
+LLM_RETRIES = metrics.counter("rosetta_llm_retries_total", "Gemini calls retried after a transient error.", ["model"])
+LLM_HEDGES = metrics.counter("rosetta_llm_hedged_requests_total", "Hedged second Gemini calls: launched, and won (answered first).", ["model", "result"])
+LLM_FALLBACKS = metrics.counter("rosetta_llm_fallbacks_total", "Gemini calls sent to a fallback model, by reason (circuit_open, latency_slo).", ["model", "reason"])
+LLM_BREAKER_STATE = metrics.gauge("rosetta_llm_circuit_breaker_state", "Per-model circuit breaker: 0 closed, 1 half-open, 2 open.", ["model"])
+JOB_EVENTS = metrics.counter(
+    "rosetta_jobs_total", "Async note jobs: submitted, succeeded, failed, cancelled, lost (taken over after a lost lease).", ["event"]
+)
+JOB_SECONDS = metrics.histogram("rosetta_job_duration_seconds", "Async note job time spent queued and running.", ["phase"])
+NOTE_WRITES = metrics.counter(
+    "rosetta_note_writes_total", "New notes by save path: write_behind (queued), fallback (queue full, saved synchronously), error.", ["mode"]
+)
+NOTE_WRITE_QUEUE_DEPTH = metrics.gauge("rosetta_note_write_queue_depth", "New notes waiting for the write-behind writer thread.")
+NOTE_WRITE_SECONDS = metrics.histogram("rosetta_note_write_behind_seconds", "Time the write-behind writer thread took to save a note.")
+COMPRESSION_BYTES = metrics.counter(
+    "rosetta_response_compression_bytes_total", "Bytes of compressed responses before (original) and after (sent) compression.", ["encoding", "kind"]
+)
+LOG_RECORDS_DROPPED = metrics.counter("rosetta_log_records_dropped_total", "Log records dropped because the log queue was full.")
+set_drop_hook(LOG_RECORDS_DROPPED.inc)
+
+def record_llm_client_event(event, model, **details):
+    """
+    Metrics hook for ResilientLLMClient events.
+    """
+    if event == "retry":
+        LLM_RETRIES.inc(model=model)
+    elif event == "hedge":
+        LLM_HEDGES.inc(model=model, result="launched")
+    elif event == "hedge_won":
+        LLM_HEDGES.inc(model=model, result="won")
+    elif event == "fallback":
+        LLM_FALLBACKS.inc(model=model, reason=details.get("reason", "unknown"))
+    elif event == "breaker":
+        LLM_BREAKER_STATE.set(BREAKER_STATE_VALUES[details["state"]], model=model)
+
+llm_client = ResilientLLMClient(
+    [GEMINI_MODEL] + LLM_FALLBACK_MODELS,
+    max_attempts=LLM_MAX_ATTEMPTS,
+    backoff_base_seconds=LLM_BACKOFF_BASE_SECONDS,
+    backoff_max_seconds=LLM_BACKOFF_MAX_SECONDS,
+    attempt_timeout_seconds=LLM_ATTEMPT_TIMEOUT_SECONDS,
+    hedge_after_seconds=LLM_HEDGE_AFTER_SECONDS,
+    latency_slo_seconds=LLM_LATENCY_SLO_SECONDS,
+    breaker_failure_threshold=LLM_BREAKER_FAILURE_THRESHOLD,
+    breaker_reset_seconds=LLM_BREAKER_RESET_SECONDS,
+    on_event=record_llm_client_event,
+)
+
+def record_note_write_event(event, **details):
+    """
+    Metrics hook for WriteBehindNoteStore events.
+    """
+    if event == "enqueued":
+        NOTE_WRITES.inc(mode="write_behind")
+        NOTE_WRITE_QUEUE_DEPTH.inc()
+    elif event == "written":
+        NOTE_WRITE_QUEUE_DEPTH.dec()
+        NOTE_WRITE_SECONDS.observe(details["seconds"])
+    elif event == "error":
+        NOTE_WRITE_QUEUE_DEPTH.dec()
+        NOTE_WRITES.inc(mode="error")
+    elif event == "fallback":
+        NOTE_WRITES.inc(mode="fallback")
+
+if NOTE_WRITE_BEHIND:
+    note_store = WriteBehindNoteStore(
+        note_store,
+        NOTE_WRITE_SPOOL_DIRECTORY,
+        max_queue=NOTE_WRITE_QUEUE_SIZE,
+        enqueue_timeout_seconds=NOTE_WRITE_ENQUEUE_TIMEOUT_SECONDS,
+        fsync=NOTES_FSYNC,
+        on_event=record_note_write_event,
+    )
+    logger.info("Writing new notes behind the request", spool_directory=NOTE_WRITE_SPOOL_DIRECTORY, max_queue=NOTE_WRITE_QUEUE_SIZE)
 
-def get_llm_response(dynamic_prompt_from_frontend):
+def record_compression(encoding, original_bytes, sent_bytes):
     """
-    Combines core instructions with dynamic prompt and sends to Gemini API.
-    Returns the response text and any prompt feedback.
+    Metrics hook for ResponseCompressor.
     """
-    # Instruction for the LLM to provide its "thoughts" before the note
-    thoughts_instruction = (
-        "IMPORTANT PREAMBLE: Before generating the medical note based on the user's request that follows, "
-        "first provide your analytical thoughts, reasoning, and implications of the given patient information and selected options. "
-        "This 'thoughts' section should explain your high-level interpretation and any critical considerations before you proceed to construct the note. "
-        "Delimit this entire 'thoughts' section clearly with the following markers:\n"
-        "===ROSETTA_MODEL_THOUGHTS_START===\n"
-        "[Your analytical thoughts and implications here]\n"
-        "===ROSETTA_MODEL_THOUGHTS_END===\n\n"
-        "After the '===ROSETTA_MODEL_THOUGHTS_END===' marker, then proceed to generate the complete medical note as requested by the main prompt below.\n\n"
+    COMPRESSION_BYTES.inc(original_bytes, encoding=encoding, kind="original")
+    COMPRESSION_BYTES.inc(sent_bytes, encoding=encoding, kind="sent")
+
+response_compressor = None
+if RESPONSE_COMPRESSION_ENABLED:
+    response_compressor = ResponseCompressor(
+        min_bytes=RESPONSE_COMPRESSION_MIN_BYTES,
+        gzip_level=RESPONSE_COMPRESSION_GZIP_LEVEL,
+        brotli_quality=RESPONSE_COMPRESSION_BROTLI_QUALITY,
+        on_compress=record_compression,
     )
 
-    try:
-        # Prepend the thoughts_instruction to the existing full prompt structure
-        full_prompt_to_gemini = (
-            f"{thoughts_instruction}"
-            f"{ROSETTA_SYSTEM_INSTRUCTION}\n\n"
-            f"{ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS}\n\n"
-            f"Dynamic Request from Frontend:\n---\n{dynamic_prompt_from_frontend}\n---"
-        )
-        
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        print(f"Sending combined prompt to Gemini model {GEMINI_MODEL}...")
-        print(f"Full prompt being sent to Gemini: {full_prompt_to_gemini}")
+@app.after_request
+def compress_response(response):
+    if response_compressor is not None:
+        response_compressor.apply(response, request.headers.get("Accept-Encoding", ""))
+    return response
 
-        generation_config = genai.types.GenerationConfig(
-            max_output_tokens=8192 # Increased max_output_tokens
-        )
-        response = model.generate_content(full_prompt_to_gemini, generation_config=generation_config)
-        
-        feedback_str = ""
-        if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-            feedback_str = f"Prompt Feedback: {str(response.prompt_feedback)}" # Ensure it's a string
-            print(feedback_str)
-
-        # Check if there are candidates and content
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            actual_finish_reason = candidate.finish_reason
-            
-            # Try to use the enum for STOP, default to integer 1 if enum path fails
-            stop_reason_enum_value = 1 # Default integer for STOP
+def timed_stage(stage):
+    """
+    Decorator recording the wrapped function's duration under rosetta_stage_duration_seconds.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_route(endpoint):
+    """
+    Decorator for Flask views: in-flight gauge, latency histogram and request counter by status.
+    Streaming responses are counted as in flight until the stream closes.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            IN_FLIGHT_REQUESTS.inc(endpoint=endpoint)
+            start = time.perf_counter()
+            def finish(status):
+                IN_FLIGHT_REQUESTS.dec(endpoint=endpoint)
+                REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                REQUESTS.inc(endpoint=endpoint, status=status)
             try:
-                stop_reason_enum_value = genai.types.FinishReason.STOP
-            except AttributeError:
-                print("Note: genai.types.FinishReason.STOP not found, relying on integer value 1 for STOP reason.")
-
-            if candidate.content and candidate.content.parts:
-                # We have content, this is the primary success path
-                if actual_finish_reason != stop_reason_enum_value:
-                     print(f"Warning: Response has content, but finish_reason was not '{stop_reason_enum_value}'. Actual reason: {actual_finish_reason} (type: {type(actual_finish_reason)})")
-
-                # Condense repeated phrases
-                text_output = candidate.content.parts[0].text
-                phrases = text_output.split(". ")  # Split into phrases
-                phrase_counts = {}
-                for phrase in phrases:
-                    phrase = phrase.strip()
-                    if phrase:
-                        phrase_counts[phrase] = phrase_counts.get(phrase, 0) + 1
-
-                for phrase, count in phrase_counts.items():
-                    if count > 5:
-                        text_output = text_output.replace(phrase, "[REPEATED PHRASE: " + phrase + "]")
-
-                return text_output, feedback_str
+                response = app.make_response(view(*args, **kwargs))
+            except Exception as e:
+                ERRORS.inc(stage="request", type=type(e).__name__)
+                finish("500")
+                raise
+            if response.is_streamed:
+                response.call_on_close(lambda: finish(str(response.status_code)))
             else:
-                # No content, but we have a candidate, so the finish_reason is important
-                error_detail = f"Gemini API call did not finish successfully (no content parts). Finish reason: {actual_finish_reason}"
-                print(error_detail)
-                print("--- Full Gemini Response (Candidate available) ---")
-                try:
-                    print(f"Raw response object: {response}")
-                    print(f"Candidate details: {candidate}")
-                except Exception as print_e:
-                    print(f"Error trying to print response/candidate details: {print_e}")
-                return f"Error: {error_detail}", feedback_str
+                finish(str(response.status_code))
+            return response
+        return wrapper
+    return decorator
+
+def record_llm_response_metrics(response):
+    """
+    Token counts (usage metadata) and finish reason of a completed or fully streamed Gemini
+    response. Never raises: metrics must not fail a request.
+    """
+    try:
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            for kind, field in (("prompt", "prompt_token_count"), ("response", "candidates_token_count"), ("cached", "cached_content_token_count")):
+                count = getattr(usage, field, 0) or 0
+                if count or kind != "cached":
+                    LLM_TOKENS.observe(count, kind=kind)
+                    LLM_TOKENS_TOTAL.inc(count, kind=kind)
+        candidates = getattr(response, "candidates", None)
+        if candidates:
+            reason = candidates[0].finish_reason
+            LLM_FINISH_REASONS.inc(reason=getattr(reason, "name", str(reason)))
+    except Exception as e:
+        logger.warning("Could not record LLM response metrics", error=str(e))
+
+# --- Helper Functions (largely same as before) ---
+
+def build_generation_config(max_output_tokens=None):
+    """
+    Generation settings shared by every Gemini call path (sync, streaming and async).
+    `max_output_tokens` comes from the request's prompt budget; defaults to MAX_OUTPUT_TOKENS.
+    """
+    return genai.types.GenerationConfig(
+        max_output_tokens=max_output_tokens or MAX_OUTPUT_TOKENS
+    )
+
+def llm_request_options(timeout):
+    """
+    Per-attempt request options. The client library's own retry is switched off: llm_client
+    retries with the request deadline in mind, and nested retries would multiply the attempts.
+    """
+    return {"timeout": timeout, "retry": None}
+
+def interpret_llm_response(response):
+    """
+    Extracts (text_output, feedback_str) from a completed Gemini response.
+    Failures are returned as text starting with "Error:", matching get_llm_response.
+    """
+    feedback_str = ""
+    record_llm_response_metrics(response)
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        feedback_str = f"Prompt Feedback: {str(response.prompt_feedback)}" # Ensure it's a string
+        logger.info("Gemini prompt feedback", prompt_feedback=feedback_str)
+
+    # Check if there are candidates and content
+    if response.candidates and len(response.candidates) > 0:
+        candidate = response.candidates[0]
+        actual_finish_reason = candidate.finish_reason
+        
+        # Try to use the enum for STOP, default to integer 1 if enum path fails
+        stop_reason_enum_value = 1 # Default integer for STOP
+        try:
+            stop_reason_enum_value = genai.types.FinishReason.STOP
+        except AttributeError:
+            logger.debug("genai.types.FinishReason.STOP not found, relying on integer value 1 for STOP reason.")
+
+        if candidate.content and candidate.content.parts:
+            # We have content, this is the primary success path
+            if actual_finish_reason != stop_reason_enum_value:
+                 logger.warning("Response has content, but finish_reason was not STOP", finish_reason=actual_finish_reason, expected=stop_reason_enum_value)
+
+            # Condense repeated phrases (single pass, see rosetta_condense.py)
+            text_output = condense_repeated_phrases(candidate.content.parts[0].text)
+
+            return text_output, feedback_str
         else:
-            # No candidates at all, this is a more severe failure
-            error_detail = "Gemini API call failed: No candidates returned."
-            print(error_detail)
-            print("--- Full Gemini Response (No candidates) ---")
+            # No content, but we have a candidate, so the finish_reason is important
+            error_detail = f"Gemini API call did not finish successfully (no content parts). Finish reason: {actual_finish_reason}"
+            logger.error(error_detail)
+            ERRORS.inc(stage="llm", type="no_content")
             try:
-                print(f"Raw response object: {response}")
-            except Exception as print_e:
-                print(f"Error trying to print raw response: {print_e}")
+                logger.debug("Full Gemini response (candidate available)", **payload_fields("response", str(response)))
+            except Exception as log_e:
+                logger.warning("Error trying to log response/candidate details", error=str(log_e))
             return f"Error: {error_detail}", feedback_str
-            
+    else:
+        # No candidates at all, this is a more severe failure
+        error_detail = "Gemini API call failed: No candidates returned."
+        logger.error(error_detail)
+        ERRORS.inc(stage="llm", type="no_candidates")
+        try:
+            logger.debug("Full Gemini response (no candidates)", response=str(response))
+        except Exception as log_e:
+            logger.warning("Error trying to log raw response", error=str(log_e))
+        return f"Error: {error_detail}", feedback_str
+
+def lookup_cached_response(full_prompt_to_gemini, generation_config, bypass_cache=False, llm_meta=None):
+    """
+    Checks the response cache for this exact prompt/model/config.
+    Returns (cache_key, cached_value_or_None). cache_key is None when caching is off or bypassed.
+    """
+    if llm_meta is not None:
+        llm_meta["cache_hit"] = False
+    if response_cache is None:
+        return None, None
+    if bypass_cache:
+        response_cache.record_bypass()
+        CACHE_LOOKUPS.inc(result="bypass")
+        return None, None
+
+    cache_key = make_cache_key(full_prompt_to_gemini, GEMINI_MODEL, generation_config)
+    cached_value = response_cache.get(cache_key)
+    CACHE_LOOKUPS.inc(result="miss" if cached_value is None else "hit")
+    if cached_value is not None:
+        logger.info("Response cache hit, skipping Gemini call", cache_key=cache_key[:12])
+        if llm_meta is not None:
+            llm_meta["cache_hit"] = True
+    return cache_key, cached_value
+
+def store_cached_response(cache_key, text_output, feedback_str):
+    """
+    Stores a successful LLM result under cache_key (no-op for errors or when caching is off).
+    """
+    if cache_key and response_cache is not None and text_output and not text_output.startswith("Error:"):
+        response_cache.set(cache_key, (text_output, feedback_str))
+
+def make_flight_key(dynamic_prompt_from_frontend, bypass_cache, max_output_tokens):
+    """
+    Single-flight key: the final prompt, model and generation config. Requests that bypass the
+    response cache only share a call with each other, never one that may answer from the cache.
+    """
+    key = make_cache_key(compose_full_prompt(dynamic_prompt_from_frontend), GEMINI_MODEL, build_generation_config(max_output_tokens))
+    return f"{key}-bypass" if bypass_cache else key
+
+def get_llm_response(dynamic_prompt_from_frontend, bypass_cache=False, llm_meta=None, request_timeout=None, max_output_tokens=None):
+    """
+    Combines core instructions with dynamic prompt and sends to Gemini API.
+    Returns the response text and any prompt feedback.
+    Concurrent identical requests (same final prompt, model and generation config) share one
+    call (rosetta_singleflight.py); llm_meta["coalesced"] tells whether this one waited on
+    another's. Arguments are as for generate_llm_response.
+    """
+    if single_flight is None:
+        return generate_llm_response(dynamic_prompt_from_frontend, bypass_cache, llm_meta, request_timeout, max_output_tokens)
+
+    flight_key = make_flight_key(dynamic_prompt_from_frontend, bypass_cache, max_output_tokens)
+
+    def call():
+        meta = {}
+        text_output, feedback_str = generate_llm_response(dynamic_prompt_from_frontend, bypass_cache, meta, request_timeout, max_output_tokens)
+        return [text_output, feedback_str, meta] # JSON-serializable for the cross-worker coordinator
+
+    try:
+        (text_output, feedback_str, meta), coalesced = single_flight.do(flight_key, call, timeout=request_timeout or SINGLE_FLIGHT_WAIT_SECONDS)
+    except (SingleFlightTimeout, SingleFlightError) as e:
+        SINGLE_FLIGHT_REQUESTS.inc(role="timeout" if isinstance(e, SingleFlightTimeout) else "error")
+        logger.warning("Waiting on an identical in-flight request failed", key=flight_key[:12], error=str(e))
+        return f"Error: {e}", ""
+    SINGLE_FLIGHT_REQUESTS.inc(role="coalesced" if coalesced else "leader")
+    if coalesced:
+        logger.info("Identical request already in flight; shared its result", key=flight_key[:12])
+    if llm_meta is not None:
+        llm_meta.update(meta)
+        llm_meta["coalesced"] = coalesced
+    return text_output, feedback_str
+
+def generate_llm_response(dynamic_prompt_from_frontend, bypass_cache=False, llm_meta=None, request_timeout=None, max_output_tokens=None):
+    """
+    Makes the Gemini call for get_llm_response (no coalescing).
+    Identical requests are served from the response cache unless bypass_cache is set;
+    `llm_meta` (optional dict) receives details such as whether the cache was hit and which
+    model answered. `request_timeout` (seconds, optional) is the deadline for the call
+    including retries (default ROSETTA_LLM_DEADLINE_SECONDS).
+    """
+    try:
+        # Prepend the precompiled static prefix (thoughts instruction + core instructions)
+        full_prompt_to_gemini = compose_full_prompt(dynamic_prompt_from_frontend)
+        generation_config = build_generation_config(max_output_tokens)
+
+        cache_key, cached_value = lookup_cached_response(full_prompt_to_gemini, generation_config, bypass_cache, llm_meta)
+        if cached_value is not None:
+            return cached_value
+        
+        request_prompt = compose_request_prompt(dynamic_prompt_from_frontend)
+        logger.info("Sending prompt to Gemini", model=GEMINI_MODEL, **payload_fields("prompt", full_prompt_to_gemini))
+
+        def attempt(model_name, timeout):
+            # Reused model; the static prefix travels as its system_instruction (or cached context)
+            model = gemini_model_providers[model_name].get_model()
+            request_options = llm_request_options(timeout)
+            with LLM_IN_FLIGHT_CALLS.track_inprogress():
+                if LOOP_GUARD_SYNC_ENABLED:
+                    # Stream under the hood so a degenerate repetition loop can be cancelled mid-generation
+                    response = model.generate_content(request_prompt, generation_config=generation_config, stream=True, request_options=request_options)
+                    stream_state = {}
+                    for _ in iterate_llm_stream(response, stream_state):
+                        pass
+                    return response, stream_state
+                return model.generate_content(request_prompt, generation_config=generation_config, request_options=request_options), None
+
+        with STAGE_SECONDS.time(stage="llm"):
+            (response, stream_state), call_info = llm_client.call(attempt, request_timeout or LLM_DEADLINE_SECONDS)
+        if llm_meta is not None:
+            llm_meta.update(model=call_info["model"], llm_attempts=call_info["attempts"], hedged=call_info["hedged"])
+        if stream_state is not None and stream_state.get("loop_detected"):
+            record_llm_response_metrics(response)
+            if llm_meta is not None:
+                llm_meta["loop_detected"] = True
+            return stream_state["condensed_output"], LOOP_STOPPED_FEEDBACK
+        
+        text_output, feedback_str = interpret_llm_response(response)
+        if call_info["model"] == GEMINI_MODEL: # A fallback model's answer is not cached as the primary's
+            store_cached_response(cache_key, text_output, feedback_str)
+        return text_output, feedback_str
+
     except Exception as e:
-        print(f"Error calling Google Gemini API: {e}")
+        logger.error("Error calling Google Gemini API", error=str(e), error_type=type(e).__name__)
+        ERRORS.inc(stage="llm", type=type(e).__name__)
         return f"Error: Exception during API call - {str(e)}", ""
 
+LOOP_STOPPED_FEEDBACK = "Generation stopped early: repetition loop detected."
+
+def iterate_llm_stream(response, stream_state):
+    """
+    Yields text chunks from a streaming Gemini response while feeding them to a
+    RepetitionCondenser. If the loop guard is on and the model falls into a repetition loop,
+    the upstream stream is cancelled to save output tokens. The condensed full text is left in
+    stream_state["condensed_output"].
+    """
+    condenser = RepetitionCondenser()
+    for chunk in response:
+        try:
+            chunk_text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. a final chunk carrying only the finish reason)
+            chunk_text = ""
+            if chunk.candidates:
+                stream_state["error_detail"] = f"Gemini API stream ended without content. Finish reason: {chunk.candidates[0].finish_reason}"
+        if chunk_text:
+            yield chunk_text
+            if condenser.feed(chunk_text) and LOOP_GUARD_ENABLED:
+                logger.warning("Repetition loop detected; cancelling generation", chars=condenser.chars_consumed, reason=condenser.loop_reason)
+                stream_state["loop_detected"] = True
+                cancel_llm_stream(response)
+                break
+    stream_state["condensed_output"] = condenser.finish()
+
+def stream_llm_response(dynamic_prompt_from_frontend, stream_state, bypass_cache=False, max_output_tokens=None):
+    """
+    Streaming counterpart of get_llm_response. Yields text chunks as Gemini produces them.
+    Prompt feedback and failure details are recorded in the `stream_state` dict.
+    A response cache hit is replayed as a single chunk.
+    Exceptions from the API call propagate to the caller.
+    """
+    full_prompt_to_gemini = compose_full_prompt(dynamic_prompt_from_frontend)
+    generation_config = build_generation_config(max_output_tokens)
+
+    cache_key, cached_value = lookup_cached_response(full_prompt_to_gemini, generation_config, bypass_cache, stream_state)
+    if cached_value is not None:
+        stream_state["feedback"] = cached_value[1]
+        yield cached_value[0]
+        return
+
+    logger.info("Streaming prompt to Gemini", model=GEMINI_MODEL, **payload_fields("prompt", full_prompt_to_gemini))
+    request_prompt = compose_request_prompt(dynamic_prompt_from_frontend)
+
+    def open_stream(model_name, timeout):
+        # generate_content waits for the first chunk, so failures before any output are retried
+        model = gemini_model_providers[model_name].get_model()
+        return model.generate_content(request_prompt, generation_config=generation_config, stream=True, request_options=llm_request_options(timeout))
+
+    start = time.perf_counter()
+    LLM_IN_FLIGHT_CALLS.inc()
+    try:
+        response, call_info = llm_client.call(open_stream, LLM_DEADLINE_SECONDS, hedge=False)
+        stream_state["model"] = call_info["model"]
+        yield from iterate_llm_stream(response, stream_state)
+    except Exception as e:
+        ERRORS.inc(stage="llm", type=type(e).__name__)
+        raise
+    finally:
+        LLM_IN_FLIGHT_CALLS.dec()
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="llm")
+    record_llm_response_metrics(response)
+
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        stream_state["feedback"] = f"Prompt Feedback: {str(response.prompt_feedback)}"
+        logger.info("Gemini prompt feedback", prompt_feedback=stream_state["feedback"])
+    if not stream_state.get("loop_detected") and stream_state["model"] == GEMINI_MODEL: # Never cache a cut-short or fallback generation
+        store_cached_response(cache_key, stream_state["condensed_output"], stream_state.get("feedback", ""))
+
 def generate_filename(service_abbreviation):
     """
     Generates a filename based on service, current time, and date.
@@ -280,67 +810,152 @@ def generate_filename(service_abbreviation):
     filename = f"rosetta_note_{date_str}_{time_str}_{safe_service_abbr}.txt"
     return filename
 
-def save_note_to_file(filename, content):
+@timed_stage("save")
+def save_note_to_file(filename, content, note_request=None):
     """
-    Saves the content to a file in the specified notes directory.
-    Creates the directory if it doesn't exist.
+    Saves a note through the configured note store (files or SQLite).
+    New notes never overwrite an existing note (a taken name gets a _2, _3, ... suffix);
+    updates are checked against the version the request was based on.
+    Returns the filename the note was saved under, or None on failure.
+    Raises NoteVersionConflict if the note changed since the update request read it.
     """
-    base_notes_path = os.environ.get("BASE_NOTES_PATH", ".")
-    output_notes_directory = os.path.join(base_notes_path, "rosetta_outputs")
-    # Ensure output notes directory exists
-    if not os.path.exists(output_notes_directory):
-        try:
-            os.makedirs(output_notes_directory)
-            print(f"Created directory: {output_notes_directory}")
-        except OSError as e: # More specific exception
-            print(f"Error creating directory {output_notes_directory}: {e}")
-            return False # Indicate failure
-            
-    filepath = os.path.join(output_notes_directory, filename)
+    note_request = note_request or {}
+    metadata = {
+        "service": note_request.get("service_abbr"),
+        "options": note_request.get("options"),
+        "model": note_request.get("model", GEMINI_MODEL), # A fallback model when GEMINI_MODEL was unavailable
+        "prompt_hash": note_request.get("prompt_hash"),
+    }
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(content)
-        print(f"Note successfully saved to: {filepath}")
-        return True
+        if note_request.get("is_update"):
+            note_store.update(filename, content, metadata, expected_version=note_request.get("base_version"))
+            saved_filename = filename
+        else:
+            saved_filename, _ = note_store.create(filename, content, metadata)
+        logger.info("Note saved", filename=saved_filename, store=note_store.kind)
+        return saved_filename
+    except NoteVersionConflict:
+        ERRORS.inc(stage="save", type="NoteVersionConflict")
+        raise
     except Exception as e:
-        print(f"Error saving note to file {filepath}: {e}")
-        return False
+        logger.error("Error saving note", filename=filename, error=str(e))
+        ERRORS.inc(stage="save", type=type(e).__name__)
+        return None
 
 # --- Flask Routes ---
 
 SMARTPHRASE_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'smartphrase_templates') # Define directory for smartphrase templates, relative to script location
+template_registry = TemplateRegistry(SMARTPHRASE_TEMPLATES_DIR, revalidate_seconds=TEMPLATE_REVALIDATE_SECONDS)
+
+def etag_response(etag, build_response, last_modified=None):
+    """
+    Answers 304 Not Modified if the request's If-None-Match has `etag` (also as the "-gzip"/"-br"
+    ETag of a compressed copy) or, without If-None-Match, If-Modified-Since is not older than
+    `last_modified` (a timestamp); else the response from build_response(). Either way the ETag
+    and Last-Modified are set and clients are told to revalidate.
+    """
+    if request.if_none_match:
+        # The 304 repeats the ETag the client has, which may be a compressed copy's
+        matched = etag if request.if_none_match.star_tag else next(
+            (tag for tag in request.if_none_match.as_set(include_weak=True) if strip_encoding_suffix(tag) == etag), None
+        )
+    else:
+        matched = etag if last_modified and request.if_modified_since and int(last_modified) <= request.if_modified_since.timestamp() else None
+    if matched:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        response = build_response()
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = int(last_modified)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route('/list_smartphrase_templates', methods=['GET'])
 def list_smartphrase_templates():
+    """
+    Lists template filenames from the template registry. With ?details=1 each template's ID,
+    ETag, placeholders and sections are included as well. Supports If-None-Match.
+    """
     try:
-        # Ensure the path is correct relative to the script's execution directory
-        # If backend.py is at project root, and smartphrase_templates is also at root, this is fine.
-        if not os.path.isdir(SMARTPHRASE_TEMPLATES_DIR):
-            print(f"Error: Directory '{SMARTPHRASE_TEMPLATES_DIR}' not found.")
+        try:
+            templates, list_etag = template_registry.list_templates()
+        except FileNotFoundError:
+            logger.error("Template directory not found", directory=SMARTPHRASE_TEMPLATES_DIR)
             return jsonify({"error": f"Template directory not found on server: {SMARTPHRASE_TEMPLATES_DIR}", "templates": []}), 404
 
-        templates = [f for f in os.listdir(SMARTPHRASE_TEMPLATES_DIR) if f.endswith('.txt')]
-        
-        return jsonify({"templates": sorted(templates)}) # Sort for consistent order
+        include_details = request.args.get('details') == '1'
+        def build_response():
+            payload = {"templates": [template.filename for template in templates]} # Sorted for consistent order
+            if include_details:
+                payload["template_details"] = [template.to_dict() for template in templates]
+            return jsonify(payload)
+        return etag_response(list_etag + ("-details" if include_details else ""), build_response)
 
     except Exception as e:
-        print(f"Error listing smartphrase templates: {e}")
+        logger.error("Error listing smartphrase templates", error=str(e))
         return jsonify({"error": "An error occurred while listing templates.", "details": str(e), "templates": []}), 500
 
+@app.route('/smartphrase_template/<path:template_id>', methods=['GET'])
+def get_smartphrase_template(template_id):
+    """
+    Serves one template (by ID, e.g. "general_soap", or filename) with its content and parsed
+    metadata. Supports If-None-Match; the ETag only changes when the content does.
+    """
+    if os.path.basename(template_id) != template_id:
+        return jsonify({"error": "Invalid template ID."}), 400
+    try:
+        template = template_registry.get(template_id)
+    except FileNotFoundError:
+        template = None
+    except Exception as e:
+        logger.error("Error loading smartphrase template", template_id=template_id, error=str(e))
+        return jsonify({"error": "An error occurred while loading the template.", "details": str(e)}), 500
+    if template is None:
+        return jsonify({"error": f"Template '{template_id}' not found."}), 404
+    last_modified = template.mtime_ns / 1e9 if template.mtime_ns else None
+    return etag_response(template.etag, lambda: jsonify(template.to_dict(include_content=True)), last_modified)
+
+def list_notes_page_response():
+    """
+    Serves one page of the note index for the query parameters of the current request.
+    Without `limit` every matching note is returned, as before.
+    """
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return jsonify({"error": "limit must be a positive integer.", "notes": []}), 400
+    date_prefix = request.args.get('date', '').strip()
+    if date_prefix and not (date_prefix.isdigit() and len(date_prefix) <= 8):
+        return jsonify({"error": "date must be a YYYY, YYYYMM or YYYYMMDD prefix.", "notes": []}), 400
+
+    try:
+        notes, next_cursor = note_store.list_page(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            service=request.args.get('service', '').strip() or None,
+            date_prefix=date_prefix or None,
+        )
+        return jsonify({"notes": notes, "next_cursor": next_cursor}), 200
+    except Exception as e:
+        logger.error("Exception during listing notes", directory=OUTPUT_NOTES_DIRECTORY, error=str(e))
+        return jsonify({"error": f"Failed to list notes: {str(e)}", "notes": []}), 500
+
 @app.route('/list_notes', methods=['GET'])
 def list_notes():
     """
     Lists all .txt files in the OUTPUT_NOTES_DIRECTORY.
+    Accepts the same paging/filter query parameters as /list_saved_notes.
     """
-    if not os.path.exists(OUTPUT_NOTES_DIRECTORY):
-        print(f"Output directory {OUTPUT_NOTES_DIRECTORY} not found for listing notes.")
+    if note_store.kind == STORE_FILES and not os.path.exists(OUTPUT_NOTES_DIRECTORY):
+        logger.warning("Output directory not found for listing notes", directory=OUTPUT_NOTES_DIRECTORY)
         return jsonify({"error": "Notes directory not found.", "notes": []}), 404
-    try:
-        notes = [f for f in os.listdir(OUTPUT_NOTES_DIRECTORY) if os.path.isfile(os.path.join(OUTPUT_NOTES_DIRECTORY, f)) and f.endswith('.txt')]
-        return jsonify({"notes": sorted(notes, reverse=True)}), 200 # Sort by newest first
-    except Exception as e:
-        print(f"Error listing notes from {OUTPUT_NOTES_DIRECTORY}: {e}")
-        return jsonify({"error": f"Failed to list notes: {str(e)}", "notes": []}), 500
+    return list_notes_page_response()
 
 @app.route('/save_smartphrase_template', methods=['POST'])
 def save_smartphrase_template():
@@ -365,7 +980,7 @@ def save_smartphrase_template():
         # Further sanitize to remove potentially problematic characters, allowing alphanumeric, underscore, hyphen
         safe_base_filename = "".join(c if c.isalnum() or c in ['_', '-','.'] else '_' for c in base_filename)
         if safe_base_filename != base_filename: # Check if original was unsafe
-             print(f"Warning: Filename '{base_filename}' sanitized to '{safe_base_filename}'")
+             logger.warning("Template filename sanitized", original=base_filename, sanitized=safe_base_filename)
              base_filename = safe_base_filename # Use the sanitized version
 
         if not base_filename or base_filename == ".txt": # Check after sanitization
@@ -375,9 +990,9 @@ def save_smartphrase_template():
         if not os.path.exists(SMARTPHRASE_TEMPLATES_DIR):
             try:
                 os.makedirs(SMARTPHRASE_TEMPLATES_DIR)
-                print(f"Created directory: {SMARTPHRASE_TEMPLATES_DIR}")
+                logger.info("Created template directory", directory=SMARTPHRASE_TEMPLATES_DIR)
             except OSError as e:
-                print(f"Error creating directory {SMARTPHRASE_TEMPLATES_DIR}: {e}")
+                logger.error("Error creating template directory", directory=SMARTPHRASE_TEMPLATES_DIR, error=str(e))
                 return jsonify({"error": f"Could not create template directory on server: {str(e)}"}), 500
         
         filepath = os.path.join(SMARTPHRASE_TEMPLATES_DIR, base_filename)
@@ -386,14 +1001,14 @@ def save_smartphrase_template():
         # if os.path.exists(filepath):
         #     return jsonify({"error": f"File '{base_filename}' already exists. Please choose a different name."}), 409 # 409 Conflict
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(content)
+        atomic_write_text(filepath, content) # The template watcher never sees a half-written file
+        template_registry.put(base_filename, content)
         
-        print(f"Template saved successfully to: {filepath}")
+        logger.info("Template saved", path=filepath)
         return jsonify({"message": "Template saved successfully.", "filename": base_filename}), 200
 
     except Exception as e:
-        print(f"Error saving smartphrase template: {e}")
+        logger.error("Error saving smartphrase template", error=str(e))
         return jsonify({"error": "An error occurred while saving the template.", "details": str(e)}), 500
 
 @app.route('/delete_smartphrase_template', methods=['POST', 'OPTIONS'])
@@ -420,7 +1035,7 @@ def delete_smartphrase_template():
         base_filename = os.path.basename(filename)
         if not base_filename.endswith('.txt'):
              # This case should ideally not happen if frontend sends correct filename
-             print(f"Warning: Received filename without .txt extension for deletion: {filename}")
+             logger.warning("Received filename without .txt extension for deletion", filename=filename)
              # Decide how to handle: either return error or try to append .txt
              # For safety, let's require .txt from frontend or handle carefully.
              # Assuming frontend sends .txt, proceed. If not, add more robust handling.
@@ -429,7 +1044,7 @@ def delete_smartphrase_template():
         # Further sanitize to remove potentially problematic characters
         safe_base_filename = "".join(c if c.isalnum() or c in ['_', '-','.'] else '_' for c in base_filename)
         if safe_base_filename != base_filename:
-             print(f"Warning: Filename '{base_filename}' sanitized to '{safe_base_filename}' for deletion attempt.")
+             logger.warning("Template filename sanitized for deletion", original=base_filename, sanitized=safe_base_filename)
              base_filename = safe_base_filename
 
         if not base_filename or base_filename == ".txt":
@@ -439,20 +1054,21 @@ def delete_smartphrase_template():
         filepath = os.path.join(SMARTPHRASE_TEMPLATES_DIR, base_filename)
 
         if not os.path.exists(filepath):
-            print(f"Attempted to delete non-existent file: {filepath}")
+            logger.warning("Attempted to delete non-existent template", path=filepath)
             return jsonify({"error": f"Template file '{base_filename}' not found."}), 404
 
         if not os.path.isfile(filepath):
-             print(f"Attempted to delete something that is not a file: {filepath}")
+             logger.warning("Attempted to delete something that is not a file", path=filepath)
              return jsonify({"error": f"Path '{base_filename}' is not a file."}), 400 # Or 409 Conflict
 
         os.remove(filepath)
+        template_registry.remove(base_filename)
         
-        print(f"Template deleted successfully: {filepath}")
+        logger.info("Template deleted", path=filepath)
         return jsonify({"message": "Template deleted successfully.", "filename": base_filename}), 200
 
     except Exception as e:
-        print(f"Error deleting smartphrase template: {e}")
+        logger.error("Error deleting smartphrase template", error=str(e))
         return jsonify({"error": "An error occurred while deleting the template.", "details": str(e)}), 500
 
 
@@ -461,52 +1077,39 @@ def delete_smartphrase_template():
 @app.route('/list_saved_notes', methods=['GET'])
 def list_saved_notes():
     """
-    Lists all .txt files in the OUTPUT_NOTES_DIRECTORY.
+    Lists all .txt files in the OUTPUT_NOTES_DIRECTORY, newest first.
     This is similar to /list_notes but specifically for the generated notes.
+    Optional query parameters: limit, cursor (the next_cursor of the previous page),
+    service (e.g. MICU) and date (YYYY, YYYYMM or YYYYMMDD prefix).
     """
     # Use the globally defined OUTPUT_NOTES_DIRECTORY
     notes_dir = OUTPUT_NOTES_DIRECTORY
     abs_notes_dir = os.path.abspath(notes_dir) # Get absolute path for clarity in logs
-    print(f"DEBUG: list_saved_notes called. Checking directory: {abs_notes_dir}") # Log entry point
+    logger.debug("list_saved_notes called", directory=abs_notes_dir)
 
-    if not os.path.exists(abs_notes_dir):
-        print(f"DEBUG: Directory does not exist: {abs_notes_dir}")
+    if note_store.kind == STORE_FILES and not os.path.exists(abs_notes_dir):
+        logger.debug("Notes directory does not exist", directory=abs_notes_dir)
         # It might be okay if it doesn't exist yet, return empty list
         return jsonify({"notes": []}), 200
         # Or return 404 if you expect it to always exist after startup
         # return jsonify({"error": "Notes directory not found.", "notes": []}), 404
 
-    print(f"DEBUG: Directory exists: {abs_notes_dir}. Listing contents...")
-    try:
-        all_files = os.listdir(abs_notes_dir)
-        # Filter for .txt files and ensure they are files
-        note_filenames = [f for f in all_files if os.path.isfile(os.path.join(abs_notes_dir, f)) and f.endswith('.txt')]
-        
-        # Sort by filename in descending (reverse) order.
-        # With the new format YYYYMMDD_HHMM_SERVICE.txt, this will place newest first.
-        sorted_notes = sorted(note_filenames, reverse=True)
-        
-        print(f"DEBUG: Sorted list of filenames (lexicographical reverse): {sorted_notes}")
-        return jsonify({"notes": sorted_notes}), 200
-    except Exception as e:
-        print(f"ERROR: Exception during listing notes from {abs_notes_dir}: {e}")
-        return jsonify({"error": f"Failed to list notes: {str(e)}", "notes": []}), 500
+    return list_notes_page_response()
 
 @app.route('/get_note/<path:filename>', methods=['GET'])
 def get_note(filename):
     """
-    Serves a specific note file from the OUTPUT_NOTES_DIRECTORY.
-    Uses send_from_directory for security.
+    Serves a specific saved note as text/plain from the note store.
+    Optional ?version=N serves an earlier version (SQLite store).
+    The note's current version is returned in the X-Rosetta-Note-Version header.
+    Supports If-None-Match / If-Modified-Since (304) and byte ranges (Range, If-Range -> 206).
     """
-    # Use the globally defined OUTPUT_NOTES_DIRECTORY
-    notes_dir = os.path.abspath(OUTPUT_NOTES_DIRECTORY) # Use absolute path for send_from_directory
-
     # Basic security: sanitize filename provided by the user
     # werkzeug.utils.secure_filename is good practice but might be too restrictive
     # Using os.path.basename is a simpler approach here to prevent directory traversal
     safe_filename = os.path.basename(filename)
     if safe_filename != filename:
-         print(f"Warning: Filename potentially unsafe. Original: '{filename}', Sanitized: '{safe_filename}'")
+         logger.warning("Filename potentially unsafe", original=filename, sanitized=safe_filename)
          # Decide whether to proceed with sanitized name or return error
          # For now, let's return an error for potentially malicious paths
          return jsonify({"error": "Invalid filename format."}), 400
@@ -515,74 +1118,188 @@ def get_note(filename):
     if not safe_filename.endswith('.txt'):
         return jsonify({"error": "Invalid file type requested."}), 400
 
-    print(f"Attempting to serve file: {safe_filename} from directory: {notes_dir}")
+    version = request.args.get('version')
+    if version is not None:
+        try:
+            version = int(version)
+        except ValueError:
+            return jsonify({"error": "version must be an integer."}), 400
+
+    logger.debug("Serving note", filename=safe_filename, store=note_store.kind)
 
     try:
-        # Check if file exists before attempting to send
-        if not os.path.isfile(os.path.join(notes_dir, safe_filename)):
-             print(f"Requested note file not found: {os.path.join(notes_dir, safe_filename)}")
+        record = note_store.get(safe_filename, version=version)
+        if record is None:
+             logger.info("Requested note not found", filename=safe_filename)
              return jsonify({"error": "Note file not found."}), 404
-
-        # Use send_from_directory to safely serve the file
-        # as_attachment=False means the browser will try to display it if possible (good for text)
-        return send_from_directory(notes_dir, safe_filename, as_attachment=False, mimetype='text/plain')
-    except FileNotFoundError:
-         # This might be redundant if the isfile check works, but good as a fallback
-         print(f"Error: FileNotFoundError for {safe_filename} in {notes_dir}")
-         return jsonify({"error": "Note file not found (send_from_directory)."}), 404
+        body = record["body"].encode("utf-8")
+        response = etag_response(
+            content_etag(record["body"]), lambda: Response(body, mimetype='text/plain'), last_modified=record["updated_at"]
+        )
+        response.headers["X-Rosetta-Note-Version"] = str(record["version"])
     except Exception as e:
-        print(f"Error serving file {safe_filename} from {notes_dir}: {e}")
+        logger.error("Error serving note", filename=safe_filename, error=str(e))
         return jsonify({"error": f"Failed to serve note file: {str(e)}"}), 500
+    if response.status_code == 200:
+        # Range requests get 206 with that slice (416 if unsatisfiable); the rest stays a 200
+        response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+    return response
 
-# --- End of New Flask Routes ---
-
-
-@app.route('/generate_note', methods=['POST'])
-def handle_generate_note():
-    print("DEBUG: /generate_note endpoint hit") # New log
+@app.route('/api/note_history/<path:filename>', methods=['GET'])
+def note_history(filename):
+    """
+    Lists the stored versions of a note (newest first) with their metadata.
+    The file store only has the current version.
+    """
+    safe_filename = os.path.basename(filename)
+    if safe_filename != filename or not safe_filename.endswith('.txt'):
+        return jsonify({"error": "Invalid filename format."}), 400
     try:
-        data = request.get_json()
-        if data is None: # Check if data is None (parsing failed or empty request)
-            print("DEBUG: request.get_json() returned None or empty data.")
-            return jsonify({"error": "Invalid JSON or no data provided"}), 400
-        print(f"DEBUG: Received data: {data}") # New log
+        record = note_store.get(safe_filename)
+        if record is None:
+            return jsonify({"error": "Note file not found."}), 404
+        return jsonify({
+            "filename": safe_filename,
+            "store": note_store.kind,
+            "service": record["service"],
+            "created_at": record["created_at"],
+            "updated_at": record["updated_at"],
+            "version": record["version"],
+            "options": record["options"],
+            "model": record["model"],
+            "prompt_hash": record["prompt_hash"],
+            "versions": note_store.history(safe_filename) or [],
+        }), 200
     except Exception as e:
-        print(f"DEBUG: Error getting or parsing JSON data: {e}")
-        return jsonify({"error": f"Error processing request JSON: {str(e)}"}), 400
-    
-    if not data: # This check might be redundant if data is None check above catches it
-        print("DEBUG: Data is empty after try-except (should not happen if None check is robust).")
-        return jsonify({"error": "No data provided (empty after parsing)"}), 400
+        logger.error("Error reading note history", filename=safe_filename, error=str(e))
+        return jsonify({"error": f"Failed to read note history: {str(e)}"}), 500
 
-    # Parse new structured payload
-    # Accept 'file_content' as an alternative to 'patient_data'
-    patient_data = data.get('patient_data', '')
-    file_content = data.get('file_content', '') # New field for file content
-
-    # Use file_content if provided, otherwise use patient_data
-    input_data = file_content if file_content else patient_data
+@app.route('/search_notes', methods=['GET'])
+def search_notes():
+    """
+    Full-text search over saved notes, best matches first.
+    Query parameters: q (words are ANDed; "exact phrase", prefix*, OR, -exclude), service,
+    date_from / date_to (YYYY, YYYYMM or YYYYMMDD, inclusive), limit (default 20) and
+    offset (pass back next_offset for the next page).
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing search query 'q'.", "results": []}), 400
+    try:
+        limit = int(request.args.get('limit', '20'))
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers.", "results": []}), 400
+    if not 1 <= limit <= SEARCH_MAX_LIMIT or offset < 0:
+        return jsonify({"error": f"limit must be between 1 and {SEARCH_MAX_LIMIT} and offset non-negative.", "results": []}), 400
+
+    start_time = time.perf_counter()
+    try:
+        results, next_offset = note_store.search(
+            query,
+            service=request.args.get('service', '').strip() or None,
+            date_from=request.args.get('date_from', '').strip() or None,
+            date_to=request.args.get('date_to', '').strip() or None,
+            limit=limit,
+            offset=offset,
+            rank_window=SEARCH_RANK_WINDOW,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e), "results": []}), 400
+    except Exception as e:
+        logger.error("Error searching notes", error=str(e), **payload_fields("query", query))
+        return jsonify({"error": f"Failed to search notes: {str(e)}", "results": []}), 500
+    return jsonify({
+        "query": query,
+        "results": results,
+        "next_offset": next_offset,
+        "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 2),
+    }), 200
+
+@app.route('/api/prompt_stats', methods=['GET'])
+def prompt_stats():
+    """
+    Reports per-section character and token counts of the precompiled prompt pieces,
+    plus hit/miss counters of the memoized options section.
+    Pass ?exact=1 to count tokens with the Gemini count_tokens API instead of estimating.
+    """
+    try:
+        token_counter = None
+        if request.args.get('exact', '').lower() in ('1', 'true', 'yes'):
+            model = genai.GenerativeModel(GEMINI_MODEL)
+            token_counter = lambda text: model.count_tokens(text).total_tokens if text else 0
+        return jsonify({
+            "model": GEMINI_MODEL,
+            "static_prefix_chars": len(STATIC_PROMPT_PREFIX),
+            "static_prefix_tokens": token_counter(STATIC_PROMPT_PREFIX) if token_counter else estimate_tokens(STATIC_PROMPT_PREFIX),
+            "sections": prompt_section_stats(token_counter),
+            "options_section_cache": options_cache_info(),
+            "gemini_model": gemini_models.status(),
+            "llm_client": llm_client.snapshot(),
+        }), 200
+    except Exception as e:
+        logger.error("Error computing prompt stats", error=str(e))
+        return jsonify({"error": "Failed to compute prompt stats.", "details": str(e)}), 500
 
-    template_name = data.get('template_name', '') # e.g., "General Soap" or "custom_from_input"
-    template_content = data.get('template_content', '') # Actual content of the template
-    options = data.get('options', {}) # e.g., {"genSHN": true, "incPathophys": false}
-    service_abbr = data.get('service_abbreviation', 'GENERAL').strip().upper()
-    existing_note_filename = data.get('existing_note_filename')
-    custom_filename_from_payload = data.get('custom_filename', '').strip()
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Hit/miss counters and size of the LLM response cache.
+    """
+    if response_cache is None:
+        return jsonify({"enabled": False}), 200
+    stats = response_cache.snapshot()
+    stats["enabled"] = True
+    return jsonify(stats), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus text exposition of the request/stage/LLM metrics, summed over all workers.
+    """
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
-    # Basic validation - check if either input_data or existing_note_filename is provided
-    is_reformat_request_signal = "(No new clinical information provided" in input_data # Check signal in input_data
-    if not input_data and not existing_note_filename:
-        return jsonify({"error": "No patient data or file content provided for a new note"}), 400
-    if not input_data and existing_note_filename and not is_reformat_request_signal:
-        # This case implies an update but with no new info and not explicitly a reformat.
-        # Could be an error or an implicit reformat. For now, let's flag if input_data is truly empty.
-        print("Warning: Update request for existing note with empty new input_data, but not explicitly a reformat signal.")
-        # We can let it proceed, the LLM will get empty new input data.
+# --- End of New Flask Routes ---
 
-    if not service_abbr:
-        service_abbr = "GENERAL"
 
-    # --- Construct the dynamic_request_for_llm ---
+def plan_section_update(data, existing_note_content, input_data):
+    """
+    Decides whether an update can be done section by section. Returns
+    {"sections": [...], "sent_ids": [...]} or None for a whole-note rewrite.
+    Payload: optional "update_mode" ("sections" or "full") and "update_sections" (ids or headings).
+    """
+    update_mode = str(data.get('update_mode', '')).strip().lower()
+    if update_mode == "full" or (not SECTION_UPDATES_ENABLED and update_mode != "sections"):
+        return None
+    if update_mode != "sections" and len(existing_note_content) < SECTION_UPDATE_MIN_CHARS:
+        return None # Short notes: a full rewrite costs little and keeps options applied note-wide
+    sections = parse_note_sections(existing_note_content)
+    if sum(1 for section in sections if section.section_id != PREAMBLE_SECTION_ID) < 2:
+        logger.info("Existing note has no recognizable section structure; falling back to a full update.")
+        return None
+    sent_ids = select_sections_for_update(sections, input_data, data.get('update_sections'))
+    if not sent_ids:
+        return None
+    return {"sections": sections, "sent_ids": sent_ids}
+
+def plan_local_reformat(data, options, template_content):
+    """
+    Returns the shorthand mode if a reformat-only request can be served by the local engine
+    (only SHN checked, no template), else None. Payload "local_shorthand": false forces
+    the model.
+    """
+    if not LOCAL_SHORTHAND_ENABLED or data.get('local_shorthand') is False or template_content:
+        return None
+    enabled = {opt_id for opt_id, is_checked in (options or {}).items() if is_checked}
+    if not enabled or not enabled <= LOCAL_REFORMAT_OPTIONS:
+        return None
+    return shorthand_mode_for_options(options)
+
+def build_dynamic_request(patient_data, template_name, template_content, options):
+    """
+    The "Dynamic Request from Frontend" part of the prompt: patient information, template
+    instructions and the user-selected options.
+    """
     dynamic_request_parts = []
 
     # 1. Patient Information
@@ -616,238 +1333,713 @@ def handle_generate_note():
     else: # No custom template, and no (or empty) predefined template content
         dynamic_request_parts.append("No specific template provided or loaded. Generate note based on standard structure and selected options.")
 
-    # 3. User-Selected Options from checkboxes
-    selected_options_instructions = ["\nUser-Selected Options for this request:"]
-    has_any_option_selected = False
-    if options: # Check if options object is not empty
-        # Map option IDs from frontend to specific instructions for LLM
-        option_to_instruction_map = {
-            "genSHN": "- Output Format: Generate SHN (Short-hand Notation). Rephrase full note using standard clinical abbreviations while maintaining clarity. Prioritize abbreviations from the 'Preferred Shorthand Glossary' if provided.",
-            "genVSHN": "- Output Format: Generate VSHN (Very Short-hand Notation). Distill into ultra-concise, rapid-style shorthand. Omit non-critical detail. Use standard medical abbreviations where appropriate, prioritizing those from the 'Preferred Shorthand Glossary' if provided. Avoid uncommon abbreviations or excessive capitalization. DO NOT use underscores (_) to connect words; instead, use terse phrasing or standard abbreviations.",
-            "formatByProblem": "- A&P Structure: Format the Assessment & Plan section 'By Problem'. (Detailed instructions for 'By Problem' A&P will be appended if this is selected).",
-            "genAandPOnly": "- Output Content: Generate ONLY the Assessment & Plan section, structured 'By Problem'. Omit all other sections like Impression, Subjective (HPI, ROS, PMH, SHx, FHx), and Objective (Vitals, PE, Labs, Imaging). The 'By Problem' A&P formatting instructions still apply.",
-            "incPathophys": "- Reasoning Detail: Include full pathophysiologic reasoning in the Assessment & Plan.",
-            "incGuidelines": "- Reasoning Detail: Include guideline recommendations if relevant.",
-            "formatSOAP": "- Documentation Type: Use SOAP format (if no overriding template is provided).",
-            "formatHnP": "- Documentation Type: Use Full H&P format (if no overriding template is provided).",
-            "formatDischarge": "- Documentation Type: Use Discharge summary format (if no overriding template is provided).",
-            "formatPreOp": "- Documentation Type: Use Pre-op note format (if no overriding template is provided).",
-            # Updated Context Options
-            "specAnesthesia": "- Context: Anesthesia. Tailor questions, assessment, and plan accordingly.",
-            "specDerm": "- Context: Dermatology. Tailor questions, assessment, and plan accordingly.",
-            "specFM": "- Context: Family Medicine. Tailor questions, assessment, and plan accordingly.",
-            "specIM": "- Context: Internal Medicine. Tailor questions, assessment, and plan accordingly.",
-            "specNeuro": "- Context: Neurology. Tailer questions, assessment, and plan accordingly.",
-            "specOBGYN": "- Context: OBGYN. Tailer questions, assessment, and plan accordingly.",
-            "specPeds": "- Context: Pediatrics. Tailer questions, assessment, and plan accordingly.",
-            "specPsych": "- Context: Psychiatry. Tailer questions, assessment, and plan accordingly.",
-            "specSurgeryGen": "- Context: Surgery (General). Tailer questions, assessment, and plan accordingly.",
-            "incMissingData": "- Output Feature: Include a checklist of missing objective data that would be relevant.",
-            "genHistoryQuestions": "- Output Feature: Generate comprehensive history questions relevant to the patient's presentation. These should cover aspects of HPI (History of Present Illness), ROS (Review of Systems), PMH (Past Medical History), SHx (Social History), FHx (Family History), Medications, and Allergies as appropriate. Questions should be integrated into their respective sections within the note; if these sections do not exist, create them. Phrase questions naturally for a patient interview.",
-            "genPEManeuvers": "- Assistance Request: Suggest relevant physical exam maneuvers based on the provided patient information, including potential findings and reasoning.",
-            "genROSTemplate": "- Output Feature: Generate a Review of Systems (ROS) question template. These questions should be relevant to the patient's presentation (from input or existing note) and should be formatted to appear after the Subjective section of the main note.",
-            "genChartReview": "- Output Feature: Generate a 'Chart Review Checklist'. This checklist MUST be placed at the VERY BEGINNING of the entire note, before any other content (including Impression). The style should be concise, like a hurried checklist, but each item must be accurate, thoughtful, and include a brief explanation for why that piece of information is needed from the chart. This checklist takes precedence in placement over the standard note structure.",
-            "confirmDeidentified": "- Redaction: Confirm data is de-identified (this is a primary instruction; ensure PII is removed).",
-            "removeDates": "- Redaction: Remove specific dates and convert to relative time where appropriate (e.g., 'yesterday', 'last week').",
-            "stripNonStandardAbbr": "- Output Feature: Include all abbreviations from the input, including non-standard ones."
-        }
-
-        # Conflict Resolution
-        # (1) User Template > (2) Documentation Type > (3) Notation Format > (4) Specialty Context > (5) Reasoning Detail
-
-        # Input Validation & Feedback
-        # If input is ambiguous or inconsistent, prompt user for clarification before generating the note.
-
-        # Ensure generated content structurally complies with clinical documentation standards.
-        for opt_id, is_checked in options.items():
-            if is_checked and opt_id in option_to_instruction_map:
-                # If genAandPOnly is selected, we don't want to add formatByProblem's basic instruction,
-                # as genAandPOnly's instruction already covers the "by problem" aspect.
-                # However, we DO want the *detailed* "By Problem" instructions later.
-                if opt_id == "formatByProblem" and options.get("genAandPOnly"):
-                    selected_options_instructions.append("- A&P Structure: (Using 'By Problem' structure as per 'A&P Only' request).") # Placeholder or confirmation
-                    has_any_option_selected = True
-                    continue # Skip adding the generic formatByProblem instruction text
-                
-                selected_options_instructions.append(option_to_instruction_map[opt_id])
-                has_any_option_selected = True
-        
-        # If "A&P Only" is selected, it implies "formatByProblem" structure.
-        # Or if "formatByProblem" is selected independently.
-        if options.get("genAandPOnly") or options.get("formatByProblem"):
-            selected_options_instructions.append("\nDetailed Instructions for 'Assessment & Plan By Problem' (apply if 'A&P Only' or 'Assessment & Plan by problem' is selected):")
-            selected_options_instructions.append("Structure the Assessment and Plan (A&P) section 'By Problem'. For EACH problem identified, strictly follow this format:\n")
-            selected_options_instructions.append("#Problem Name (e.g., #Hypertension)")
-            selected_options_instructions.append("Assessment: [Concisely define the problem based on available lab/history/physical exam/presentation details. Include likely or possible etiologies for this patient. Describe the patient's current state or status regarding this problem.]")
-            selected_options_instructions.append("Plan:")
-            selected_options_instructions.append("- [Specific action/recommendation 1 for this problem]")
-            selected_options_instructions.append("- [Specific action/recommendation 2 for this problem]")
-            selected_options_instructions.append("  - [Sub-point or further detail for action 2, if any, indented]")
-            selected_options_instructions.append("- [Continue with more hyphenated plan items as needed for THIS problem, grouped logically as an attending physician would.]\n")
-            selected_options_instructions.append("General Rules for 'By Problem' A&P:")
-            selected_options_instructions.append("- Each problem MUST start with a '#' followed by the problem name.")
-            selected_options_instructions.append("- The 'Assessment:' part for each problem should be a comprehensive but concise paragraph.")
-            selected_options_instructions.append("- The 'Plan:' part for each problem MUST use hyphenated lists for actionable items.")
-            selected_options_instructions.append("- Ensure clinical reasoning is evident in the grouping and content of plan items.")
-
-            # Apply SHN/VSHN to the A&P content if those options are also selected
-            if options.get("genAandPOnly"): # If A&P Only is selected, these apply to the A&P section
-                if options.get("genVSHN"):
-                    selected_options_instructions.append("\nIMPORTANT FOR A&P Only + VSHN: Apply VSHN principles (ultra-concise, rapid-style shorthand) to the generated Assessment & Plan section. Prioritize abbreviations from the 'Preferred Shorthand Glossary'.")
-                elif options.get("genSHN"):
-                    selected_options_instructions.append("\nIMPORTANT FOR A&P Only + SHN: Apply SHN principles (standard clinical abbreviations) to the generated Assessment & Plan section, prioritizing abbreviations from the 'Preferred Shorthand Glossary', while maintaining clarity.")
-            else: # If not A&P Only, but formatByProblem is selected, these apply to the whole note
-                if options.get("genVSHN"):
-                    selected_options_instructions.append("\nIMPORTANT FOR VSHN + By Problem A&P: After structuring the A&P 'By Problem', apply VSHN principles (ultra-concise, rapid-style shorthand) to the ENTIRE note, including the content within each problem's Assessment and Plan. Prioritize abbreviations from the 'Preferred Shorthand Glossary'. Strive for maximum brevity while retaining the problem-oriented structure.")
-                elif options.get("genSHN"):
-                    selected_options_instructions.append("\nIMPORTANT FOR SHN + By Problem A&P: After structuring the A&P 'By Problem', apply SHN principles (standard clinical abbreviations) to the ENTIRE note, including the content within each problem's Assessment and Plan, prioritizing abbreviations from the 'Preferred Shorthand Glossary', while maintaining clarity.")
-
-        # Add the shorthand glossary if SHN or VSHN is selected
-        if options.get("genSHN") or options.get("genVSHN"):
-            if PREFERRED_SHORTHAND_GLOSSARY: # Check if glossary is not empty
-                glossary_items_string = "\n".join([f"- '{full}': use '{abbr}'" for full, abbr in PREFERRED_SHORTHAND_GLOSSARY.items()])
-                glossary_instruction = (
-                    "\n\nPreferred Shorthand Glossary (use these abbreviations when generating SHN/VSHN):\n"
-                    "---------------------------------------------------------------------------------\n"
-                    f"{glossary_items_string}\n"
-                    "---------------------------------------------------------------------------------\n"
-                    "If a term is not in this glossary, use standard clinical judgment for abbreviation, "
-                    "but refer to this list first for consistency. Avoid inventing new or highly unusual abbreviations."
-                )
-                selected_options_instructions.append(glossary_instruction)
-
-    if not has_any_option_selected:
-        selected_options_instructions.append("- (Using default behaviors as per core instructions for non-specified options)")
-    
-    dynamic_request_parts.extend(selected_options_instructions)
+    # 3. User-Selected Options from checkboxes (precompiled and memoized per option set)
+    dynamic_request_parts.append(compile_options_section(options, include_glossary=not LOCAL_SHORTHAND_ENABLED))
     dynamic_request_for_llm = "\n".join(dynamic_request_parts)
     dynamic_request_for_llm += "\n\n--- END OF DYNAMIC REQUEST FROM FRONTEND ---"
-    
-    # --- End of Constructing dynamic_request_for_llm ---
+    return dynamic_request_for_llm
+
+def compose_note_prompt(prompt_mode, dynamic_request_for_llm, existing_note_content=None, section_update=None):
+    """
+    Assembles the prompt passed to get_llm_response. `prompt_mode` is "new", "reformat"
+    (rewrite the existing note with new options), "sections" (section-level update) or
+    "update" (integrate new information into the whole existing note).
+    """
+    parts = []
+    if prompt_mode == "reformat":
+        parts.append(
+            "You are REFORMATTING an existing medical note based on newly selected user options.\n"
+            "The 'EXISTING NOTE CONTENT' is provided below.\n"
+            "Your task is to re-write this entire existing content according to ALL instructions and 'User-Selected Options' (detailed in the 'Dynamic Request from Frontend' section that follows the existing content).\n"
+            "Pay close attention to formatting requests like SHN, VSHN, A&P By Problem, etc.\n\n"
+            f"EXISTING NOTE CONTENT:\n---\n{existing_note_content}\n---\n\n"
+            "NOW, APPLY THE FOLLOWING DYNAMIC REQUEST (CONTAINING OPTIONS AND FORMATTING INSTRUCTIONS) TO THE ABOVE EXISTING CONTENT:"
+        )
+    elif prompt_mode == "sections": # Only the affected sections are sent and returned
+        parts.append(build_section_update_prompt(section_update["sections"], section_update["sent_ids"]))
+    elif prompt_mode == "update": # Standard update: integrate new info from patient_data
+        parts.append(
+            "You are UPDATING an existing medical note. The 'EXISTING NOTE CONTENT' is provided below.\n"
+            "1. The 'Dynamic Request from Frontend' (which follows the existing content) contains NEW 'Patient Information'. Integrate this new information into the existing content, making necessary modifications and additions.\n"
+            "2. When integrating, especially in structured sections like 'Objective', ensure that proper formatting, including line breaks for distinct items (e.g., HEENT, Heart, Lungs), is maintained or re-established throughout the section.\n"
+            "3. After integration, apply all other instructions and 'User-Selected Options' from the 'Dynamic Request from Frontend' to the ENTIRE resulting note (e.g., SHN/VSHN conversion, A&P by Problem, etc.).\n\n"
+            f"EXISTING NOTE CONTENT:\n---\n{existing_note_content}\n---\n\n"
+            "NOW, PROCESS THE FOLLOWING DYNAMIC REQUEST (CONTAINING NEW PATIENT INFO AND OPTIONS) AND APPLY IT TO THE ABOVE EXISTING CONTENT:"
+        )
+    parts.append(dynamic_request_for_llm)
+    return "\n\n".join(parts)
+
+@timed_stage("prompt_assembly")
+def build_note_request(data):
+    """
+    Parses a /generate_note payload and assembles the prompt for get_llm_response.
+    Returns (note_request, None) on success, or (None, (error_payload, status_code)) if the
+    payload is invalid. Shared by the regular and streaming generation paths.
+    """
+    # Parse new structured payload
+    # Accept 'file_content' as an alternative to 'patient_data'
+    patient_data = data.get('patient_data', '')
+    file_content = data.get('file_content', '') # New field for file content
+
+    # Use file_content if provided, otherwise use patient_data
+    input_data = file_content if file_content else patient_data
 
-    final_llm_prompt_parts = []
+    template_name = data.get('template_name', '') # e.g., "General Soap" or "custom_from_input"
+    template_content = data.get('template_content', '') # Actual content of the template
+    options = data.get('options', {}) # e.g., {"genSHN": true, "incPathophys": false}
+    service_abbr = data.get('service_abbreviation', 'GENERAL').strip().upper()
+    existing_note_filename = data.get('existing_note_filename')
+    custom_filename_from_payload = data.get('custom_filename', '').strip()
+
+    # A predefined template can be sent by ID ("template_id": "general_soap") instead of its full
+    # content; it is resolved from the template registry. Explicit template_content still wins.
+    template_id = (data.get('template_id') or '').strip()
+    if template_id and not template_content and template_name != "custom_from_input":
+        try:
+            template = template_registry.get(os.path.basename(template_id))
+        except FileNotFoundError:
+            template = None
+        if template is None:
+            return None, ({"error": f"Unknown template_id '{template_id}'."}, 400)
+        template_content = template.content
+        template_name = template_name or template.template_id
+
+    # Basic validation - check if either input_data or existing_note_filename is provided
+    is_reformat_request_signal = "(No new clinical information provided" in input_data # Check signal in input_data
+    if not input_data and not existing_note_filename:
+        return None, ({"error": "No patient data or file content provided for a new note"}, 400)
+    if not input_data and existing_note_filename and not is_reformat_request_signal:
+        # This case implies an update but with no new info and not explicitly a reformat.
+        # Could be an error or an implicit reformat. For now, let's flag if input_data is truly empty.
+        logger.warning("Update request for existing note with empty new input_data, but not explicitly a reformat signal.")
+        # We can let it proceed, the LLM will get empty new input data.
+
+    if not service_abbr:
+        service_abbr = "GENERAL"
+
+    prompt_mode = "new"
+    existing_note_content = None
+    section_update = None
+    local_output = None
+    base_version = None
     output_filename = ""
     operation_type_message = "generated and saved"
 
     if existing_note_filename:
         # Update existing note - custom filename from payload is ignored if updating an existing note.
         # The existing_note_filename takes precedence.
-        print(f"Received UPDATE request for note: {existing_note_filename} (service: {service_abbr})")
+        logger.info("Received UPDATE request", filename=existing_note_filename, service=service_abbr)
         if custom_filename_from_payload:
-            print(f"Note: Custom filename '{custom_filename_from_payload}' provided but will be ignored because this is an update to an existing note '{existing_note_filename}'.")
-        base_notes_path = os.environ.get("BASE_NOTES_PATH", ".")
-        output_notes_directory = os.path.join(base_notes_path, "rosetta_outputs")
-        existing_note_path = os.path.join(output_notes_directory, existing_note_filename)
-        if not os.path.isfile(existing_note_path):
-            return jsonify({"error": f"Existing note '{existing_note_filename}' not found or is not a file."}), 404
+            logger.info("Custom filename ignored for an update to an existing note", custom_filename=custom_filename_from_payload, filename=existing_note_filename)
         try:
-            with open(existing_note_path, 'r', encoding='utf-8') as f:
-                existing_note_content = f.read()
+            existing_note = note_store.get(os.path.basename(existing_note_filename))
+            if existing_note is None:
+                return None, ({"error": f"Existing note '{existing_note_filename}' not found or is not a file."}, 404)
+            existing_note_content = existing_note["body"]
+            # The save fails with 409 if the note changes before this update is written. Clients
+            # can pin the version they displayed (X-Rosetta-Note-Version) with "expected_version".
+            base_version = existing_note["version"]
+            if data.get('expected_version') is not None:
+                try:
+                    base_version = int(data['expected_version'])
+                except (TypeError, ValueError):
+                    return None, ({"error": "expected_version must be an integer."}, 400)
+            if not is_reformat_request_signal:
+                section_update = plan_section_update(data, existing_note_content, input_data)
             
-            if is_reformat_request_signal: # patient_data contains the signal "(No new clinical information provided..."
-                print("This is a REFORMAT ONLY request for existing note.")
-                final_llm_prompt_parts.append(
-                    "You are REFORMATTING an existing medical note based on newly selected user options.\n"
-                    "The 'EXISTING NOTE CONTENT' is provided below.\n"
-                    "Your task is to re-write this entire existing content according to ALL instructions and 'User-Selected Options' (detailed in the 'Dynamic Request from Frontend' section that follows the existing content).\n"
-                    "Pay close attention to formatting requests like SHN, VSHN, A&P By Problem, etc.\n\n"
-                    f"EXISTING NOTE CONTENT:\n---\n{existing_note_content}\n---\n\n"
-                    "NOW, APPLY THE FOLLOWING DYNAMIC REQUEST (CONTAINING OPTIONS AND FORMATTING INSTRUCTIONS) TO THE ABOVE EXISTING CONTENT:"
+            local_reformat_mode = plan_local_reformat(data, options, template_content) if is_reformat_request_signal else None
+            if local_reformat_mode:
+                # Served without the model; the raw output has the same shape as a model response
+                reformatted, replacements = rewrite_shorthand(existing_note_content, local_reformat_mode)
+                logger.info("Shorthand REFORMAT request served locally", mode=local_reformat_mode, replacements=replacements)
+                local_output = (
+                    f"{THOUGHTS_START_DELIM}\nReformatted to {local_reformat_mode.upper()} locally with the preferred shorthand "
+                    f"glossary ({replacements} replacements); the model was not called.\n{THOUGHTS_END_DELIM}\n{reformatted}"
                 )
+
+            if is_reformat_request_signal: # patient_data contains the signal "(No new clinical information provided..."
+                logger.info("REFORMAT ONLY request for existing note")
+                prompt_mode = "reformat"
+            elif section_update: # Only the affected sections are sent and returned
+                logger.info("SECTION UPDATE request", sections=", ".join(section_update['sent_ids']))
+                prompt_mode = "sections"
             else: # Standard update: integrate new info from patient_data
-                print("This is an UPDATE request with new information for an existing note.")
-                final_llm_prompt_parts.append(
-                    "You are UPDATING an existing medical note. The 'EXISTING NOTE CONTENT' is provided below.\n"
-                    "1. The 'Dynamic Request from Frontend' (which follows the existing content) contains NEW 'Patient Information'. Integrate this new information into the existing content, making necessary modifications and additions.\n"
-                    "2. When integrating, especially in structured sections like 'Objective', ensure that proper formatting, including line breaks for distinct items (e.g., HEENT, Heart, Lungs), is maintained or re-established throughout the section.\n"
-                    "3. After integration, apply all other instructions and 'User-Selected Options' from the 'Dynamic Request from Frontend' to the ENTIRE resulting note (e.g., SHN/VSHN conversion, A&P by Problem, etc.).\n\n"
-                    f"EXISTING NOTE CONTENT:\n---\n{existing_note_content}\n---\n\n"
-                    "NOW, PROCESS THE FOLLOWING DYNAMIC REQUEST (CONTAINING NEW PATIENT INFO AND OPTIONS) AND APPLY IT TO THE ABOVE EXISTING CONTENT:"
-                )
-            
-            final_llm_prompt_parts.append(dynamic_request_for_llm)
+                logger.info("UPDATE request with new information for an existing note")
+                prompt_mode = "update"
+
             output_filename = existing_note_filename
             operation_type_message = "updated and saved"
         except Exception as e:
-            print(f"Error reading existing note {existing_note_filename}: {e}")
-            return jsonify({"error": f"Failed to read existing note: {str(e)}"}), 500
+            logger.error("Error reading existing note", filename=existing_note_filename, error=str(e))
+            return None, ({"error": f"Failed to read existing note: {str(e)}"}, 500)
     else:
         # Create new note
-        print(f"Received NEW note request for service: {service_abbr}")
-        final_llm_prompt_parts.append(dynamic_request_for_llm)
-        
+        logger.info("Received NEW note request", service=service_abbr)
+
         if custom_filename_from_payload:
             # Sanitize the custom filename
             safe_custom_filename = "".join(c if c.isalnum() or c in ['_', '-'] else '_' for c in custom_filename_from_payload)
             if not safe_custom_filename: # If sanitization results in empty or only problematic chars
-                print(f"Warning: Custom filename '{custom_filename_from_payload}' sanitized to empty. Falling back to auto-generated name.")
+                logger.warning("Custom filename sanitized to empty; falling back to auto-generated name", custom_filename=custom_filename_from_payload)
                 output_filename = generate_filename(service_abbr)
             else:
                 output_filename = f"{safe_custom_filename}.txt"
-                print(f"Using custom filename (sanitized): {output_filename}")
+                logger.info("Using custom filename (sanitized)", filename=output_filename)
         else:
             output_filename = generate_filename(service_abbr)
-            print(f"Using auto-generated filename: {output_filename}")
+            logger.info("Using auto-generated filename", filename=output_filename)
+
+    # --- Token budget: compact oversized inputs and size max_output_tokens (rosetta_budget.py) ---
+    budget = None
+    max_output_tokens = None
+    if local_output is None:
+        budget_sections = {"patient_input": patient_data, "template": template_content}
+        if prompt_mode in ("reformat", "update"): # Reported, never compacted: the rewrite replaces the stored note
+            budget_sections["existing_note"] = existing_note_content
+        elif prompt_mode == "sections": # Reported, but never compacted: the reply is merged into them
+            budget_sections["existing_note_sections"] = "\n\n".join(
+                section.text for section in section_update["sections"] if section.section_id in section_update["sent_ids"]
+            )
+
+        def assemble(sections):
+            dynamic_request = build_dynamic_request(sections["patient_input"], template_name, sections["template"], options)
+            return compose_full_prompt(compose_note_prompt(prompt_mode, dynamic_request, sections.get("existing_note"), section_update))
+
+        budget_sections, budget = prompt_budgeter.fit(budget_sections, assemble)
+        for compaction in budget["compactions"]:
+            PROMPT_COMPACTIONS.inc(policy=compaction["policy"])
+        patient_data = budget_sections["patient_input"]
+        rewrite_text = budget_sections.get("existing_note_sections", existing_note_content)
+        max_output_tokens, budget["output_profile"] = prompt_budgeter.max_output_tokens(options, rewrite_text)
+        budget["max_output_tokens"] = max_output_tokens
+
+    dynamic_request_for_llm = build_dynamic_request(patient_data, template_name, template_content, options)
+    final_llm_prompt = compose_note_prompt(prompt_mode, dynamic_request_for_llm, existing_note_content, section_update)
+
+    return {
+        "prompt": final_llm_prompt,
+        "output_filename": output_filename,
+        "operation_type_message": operation_type_message,
+        "service_abbr": service_abbr,
+        "is_update": bool(existing_note_filename),
+        "base_version": base_version,
+        "options": options,
+        "prompt_hash": hashlib.sha256(final_llm_prompt.encode("utf-8")).hexdigest(),
+        "section_update": section_update, # None unless only some sections were sent
+        "shorthand_mode": shorthand_mode_for_options(options) if LOCAL_SHORTHAND_ENABLED else None,
+        "local_output": local_output, # Raw output of a locally served reformat; skips the model
+        "max_output_tokens": max_output_tokens, # None: the default from build_generation_config
+        "budget": budget, # Prompt budget report, returned to the client; None when served locally
+        "bypass_cache": bool(data.get('bypass_cache', False)), # Per-request response cache bypass
+    }, None
+
+def split_model_output(llm_raw_output):
+    """
+    Splits raw LLM output into (model_thoughts_text, note_text) using the thoughts markers.
+    If the markers are missing, the entire output is treated as the note.
+    """
+    start_idx = llm_raw_output.find(THOUGHTS_START_DELIM)
+    end_idx = llm_raw_output.find(THOUGHTS_END_DELIM)
 
-    final_llm_prompt = "\n\n".join(final_llm_prompt_parts)
-    
-    # The get_llm_response function will prepend ROSETTA_SYSTEM_INSTRUCTION and ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS
-    # So, final_llm_prompt here is effectively the 'dynamic_prompt_from_frontend' argument for get_llm_response
-    llm_raw_output, prompt_feedback_details = get_llm_response(final_llm_prompt) 
-    
-    print(f"DEBUG: llm_raw_output (first 500 chars): {llm_raw_output[:500]}") # Added DEBUG log
-    
-    response_data = {"prompt_feedback": prompt_feedback_details if prompt_feedback_details else "N/A"}
+    if start_idx != -1 and end_idx != -1 and start_idx < end_idx:
+        model_thoughts_text = llm_raw_output[start_idx + len(THOUGHTS_START_DELIM):end_idx].strip()
+        # The actual note is whatever comes after the thoughts_end_delim
+        note_text = llm_raw_output[end_idx + len(THOUGHTS_END_DELIM):].strip()
+    else:
+        # If delimiters are not found, assume the whole output is the note.
+        logger.warning("Model thoughts delimiters not found in LLM output. Treating entire output as note.")
+        note_text = llm_raw_output.strip() # Assign raw output to note_text if delimiters are missing
+        model_thoughts_text = "(No separate thoughts section provided by the model or delimiters not found.)"
+    return model_thoughts_text, note_text
 
-    model_thoughts_text = ""
-    note_text = ""
+def finalize_note_output(llm_raw_output, prompt_feedback_details, note_request):
+    """
+    Splits the LLM output into thoughts and note, saves the cleaned note and
+    builds the response payload. Returns (response_data, status_code).
+    """
+    response_data = {"prompt_feedback": prompt_feedback_details if prompt_feedback_details else "N/A"}
+    if note_request.get("budget"):
+        response_data["budget"] = note_request["budget"]
+    output_filename = note_request["output_filename"]
+    operation_type_message = note_request["operation_type_message"]
 
     if llm_raw_output and not llm_raw_output.startswith("Error:"):
-        thoughts_start_delim = "===ROSETTA_MODEL_THOUGHTS_START==="
-        thoughts_end_delim = "===ROSETTA_MODEL_THOUGHTS_END==="
-
-        start_idx = llm_raw_output.find(thoughts_start_delim)
-        end_idx = llm_raw_output.find(thoughts_end_delim)
-
-        if start_idx != -1 and end_idx != -1 and start_idx < end_idx:
-            model_thoughts_text = llm_raw_output[start_idx + len(thoughts_start_delim):end_idx].strip()
-            # The actual note is whatever comes after the thoughts_end_delim
-            note_text = llm_raw_output[end_idx + len(thoughts_end_delim):].strip()
-        else:
-            # If delimiters are not found, assume the whole output is the note.
-            print("Warning: Model thoughts delimiters not found in LLM output. Treating entire output as note.")
-            note_text = llm_raw_output.strip() # Assign raw output to note_text if delimiters are missing
-            model_thoughts_text = "(No separate thoughts section provided by the model or delimiters not found.)"
+        parse_started = time.perf_counter()
+        model_thoughts_text, note_text = split_model_output(llm_raw_output)
 
         # Clean the note_text (as it's the part that will be saved and primarily displayed as "note")
         cleaned_note_text = note_text.replace("**", "").strip()
+
+        shorthand_mode = note_request.get("shorthand_mode")
+        if note_request.get("local_output") is not None:
+            response_data["shorthand"] = {"mode": shorthand_mode, "local_reformat": True}
+        elif shorthand_mode:
+            # The glossary is no longer in the prompt; apply it to what the model wrote (before
+            # a section merge, so sections that weren't sent stay byte-for-byte)
+            cleaned_note_text, replacements = rewrite_shorthand(cleaned_note_text, shorthand_mode)
+            response_data["shorthand"] = {"mode": shorthand_mode, "local_reformat": False, "replacements": replacements}
+
+        section_update = note_request.get("section_update")
+        if section_update:
+            # The model returned only the changed sections; merge them into the existing note
+            updates = parse_section_update(cleaned_note_text)
+            if not updates:
+                ERRORS.inc(stage="parse", type="no_marked_sections")
+                response_data["error"] = "The model did not return any marked note sections; the note was not changed."
+                response_data["llm_model_thoughts"] = model_thoughts_text
+                response_data["llm_note_output"] = cleaned_note_text
+                return response_data, 500
+            cleaned_note_text, applied_ids = merge_section_update(section_update["sections"], updates, section_update["sent_ids"])
+            cleaned_note_text = cleaned_note_text.strip()
+            response_data["updated_sections"] = applied_ids
+        STAGE_SECONDS.observe(time.perf_counter() - parse_started, stage="parse")
         
-        print(f"DEBUG: model_thoughts_text (first 500 chars): {model_thoughts_text[:500]}") # Added DEBUG log
-        print(f"DEBUG: cleaned_note_text (first 500 chars): {cleaned_note_text[:500]}") # Added DEBUG log
+        logger.debug("Split model output", **payload_fields("thoughts", model_thoughts_text), **payload_fields("note", cleaned_note_text))
         
         # The model_thoughts_text can retain its original formatting from the LLM for now,
         # unless specific cleaning is also desired for it.
 
-        if save_note_to_file(output_filename, cleaned_note_text): # Save only the cleaned note part
+        try:
+            saved_filename = save_note_to_file(output_filename, cleaned_note_text, note_request) # Save only the cleaned note part
+        except NoteVersionConflict as e:
+            logger.warning("Not saving note: it changed since the update was requested", filename=output_filename, error=str(e))
+            response_data["error"] = f"{e} Reload the note and apply the update again."
+            response_data["llm_model_thoughts"] = model_thoughts_text
+            response_data["llm_note_output"] = cleaned_note_text
+            return response_data, 409
+        if saved_filename:
             response_data["message"] = f"Note {operation_type_message} successfully."
-            response_data["filename"] = output_filename
+            response_data["filename"] = saved_filename # May carry a _2 suffix if the name was taken
             response_data["llm_model_thoughts"] = model_thoughts_text
             response_data["llm_note_output"] = cleaned_note_text
-            print(f"DEBUG: Preparing to jsonify success response_data: {response_data}") # Added DEBUG log
-            return jsonify(response_data), 200
+            logger.debug("Note generated and saved", filename=saved_filename)
+            return response_data, 200
         else:
             response_data["error"] = "Failed to save the note."
             response_data["llm_model_thoughts"] = model_thoughts_text # Still return thoughts if available
             response_data["llm_note_output"] = cleaned_note_text     # and note
-            print(f"DEBUG: Preparing to jsonify save_failure response_data: {response_data}") # Added DEBUG log
-            return jsonify(response_data), 500
+            logger.debug("Note generated but saving failed", filename=output_filename)
+            return response_data, 500
     else:
         response_data["error"] = "Failed to get a valid response from LLM."
         response_data["details"] = llm_raw_output # This would be the error message from get_llm_response
         response_data["llm_model_thoughts"] = ""
         response_data["llm_note_output"] = ""
-        print(f"DEBUG: Preparing to jsonify LLM_failure response_data: {response_data}") # Added DEBUG log
-        return jsonify(response_data), 500
+        logger.debug("LLM call failed", details=llm_raw_output)
+        return response_data, 500
+
+def stream_note_events(note_request):
+    """
+    Generator yielding Server-Sent Events for a streaming /generate_note request.
+    Emits "thoughts" and "note" events as chunks arrive, then a final "done" event
+    (carrying the saved filename) or an "error" event.
+    """
+    splitter = ThoughtsNoteSplitter()
+    raw_chunks = []
+    stream_state = {}
+    yield format_sse_event("start", {"filename": note_request["output_filename"]})
+    if note_request["local_output"] is not None:
+        chunks = [note_request["local_output"]]
+    else:
+        chunks = stream_llm_response(note_request["prompt"], stream_state, note_request["bypass_cache"], note_request["max_output_tokens"])
+    try:
+        for chunk_text in chunks:
+            raw_chunks.append(chunk_text)
+            for event_name, text in splitter.feed(chunk_text):
+                yield format_sse_event(event_name, {"text": text})
+        for event_name, text in splitter.finish():
+            yield format_sse_event(event_name, {"text": text})
+    except Exception as e:
+        logger.error("Error during streaming Gemini call", error=str(e))
+        yield format_sse_event("error", {
+            "error": "Failed to get a valid response from LLM.",
+            "details": f"Error: Exception during API call - {str(e)}",
+        })
+        return
+
+    # Saved note uses the condensed text (same as the non-streaming path); cache hits are already condensed
+    llm_raw_output = stream_state.get("condensed_output", "".join(raw_chunks))
+    if not llm_raw_output.strip():
+        llm_raw_output = f"Error: {stream_state.get('error_detail', 'Gemini API stream returned no content.')}"
+    note_request["model"] = LOCAL_SHORTHAND_MODEL if note_request["local_output"] is not None else stream_state.get("model", GEMINI_MODEL)
+    response_data, status_code = finalize_note_output(llm_raw_output, stream_state.get("feedback", ""), note_request)
+    response_data["status_code"] = status_code
+    response_data["model"] = note_request["model"]
+    response_data["cache_hit"] = stream_state.get("cache_hit", False)
+    response_data["loop_detected"] = stream_state.get("loop_detected", False)
+    yield format_sse_event("done" if status_code == 200 else "error", response_data)
+
+@app.route('/generate_note', methods=['POST'])
+@instrument_route("/generate_note")
+def handle_generate_note():
+    logger.debug("/generate_note endpoint hit")
+    try:
+        data = request.get_json()
+        if data is None: # Check if data is None (parsing failed or empty request)
+            logger.debug("request.get_json() returned None or empty data.")
+            return jsonify({"error": "Invalid JSON or no data provided"}), 400
+        logger.debug("Received /generate_note payload", **payload_fields("payload", str(data)))
+    except Exception as e:
+        logger.debug("Error getting or parsing JSON data", error=str(e))
+        return jsonify({"error": f"Error processing request JSON: {str(e)}"}), 400
+    
+    if not data: # This check might be redundant if data is None check above catches it
+        logger.debug("Data is empty after try-except (should not happen if None check is robust).")
+        return jsonify({"error": "No data provided (empty after parsing)"}), 400
+
+    # Async mode: queue the whole request (prompt build included) and answer with a job ID
+    if wants_async_job(data, request.args.get('async')):
+        return submit_note_job(data)
+
+    note_request, error = build_note_request(data)
+    if error:
+        error_payload, status_code = error
+        return jsonify(error_payload), status_code
+
+    # Streaming mode: /generate_note?stream=1 returns Server-Sent Events as the model generates
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        logger.info("Streaming response", filename=note_request['output_filename'])
+        return Response(
+            stream_note_events(note_request),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    response_data, status_code = generate_note_response(note_request)
+    return jsonify(response_data), status_code
+
+LOCAL_OUTPUT_FEEDBACK = "N/A (served locally)"
+
+def generate_note_response(note_request):
+    """
+    Gemini call (or local output), thoughts/note split and save for a built note request.
+    Returns (response_data, status_code); shared by /generate_note and async jobs.
+    """
+    # The get_llm_response function will prepend ROSETTA_SYSTEM_INSTRUCTION and ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS
+    # So, note_request["prompt"] here is effectively the 'dynamic_prompt_from_frontend' argument for get_llm_response
+    llm_meta = {}
+    if note_request["local_output"] is not None:
+        llm_raw_output, prompt_feedback_details = note_request["local_output"], LOCAL_OUTPUT_FEEDBACK
+    else:
+        llm_raw_output, prompt_feedback_details = get_llm_response(
+            note_request["prompt"], note_request["bypass_cache"], llm_meta, max_output_tokens=note_request["max_output_tokens"]
+        )
+    return finish_note_response(note_request, llm_raw_output, prompt_feedback_details, llm_meta)
+
+def finish_note_response(note_request, llm_raw_output, prompt_feedback_details, llm_meta):
+    """
+    Thoughts/note split, save and response fields once the model (or the local shorthand
+    engine) has answered. Shared by the Flask, batch and ASGI paths; returns (response_data, status_code).
+    """
+    logger.debug("LLM output received", **payload_fields("llm_output", llm_raw_output))
+
+    # Cache hits go straight to the same thoughts/note split and save logic
+    note_request["model"] = LOCAL_SHORTHAND_MODEL if note_request["local_output"] is not None else llm_meta.get("model", GEMINI_MODEL)
+    response_data, status_code = finalize_note_output(llm_raw_output, prompt_feedback_details, note_request)
+    response_data["cache_hit"] = llm_meta.get("cache_hit", False)
+    response_data["loop_detected"] = llm_meta.get("loop_detected", False)
+    response_data["coalesced"] = llm_meta.get("coalesced", False)
+    response_data["model"] = note_request["model"]
+    return response_data, status_code
+
+# --- Batch Note Generation ---
+
+_batch_executor = None
+_batch_executor_pid = None
+_batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    """
+    Process-wide worker pool for batch items, created lazily so each gunicorn worker
+    (forked after import) gets its own threads.
+    """
+    global _batch_executor, _batch_executor_pid
+    with _batch_executor_lock:
+        if _batch_executor is None or _batch_executor_pid != os.getpid():
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="rosetta-batch")
+            _batch_executor_pid = os.getpid()
+        return _batch_executor
+
+def uniquify_batch_filenames(note_requests):
+    """
+    Notes generated in the same minute for the same service get the same auto-generated name,
+    so later new notes in a batch are renamed NAME_2.txt, NAME_3.txt, ... instead of
+    overwriting each other. Updates keep their existing filename.
+    """
+    taken = {note_request["output_filename"] for note_request in note_requests if note_request["is_update"]}
+    for note_request in note_requests:
+        if note_request["is_update"]:
+            continue
+        filename = note_request["output_filename"]
+        stem, extension = os.path.splitext(filename)
+        suffix = 2
+        while filename in taken:
+            filename = f"{stem}_{suffix}{extension}"
+            suffix += 1
+        taken.add(filename)
+        note_request["output_filename"] = filename
+
+def generate_batch_item(index, note_request, item_state):
+    """
+    Runs one batch item on a pool thread: Gemini call, split and save.
+    If the item has already been reported as timed out, the late result is not saved.
+    """
+    item_state["started_at"] = time.time()
+    llm_meta = {}
+    if note_request["local_output"] is not None:
+        llm_raw_output, prompt_feedback_details = note_request["local_output"], LOCAL_OUTPUT_FEEDBACK
+    else:
+        llm_raw_output, prompt_feedback_details = get_llm_response(
+            note_request["prompt"], note_request["bypass_cache"], llm_meta,
+            request_timeout=BATCH_ITEM_TIMEOUT_SECONDS, max_output_tokens=note_request["max_output_tokens"],
+        )
+    if item_state.get("abandoned"):
+        logger.warning("Batch item finished after its timeout; not saving", index=index, filename=note_request['output_filename'])
+        return None
+    return finish_note_response(note_request, llm_raw_output, prompt_feedback_details, llm_meta)
+
+def run_note_batch(items):
+    """
+    Generator over per-item results, in completion order. `items` is a list of
+    (index, note_request); each result is a dict with "index" and "status_code".
+    Items still running BATCH_ITEM_TIMEOUT_SECONDS after they started are reported as 504.
+    """
+    executor = get_batch_executor()
+    item_states = {}
+    pending = {}
+    for index, note_request in items:
+        item_states[index] = {}
+        future = executor.submit(generate_batch_item, index, note_request, item_states[index])
+        pending[future] = (index, note_request)
+
+    while pending:
+        done, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, note_request = pending.pop(future)
+            try:
+                response_data, status_code = future.result()
+            except Exception as e:
+                logger.error("Error in batch item", index=index, error=str(e))
+                response_data, status_code = {"error": "Unexpected error while generating note.", "details": str(e)}, 500
+            response_data["index"] = index
+            response_data["status_code"] = status_code
+            yield response_data
+
+        now = time.time()
+        for future, (index, note_request) in list(pending.items()):
+            if future.done():
+                continue # Picked up by the next wait()
+            started_at = item_states[index].get("started_at")
+            if started_at is not None and now - started_at > BATCH_ITEM_TIMEOUT_SECONDS:
+                item_states[index]["abandoned"] = True
+                del pending[future]
+                logger.warning("Batch item timed out", index=index, filename=note_request['output_filename'], timeout_seconds=BATCH_ITEM_TIMEOUT_SECONDS)
+                yield {
+                    "index": index,
+                    "status_code": 504,
+                    "error": "Timed out waiting for the LLM.",
+                    "filename": note_request["output_filename"],
+                }
+
+def stream_batch_events(items, errors):
+    """
+    Server-Sent Events for a streaming batch: one "item" event per finished note,
+    then a "done" event with counts.
+    """
+    yield format_sse_event("start", {"count": len(items) + len(errors)})
+    for error_result in errors:
+        yield format_sse_event("item", error_result)
+    succeeded = 0
+    for result in run_note_batch(items):
+        if result["status_code"] == 200:
+            succeeded += 1
+        yield format_sse_event("item", result)
+    yield format_sse_event("done", {"succeeded": succeeded, "failed": len(items) + len(errors) - succeeded})
+
+@app.route('/generate_notes_batch', methods=['POST'])
+@instrument_route("/generate_notes_batch")
+def handle_generate_notes_batch():
+    """
+    Generates several notes in one request. Body: {"items": [<generate_note payload>, ...]}.
+    All prompts are built up front, then the Gemini calls run concurrently on a bounded pool
+    (ROSETTA_BATCH_MAX_WORKERS) and each note is saved as soon as it finishes.
+    Returns {"results": [...]} in request order, or with ?stream=1 an SSE "item" event per
+    note in completion order.
+    """
+    try:
+        data = request.get_json()
+    except Exception as e:
+        return jsonify({"error": f"Error processing request JSON: {str(e)}"}), 400
+    payloads = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(payloads, list) or not payloads:
+        return jsonify({"error": "Expected a non-empty 'items' list."}), 400
+    if len(payloads) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items in batch ({len(payloads)} > {BATCH_MAX_ITEMS})."}), 400
+
+    # Build every prompt before any Gemini call; invalid items are reported without failing the batch
+    items = []
+    errors = []
+    for index, payload in enumerate(payloads):
+        note_request, error = build_note_request(payload) if isinstance(payload, dict) else (None, ({"error": "Item must be a JSON object."}, 400))
+        if error:
+            error_payload, status_code = error
+            errors.append(dict(error_payload, index=index, status_code=status_code))
+        else:
+            items.append((index, note_request))
+    uniquify_batch_filenames([note_request for _, note_request in items])
+    logger.info("Batch received", items=len(payloads), valid=len(items), max_workers=BATCH_MAX_WORKERS)
+
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return Response(
+            stream_batch_events(items, errors),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    started_at = time.time()
+    results = errors + list(run_note_batch(items))
+    results.sort(key=lambda result: result["index"])
+    succeeded = sum(1 for result in results if result["status_code"] == 200)
+    return jsonify({
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "elapsed_seconds": round(time.time() - started_at, 3),
+    }), 200 # Per-item status codes are in the results
+
+# --- Asynchronous Note Jobs ---
+
+def run_note_job(payload):
+    """
+    Job handler: the full /generate_note pipeline for a stored payload, on a job worker thread.
+    """
+    note_request, error = build_note_request(payload)
+    if error:
+        return error
+    return generate_note_response(note_request)
+
+def record_job_event(event, **details):
+    """
+    Metrics hook for JobRunner events.
+    """
+    if event == "started":
+        JOB_SECONDS.observe(details["queue_seconds"], phase="queue")
+    elif event == "finished":
+        JOB_EVENTS.inc(event=details["status"])
+        JOB_SECONDS.observe(details["run_seconds"], phase="run")
+    else:
+        JOB_EVENTS.inc(event=event)
+
+job_queue = None
+job_runner = None
+_job_start_lock = threading.Lock()
+
+def ensure_job_runner():
+    """
+    Opens the job queue and starts this process's job workers on first use. Called for every
+    request served, so a server picks up jobs left by dead processes as soon as it takes
+    traffic, while tools and benchmarks that only import this module pay nothing.
+    Returns the JobRunner, or None when async jobs are disabled.
+    """
+    global job_queue, job_runner
+    if not JOBS_ENABLED:
+        return None
+    if job_runner is None:
+        with _job_start_lock:
+            if job_runner is None:
+                queue = JobQueue(
+                    JOB_QUEUE_PATH,
+                    lease_seconds=JOB_LEASE_SECONDS,
+                    max_attempts=JOB_MAX_ATTEMPTS,
+                    retention_seconds=JOB_RETENTION_SECONDS,
+                    service_limits=JOB_SERVICE_LIMITS,
+                )
+                runner = JobRunner(queue, run_note_job, workers=JOB_WORKERS, on_event=record_job_event)
+                runner.start()
+                job_queue, job_runner = queue, runner
+    return job_runner
+
+@app.before_request
+def start_job_runner():
+    ensure_job_runner()
+
+def wants_async_job(data, query_value):
+    """
+    True when a /generate_note request asks for async mode (?async=1 or "async": true).
+    """
+    return JOBS_ENABLED and ((query_value or '').lower() in ('1', 'true', 'yes') or data.get('async') is True)
+
+def queue_note_job(data):
+    """
+    Queues a /generate_note payload. Returns (response_payload, status_code): 202 with the job
+    ID and where to poll it, or an error.
+    """
+    try:
+        priority = parse_priority(data.get('priority'))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    job_payload = {key: value for key, value in data.items() if key not in ('async', 'priority')}
+    service = str(data.get('service_abbreviation') or 'GENERAL').strip().upper()
+    ensure_job_runner() # The ASGI routes bypass Flask's before_request
+    try:
+        job_id = job_queue.submit(job_payload, priority=priority, service=service)
+    except Exception as e:
+        logger.error("Error queueing note job", error=str(e))
+        return {"error": "Failed to queue the note job.", "details": str(e)}, 500
+    JOB_EVENTS.inc(event="submitted")
+    job_runner.notify()
+    logger.info("Note job queued", job_id=job_id, service=service, priority=data.get('priority') or "routine")
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}, 202
+
+def submit_note_job(data):
+    response_payload, status_code = queue_note_job(data)
+    response = jsonify(response_payload)
+    if status_code == 202:
+        response.headers["Location"] = response_payload["status_url"]
+    return response, status_code
+
+@app.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+@instrument_route("/jobs/<job_id>")
+def handle_job(job_id):
+    """
+    GET: job status, and once finished its status_code and result (the /generate_note
+    response). ?wait=N long-polls up to N seconds (max ROSETTA_JOB_MAX_WAIT_SECONDS) for the
+    job to finish. DELETE: cancels a job that has not started yet (409 otherwise).
+    """
+    if job_queue is None:
+        return jsonify({"error": "Async jobs are disabled (set ROSETTA_JOBS=1)."}), 404
+    try:
+        if request.method == 'DELETE':
+            job_queue.cancel(job_id)
+            JOB_EVENTS.inc(event="cancelled")
+            return jsonify(job_queue.get(job_id)), 200
+        try:
+            wait_seconds = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT_SECONDS)
+        except ValueError:
+            return jsonify({"error": "'wait' must be a number of seconds."}), 400
+        job = job_runner.wait(job_id, wait_seconds) if wait_seconds > 0 else job_queue.get(job_id)
+        return jsonify(job), 200
+    except JobNotFound:
+        return jsonify({"error": "Job not found (unknown, or finished and expired)."}), 404
+    except JobStateError as e:
+        return jsonify({"error": str(e)}), 409
+
+@app.route('/jobs', methods=['GET'])
+@instrument_route("/jobs")
+def list_jobs():
+    """
+    Recent jobs, newest first, without results. Filters: status, limit (default 50).
+    """
+    if job_queue is None:
+        return jsonify({"error": "Async jobs are disabled (set ROSETTA_JOBS=1)."}), 404
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer."}), 400
+    return jsonify({
+        "jobs": job_queue.list_jobs(request.args.get('status') or None, limit),
+        "runner": job_runner.snapshot(),
+    }), 200
 
 def start_file_watcher():
     # This function is now correctly defined at the top level.
@@ -855,188 +2047,183 @@ def start_file_watcher():
     if not os.path.exists(INPUT_FILES_DIRECTORY):
         try:
             os.makedirs(INPUT_FILES_DIRECTORY)
-            print(f"Created input directory for watcher: {INPUT_FILES_DIRECTORY}")
+            logger.info("Created input directory for watcher", directory=INPUT_FILES_DIRECTORY)
         except OSError as e:
-            print(f"Error creating input directory {INPUT_FILES_DIRECTORY}: {e}. File watcher not started.")
+            logger.error("Error creating input directory; file watcher not started", directory=INPUT_FILES_DIRECTORY, error=str(e))
             return
     # Ensure output directory also exists or can be created by save_note_to_file
     if not os.path.exists(OUTPUT_NOTES_DIRECTORY):
         try:
             os.makedirs(OUTPUT_NOTES_DIRECTORY)
-            print(f"Created output directory: {OUTPUT_NOTES_DIRECTORY}")
+            logger.info("Created output directory", directory=OUTPUT_NOTES_DIRECTORY)
         except OSError as e:
-            print(f"Error creating output directory {OUTPUT_NOTES_DIRECTORY}: {e}. Note saving might fail.")
+            logger.error("Error creating output directory; note saving might fail", directory=OUTPUT_NOTES_DIRECTORY, error=str(e))
             # Continue starting watcher, but saving will attempt to create it again or fail.
 
     event_handler = NewFileHandler()
     observer = Observer()
     observer.schedule(event_handler, INPUT_FILES_DIRECTORY, recursive=False) # Watch the INPUT_FILES_DIRECTORY
     observer.start()
-    print(f"File watcher started on directory: {INPUT_FILES_DIRECTORY} (watching for new {INPUT_FILE_EXTENSION} files)")
+    logger.info("File watcher started", directory=INPUT_FILES_DIRECTORY, extension=INPUT_FILE_EXTENSION)
     try:
         while True:
             time.sleep(5) # Keep the thread alive
     except KeyboardInterrupt: # This won't be caught here if Flask is main thread
         observer.stop()
     except Exception as e:
-        print(f"File watcher error: {e}")
+        logger.error("File watcher error", error=str(e))
         observer.stop()
     observer.join()
 
 
 if __name__ == "__main__":
-    print(f"Starting Rosetta Flask server on http://127.0.0.1:5000")
-    print(f"Output notes will be saved in: {os.path.abspath(OUTPUT_NOTES_DIRECTORY)}")
+    logger.info("Starting Rosetta Flask server on http://127.0.0.1:5000", notes_directory=os.path.abspath(OUTPUT_NOTES_DIRECTORY))
     app.run(debug=True, host='0.0.0.0', port=5000) # Removed use_reloader=False as watchdog is removed
                                                # host='0.0.0.0' makes it accessible on your local network.
 
 
 # --- Google Cloud DLP De-identification Route ---
+def _local_deidentify(text):
+    try:
+        return local_deidentifier.deidentify(text), None
+    except Exception as e:
+        ERRORS.inc(stage="local_deid", type=type(e).__name__)
+        return None, str(e)
+
+def deidentify_texts_for_mode(texts, gcp_project_id, mode):
+    """
+    De-identifies `texts` with the given mode. Returns (deidentified_text, error) pairs in order.
+    """
+    if mode == DEID_MODE_DLP:
+        results = [(text, None) for text in texts]
+    else:
+        with STAGE_SECONDS.time(stage="local_deid"):
+            results = [_local_deidentify(text) for text in texts]
+        if mode == DEID_MODE_LOCAL:
+            return results
+    # Texts the local pre-pass failed on are not sent to DLP
+    pending = [index for index, (_, error) in enumerate(results) if error is None]
+    if pending:
+        with STAGE_SECONDS.time(stage="dlp"):
+            dlp_results = dlp_deidentifier.deidentify_texts([results[index][0] for index in pending], gcp_project_id)
+        for index, (deidentified_text, error) in zip(pending, dlp_results):
+            if error:
+                ERRORS.inc(stage="dlp", type="api_error")
+            results[index] = (deidentified_text, error)
+    return results
+
+def deid_error_message(mode):
+    # Names the mode, so a failure of the local engine isn't reported as a DLP outage
+    return f"De-identification failed (mode={mode})."
+
+def resolve_deid_request(data):
+    """
+    Returns (mode, gcp_project_id, None) for a de-identification payload, or
+    (None, None, (error_payload, status_code)). A project ID is only required when DLP is used.
+    """
+    try:
+        mode = normalize_deid_mode(data.get('deid_mode'), DEID_MODE)
+    except ValueError as e:
+        return None, None, ({"error": str(e)}, 400)
+    gcp_project_id = data.get('gcp_project_id') or os.environ.get("GCP_PROJECT_ID") # Fallback to env var
+    if mode != DEID_MODE_LOCAL and not gcp_project_id:
+        return None, None, ({"error": "gcp_project_id is missing in request and GCP_PROJECT_ID env var not set."}, 400)
+    return mode, gcp_project_id, None
+
 @app.route('/api/deidentify_text', methods=['POST'])
+@instrument_route("/api/deidentify_text")
 def deidentify_text_gcp_dlp():
     """
-    De-identifies text using Google Cloud DLP API.
+    De-identifies text using Google Cloud DLP API (or the local engine, see ROSETTA_DEID_MODE).
     Expects JSON: {"text_content": "...", "gcp_project_id": "your-gcp-project-id"}
-    Make sure GOOGLE_APPLICATION_CREDENTIALS environment variable is set.
+    Optional "deid_mode": "dlp", "local" or "local_then_dlp".
+    Make sure GOOGLE_APPLICATION_CREDENTIALS environment variable is set when DLP is used.
     """
-    print("DEBUG: /api/deidentify_text endpoint hit")
+    logger.debug("/api/deidentify_text endpoint hit")
     try:
         data = request.get_json()
         if not data:
             return jsonify({"error": "Invalid JSON or no data provided"}), 400
 
         text_to_deidentify = data.get('text_content')
-        gcp_project_id = data.get('gcp_project_id') # Or get from environment variable
 
         if not text_to_deidentify:
             # Return empty if input is empty, or handle as an error
             return jsonify({"deidentified_text": "", "status": "Input text was empty or missing."}), 200
-        if not gcp_project_id:
-            gcp_project_id = os.environ.get("GCP_PROJECT_ID") # Fallback to env var
-            if not gcp_project_id:
-                return jsonify({"error": "gcp_project_id is missing in request and GCP_PROJECT_ID env var not set."}), 400
-
-        print(f"DEBUG: Attempting de-identification for project: {gcp_project_id}")
-
-        dlp = dlp_v2.DlpServiceClient()
-
-        # Specify the GCloud project ID, and parent
-        parent = f"projects/{gcp_project_id}/locations/global" # Corrected to include /locations/global
-
-        # Specify what content you want the service to de-identify.
-        item = {"value": text_to_deidentify}
-
-        # Specify the types of info to redact.
-        # These are common PHI types. For a full list, see:
-        # https://cloud.google.com/dlp/docs/infotypes-reference
-        info_types = [
-            {"name": "PERSON_NAME"},
-            {"name": "DATE"}, # General dates
-            {"name": "DATE_OF_BIRTH"},
-            {"name": "AGE"},
-            {"name": "GENDER"},
-            {"name": "PHONE_NUMBER"},
-            {"name": "EMAIL_ADDRESS"},
-            {"name": "STREET_ADDRESS"},
-            {"name": "LOCATION"}, # Covers cities, states, countries, etc.
-            {"name": "MEDICAL_RECORD_NUMBER"},
-            {"name": "PASSPORT"},
-            {"name": "US_SOCIAL_SECURITY_NUMBER"}, # Corrected infoType
-            {"name": "IBAN_CODE"}, # Example financial
-            {"name": "CREDIT_CARD_NUMBER"},
-            {"name": "IP_ADDRESS"},
-            # Add more specific medical info types if needed and available
-            # For example, some specific conditions or identifiers might be custom or require careful selection
-            # For HIPAA, it's crucial to be comprehensive.
-            # Consider also GENERIC_ID if other IDs are present.
-        ]
-
-        # Specify the de-identification configuration.
-        # Replace with INFO_TYPE_DESCRIPTION or a fixed placeholder.
-        deidentify_config = {
-            "info_type_transformations": {
-                "transformations": [
-                    {
-                        "primitive_transformation": {
-                            "replace_with_info_type_config": {} # Replaces with the infoType name e.g. [PERSON_NAME]
-                        }
-                    }
-                ]
-            }
-        }
-        
-        # More advanced: Character masking
-        # deidentify_config = {
-        #     "info_type_transformations": {
-        #         "transformations": [
-        #             {
-        #                 "primitive_transformation": {
-        #                     "character_mask_config": {
-        #                         "masking_character": "#"
-        #                     }
-        #                 }
-        #             }
-        #         ]
-        #     }
-        # }
-
-
-        # Construct the InspectConfig
-        inspect_config = {"info_types": info_types}
-
-        # Call the API
+        mode, gcp_project_id, error = resolve_deid_request(data)
+        if error:
+            error_payload, status_code = error
+            return jsonify(error_payload), status_code
+
+        logger.debug("Attempting de-identification", mode=mode, project=gcp_project_id)
+
+        # Call the API (pooled client; long inputs are chunked and sent in parallel)
         try:
-            # Prepare the request dictionary
-            request_dict = {
-                "parent": parent,
-                "deidentify_config": deidentify_config,
-                "inspect_config": inspect_config,
-                "item": item,
-                # Explicitly set location_id, though parent also contains it.
-                # This can sometimes help with regional routing or detector availability.
-                "location_id": "global" 
-            }
-            response = dlp.deidentify_content(request=request_dict)
-            deidentified_text = response.item.value
-            print("DEBUG: DLP API call successful.")
-            return jsonify({"deidentified_text": deidentified_text, "status": "De-identification successful."}), 200
+            deidentified_text, dlp_error = deidentify_texts_for_mode([text_to_deidentify], gcp_project_id, mode)[0]
+            if dlp_error:
+                raise RuntimeError(dlp_error)
+            logger.debug("De-identification successful.")
+            return jsonify({"deidentified_text": deidentified_text, "status": "De-identification successful.", "deid_mode": mode}), 200
         except Exception as e:
-            print(f"ERROR: Google Cloud DLP API call failed: {e}")
+            logger.error("De-identification failed", mode=mode, error=str(e))
             # Consider logging more details from the exception if it's a Google API error
-            return jsonify({"error": "DLP API call failed.", "details": str(e)}), 500
+            return jsonify({"error": deid_error_message(mode), "details": str(e)}), 500
+
+    except Exception as e:
+        logger.error("Exception in /api/deidentify_text", error=str(e))
+        return jsonify({"error": "An unexpected error occurred during de-identification.", "details": str(e)}), 500
 
+@app.route('/api/deidentify_texts', methods=['POST'])
+@instrument_route("/api/deidentify_texts")
+def deidentify_texts_gcp_dlp():
+    """
+    Batch form of /api/deidentify_text.
+    Expects JSON: {"texts": ["...", ...], "gcp_project_id": "your-gcp-project-id"} (optional "deid_mode")
+    Returns {"results": [{"deidentified_text": "..."} or {"error": "..."}, ...]} in input order.
+    Small texts share DLP calls and large ones are chunked, all de-identified concurrently.
+    """
+    try:
+        data = request.get_json()
     except Exception as e:
-        print(f"ERROR: Exception in /api/deidentify_text: {e}")
+        return jsonify({"error": f"Error processing request JSON: {str(e)}"}), 400
+    texts = data.get('texts') if isinstance(data, dict) else None
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "Expected a 'texts' list of strings."}), 400
+    if len(texts) > DLP_BATCH_MAX_TEXTS:
+        return jsonify({"error": f"Too many texts in batch ({len(texts)} > {DLP_BATCH_MAX_TEXTS})."}), 400
+    mode, gcp_project_id, error = resolve_deid_request(data)
+    if error:
+        error_payload, status_code = error
+        return jsonify(error_payload), status_code
+
+    try:
+        results = []
+        for deidentified_text, error in deidentify_texts_for_mode(texts, gcp_project_id, mode):
+            results.append({"error": deid_error_message(mode), "details": error} if error else {"deidentified_text": deidentified_text})
+        failed = sum(1 for result in results if "error" in result)
+        return jsonify({"results": results, "succeeded": len(results) - failed, "failed": failed, "deid_mode": mode}), 200
+    except Exception as e:
+        logger.error("Exception in /api/deidentify_texts", error=str(e))
         return jsonify({"error": "An unexpected error occurred during de-identification.", "details": str(e)}), 500
 
 @app.route('/api/delete_all_notes', methods=['POST']) # Changed to POST for safety
 def delete_all_notes():
     """
-    Deletes all .txt files in the OUTPUT_NOTES_DIRECTORY.
+    Deletes all saved notes from the note store.
     Requires a confirmation parameter in the request.
     """
-    print("DEBUG: /api/delete_all_notes endpoint hit")
+    logger.debug("/api/delete_all_notes endpoint hit")
     try:
         data = request.get_json()
         if not data or data.get("confirm") != True: # Require explicit confirmation
             return jsonify({"error": "Deletion not confirmed."}), 400
 
-        if not os.path.exists(OUTPUT_NOTES_DIRECTORY):
-            print(f"Info: Output directory {OUTPUT_NOTES_DIRECTORY} not found. Nothing to delete.")
+        if note_store.kind == STORE_FILES and not os.path.exists(OUTPUT_NOTES_DIRECTORY):
+            logger.info("Output directory not found. Nothing to delete.", directory=OUTPUT_NOTES_DIRECTORY)
             return jsonify({"message": "Notes directory not found, nothing to delete."}), 200 # Or 404 if preferred
 
-        deleted_count = 0
-        errors = []
-        for filename in os.listdir(OUTPUT_NOTES_DIRECTORY):
-            if filename.endswith(".txt"):
-                filepath = os.path.join(OUTPUT_NOTES_DIRECTORY, filename)
-                try:
-                    os.remove(filepath)
-                    deleted_count += 1
-                    print(f"Deleted: {filepath}")
-                except Exception as e:
-                    print(f"Error deleting file {filepath}: {e}")
-                    errors.append(f"Could not delete {filename}: {str(e)}")
+        deleted_count, errors = note_store.delete_all() # Includes notes in YYYYMM shards
+        logger.info("Deleted all notes", count=deleted_count, store=note_store.kind)
         
         if errors:
             return jsonify({
@@ -1047,5 +2234,5 @@ def delete_all_notes():
         return jsonify({"message": f"Successfully deleted {deleted_count} notes."}), 200
 
     except Exception as e:
-        print(f"ERROR: Exception in /api/delete_all_notes: {e}")
+        logger.error("Exception in /api/delete_all_notes", error=str(e))
         return jsonify({"error": "An unexpected error occurred during deletion.", "details": str(e)}), 500
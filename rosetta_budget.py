@@ -0,0 +1,190 @@
+import re
+
+from rosetta_logging import get_logger
+from rosetta_prompts import canonical_option_key, estimate_tokens
+
+logger = get_logger(__name__)
+
+# --- Prompt token budgeting ---
+# Before a prompt goes to Gemini its variable sections (pasted patient input, existing note) are
+# counted against a token budget. When the assembled prompt is over budget, compaction policies
+# run in the configured order until it fits:
+#   dedupe_blocks       repeated paragraphs of the patient input (re-pasted lab/vitals blocks)
+#                       are replaced by a short marker
+#   drop_boilerplate    chart boilerplate lines (page footers, "Electronically signed by",
+#                       lab performing-site lines, separator rules) are removed from the input
+#   truncate_input      last resort: the middle of the patient input is cut out
+# Templates, the options section and the existing note are never compacted: every mode that
+# sends the existing note saves the model's rewrite in its place, so anything cut from it would
+# be gone from the stored note. max_output_tokens is picked per option profile (an A&P-only
+# or VSHN note needs far less than a full H&P), but never below what rewriting the existing
+# note needs.
+
+DEFAULT_POLICIES = ("dedupe_blocks", "drop_boilerplate", "truncate_input")
+# Output cap per enabled option; with several, the smallest applies
+DEFAULT_OUTPUT_TOKEN_PROFILES = {"genAandPOnly": 4096, "genVSHN": 6144}
+# Options whose output is one section, so it does not grow with the existing note
+SECTION_ONLY_OPTIONS = frozenset({"genAandPOnly"})
+# Headroom on top of the existing note when a note is rewritten (model thoughts, new content)
+REWRITE_HEADROOM_TOKENS = 2048
+
+# Paragraphs shorter than this are left alone by dedupe_blocks ("Plan:", "Denies.")
+MIN_DEDUPE_BLOCK_CHARS = 60
+DUPLICATE_BLOCK_MARKER = "[Repeated block omitted]"
+TRUNCATED_INPUT_MARKER = "\n[... {} characters of input omitted to fit the prompt budget ...]\n"
+
+_BOILERPLATE_PATTERNS = [
+    r"page \d+( of \d+)?",
+    r"(printed|generated|exported) (on|by|at)\b.*",
+    r".*\belectronically signed by\b.*",
+    r"(result status|resulting agency|performing (lab|site|location|organization)|lab (location|address)|specimen collected by|ordering (provider|physician)|authorizing provider)\s*:.*",
+    r"(confidentiality notice|disclaimer)\b.*",
+    r"this (document|report|message) (is|was|may|contains)\b.*",
+    r"[-=_*~#]{5,}",
+]
+BOILERPLATE_PATTERN = re.compile(r"^\s*(?:" + "|".join(_BOILERPLATE_PATTERNS) + r")\s*$", re.IGNORECASE)
+_BLANK_RUN_PATTERN = re.compile(r"\n[ \t]*\n(?:[ \t]*\n)+")
+_PARAGRAPH_SPLIT_PATTERN = re.compile(r"\n[ \t]*\n")
+
+
+def parse_output_profiles(spec):
+    """
+    Parses "genAandPOnly=4096,genVSHN=6144" into a dict; malformed entries are skipped.
+    """
+    profiles = {}
+    for entry in (spec or "").split(","):
+        option, _, value = entry.partition("=")
+        try:
+            profiles[option.strip()] = int(value)
+        except ValueError:
+            if entry.strip():
+                logger.warning("Ignoring malformed output token profile", entry=entry.strip())
+    return profiles
+
+
+# --- Compaction policies ---
+# Each takes (text, excess_tokens, token_counter) and returns the compacted text. The first two
+# remove redundancy wholesale; the last two only remove about as much as the budget requires.
+
+def dedupe_blocks(text, excess_tokens=None, token_counter=estimate_tokens):
+    seen = set()
+    blocks = []
+    for block in _PARAGRAPH_SPLIT_PATTERN.split(text):
+        normalized = " ".join(block.split()).lower()
+        if len(normalized) >= MIN_DEDUPE_BLOCK_CHARS:
+            if normalized in seen:
+                if not blocks or blocks[-1] != DUPLICATE_BLOCK_MARKER:
+                    blocks.append(DUPLICATE_BLOCK_MARKER)
+                continue
+            seen.add(normalized)
+        blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+def drop_boilerplate(text, excess_tokens=None, token_counter=estimate_tokens):
+    kept = [line for line in text.split("\n") if not BOILERPLATE_PATTERN.match(line)]
+    return _BLANK_RUN_PATTERN.sub("\n\n", "\n".join(kept))
+
+
+def truncate_middle(text, excess_tokens, token_counter=estimate_tokens):
+    """
+    Keeps the head (two thirds) and tail (one third) of `text`, cut at line boundaries,
+    dropping about `excess_tokens` from the middle.
+    """
+    tokens = token_counter(text)
+    if not tokens or excess_tokens <= 0:
+        return text
+    excess_tokens += token_counter(TRUNCATED_INPUT_MARKER.format(len(text))) # The marker counts too
+    keep_chars = max(0, int(len(text) * (tokens - excess_tokens) / tokens))
+    if keep_chars >= len(text):
+        return text
+    head_end = text.rfind("\n", 0, keep_chars * 2 // 3)
+    head_end = head_end if head_end > 0 else keep_chars * 2 // 3
+    tail_start = text.find("\n", len(text) - keep_chars // 3)
+    tail_start = tail_start if tail_start != -1 else len(text) - keep_chars // 3
+    if tail_start <= head_end:
+        return text
+    return text[:head_end] + TRUNCATED_INPUT_MARKER.format(tail_start - head_end) + text[tail_start:]
+
+
+# Policy name -> (prompt section it compacts, function)
+COMPACTION_POLICIES = {
+    "dedupe_blocks": ("patient_input", dedupe_blocks),
+    "drop_boilerplate": ("patient_input", drop_boilerplate),
+    "truncate_input": ("patient_input", truncate_middle),
+}
+
+
+class PromptBudgeter:
+    """
+    Fits the variable sections of a prompt into `prompt_token_budget` (0 disables compaction)
+    and picks max_output_tokens. `token_counter` defaults to the ~4 chars/token estimate.
+    """
+
+    def __init__(self, prompt_token_budget, policies=DEFAULT_POLICIES, default_max_output_tokens=8192,
+                 output_token_profiles=None, token_counter=estimate_tokens):
+        self.prompt_token_budget = prompt_token_budget
+        self.policies = []
+        for name in policies:
+            if name in COMPACTION_POLICIES:
+                self.policies.append(name)
+            elif name:
+                logger.warning("Ignoring unknown prompt compaction policy", policy=name)
+        self.default_max_output_tokens = default_max_output_tokens
+        self.output_token_profiles = DEFAULT_OUTPUT_TOKEN_PROFILES if output_token_profiles is None else output_token_profiles
+        self.token_counter = token_counter
+
+    def max_output_tokens(self, options, rewrite_text=None):
+        """
+        Returns (max_output_tokens, profile). The profile is the option whose cap applied, or
+        "default". When `rewrite_text` (existing note or sections being rewritten) is given, the
+        cap is raised to fit it unless the output is a single section.
+        """
+        enabled = canonical_option_key(options)
+        limit, profile = self.default_max_output_tokens, "default"
+        for option, option_limit in self.output_token_profiles.items():
+            if option in enabled and option_limit < limit:
+                limit, profile = option_limit, option
+        if rewrite_text and not (enabled & SECTION_ONLY_OPTIONS):
+            needed = min(self.default_max_output_tokens, self.token_counter(rewrite_text) + REWRITE_HEADROOM_TOKENS)
+            if needed > limit:
+                limit, profile = needed, f"{profile}+rewrite"
+        return limit, profile
+
+    def fit(self, sections, assemble):
+        """
+        `sections` maps section names ("patient_input", "existing_note", "template", ...) to their
+        text; `assemble(sections)` builds the full prompt from them. Returns (sections, report),
+        with compaction policies applied in order while the prompt is over budget.
+        """
+        sections = dict(sections)
+        total = self.token_counter(assemble(sections))
+        report = {
+            "prompt_token_budget": self.prompt_token_budget,
+            "prompt_tokens_before": total,
+            "compactions": [],
+        }
+        for name in self.policies:
+            if not self.prompt_token_budget or total <= self.prompt_token_budget:
+                break
+            section, policy = COMPACTION_POLICIES[name]
+            text = sections.get(section)
+            if not text:
+                continue
+            compacted = policy(text, total - self.prompt_token_budget, self.token_counter)
+            if compacted == text:
+                continue
+            new_total = self.token_counter(assemble(dict(sections, **{section: compacted})))
+            if new_total >= total:
+                continue # Nothing left to gain (e.g. a tiny input would only gain a marker)
+            sections[section] = compacted
+            report["compactions"].append({"policy": name, "section": section, "tokens_saved": total - new_total})
+            total = new_total
+
+        report["prompt_tokens"] = total
+        report["within_budget"] = not self.prompt_token_budget or total <= self.prompt_token_budget
+        report["section_tokens"] = {name: self.token_counter(text) for name, text in sections.items() if text}
+        if report["compactions"]:
+            logger.info("Prompt compacted to fit the token budget", before=report["prompt_tokens_before"], after=total,
+                        budget=self.prompt_token_budget, policies=",".join(entry["policy"] for entry in report["compactions"]))
+        return sections, report
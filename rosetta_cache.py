@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- LLM response cache ---
+# Content-addressed: the key is a hash of the final prompt, model name and generation
+# config, so only byte-identical requests share an entry. Entries live in a bounded
+# in-memory LRU with a TTL, optionally backed by one JSON file per entry on disk.
+
+
+def make_cache_key(full_prompt, model_name, generation_config):
+    """
+    Returns the hex SHA-256 of (model, generation config, prompt).
+    `generation_config` may be any object; it is keyed by its sorted dict form when possible.
+    """
+    if hasattr(generation_config, "__dict__"):
+        config_repr = json.dumps(vars(generation_config), sort_keys=True, default=str)
+    elif isinstance(generation_config, dict):
+        config_repr = json.dumps(generation_config, sort_keys=True, default=str)
+    else:
+        config_repr = repr(generation_config)
+
+    hasher = hashlib.sha256()
+    for part in (model_name, config_repr, full_prompt):
+        encoded = part.encode("utf-8")
+        hasher.update(len(encoded).to_bytes(8, "big")) # Length-prefixed so parts can't run together
+        hasher.update(encoded)
+    return hasher.hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU + TTL cache for (text_output, feedback_str) results.
+    If `disk_directory` is set, entries are also written there and consulted on a memory miss,
+    so they survive restarts and are shared between gunicorn workers.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=3600, disk_directory=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_directory = disk_directory
+        self._entries = OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "bypassed": 0}
+
+        if self.disk_directory and not os.path.exists(self.disk_directory):
+            try:
+                os.makedirs(self.disk_directory)
+                logger.info("Created response cache directory", directory=self.disk_directory)
+            except OSError as e:
+                logger.error("Error creating response cache directory; disk tier disabled", directory=self.disk_directory, error=str(e))
+                self.disk_directory = None
+
+    def _is_fresh(self, stored_at):
+        return self.ttl_seconds <= 0 or (time.time() - stored_at) < self.ttl_seconds
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_directory, f"{key}.json")
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if self._is_fresh(stored_at):
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self.stats["expired"] += 1
+
+        value = self._get_from_disk(key)
+        with self._lock:
+            if value is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._store_in_memory(key, value[0], value[1])
+            return value[1]
+
+    def _get_from_disk(self, key):
+        if not self.disk_directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error("Error reading response cache entry", path=path, error=str(e))
+            return None
+        if not self._is_fresh(record["stored_at"]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return record["stored_at"], tuple(record["value"])
+
+    def _store_in_memory(self, key, stored_at, value):
+        # Caller holds the lock
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def set(self, key, value):
+        stored_at = time.time()
+        with self._lock:
+            self._store_in_memory(key, stored_at, value)
+            self.stats["stores"] += 1
+
+        if self.disk_directory:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"stored_at": stored_at, "value": list(value)}, f)
+                os.replace(tmp_path, path) # Atomic, so other workers never read a partial entry
+            except Exception as e:
+                logger.error("Error writing response cache entry", path=path, error=str(e))
+
+    def record_bypass(self):
+        with self._lock:
+            self.stats["bypassed"] += 1
+
+    def snapshot(self):
+        """
+        Counters plus current size, for the /api/cache_stats endpoint.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["ttl_seconds"] = self.ttl_seconds
+        stats["disk_tier"] = bool(self.disk_directory)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.disk_directory and os.path.isdir(self.disk_directory):
+            for filename in os.listdir(self.disk_directory):
+                if filename.endswith(".json"):
+                    try:
+                        os.remove(os.path.join(self.disk_directory, filename))
+                    except OSError as e:
+                        logger.error("Error removing response cache entry", filename=filename, error=str(e))
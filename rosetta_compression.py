@@ -0,0 +1,146 @@
+import gzip
+
+from rosetta_logging import get_logger
+
+try:
+    import brotli # Optional: "br" is offered only when the brotli package is installed
+except ImportError:
+    brotli = None
+
+logger = get_logger(__name__)
+
+# --- Response compression ---
+# Text and JSON responses of at least `min_bytes` are compressed for clients that accept it
+# (Accept-Encoding): brotli when available, else gzip. /generate_note answers (note + thoughts)
+# and long notes shrink 3-6x. Streams (SSE), files sent by send_from_directory, byte ranges
+# and responses that are already encoded are left alone.
+#
+# A strong ETag names one representation, so a compressed response gets "<etag>-gzip" (or -br),
+# like Apache's mod_deflate. strip_encoding_suffix() maps it back for If-None-Match checks.
+
+ENCODING_BROTLI = "br"
+ENCODING_GZIP = "gzip"
+# Preference order when the client accepts several equally
+AVAILABLE_ENCODINGS = ((ENCODING_BROTLI,) if brotli is not None else ()) + (ENCODING_GZIP,)
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def parse_accept_encoding(header):
+    """
+    {"gzip": 1.0, "br": 0.5, "*": 0.0, ...} from an Accept-Encoding header.
+    """
+    weights = {}
+    for part in (header or "").split(","):
+        coding, _, parameters = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        parameter = parameters.strip()
+        if parameter.startswith("q="):
+            try:
+                weight = float(parameter[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding] = weight
+    return weights
+
+
+def negotiate_encoding(accept_encoding, available=AVAILABLE_ENCODINGS):
+    """
+    The best of `available` for an Accept-Encoding header, or None for identity.
+    """
+    weights = parse_accept_encoding(accept_encoding)
+    best, best_weight = None, 0.0
+    for encoding in available:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def encoded_etag(etag, encoding):
+    return f"{etag}-{encoding}"
+
+
+def strip_encoding_suffix(etag):
+    for encoding in (ENCODING_BROTLI, ENCODING_GZIP):
+        suffix = f"-{encoding}"
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def is_compressible(content_type):
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class ResponseCompressor:
+    """
+    Picks an encoding per response and compresses the body. apply() works on a Flask/Werkzeug
+    response (after_request); compress_body() on raw bytes (the ASGI routes).
+    on_compress(encoding, original_bytes, sent_bytes) is called for every compressed response.
+    """
+
+    def __init__(self, min_bytes=1024, gzip_level=6, brotli_quality=5, on_compress=None):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.on_compress = on_compress
+
+    def compress(self, data, encoding):
+        if encoding == ENCODING_BROTLI:
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0) # mtime=0: same input, same bytes
+
+    def _record(self, encoding, original_bytes, sent_bytes):
+        if self.on_compress is not None:
+            try:
+                self.on_compress(encoding, original_bytes, sent_bytes)
+            except Exception as e:
+                logger.warning("Compression metrics hook failed", error=str(e))
+
+    def compress_body(self, body, content_type, accept_encoding):
+        """
+        Returns (body, encoding); encoding is None when the body is sent as is.
+        """
+        if len(body) < self.min_bytes or not is_compressible(content_type):
+            return body, None
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            return body, None
+        compressed = self.compress(body, encoding)
+        if len(compressed) >= len(body):
+            return body, None
+        self._record(encoding, len(body), len(compressed))
+        return compressed, encoding
+
+    def apply(self, response, accept_encoding):
+        """
+        Compresses a buffered 2xx response in place when worthwhile. Returns the response.
+        """
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code >= 300
+            or response.status_code in (204, 206)
+            or "Content-Encoding" in response.headers
+            or "Content-Range" in response.headers
+            or not is_compressible(response.content_type)
+        ):
+            return response
+        body = response.get_data()
+        if len(body) < self.min_bytes:
+            return response
+        response.vary.add("Accept-Encoding") # Caches must not hand a gzip body to an identity client
+        body, encoding = self.compress_body(body, response.content_type, accept_encoding)
+        if encoding is None:
+            return response
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(encoded_etag(etag, encoding))
+        return response
@@ -0,0 +1,179 @@
+import hashlib
+import re
+from collections import deque
+
+# --- Repeated-phrase condensation and repetition-loop detection ---
+# Replaces the old "split on '. ', count, then str.replace once per repeated phrase" step in
+# get_llm_response. Everything here is a single pass over the text: phrases are counted as they
+# complete, and the condensed output is rebuilt once at the end. The same object can be fed a
+# streamed response chunk by chunk, which lets callers stop a degenerate generation early.
+
+PHRASE_DELIMITER = ". "
+# Phrases seen more than this many times are wrapped as [REPEATED PHRASE: ...] (same as before)
+REPEAT_THRESHOLD = 5
+
+# Units used for loop detection: sentences or lines
+_LOOP_UNIT_BOUNDARY = re.compile(r"\.\s|\n")
+
+
+def _phrase_key(phrase, max_phrase_chars):
+    # Long phrases are tracked by digest so the counting table stays small
+    if len(phrase) <= max_phrase_chars:
+        return phrase
+    return hashlib.blake2b(phrase.encode("utf-8"), digest_size=16).digest()
+
+
+class RepetitionCondenser:
+    """
+    Single-pass condenser for LLM output.
+
+    feed(chunk) consumes text incrementally and returns True once a repetition loop is detected
+    (the last `loop_min_repeats` units form the same block of 1..`loop_max_period` units, or one
+    phrase has been produced `loop_max_total_repeats` times). finish() returns the full text with
+    phrases seen more than `repeat_threshold` times wrapped as "[REPEATED PHRASE: ...]".
+
+    Memory for bookkeeping is bounded: at most `max_tracked_phrases` distinct phrases are counted,
+    phrases longer than `max_phrase_chars` are keyed by digest, and loop detection only keeps a
+    few recent units and a run counter per period. With `detect_loops=False` only the
+    condensation bookkeeping is done.
+    """
+
+    def __init__(self, repeat_threshold=REPEAT_THRESHOLD, max_tracked_phrases=4096, max_phrase_chars=256,
+                 loop_min_repeats=8, loop_max_period=6, loop_max_total_repeats=40, detect_loops=True):
+        self.repeat_threshold = repeat_threshold
+        self.max_tracked_phrases = max_tracked_phrases
+        self.max_phrase_chars = max_phrase_chars
+        self.loop_min_repeats = loop_min_repeats
+        self.loop_max_period = loop_max_period
+        self.loop_max_total_repeats = loop_max_total_repeats
+        self.detect_loops = detect_loops
+
+        self._segments = []       # completed ". "-delimited segments, in order
+        self._pending_parts = []  # chunks after the last ". " seen so far (joined lazily)
+        self._pending_last_char = ""
+        self._phrase_counts = {}  # phrase key -> count
+        self._any_repeated = False
+        self._loop_pending = ""
+        self._recent_units = deque(maxlen=loop_max_period + 1)
+        self._period_runs = [0] * (loop_max_period + 1)
+        self.loop_detected = False
+        self.loop_reason = ""
+        self.chars_consumed = 0
+
+    # --- Counting ---
+
+    def _count_phrase(self, segment):
+        phrase = segment.strip()
+        if not phrase:
+            return
+        key = _phrase_key(phrase, self.max_phrase_chars)
+        count = self._phrase_counts.get(key)
+        if count is None:
+            if len(self._phrase_counts) >= self.max_tracked_phrases:
+                return # Table full; untracked phrases are simply never condensed
+            count = 0
+        count += 1
+        self._phrase_counts[key] = count
+        if count > self.repeat_threshold:
+            self._any_repeated = True
+        if self.detect_loops and count >= self.loop_max_total_repeats and not self.loop_detected:
+            self.loop_detected = True
+            self.loop_reason = f"phrase repeated {count} times: {phrase[:80]!r}"
+
+    # --- Loop detection ---
+
+    def _check_loop(self):
+        # For each period p, _period_runs[p] counts how many consecutive recent units equal the
+        # unit p positions earlier. A run of p * (loop_min_repeats - 1) means the last block of
+        # p units has repeated loop_min_repeats times. O(loop_max_period) per unit.
+        units = self._recent_units
+        newest = units[-1]
+        for period in range(1, self.loop_max_period + 1):
+            if len(units) > period and units[-1 - period] == newest:
+                self._period_runs[period] += 1
+                if self._period_runs[period] >= period * (self.loop_min_repeats - 1):
+                    self.loop_detected = True
+                    self.loop_reason = f"block of {period} unit(s) repeated {self.loop_min_repeats}+ times"
+                    return
+            else:
+                self._period_runs[period] = 0
+
+    def _add_loop_unit(self, unit):
+        unit = unit.strip()
+        if not unit:
+            return
+        self._recent_units.append(_phrase_key(unit, self.max_phrase_chars))
+        if not self.loop_detected:
+            self._check_loop()
+
+    # --- Public API ---
+
+    def feed(self, chunk):
+        """
+        Consumes the next piece of text. Returns True if a repetition loop has been detected.
+        """
+        if not chunk:
+            return self.loop_detected
+        self.chars_consumed += len(chunk)
+
+        # Phrase segmentation (". ") for condensation. The pending text is only joined when a
+        # delimiter actually arrives, so long delimiter-free runs don't get re-copied per chunk.
+        if PHRASE_DELIMITER not in self._pending_last_char + chunk:
+            self._pending_parts.append(chunk)
+            self._pending_last_char = chunk[-1]
+        else:
+            parts = ("".join(self._pending_parts) + chunk).split(PHRASE_DELIMITER)
+            pending = parts.pop() # Last part may still be growing
+            self._pending_parts = [pending] if pending else []
+            self._pending_last_char = pending[-1:]
+            for segment in parts:
+                self._segments.append(segment)
+                self._count_phrase(segment)
+
+        if not self.detect_loops:
+            return False
+
+        # Unit segmentation (sentences and lines) for loop detection
+        loop_text = self._loop_pending + chunk
+        last_end = 0
+        for match in _LOOP_UNIT_BOUNDARY.finditer(loop_text):
+            self._add_loop_unit(loop_text[last_end:match.start()])
+            last_end = match.end()
+        self._loop_pending = loop_text[last_end:]
+        if len(self._loop_pending) > 4 * self.max_phrase_chars:
+            # Unbounded run without a boundary; treat it as a unit so memory stays bounded
+            self._add_loop_unit(self._loop_pending)
+            self._loop_pending = ""
+
+        return self.loop_detected
+
+    def finish(self):
+        """
+        Returns the condensed text for everything fed. Call once, after the last feed().
+        """
+        pending = "".join(self._pending_parts)
+        self._count_phrase(pending)
+        segments = self._segments + [pending]
+        if not self._any_repeated:
+            return PHRASE_DELIMITER.join(segments)
+
+        out = []
+        for segment in segments:
+            phrase = segment.strip()
+            if phrase and self._phrase_counts.get(_phrase_key(phrase, self.max_phrase_chars), 0) > self.repeat_threshold:
+                # Keep the surrounding whitespace, wrap only the phrase itself
+                lead = segment[:len(segment) - len(segment.lstrip())]
+                trail = segment[len(segment.rstrip()):]
+                segment = f"{lead}[REPEATED PHRASE: {phrase}]{trail}"
+            out.append(segment)
+        return PHRASE_DELIMITER.join(out)
+
+
+def condense_repeated_phrases(text_output):
+    """
+    One-shot condensation of a complete LLM output (linear time). Loop detection is skipped
+    since the text is already complete.
+    """
+    condenser = RepetitionCondenser(detect_loops=False)
+    condenser.feed(text_output)
+    return condenser.finish()
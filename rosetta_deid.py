@@ -0,0 +1,315 @@
+import itertools
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import dlp_v2
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- Google Cloud DLP de-identification ---
+# One pooled DLP client per process, request configs built once at import, and large inputs
+# split on paragraph/line/sentence boundaries into size-bounded chunks that are de-identified
+# concurrently and stitched back together in order. Chunks from several texts (batch requests)
+# are packed into DLP table items so many small texts share one API call.
+
+# Specify the types of info to redact.
+# These are common PHI types. For a full list, see:
+# https://cloud.google.com/dlp/docs/infotypes-reference
+DLP_INFO_TYPES = [
+    {"name": "PERSON_NAME"},
+    {"name": "DATE"}, # General dates
+    {"name": "DATE_OF_BIRTH"},
+    {"name": "AGE"},
+    {"name": "GENDER"},
+    {"name": "PHONE_NUMBER"},
+    {"name": "EMAIL_ADDRESS"},
+    {"name": "STREET_ADDRESS"},
+    {"name": "LOCATION"}, # Covers cities, states, countries, etc.
+    {"name": "MEDICAL_RECORD_NUMBER"},
+    {"name": "PASSPORT"},
+    {"name": "US_SOCIAL_SECURITY_NUMBER"}, # Corrected infoType
+    {"name": "IBAN_CODE"}, # Example financial
+    {"name": "CREDIT_CARD_NUMBER"},
+    {"name": "IP_ADDRESS"},
+    # Add more specific medical info types if needed and available
+    # For example, some specific conditions or identifiers might be custom or require careful selection
+    # For HIPAA, it's crucial to be comprehensive.
+    # Consider also GENERIC_ID if other IDs are present.
+]
+
+DLP_INSPECT_CONFIG = {"info_types": DLP_INFO_TYPES}
+
+# Replace with INFO_TYPE_DESCRIPTION or a fixed placeholder.
+DLP_DEIDENTIFY_CONFIG = {
+    "info_type_transformations": {
+        "transformations": [
+            {
+                "primitive_transformation": {
+                    "replace_with_info_type_config": {} # Replaces with the infoType name e.g. [PERSON_NAME]
+                }
+            }
+        ]
+    }
+}
+
+# More advanced: Character masking
+# DLP_DEIDENTIFY_CONFIG = {
+#     "info_type_transformations": {
+#         "transformations": [
+#             {
+#                 "primitive_transformation": {
+#                     "character_mask_config": {
+#                         "masking_character": "#"
+#                     }
+#                 }
+#             }
+#         ]
+#     }
+# }
+
+# DLP accepts up to 0.5 MB per request; staying well below that keeps each call fast
+DEFAULT_CHUNK_CHARS = 20000
+TABLE_COLUMN_NAME = "text"
+
+# Preferred split points, strongest first. Splitting at a paragraph or line break keeps
+# "Name: John Smith"-style context together, so detection matches the unsplit text.
+_SPLIT_PATTERNS = [re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r"[.!?]\s"), re.compile(r"\s")]
+
+
+def _deidentify_request(item, gcp_project_id):
+    return {
+        "parent": f"projects/{gcp_project_id}/locations/global", # Corrected to include /locations/global
+        "deidentify_config": DLP_DEIDENTIFY_CONFIG,
+        "inspect_config": DLP_INSPECT_CONFIG,
+        "item": item,
+        # Explicitly set location_id, though parent also contains it.
+        # This can sometimes help with regional routing or detector availability.
+        "location_id": "global",
+    }
+
+
+def build_deidentify_request(text_to_deidentify, gcp_project_id):
+    """
+    Builds the DLP deidentify_content request dict for one piece of text.
+    """
+    return _deidentify_request({"value": text_to_deidentify}, gcp_project_id)
+
+
+def build_table_deidentify_request(texts, gcp_project_id):
+    """
+    Builds one deidentify_content request carrying `texts` as the rows of a one-column table.
+    infoType transformations apply to every cell, so each row is de-identified independently.
+    """
+    table = {
+        "headers": [{"name": TABLE_COLUMN_NAME}],
+        "rows": [{"values": [{"string_value": text}]} for text in texts],
+    }
+    return _deidentify_request({"table": table}, gcp_project_id)
+
+
+def read_deidentify_response(response, expected_count):
+    """
+    Returns the de-identified strings from a deidentify_content response, in request order.
+    """
+    if expected_count == 1 and not response.item.table.rows:
+        return [response.item.value]
+    values = [row.values[0].string_value for row in response.item.table.rows]
+    if len(values) != expected_count:
+        raise ValueError(f"DLP returned {len(values)} rows, expected {expected_count}.")
+    return values
+
+
+def split_text_for_dlp(text, max_chunk_chars=DEFAULT_CHUNK_CHARS):
+    """
+    Splits `text` into chunks of at most `max_chunk_chars` whose concatenation is exactly `text`.
+    Each cut is made at the last paragraph break, line break, sentence end or whitespace inside
+    the window (in that order of preference); only a run with no whitespace at all is hard-cut.
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > max_chunk_chars:
+        window_end = start + max_chunk_chars
+        cut = None
+        for pattern in _SPLIT_PATTERNS:
+            # Only accept split points in the back half so chunks don't become tiny
+            for match in pattern.finditer(text, start + max_chunk_chars // 2, window_end):
+                cut = match.end()
+            if cut is not None:
+                break
+        if cut is None or cut <= start:
+            cut = window_end
+        chunks.append(text[start:cut])
+        start = cut
+    chunks.append(text[start:])
+    return chunks
+
+
+def plan_dlp_requests(texts, max_chunk_chars=DEFAULT_CHUNK_CHARS, max_request_chars=DEFAULT_CHUNK_CHARS):
+    """
+    Splits every text into chunks and groups the chunks into requests of at most
+    `max_request_chars` characters. Returns (chunk_owners, requests): chunk_owners[i] is the
+    index of the text chunk i belongs to, and each request is a list of (chunk_id, chunk_text).
+    Empty texts produce no chunks.
+    """
+    chunk_owners = []
+    requests = []
+    current = []
+    current_chars = 0
+    for text_index, text in enumerate(texts):
+        if not text:
+            continue
+        for chunk in split_text_for_dlp(text, max_chunk_chars):
+            if current and current_chars + len(chunk) > max_request_chars:
+                requests.append(current)
+                current = []
+                current_chars = 0
+            current.append((len(chunk_owners), chunk))
+            current_chars += len(chunk)
+            chunk_owners.append(text_index)
+    if current:
+        requests.append(current)
+    return chunk_owners, requests
+
+
+def build_planned_request(planned_request, gcp_project_id):
+    chunk_texts = [chunk for _, chunk in planned_request]
+    if len(chunk_texts) == 1:
+        return build_deidentify_request(chunk_texts[0], gcp_project_id)
+    return build_table_deidentify_request(chunk_texts, gcp_project_id)
+
+
+def assemble_deidentified_texts(texts, chunk_owners, chunk_results, request_errors):
+    """
+    Stitches de-identified chunks back into per-text results.
+    `chunk_results` maps chunk_id -> text and `request_errors` maps chunk_id -> error message for
+    chunks whose request failed. Returns a list of (deidentified_text or None, error or None).
+    """
+    pieces = [[] for _ in texts]
+    errors = [None] * len(texts)
+    for chunk_id, text_index in enumerate(chunk_owners):
+        if chunk_id in request_errors:
+            errors[text_index] = errors[text_index] or request_errors[chunk_id]
+        else:
+            pieces[text_index].append(chunk_results[chunk_id])
+    return [
+        (None, errors[index]) if errors[index] else ("".join(pieces[index]), None)
+        for index in range(len(texts))
+    ]
+
+
+class DlpClientPool:
+    """
+    Process-wide pool of DlpServiceClient objects, handed out round-robin. Clients (and their
+    gRPC channels) are created lazily and rebuilt after fork. With `insecure_endpoint`
+    ("host:port") the clients talk plaintext gRPC to a local stub instead of Google.
+    """
+
+    def __init__(self, size=2, insecure_endpoint=None):
+        self.size = max(1, size)
+        self.insecure_endpoint = insecure_endpoint
+        self._lock = threading.Lock()
+        self._pid = None
+        self._clients = []
+        self._next = None
+
+    def _create_client(self):
+        if self.insecure_endpoint:
+            import grpc
+            from google.cloud.dlp_v2.services.dlp_service.transports import DlpServiceGrpcTransport
+            transport = DlpServiceGrpcTransport(channel=grpc.insecure_channel(self.insecure_endpoint))
+            return dlp_v2.DlpServiceClient(transport=transport)
+        return dlp_v2.DlpServiceClient()
+
+    def get(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # gRPC channels must not be shared across fork()
+                self._pid = os.getpid()
+                self._clients = [self._create_client() for _ in range(self.size)]
+                self._next = itertools.cycle(self._clients)
+                logger.info("Created DLP clients", clients=self.size, endpoint=self.insecure_endpoint)
+            return next(self._next)
+
+
+def create_async_dlp_client(insecure_endpoint=None):
+    """
+    DlpServiceAsyncClient for the ASGI path (its channel is bound to the running event loop).
+    """
+    if insecure_endpoint:
+        import grpc
+        from google.cloud.dlp_v2.services.dlp_service.transports import DlpServiceGrpcAsyncIOTransport
+        transport = DlpServiceGrpcAsyncIOTransport(channel=grpc.aio.insecure_channel(insecure_endpoint))
+        return dlp_v2.DlpServiceAsyncClient(transport=transport)
+    return dlp_v2.DlpServiceAsyncClient()
+
+
+class DlpDeidentifier:
+    """
+    Chunked, concurrent de-identification on top of a DlpClientPool.
+    At most `max_parallel_requests` DLP calls per process are in flight at once.
+    """
+
+    def __init__(self, client_pool, max_chunk_chars=DEFAULT_CHUNK_CHARS, max_request_chars=DEFAULT_CHUNK_CHARS,
+                 max_parallel_requests=8, request_timeout=60):
+        self.client_pool = client_pool
+        self.max_chunk_chars = max_chunk_chars
+        self.max_request_chars = max_request_chars
+        self.max_parallel_requests = max_parallel_requests
+        self.request_timeout = request_timeout
+        self._executor_lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_parallel_requests, thread_name_prefix="rosetta-dlp")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _call(self, planned_request, gcp_project_id):
+        client = self.client_pool.get()
+        response = client.deidentify_content(
+            request=build_planned_request(planned_request, gcp_project_id), timeout=self.request_timeout
+        )
+        return read_deidentify_response(response, len(planned_request))
+
+    def deidentify_texts(self, texts, gcp_project_id):
+        """
+        De-identifies each text in `texts`. Returns a list of (deidentified_text, error) pairs in
+        input order; a failed DLP call only fails the texts whose chunks it carried.
+        """
+        chunk_owners, planned_requests = plan_dlp_requests(texts, self.max_chunk_chars, self.max_request_chars)
+        chunk_results = {}
+        request_errors = {}
+
+        if len(planned_requests) == 1:
+            futures = None # Nothing to parallelize; skip the pool hop
+        else:
+            executor = self._get_executor()
+            futures = [executor.submit(self._call, planned, gcp_project_id) for planned in planned_requests]
+
+        for request_index, planned in enumerate(planned_requests):
+            try:
+                values = futures[request_index].result() if futures else self._call(planned, gcp_project_id)
+                for (chunk_id, _), value in zip(planned, values):
+                    chunk_results[chunk_id] = value
+            except Exception as e:
+                logger.error("Google Cloud DLP API call failed", chunks=len(planned), error=str(e))
+                for chunk_id, _ in planned:
+                    request_errors[chunk_id] = str(e)
+
+        return assemble_deidentified_texts(texts, chunk_owners, chunk_results, request_errors)
+
+    def deidentify_text(self, text, gcp_project_id):
+        """
+        De-identifies a single text; raises RuntimeError if any of its DLP calls failed.
+        """
+        deidentified_text, error = self.deidentify_texts([text], gcp_project_id)[0]
+        if error:
+            raise RuntimeError(error)
+        return deidentified_text
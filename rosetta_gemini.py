@@ -0,0 +1,168 @@
+import datetime
+import os
+import threading
+import time
+
+import google.generativeai as genai
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- Long-lived Gemini model client ---
+# One GenerativeModel per process (and per model name), created lazily so gunicorn workers
+# forked from a preloaded master each build their own gRPC channel. The static Rosetta
+# instructions are attached as the model's system_instruction, or, in context-cache mode,
+# uploaded once as a Gemini cached context that requests reference by name.
+
+
+class GeminiModelProvider:
+    """
+    Hands out a reusable GenerativeModel for `model_name` with `system_instruction` attached.
+
+    With `use_context_cache=True` the system instruction is registered as a CachedContent
+    (ttl `context_cache_ttl_seconds`) and refreshed before it expires, so each request only
+    uploads the dynamic part of the prompt. If the cache cannot be created (e.g. the prefix is
+    below the model's minimum cacheable size) the provider falls back to the plain
+    system_instruction model and retries after `context_cache_retry_seconds`.
+    """
+
+    def __init__(self, model_name, system_instruction, use_context_cache=False,
+                 context_cache_ttl_seconds=3600, context_cache_refresh_margin_seconds=300,
+                 context_cache_retry_seconds=600):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.use_context_cache = use_context_cache
+        self.context_cache_ttl_seconds = context_cache_ttl_seconds
+        self.context_cache_refresh_margin_seconds = context_cache_refresh_margin_seconds
+        self.context_cache_retry_seconds = context_cache_retry_seconds
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._model = None
+        self._model_uses_cache = False
+        self._cached_content = None
+        self._cache_expires_at = 0.0
+        self._cache_retry_at = 0.0
+        self._refresher_started = False
+
+    def _reset_if_forked(self):
+        # Caller holds the lock. gRPC channels must not be shared across fork().
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._model = None
+            self._model_uses_cache = False
+            self._cached_content = None
+            self._cache_expires_at = 0.0
+            self._refresher_started = False
+
+    def _plain_model(self):
+        return genai.GenerativeModel(self.model_name, system_instruction=self.system_instruction)
+
+    def _refresh_context_cache(self):
+        """
+        Creates or extends the cached context. Caller holds the lock.
+        Returns True if a usable cached context is in place.
+        """
+        now = time.time()
+        ttl = datetime.timedelta(seconds=self.context_cache_ttl_seconds)
+        if self._cached_content is not None:
+            try:
+                self._cached_content.update(ttl=ttl)
+                self._cache_expires_at = now + self.context_cache_ttl_seconds
+                logger.info("Refreshed Gemini context cache", cache=self._cached_content.name, model=self.model_name)
+                return True
+            except Exception as e:
+                # The cache may have expired server-side; fall through and recreate it
+                logger.warning("Error refreshing Gemini context cache; recreating", model=self.model_name, error=str(e))
+                self._cached_content = None
+
+        if now < self._cache_retry_at:
+            return False
+        try:
+            self._cached_content = genai.caching.CachedContent.create(
+                model=f"models/{self.model_name}",
+                display_name="rosetta-static-instructions",
+                system_instruction=self.system_instruction,
+                ttl=ttl,
+            )
+            self._cache_expires_at = now + self.context_cache_ttl_seconds
+            self._model = genai.GenerativeModel.from_cached_content(cached_content=self._cached_content)
+            self._model_uses_cache = True
+            logger.info("Created Gemini context cache", cache=self._cached_content.name, model=self.model_name)
+            return True
+        except Exception as e:
+            logger.error("Error creating Gemini context cache; using inline system_instruction", model=self.model_name, error=str(e))
+            self._cached_content = None
+            self._cache_retry_at = now + self.context_cache_retry_seconds
+            return False
+
+    def get_model(self):
+        """
+        Returns the process-wide GenerativeModel, (re)creating or refreshing it as needed.
+        """
+        with self._lock:
+            self._reset_if_forked()
+
+            if self.use_context_cache:
+                self._start_refresher()
+                expiring = time.time() >= self._cache_expires_at - self.context_cache_refresh_margin_seconds
+                if self._cached_content is None or expiring:
+                    self._refresh_context_cache()
+                if self._cached_content is None and self._model_uses_cache:
+                    # Cached context is gone; fall back to the inline system_instruction model
+                    self._model = None
+                    self._model_uses_cache = False
+
+            if self._model is None:
+                self._model = self._plain_model()
+            return self._model
+
+    def _start_refresher(self):
+        # Caller holds the lock. Keeps the cached context alive between requests.
+        if self._refresher_started:
+            return
+        self._refresher_started = True
+        interval = max(30, self.context_cache_ttl_seconds - self.context_cache_refresh_margin_seconds)
+        owner_pid = os.getpid()
+
+        def refresh_loop():
+            while True:
+                time.sleep(interval)
+                if os.getpid() != owner_pid:
+                    return
+                with self._lock:
+                    if self._cached_content is not None or time.time() >= self._cache_retry_at:
+                        self._refresh_context_cache()
+
+        threading.Thread(target=refresh_loop, name=f"gemini-context-cache-{self.model_name}", daemon=True).start()
+
+    def status(self):
+        """
+        Small status dict for diagnostics endpoints.
+        """
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "context_cache_enabled": self.use_context_cache,
+                "context_cache_name": self._cached_content.name if self._cached_content is not None else None,
+                "context_cache_expires_in_seconds": max(0, int(self._cache_expires_at - time.time())) if self._cached_content is not None else None,
+                "system_instruction_chars": len(self.system_instruction),
+            }
+
+
+def cancel_llm_stream(response):
+    """
+    Best-effort cancellation of an in-flight streaming generate_content call, so the model
+    stops producing (and billing) output tokens. Works for the gRPC call object and for the
+    REST transport's generator; anything else is left to garbage collection.
+    """
+    iterator = getattr(response, "_iterator", None)
+    for method_name in ("cancel", "close"):
+        method = getattr(iterator, method_name, None)
+        if callable(method):
+            try:
+                method()
+            except Exception as e:
+                logger.warning("Error cancelling Gemini stream", error=str(e))
+            return
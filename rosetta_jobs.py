@@ -0,0 +1,415 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from rosetta_logging import get_logger
+from rosetta_process import SqliteConnections, pid_alive
+
+logger = get_logger(__name__)
+
+# --- Durable background jobs ---
+# Asynchronous note generation: a job is a /generate_note payload stored in a SQLite queue (WAL
+# mode, shared by every gunicorn worker on the host). A JobRunner in each process claims queued
+# jobs, highest priority first, and runs them on a bounded pool of threads; clients poll (or
+# long-poll) the job for its status and result.
+#
+# A claimed job is leased to its worker, and the worker renews the lease while the job runs.
+# If the process dies (deploy, instance recycled, OOM), the lease runs out and the job is queued
+# again, up to `max_attempts` runs in total. A restarted process on the same host requeues the
+# dead process's jobs at once instead of waiting for the lease. Per-service concurrency limits
+# count running jobs across all workers sharing the database.
+#
+# The stored payload (patient text) is cleared once a job finishes. Finished jobs are deleted
+# after `retention_seconds`.
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = frozenset({JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED})
+
+# Lower runs first
+PRIORITIES = {"stat": 0, "urgent": 1, "routine": 2}
+DEFAULT_PRIORITY = "routine"
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    service TEXT NOT NULL DEFAULT '',
+    payload TEXT,
+    result TEXT,
+    status_code INTEGER,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_owner TEXT,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at);
+CREATE INDEX IF NOT EXISTS jobs_running_service ON jobs (status, service);
+"""
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class JobStateError(Exception):
+    """
+    Raised when a job is not in a state that allows the operation (e.g. cancelling a running job).
+    """
+
+
+def parse_priority(value):
+    """
+    "stat" / "urgent" / "routine" (or their numbers 0-2) to a queue priority. Raises ValueError.
+    """
+    if value is None or value == "":
+        return PRIORITIES[DEFAULT_PRIORITY]
+    if isinstance(value, str) and value.strip().lower() in PRIORITIES:
+        return PRIORITIES[value.strip().lower()]
+    if isinstance(value, int) and not isinstance(value, bool) and value in PRIORITIES.values():
+        return value
+    raise ValueError(f"Unknown priority {value!r}; use one of {', '.join(PRIORITIES)}.")
+
+
+def priority_name(priority):
+    for name, value in PRIORITIES.items():
+        if value == priority:
+            return name
+    return str(priority)
+
+
+def parse_service_limits(spec):
+    """
+    Parses "MICU=2,CARDS=1,*=4" into a dict; "*" is the limit for every other service.
+    Malformed entries are skipped.
+    """
+    limits = {}
+    for entry in (spec or "").split(","):
+        service, _, value = entry.partition("=")
+        try:
+            limits[service.strip().upper() or "*"] = int(value)
+        except ValueError:
+            if entry.strip():
+                logger.warning("Ignoring malformed job service limit", entry=entry.strip())
+    return limits
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue. One connection per thread and process, as in SqliteNoteStore.
+    """
+
+    def __init__(self, path, lease_seconds=60.0, max_attempts=3, retention_seconds=86400.0,
+                 service_limits=None, busy_timeout_seconds=10.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.service_limits = service_limits or {}
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self._db = SqliteConnections(path, busy_timeout_seconds)
+        self._hostname = socket.gethostname()
+        self._last_cleanup = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db.connection().executescript(JOBS_SCHEMA)
+        logger.info("Using SQLite job queue", path=path)
+
+    def new_worker_id(self):
+        # host:pid:token, so a restarted process can recognise leases of dead local processes
+        return f"{self._hostname}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def submit(self, payload, priority=PRIORITIES[DEFAULT_PRIORITY], service=""):
+        job_id = uuid.uuid4().hex
+        self._db.connection().execute(
+            "INSERT INTO jobs (id, status, priority, service, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, JOB_QUEUED, priority, (service or "").upper(), json.dumps(payload), time.time()),
+        )
+        return job_id
+
+    def _service_limit(self, service):
+        return self.service_limits.get(service, self.service_limits.get("*"))
+
+    def claim(self, worker_id):
+        """
+        Leases the next runnable job to `worker_id`: highest priority, then oldest, skipping
+        services at their concurrency limit. Returns (job_id, payload, attempts) or None.
+        """
+        def work(connection):
+            now = time.time()
+            self._expire_leases(connection, now)
+            running = connection.execute(
+                "SELECT service, COUNT(*) FROM jobs WHERE status = ? GROUP BY service", (JOB_RUNNING,)
+            ).fetchall()
+            full = [service for service, count in running if self._service_limit(service) is not None and count >= self._service_limit(service)]
+            sql = "SELECT id, payload, attempts FROM jobs WHERE status = ?"
+            params = [JOB_QUEUED]
+            if full:
+                sql += f" AND service NOT IN ({', '.join('?' * len(full))})"
+                params += full
+            row = connection.execute(sql + " ORDER BY priority, created_at LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?, lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                (JOB_RUNNING, now, worker_id, now + self.lease_seconds, row["id"]),
+            )
+            return row["id"], json.loads(row["payload"]), row["attempts"] + 1
+        return self._db.write_transaction(work)
+
+    def _expire_leases(self, connection, now):
+        # Caller holds the write transaction. Jobs of dead workers go back to the queue (or fail
+        # once they have used up their attempts).
+        stale = connection.execute(
+            "SELECT id, attempts, lease_owner, lease_expires_at FROM jobs WHERE status = ?", (JOB_RUNNING,)
+        ).fetchall()
+        for row in stale:
+            host, _, rest = (row["lease_owner"] or "").partition(":")
+            pid = rest.partition(":")[0]
+            owner_dead = host == self._hostname and pid.isdigit() and not pid_alive(int(pid))
+            if not owner_dead and (row["lease_expires_at"] or 0) > now:
+                continue
+            if row["attempts"] >= self.max_attempts:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, status_code = 500, finished_at = ?, payload = NULL, lease_owner = NULL WHERE id = ?",
+                    (JOB_FAILED, f"Worker lost while running the job ({row['attempts']} attempts).", now, row["id"]),
+                )
+                logger.error("Job failed after its worker was lost too often", job_id=row["id"], attempts=row["attempts"])
+            else:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL WHERE id = ?", (JOB_QUEUED, row["id"])
+                )
+                logger.warning("Requeued job of a lost worker", job_id=row["id"], attempts=row["attempts"], owner=row["lease_owner"])
+
+    def renew_leases(self, worker_id, job_ids):
+        if not job_ids:
+            return
+        self._db.connection().execute(
+            f"UPDATE jobs SET lease_expires_at = ? WHERE status = ? AND lease_owner = ? AND id IN ({', '.join('?' * len(job_ids))})",
+            [time.time() + self.lease_seconds, JOB_RUNNING, worker_id] + list(job_ids),
+        )
+
+    def complete(self, job_id, worker_id, status, result=None, status_code=None, error=None):
+        """
+        Records a job's outcome. Returns False if the job was no longer leased to `worker_id`
+        (its lease expired and another worker took it over).
+        """
+        cursor = self._db.connection().execute(
+            "UPDATE jobs SET status = ?, result = ?, status_code = ?, error = ?, finished_at = ?, payload = NULL, "
+            "lease_owner = NULL, lease_expires_at = NULL WHERE id = ? AND status = ? AND lease_owner = ?",
+            (status, json.dumps(result) if result is not None else None, status_code, error, time.time(), job_id, JOB_RUNNING, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id):
+        def work(connection):
+            row = connection.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                raise JobNotFound(job_id)
+            if row["status"] != JOB_QUEUED:
+                raise JobStateError(f"Job is {row['status']}; only queued jobs can be cancelled.")
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, payload = NULL WHERE id = ?", (JOB_CANCELLED, time.time(), job_id)
+            )
+        self._db.write_transaction(work)
+
+    def _row_to_job(self, row):
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "priority": priority_name(row["priority"]),
+            "service": row["service"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+        }
+        if row["status"] == JOB_QUEUED:
+            job["queue_position"] = self._db.connection().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority < ? OR (priority = ? AND created_at < ?))",
+                (JOB_QUEUED, row["priority"], row["priority"], row["created_at"]),
+            ).fetchone()[0]
+        if row["status"] in FINISHED_STATUSES:
+            job["status_code"] = row["status_code"]
+            job["result"] = json.loads(row["result"]) if row["result"] else None
+            if row["error"]:
+                job["error"] = row["error"]
+        return job
+
+    def get(self, job_id):
+        row = self._db.connection().execute(
+            "SELECT id, status, priority, service, result, status_code, error, attempts, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            raise JobNotFound(job_id)
+        return self._row_to_job(row)
+
+    def list_jobs(self, status=None, limit=50):
+        sql = "SELECT id, status, priority, service, NULL AS result, status_code, error, attempts, created_at, started_at, finished_at FROM jobs"
+        params = []
+        if status:
+            sql += " WHERE status = ?"
+            params.append(status)
+        rows = self._db.connection().execute(sql + " ORDER BY created_at DESC LIMIT ?", params + [limit]).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def counts(self):
+        rows = self._db.connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def remove_expired(self):
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        cursor = self._db.connection().execute(
+            f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) AND finished_at < ?",
+            list(FINISHED_STATUSES) + [now - self.retention_seconds],
+        )
+        if cursor.rowcount:
+            logger.info("Removed expired jobs", count=cursor.rowcount)
+
+
+class JobRunner:
+    """
+    Runs jobs from `queue` on `workers` threads in this process. `handler(payload)` returns
+    (result, status_code); a 2xx status marks the job succeeded, anything else failed.
+    `on_event(event, **details)` (optional) hears "started" (queue_seconds), "finished"
+    (status, run_seconds) and "lost" (the job was taken over after its lease expired).
+    Threads start on start() and are restarted in forked children (gunicorn workers).
+    """
+
+    def __init__(self, queue, handler, workers=2, poll_interval_seconds=1.0, on_event=None):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval_seconds = poll_interval_seconds
+        self.on_event = on_event
+        self._wakeup = threading.Condition()
+        self._finished = threading.Condition()
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._started_pid = None
+        self.worker_id = None
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _emit(self, event, **details):
+        if self.on_event is not None:
+            try:
+                self.on_event(event, **details)
+            except Exception as e:
+                logger.warning("Job runner event hook failed", job_event=event, error=str(e))
+
+    def start(self):
+        if self._started_pid == os.getpid() or self.workers <= 0:
+            return
+        self._started_pid = os.getpid()
+        self.worker_id = self.queue.new_worker_id()
+        self._running = {}
+        for index in range(self.workers):
+            threading.Thread(target=self._work_loop, name=f"rosetta-job-{index}", daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name="rosetta-job-heartbeat", daemon=True).start()
+        logger.info("Job runner started", workers=self.workers, worker_id=self.worker_id)
+
+    def _restart_after_fork(self):
+        if self._started_pid is not None:
+            self._wakeup = threading.Condition()
+            self._finished = threading.Condition()
+            self._running_lock = threading.Lock()
+            self._started_pid = None
+            self.start()
+
+    def notify(self):
+        """
+        Wakes an idle worker thread (call after submitting a job in this process).
+        """
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _work_loop(self):
+        owner_pid = os.getpid()
+        while os.getpid() == owner_pid:
+            try:
+                claimed = self.queue.claim(self.worker_id)
+            except Exception as e:
+                logger.error("Error claiming a job", error=str(e))
+                claimed = None
+            if claimed is None:
+                try:
+                    self.queue.remove_expired()
+                except Exception as e:
+                    logger.warning("Error removing expired jobs", error=str(e))
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval_seconds)
+                continue
+            self._run(*claimed)
+
+    def _run(self, job_id, payload, attempts):
+        started = time.time()
+        with self._running_lock:
+            self._running[job_id] = started
+        try:
+            job = self.queue.get(job_id)
+            self._emit("started", queue_seconds=max(0.0, started - job["created_at"]))
+            logger.info("Job started", job_id=job_id, service=job["service"], priority=job["priority"], attempt=attempts)
+            try:
+                result, status_code = self.handler(payload)
+                status = JOB_SUCCEEDED if 200 <= status_code < 300 else JOB_FAILED
+                error = None if status == JOB_SUCCEEDED else (result or {}).get("error")
+            except Exception as e:
+                logger.error("Job raised an exception", job_id=job_id, error=str(e), error_type=type(e).__name__)
+                result, status_code, status, error = None, 500, JOB_FAILED, f"Unexpected error while generating note: {e}"
+            if self.queue.complete(job_id, self.worker_id, status, result, status_code, error):
+                self._emit("finished", status=status, run_seconds=time.time() - started)
+                logger.info("Job finished", job_id=job_id, status=status, status_code=status_code, seconds=round(time.time() - started, 3))
+            else:
+                self._emit("lost")
+                logger.warning("Job result discarded: lease was lost to another worker", job_id=job_id)
+        except Exception as e:
+            logger.error("Error running job", job_id=job_id, error=str(e))
+        finally:
+            with self._running_lock:
+                self._running.pop(job_id, None)
+            with self._finished:
+                self._finished.notify_all()
+
+    def _heartbeat_loop(self):
+        owner_pid = os.getpid()
+        while os.getpid() == owner_pid:
+            time.sleep(max(1.0, self.queue.lease_seconds / 3))
+            with self._running_lock:
+                job_ids = list(self._running)
+            try:
+                self.queue.renew_leases(self.worker_id, job_ids)
+            except Exception as e:
+                logger.warning("Error renewing job leases", error=str(e))
+
+    def wait(self, job_id, timeout):
+        """
+        Long-poll: returns the job once it has finished or `timeout` seconds have passed.
+        Jobs finishing in this process wake the waiter at once; others are seen within the
+        poll interval.
+        """
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            job = self.queue.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job["status"] in FINISHED_STATUSES or remaining <= 0:
+                return job
+            with self._finished:
+                self._finished.wait(min(remaining, self.poll_interval_seconds))
+
+    def snapshot(self):
+        with self._running_lock:
+            running = len(self._running)
+        return {"workers": self.workers, "running_here": running, "worker_id": self.worker_id, "jobs": self.queue.counts()}
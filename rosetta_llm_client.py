@@ -0,0 +1,438 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from google.api_core import exceptions as api_exceptions
+from requests import exceptions as requests_exceptions
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- Resilient Gemini calls ---
+# Every Gemini call goes through a ResilientLLMClient. The caller passes an attempt function
+# (model name, timeout) -> result, and the client:
+#   retries     transient failures (429, 500, 502, 503, 504, timeouts, connection errors) with
+#               jittered exponential backoff ("full jitter"), only while the request deadline
+#               leaves room for another attempt
+#   hedges      optionally starts a second identical call when the first has not answered after
+#               `hedge_after_seconds`; whichever finishes first wins
+#   breaks      keeps a circuit breaker per model: after `breaker_failure_threshold` consecutive
+#               transient failures the model is skipped for `breaker_reset_seconds`, then one
+#               probe request decides whether it is healthy again
+#   falls back  walks the model chain (GEMINI_MODEL, then ROSETTA_LLM_FALLBACK_MODELS) when a
+#               model's breaker is open, or when its recent latency would miss the latency SLO
+#               or the time left before the deadline
+# Non-transient errors (bad request, permission denied, safety blocks) are raised at once.
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+# Gauge values for rosetta_llm_circuit_breaker_state
+BREAKER_STATE_VALUES = {BREAKER_CLOSED: 0, BREAKER_HALF_OPEN: 1, BREAKER_OPEN: 2}
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+RETRYABLE_EXCEPTIONS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.RetryError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    ConnectionError,
+    # REST transport (custom endpoints). Other OSErrors (a missing file, a codec error) are bugs,
+    # not transient failures, and must not count against a model's breaker.
+    requests_exceptions.ConnectionError,
+    requests_exceptions.Timeout,
+)
+# Weight of the newest sample in a model's moving latency average
+LATENCY_EWMA_WEIGHT = 0.3
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when every model in the chain has an open circuit breaker.
+    """
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """
+    Raised when the request deadline passed before any attempt succeeded.
+    """
+
+
+def is_retryable(error):
+    if isinstance(error, (CircuitOpenError, LLMDeadlineExceeded)):
+        return False
+    if isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. While open, allow() refuses calls until
+    `reset_seconds` have passed; then it lets exactly one probe through (half-open), whose
+    outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0, on_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _set_state(self, state):
+        # Caller holds the lock
+        if state != self.state:
+            self.state = state
+            if self.on_change is not None:
+                self.on_change(state)
+
+    def allow(self):
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set_state(BREAKER_HALF_OPEN)
+                self._probe_in_flight = False
+            if self.state == BREAKER_HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+                return True
+            return self.state == BREAKER_CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            self._set_state(BREAKER_CLOSED)
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == BREAKER_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(BREAKER_OPEN)
+
+    def release_probe(self):
+        # A half-open probe that ended without a verdict (non-transient error) frees the slot
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class _ModelHealth:
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.latency_seconds = None # Moving average of completed attempts
+        self.latency_updated_at = 0.0
+
+    def observe_latency(self, seconds):
+        if self.latency_seconds is None:
+            self.latency_seconds = seconds
+        else:
+            self.latency_seconds += LATENCY_EWMA_WEIGHT * (seconds - self.latency_seconds)
+        self.latency_updated_at = time.monotonic()
+
+
+class ResilientLLMClient:
+    """
+    Runs LLM calls with retries, hedging, per-model circuit breakers and a fallback chain.
+
+    `models` is the chain, preferred model first. `on_event(event, model, **details)` (optional)
+    is told about "retry", "hedge", "hedge_won", "fallback" (details: reason) and "breaker"
+    (details: state), e.g. to update metrics. `hedge_after_seconds` and `latency_slo_seconds`
+    of 0 disable hedging and SLO-based fallback.
+    """
+
+    def __init__(self, models, max_attempts=3, backoff_base_seconds=0.5, backoff_max_seconds=8.0,
+                 attempt_timeout_seconds=120.0, hedge_after_seconds=0, latency_slo_seconds=0,
+                 breaker_failure_threshold=5, breaker_reset_seconds=30.0, max_hedge_workers=32, on_event=None):
+        self.models = list(dict.fromkeys(model for model in models if model))
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.attempt_timeout_seconds = attempt_timeout_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+        self.latency_slo_seconds = latency_slo_seconds
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.max_hedge_workers = max_hedge_workers
+        self.on_event = on_event
+        self._health = {
+            model: _ModelHealth(CircuitBreaker(
+                breaker_failure_threshold, breaker_reset_seconds,
+                on_change=lambda state, model=model: self._emit("breaker", model, state=state),
+            ))
+            for model in self.models
+        }
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def _emit(self, event, model, **details):
+        if event == "breaker":
+            log = logger.warning if details.get("state") == BREAKER_OPEN else logger.info
+            log("LLM circuit breaker changed state", model=model, **details)
+        if self.on_event is not None:
+            try:
+                self.on_event(event, model, **details)
+            except Exception as e:
+                logger.warning("LLM client event hook failed", llm_event=event, error=str(e))
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                # A pool inherited through fork() has no threads; build one per process
+                self._executor = ThreadPoolExecutor(max_workers=self.max_hedge_workers, thread_name_prefix="llm-hedge")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    # --- Model selection ---
+
+    def _slo_at_risk(self, health, remaining_seconds):
+        if health.latency_seconds is None:
+            return False
+        if time.monotonic() - health.latency_updated_at > self.breaker_reset_seconds:
+            return False # Stale estimate: give the model another chance to prove itself
+        if self.latency_slo_seconds and health.latency_seconds > self.latency_slo_seconds:
+            return True
+        return health.latency_seconds > remaining_seconds
+
+    def _choose_model(self, remaining_seconds):
+        """
+        Returns (model, fallback reason or None), or (None, None) when every breaker is open.
+        Models whose latency puts the SLO at risk are passed over while a later model is
+        available, but are still preferred to no model at all.
+        """
+        skipped_slow = []
+        reason = None
+        for index, model in enumerate(self.models):
+            health = self._health[model]
+            if index < len(self.models) - 1 and self._slo_at_risk(health, remaining_seconds):
+                skipped_slow.append(model)
+                reason = reason or "latency_slo"
+                continue
+            if health.breaker.allow():
+                return model, (reason if index else None)
+            reason = reason or "circuit_open"
+        for model in skipped_slow:
+            if self._health[model].breaker.allow():
+                return model, (reason if model != self.models[0] else None)
+        return None, None
+
+    def _backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1)))
+
+    def _record(self, model, error, elapsed_seconds):
+        health = self._health[model]
+        if error is None:
+            health.observe_latency(elapsed_seconds)
+            health.breaker.record_success()
+        elif is_retryable(error):
+            if isinstance(error, (TimeoutError, asyncio.TimeoutError, api_exceptions.DeadlineExceeded)):
+                health.observe_latency(elapsed_seconds)
+            health.breaker.record_failure()
+        else:
+            health.breaker.release_probe()
+
+    # --- Synchronous calls ---
+
+    def _timed_call(self, attempt_function, model, timeout):
+        start = time.monotonic()
+        try:
+            value = attempt_function(model, timeout)
+        except Exception as e:
+            self._record(model, e, time.monotonic() - start)
+            raise
+        self._record(model, None, time.monotonic() - start)
+        return value
+
+    def _hedged_call(self, attempt_function, model, timeout):
+        """
+        Returns (value, hedge_won). The losing call keeps running in its pool thread until it
+        finishes or times out (unary calls cannot be cancelled); its result is discarded.
+        """
+        executor = self._get_executor()
+        attempt_deadline = time.monotonic() + timeout
+        primary = executor.submit(self._timed_call, attempt_function, model, timeout)
+        done, _ = wait([primary], timeout=self.hedge_after_seconds)
+        if done:
+            return primary.result(), False
+
+        self._emit("hedge", model)
+        hedge = executor.submit(self._timed_call, attempt_function, model, max(0.0, attempt_deadline - time.monotonic()))
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, attempt_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._emit("hedge_won", model)
+                    return future.result(), future is hedge
+                error = future.exception()
+        raise error or TimeoutError(f"Gemini call to {model} timed out after {timeout:.1f}s")
+
+    def call(self, attempt_function, deadline_seconds=None, hedge=True):
+        """
+        Runs `attempt_function(model, timeout)` until it succeeds, a non-transient error occurs,
+        the attempts run out or the deadline passes. Returns (value, info) where info has
+        "model", "attempts", "hedged" and "fallback_reason". Streaming calls pass hedge=False.
+        """
+        start = time.monotonic()
+        deadline = start + (deadline_seconds or self.attempt_timeout_seconds * self.max_attempts)
+        info = {"model": None, "attempts": 0, "hedged": False, "fallback_reason": None}
+        last_error = None
+        while info["attempts"] < self.max_attempts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            model, fallback_reason = self._choose_model(remaining)
+            if model is None:
+                raise last_error or CircuitOpenError("Every Gemini model's circuit breaker is open; try again shortly.")
+            if fallback_reason:
+                self._emit("fallback", model, reason=fallback_reason)
+            info.update(model=model, fallback_reason=fallback_reason)
+            info["attempts"] += 1
+            timeout = min(self.attempt_timeout_seconds, remaining) if self.attempt_timeout_seconds else remaining
+            try:
+                if hedge and self.hedge_after_seconds and self.hedge_after_seconds < timeout:
+                    value, info["hedged"] = self._hedged_call(attempt_function, model, timeout)
+                else:
+                    value = self._timed_call(attempt_function, model, timeout)
+                return value, info
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                if info["attempts"] >= self.max_attempts:
+                    break
+                delay = self._backoff_seconds(info["attempts"])
+                if time.monotonic() + delay >= deadline:
+                    break
+                logger.warning("Transient Gemini error; retrying", model=model, attempt=info["attempts"],
+                               delay_seconds=round(delay, 3), error=str(e), error_type=type(e).__name__)
+                self._emit("retry", model)
+                time.sleep(delay)
+        if last_error is not None:
+            raise last_error
+        raise LLMDeadlineExceeded(f"No Gemini response within the {deadline - start:.1f}s deadline.")
+
+    # --- asyncio calls (ASGI mode) ---
+
+    async def _timed_call_async(self, attempt_coroutine_function, model, timeout):
+        start = time.monotonic()
+        try:
+            value = await asyncio.wait_for(attempt_coroutine_function(model, timeout), timeout)
+        except Exception as e:
+            self._record(model, e, time.monotonic() - start)
+            raise
+        self._record(model, None, time.monotonic() - start)
+        return value
+
+    async def _hedged_call_async(self, attempt_coroutine_function, model, timeout):
+        # Unlike threads, the losing coroutine is cancelled
+        attempt_deadline = time.monotonic() + timeout
+        primary = asyncio.ensure_future(self._timed_call_async(attempt_coroutine_function, model, timeout))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_after_seconds)
+        if done:
+            return primary.result(), False
+
+        self._emit("hedge", model)
+        hedge = asyncio.ensure_future(self._timed_call_async(attempt_coroutine_function, model, max(0.0, attempt_deadline - time.monotonic())))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, attempt_deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._emit("hedge_won", model)
+                        return task.result(), task is hedge
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error or asyncio.TimeoutError(f"Gemini call to {model} timed out after {timeout:.1f}s")
+
+    async def call_async(self, attempt_coroutine_function, deadline_seconds=None, hedge=True):
+        """
+        asyncio counterpart of call(); `attempt_coroutine_function(model, timeout)` is awaited.
+        """
+        start = time.monotonic()
+        deadline = start + (deadline_seconds or self.attempt_timeout_seconds * self.max_attempts)
+        info = {"model": None, "attempts": 0, "hedged": False, "fallback_reason": None}
+        last_error = None
+        while info["attempts"] < self.max_attempts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            model, fallback_reason = self._choose_model(remaining)
+            if model is None:
+                raise last_error or CircuitOpenError("Every Gemini model's circuit breaker is open; try again shortly.")
+            if fallback_reason:
+                self._emit("fallback", model, reason=fallback_reason)
+            info.update(model=model, fallback_reason=fallback_reason)
+            info["attempts"] += 1
+            timeout = min(self.attempt_timeout_seconds, remaining) if self.attempt_timeout_seconds else remaining
+            try:
+                if hedge and self.hedge_after_seconds and self.hedge_after_seconds < timeout:
+                    value, info["hedged"] = await self._hedged_call_async(attempt_coroutine_function, model, timeout)
+                else:
+                    value = await self._timed_call_async(attempt_coroutine_function, model, timeout)
+                return value, info
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                if info["attempts"] >= self.max_attempts:
+                    break
+                delay = self._backoff_seconds(info["attempts"])
+                if time.monotonic() + delay >= deadline:
+                    break
+                logger.warning("Transient Gemini error; retrying (async)", model=model, attempt=info["attempts"],
+                               delay_seconds=round(delay, 3), error=str(e), error_type=type(e).__name__)
+                self._emit("retry", model)
+                await asyncio.sleep(delay)
+        if last_error is not None:
+            raise last_error
+        raise LLMDeadlineExceeded(f"No Gemini response within the {deadline - start:.1f}s deadline.")
+
+    def snapshot(self):
+        """
+        Per-model breaker state and latency estimate, for diagnostics endpoints.
+        """
+        return {
+            "models": [
+                {
+                    "model": model,
+                    "circuit_breaker": health.breaker.state,
+                    "consecutive_failures": health.breaker.consecutive_failures,
+                    "latency_seconds": round(health.latency_seconds, 3) if health.latency_seconds is not None else None,
+                }
+                for model, health in self._health.items()
+            ],
+            "max_attempts": self.max_attempts,
+            "hedge_after_seconds": self.hedge_after_seconds,
+            "latency_slo_seconds": self.latency_slo_seconds,
+        }
@@ -0,0 +1,289 @@
+import re
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- Local (offline) de-identification ---
+# A fast, credential-free alternative or pre-pass to Google Cloud DLP (see rosetta_deid.py).
+# Structured identifiers are found with a few compiled scanners (labelled, numeric, month-name
+# dates, emails); person names with a title pattern ("Dr. X") plus a dictionary matcher over
+# capitalized tokens. Matches are replaced with the same [INFO_TYPE] tokens DLP produces, so
+# the API contract doesn't change.
+#
+# This is pattern/dictionary based: it will miss names that are not in the dictionary and
+# have no title. Use "local_then_dlp" mode when Cloud DLP is available.
+
+DEID_MODE_DLP = "dlp"
+DEID_MODE_LOCAL = "local"
+DEID_MODE_LOCAL_THEN_DLP = "local_then_dlp"
+DEID_MODES = (DEID_MODE_DLP, DEID_MODE_LOCAL, DEID_MODE_LOCAL_THEN_DLP)
+
+_MONTH = r"(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.?"
+_DATE = (
+    r"(?:\d{1,2}[/-]\d{1,2}[/-](?:\d{4}|\d{2})(?![\d/])"        # 3/14/2025, 03-14-25
+    r"|\d{4}-\d{2}-\d{2}(?!\d)"                                  # 2025-03-14
+    rf"|{_MONTH}\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}(?!\d)"  # March 14, 2025
+    rf"|\d{{1,2}}\s+{_MONTH}\s+\d{{4}}(?!\d))"                   # 14 Mar 2025
+)
+_NAME_WORD = r"[A-Z][a-zA-Z'\-]+"
+
+# The scanners below each start with a single character class and only check the preceding
+# context (word boundary, "not after a digit") with a lookbehind placed after that first
+# character. That keeps re's fast first-character search usable; a leading \b or lookbehind
+# on an alternation makes it try every position, which is several times slower on notes.
+
+# Labelled identifiers. Only the named group is replaced, not the label.
+_LABEL_REGEX = re.compile(
+    r"[MD](?<![\w.]\w)(?:"
+    r"(?<=M)(?:RN|R\#|edical\ Record(?:\ Number|\ No\.?)?)\s*[:\#]?\s*(?P<MEDICAL_RECORD_NUMBER>[A-Z]{0,2}\d{5,12})\b"
+    rf"|(?<=D)(?:OB|\.O\.B\.|ate\ of\ Birth)\s*[:\-]?\s*(?P<DATE_OF_BIRTH>{_DATE})"
+    rf"|(?:(?<=M)(?:rs|s|iss|r)|(?<=D)r)\.?\s+(?P<PERSON_NAME>{_NAME_WORD}(?:\s+{_NAME_WORD})?)"
+    r")"
+)
+
+# Identifiers that start with a digit, "(" or "+". The whole match is replaced. Alternatives
+# are tried in order, so specific forms come before the generic ones they overlap with.
+_NUMBER_REGEX = re.compile(
+    r"[\d(+](?<!\d\d)(?:" # Never starts inside a run of digits
+    r"(?P<US_SOCIAL_SECURITY_NUMBER>(?<![\d\-]\d)(?<=\d)\d\d(?<!000)(?<!666)(?<!9\d\d)-(?!00)\d\d-(?!0000)\d{4}(?![\d\-]))"
+    r"|(?P<DATE>(?<![\w/]\d)(?<=\d)(?:"
+    r"\d?[/-]\d{1,2}[/-](?:\d{4}|\d{2})(?![\d/])"               # 3/14/2025, 03-14-25
+    r"|\d{3}-\d{2}-\d{2}(?!\d)"                                  # 2025-03-14
+    rf"|\d?\s+{_MONTH}\s+\d{{4}}(?!\d)))"                        # 14 Mar 2025
+    r"|(?P<IP_ADDRESS>(?<![\d.]\d)(?<=\d)\d{0,2}(?:\.\d{1,3}){3}(?!\.?\d))"
+    r"|(?P<CREDIT_CARD_NUMBER>(?<![\d\-]\d)(?<=\d)\d{3}(?:[ \-]?\d{4}){2}[ \-]?\d{1,7}(?![\d\-]))"
+    r"|(?P<PHONE_NUMBER>(?:"
+    r"(?<=\+)1[-.\s]?(?:\(\d{3}\)\s?|\d{3}[-.\s])"               # +1 555 ..., +1 (555) ...
+    r"|(?<![\w)]\()(?<=\()\d{3}\)\s?"                            # (555) ...
+    r"|(?<![\d\-]\d)(?<=\d)(?:\d\d[-.\s]|(?<=1)[-.\s]?(?:\(\d{3}\)\s?|\d{3}[-.\s]))"  # 555-..., 1-555-...
+    r")\d{3}[-.\s]\d{4}(?![\d\-]))"
+    r")"
+)
+
+# Dates written with a month name ("March 14, 2025"). The whole match is replaced.
+_MONTH_DATE_REGEX = re.compile(
+    r"[JFMASOND](?<![\w.]\w)"
+    r"(?:(?<=J)(?:an|un|ul)|(?<=F)eb|(?<=M)(?:ar|ay)|(?<=A)(?:pr|ug)|(?<=S)ep|(?<=O)ct|(?<=N)ov|(?<=D)ec)"
+    r"[a-z]*\.?\s+\d{1,2}(?:st|nd|rd|th)?,?\s+\d{4}(?!\d)"
+)
+
+# Email addresses are found around each "@", so text without one costs a single scan
+_EMAIL_LOCAL_REGEX = re.compile(r"[A-Za-z0-9._%+\-]+\Z")
+_EMAIL_DOMAIN_REGEX = re.compile(r"[A-Za-z0-9.\-]+\.[A-Za-z]{2,}")
+_EMAIL_MAX_LOCAL_CHARS = 64
+
+# Capitalized words (and hyphen/apostrophe compounds) that the name matcher looks up
+_NAME_TOKEN_REGEX = re.compile(r"[A-Z](?<![\w'\-]\w)[A-Za-z'\-]*[a-zA-Z]\b")
+_NAME_FOLLOWING_TOKEN_REGEX = re.compile(r"\s+([A-Z][A-Za-z'\-]*[a-zA-Z])\b")
+
+# Small built-in dictionary of common US first names and surnames, chosen to avoid words that
+# also appear capitalized in clinical text (e.g. "May", "Will", "Long", "Parkinson").
+# Extend with ROSETTA_LOCAL_DEID_NAMES_FILE (one name per line; multi-word entries allowed).
+DEFAULT_NAME_DICTIONARY = """
+james john robert michael william david richard joseph thomas charles christopher daniel matthew
+anthony donald steven paul andrew joshua kenneth kevin brian george timothy ronald edward jason
+jeffrey ryan jacob gary nicholas eric jonathan stephen larry justin scott brandon benjamin samuel
+gregory alexander patrick jack dennis jerry tyler aaron jose adam nathan henry zachary douglas
+peter kyle noah ethan jeremy walter keith roger terry austin sean gerald carl harold
+dylan arthur lawrence jordan jesse bryan billy bruce gabriel joe logan alan juan albert willie
+elijah wayne randy vincent mason roy ralph bobby russell bradley philip eugene
+mary patricia jennifer linda elizabeth barbara susan jessica sarah karen lisa nancy betty sandra
+margaret ashley kimberly emily donna michelle carol amanda melissa deborah stephanie dorothy
+rebecca sharon laura cynthia amy kathleen angela shirley brenda emma anna pamela nicole samantha
+katherine christine helen debra rachel carolyn janet maria catherine heather diane olivia julie
+joyce victoria ruth lauren kelly christina joan evelyn judith andrea hannah megan cheryl
+jacqueline martha madison teresa gloria sara janice ann kathryn abigail sophia frances jean alice
+judy isabella julia beverly denise marilyn danielle brittany diana natalie theresa
+smith johnson williams jones garcia miller davis rodriguez martinez hernandez lopez gonzalez
+wilson anderson taylor moore jackson martin lee perez thompson harris sanchez clark ramirez
+lewis robinson walker allen wright torres nguyen flores adams nelson baker
+rivera campbell mitchell carter roberts gomez phillips evans turner diaz parker cruz
+edwards collins reyes stewart morris morales murphy rogers gutierrez ortiz morgan cooper
+peterson bailey howard ramos kim richardson watson chavez
+bennett mendoza ruiz hughes alvarez castillo sanders patel myers ross
+jimenez powell jenkins perry sullivan coleman butler henderson barnes
+gonzales fisher vasquez simmons romero patterson hamilton graham reynolds
+griffin wallace moreno hayes bryant herrera gibson ellis tran medina aguilar stevens
+murray castro marshall owens harrison fernandez mcdonald woods kennedy
+vargas chen freeman webb tucker guzman burns crawford olson simpson porter hunter gordon
+mendez silva shaw snyder dixon munoz hicks holmes palmer wagner robertson
+boyd salazar warren meyer schmidt garza daniels ferguson nichols
+stephens soto weaver gardner payne dunn kelley spencer hawkins arnold pierce
+hansen peters santos knight elliott cunningham duncan armstrong hudson carroll
+riley andrews alvarado delgado berry perkins hoffman johnston matthews pena richards
+contreras willis carpenter sandoval
+"""
+
+
+class NameMatcher:
+    """
+    Multi-pattern dictionary matcher for person names over capitalized word tokens.
+
+    Names are stored in a token trie (one level per word), so multi-word entries like
+    "Mary Ann" and single first/last names are matched in one left-to-right pass with a
+    greedy longest match. Adjacent matched names ("John Smith") are merged into one span.
+    """
+
+    def __init__(self, names):
+        self._trie = {}
+        self.size = 0
+        for name in names:
+            words = name.lower().split()
+            if not words:
+                continue
+            node = self._trie
+            for word in words:
+                node = node.setdefault(word, {})
+            if "" not in node:
+                node[""] = True # Terminal marker
+                self.size += 1
+
+    def find_spans(self, text):
+        """
+        Returns [(start, end)] character spans of dictionary names in `text`, in order.
+        """
+        spans = []
+        resume = 0
+        for match in _NAME_TOKEN_REGEX.finditer(text):
+            if match.start() < resume:
+                continue
+            node = self._trie.get(match.group().lower())
+            if node is None:
+                continue
+            # Extend over whitespace-separated following words while they stay in the trie
+            end = match.end() if "" in node else None
+            probe_end = match.end()
+            while True:
+                following = _NAME_FOLLOWING_TOKEN_REGEX.match(text, probe_end)
+                if following is None:
+                    break
+                node = node.get(following.group(1).lower())
+                if node is None:
+                    break
+                probe_end = following.end()
+                if "" in node:
+                    end = probe_end
+            if end is None:
+                continue
+            start = match.start()
+            if spans and text[spans[-1][1]:start] == " ":
+                spans[-1] = (spans[-1][0], end) # "John" + "Smith" -> one PERSON_NAME
+            else:
+                spans.append((start, end))
+            resume = end
+        return spans
+
+
+def load_name_dictionary(path=None):
+    names = DEFAULT_NAME_DICTIONARY.split()
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                names.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+            logger.info("Loaded local de-identification name dictionary", path=path)
+        except Exception as e:
+            logger.error("Error loading name dictionary; using the built-in list only", path=path, error=str(e))
+    return names
+
+
+def _luhn_valid(digits):
+    total = 0
+    for position, char in enumerate(reversed(digits)):
+        value = int(char)
+        if position % 2 == 1:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+class LocalDeidentifier:
+    """
+    Offline de-identifier. deidentify(text) returns the text with identifiers replaced by
+    [INFO_TYPE] tokens; find_spans(text) returns the (start, end, info_type) spans it would replace.
+    """
+
+    def __init__(self, names=None):
+        self.name_matcher = NameMatcher(names if names is not None else load_name_dictionary())
+
+    def _pattern_spans(self, text):
+        # (start, end, info_type, priority) from every scanner; lower priority wins a tie
+        candidates = []
+        for match in _LABEL_REGEX.finditer(text):
+            info_type = match.lastgroup
+            candidates.append((match.start(info_type), match.end(info_type), info_type, 0))
+        if "@" in text:
+            at = text.find("@")
+            while at != -1:
+                local = _EMAIL_LOCAL_REGEX.search(text, max(0, at - _EMAIL_MAX_LOCAL_CHARS), at)
+                domain = _EMAIL_DOMAIN_REGEX.match(text, at + 1)
+                if local and domain:
+                    candidates.append((local.start(), domain.end(), "EMAIL_ADDRESS", 1))
+                at = text.find("@", at + 1)
+        for match in _NUMBER_REGEX.finditer(text):
+            info_type = match.lastgroup
+            value = match.group()
+            if info_type == "IP_ADDRESS" and any(int(octet) > 255 for octet in value.split(".")):
+                continue
+            if info_type == "CREDIT_CARD_NUMBER":
+                digits = "".join(char for char in value if char.isdigit())
+                if not (13 <= len(digits) <= 19 and _luhn_valid(digits)):
+                    continue
+            candidates.append((match.start(), match.end(), info_type, 2))
+        for match in _MONTH_DATE_REGEX.finditer(text):
+            candidates.append((match.start(), match.end(), "DATE", 3))
+
+        # Leftmost match wins; at the same start the labelled/more specific scanner wins
+        candidates.sort(key=lambda span: (span[0], span[3]))
+        spans = []
+        last_end = 0
+        for start, end, info_type, _ in candidates:
+            if start >= last_end:
+                spans.append((start, end, info_type))
+                last_end = end
+        return spans
+
+    def find_spans(self, text):
+        spans = self._pattern_spans(text)
+        name_spans = self.name_matcher.find_spans(text)
+        if name_spans:
+            # Dictionary names only fill gaps; pattern matches (emails, titled names) win overlaps
+            merged = list(spans)
+            taken = iter(spans)
+            current = next(taken, None)
+            for start, end in name_spans:
+                while current is not None and current[1] <= start:
+                    current = next(taken, None)
+                if current is None or end <= current[0]:
+                    merged.append((start, end, "PERSON_NAME"))
+            spans = sorted(merged)
+        return spans
+
+    def deidentify(self, text):
+        if not text:
+            return text
+        out = []
+        last_end = 0
+        for start, end, info_type in self.find_spans(text):
+            if start < last_end:
+                continue
+            out.append(text[last_end:start])
+            out.append(f"[{info_type}]")
+            last_end = end
+        out.append(text[last_end:])
+        return "".join(out)
+
+
+def normalize_deid_mode(mode, default=DEID_MODE_DLP):
+    """
+    Returns a valid de-identification mode for a request/env value ("dlp", "local",
+    "local_then_dlp"), or raises ValueError for anything else.
+    """
+    if not mode:
+        return default
+    mode = str(mode).strip().lower().replace("-", "_")
+    if mode not in DEID_MODES:
+        raise ValueError(f"Unknown de-identification mode '{mode}'. Expected one of: {', '.join(DEID_MODES)}.")
+    return mode
@@ -0,0 +1,234 @@
+import atexit
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+# --- Structured, non-blocking logging ---
+# Request paths log through the standard `logging` module into a bounded in-memory queue; a
+# background listener thread formats the records and writes them to stdout. A slow stdout (log
+# ingestion on Cloud Run) therefore never blocks a request, and when the queue is full records
+# are dropped and counted instead of waiting.
+#
+# Records are one JSON object per line by default ("severity"/"message" are what Cloud Logging
+# picks up), with any keyword fields passed to the logger:
+#     logger = get_logger(__name__)
+#     logger.info("Note saved", filename=filename, store="sqlite")
+#
+# Prompts, notes and patient text are logged as length + hash (payload_fields) unless full
+# payload logging is switched on for debugging; long string fields are truncated either way.
+
+FORMAT_JSON = "json"
+FORMAT_TEXT = "text"
+TRUNCATION_SUFFIX = "...[+{} chars]"
+HASH_CHARS = 16
+
+# Keyword arguments the stdlib logger understands; everything else becomes a structured field
+_LOGGING_KWARGS = ("exc_info", "stack_info", "stacklevel", "extra")
+
+_settings = {"full_payloads": False}
+_state = {"handler": None, "listener": None, "queue_size": 10000, "handlers": None, "drop_hook": None}
+
+
+class RosettaLogger(logging.LoggerAdapter):
+    """
+    Logger that accepts structured fields as keyword arguments.
+    """
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOGGING_KWARGS}
+        if fields:
+            extra = dict(kwargs.get("extra") or {})
+            extra["fields"] = dict(extra.get("fields") or {}, **fields)
+            kwargs["extra"] = extra
+        return msg, kwargs
+
+
+def get_logger(name):
+    return RosettaLogger(logging.getLogger(name), {})
+
+
+def full_payloads_enabled():
+    return _settings["full_payloads"]
+
+
+def describe_payload(text):
+    """
+    (length, short SHA-256) of a prompt/note/patient text: enough to correlate log lines
+    without writing the text itself.
+    """
+    text = text or ""
+    return len(text), hashlib.sha256(text.encode("utf-8", "replace")).hexdigest()[:HASH_CHARS]
+
+
+def payload_fields(name, text):
+    """
+    Structured fields for a potentially large or PHI-bearing text: `<name>_chars` and
+    `<name>_sha256`, plus `<name>` itself only when full payload logging is on.
+    """
+    length, digest = describe_payload(text)
+    fields = {f"{name}_chars": length, f"{name}_sha256": digest}
+    if _settings["full_payloads"]:
+        fields[name] = text
+    return fields
+
+
+def truncate(value, max_chars):
+    if not max_chars or len(value) <= max_chars:
+        return value
+    return value[:max_chars] + TRUNCATION_SUFFIX.format(len(value) - max_chars)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON line (or "time LEVEL logger: message key=value" text), with
+    string values longer than `max_field_chars` truncated (0 disables truncation).
+    """
+
+    def __init__(self, output_format=FORMAT_JSON, max_field_chars=1000):
+        super().__init__()
+        self.output_format = output_format
+        self.max_field_chars = max_field_chars
+
+    def _clip(self, value):
+        if isinstance(value, str):
+            return truncate(value, self.max_field_chars)
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        return truncate(str(value), self.max_field_chars)
+
+    def format(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds")
+        message = self._clip(record.getMessage())
+        fields = {key: self._clip(value) for key, value in (getattr(record, "fields", None) or {}).items()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if self.output_format == FORMAT_TEXT:
+            line = f"{timestamp} {record.levelname} {record.name}: {message}"
+            if fields:
+                line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            if record.exc_text:
+                line += "\n" + record.exc_text
+            return line
+        entry = {"time": timestamp, "severity": record.levelname, "logger": record.name, "message": message}
+        entry.update(fields)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    """
+    Lets through a `rate` fraction of DEBUG records; INFO and above always pass.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1.0 or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never waits: if the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; here the record is only made self-contained
+        # (args merged, traceback rendered while the frames still exist)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            if _state["drop_hook"] is not None:
+                _state["drop_hook"]()
+
+
+def _start_listener():
+    log_queue = queue.Queue(maxsize=_state["queue_size"])
+    handler = _state["handler"]
+    handler.queue = log_queue
+    listener = logging.handlers.QueueListener(log_queue, *_state["handlers"], respect_handler_level=True)
+    listener.start()
+    _state["listener"] = listener
+
+
+def _restart_listener_after_fork():
+    # The listener thread does not survive fork(); a forked worker gets its own queue and thread
+    if _state["handler"] is not None:
+        _start_listener()
+
+
+def _stop_listener():
+    listener = _state["listener"]
+    if listener is not None:
+        _state["listener"] = None
+        listener.stop() # Drains what is already queued
+
+
+def configure_logging(level="INFO", output_format=FORMAT_JSON, full_payloads=False, max_field_chars=1000,
+                      debug_sample_rate=1.0, queue_size=10000, stream=None):
+    """
+    Routes the root logger through the non-blocking queue to `stream` (stdout by default).
+    Safe to call again (e.g. to change the level); the previous handler is replaced.
+    """
+    _settings["full_payloads"] = full_payloads
+    root = logging.getLogger()
+    if _state["handler"] is not None:
+        root.removeHandler(_state["handler"])
+        _stop_listener()
+
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(output_format, 0 if full_payloads else max_field_chars))
+    handler = NonBlockingQueueHandler(None)
+    handler.addFilter(DebugSampler(debug_sample_rate))
+    _state.update(handler=handler, handlers=[stream_handler], queue_size=queue_size)
+    _start_listener()
+
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+
+def set_drop_hook(callback):
+    """
+    Registers a no-argument callable run for every dropped record (e.g. a metrics counter).
+    """
+    _state["drop_hook"] = callback
+
+
+def logging_stats():
+    handler = _state["handler"]
+    listener = _state["listener"]
+    return {
+        "dropped_records": handler.dropped if handler else 0,
+        "queued_records": listener.queue.qsize() if listener else 0,
+        "full_payloads": _settings["full_payloads"],
+    }
+
+
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+atexit.register(_stop_listener)
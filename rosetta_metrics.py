@@ -0,0 +1,313 @@
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from rosetta_logging import get_logger
+from rosetta_process import pid_alive
+
+logger = get_logger(__name__)
+
+# --- Prometheus-text metrics ---
+# Counters, gauges and histograms with labels, rendered in the Prometheus text exposition
+# format at /metrics. No client library needed.
+#
+# Under gunicorn every worker is its own process, so a scrape only reaches one of them. With
+# a metrics directory, each process writes a snapshot of its values there (at most every
+# `flush_interval_seconds`, and at exit) and /metrics sums the snapshots of every process
+# started by the same master (files are keyed by parent pid, so earlier server runs are
+# ignored):
+#   - counters and histograms include workers that have exited, so totals never go backwards
+#     when gunicorn recycles a worker;
+#   - gauges (in-flight requests) only include processes that are still alive.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+METRIC_NAME_PATTERN = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+SNAPSHOT_PATTERN = re.compile(r"^metrics_(\d+)_(\d+)\.json$")
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        if not METRIC_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid metric name: {name}")
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # tuple of label values -> value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _snapshot_values(self):
+        # Caller holds the registry lock
+        return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self.registry.updating():
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.updating():
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.updating():
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames, buckets):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.updating():
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0] # per-bucket counts, +Inf, sum
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[position] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class MetricsRegistry:
+    """
+    Holds the metric families of this process. `multiprocess_dir` (optional) enables the
+    cross-process aggregation described at the top of this module.
+    """
+
+    def __init__(self, multiprocess_dir=None, flush_interval_seconds=1.0):
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval_seconds = flush_interval_seconds
+        self._lock = threading.RLock()
+        self._families = {}
+        self._pid = None
+        self._dirty = False
+        self._flush_thread = None
+        if multiprocess_dir:
+            os.makedirs(multiprocess_dir, exist_ok=True)
+            atexit.register(self.flush)
+
+    # --- Registration ---
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._families:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._families[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    # --- Process bookkeeping ---
+
+    @contextmanager
+    def updating(self):
+        with self._lock:
+            self._check_process()
+            yield
+            self._dirty = True
+
+    def _check_process(self):
+        # Caller holds the lock. A forked worker starts from zero (values inherited from the
+        # parent belong to the parent) and needs its own flush thread.
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        self._pid = pid
+        for metric in self._families.values():
+            metric._values = {}
+        if self.multiprocess_dir:
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="rosetta-metrics-flush", daemon=True)
+            self._flush_thread.start()
+
+    def _snapshot_path(self):
+        return os.path.join(self.multiprocess_dir, f"metrics_{os.getppid()}_{os.getpid()}.json")
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval_seconds)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes this process's snapshot to the metrics directory (no-op without one).
+        """
+        if not self.multiprocess_dir:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                return # Nothing recorded in this process yet
+            snapshot = {name: metric._snapshot_values() for name, metric in self._families.items()}
+            self._dirty = False
+        path = self._snapshot_path()
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "values": snapshot}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot", path=path, error=str(e))
+
+    # --- Aggregation and rendering ---
+
+    def _collect_snapshots(self):
+        # [(pid, alive, {name: [[labelvalues, value], ...]})] for the other processes of this
+        # server; snapshots left behind by earlier runs are removed
+        snapshots = []
+        group, own_pid = os.getppid(), os.getpid()
+        try:
+            filenames = os.listdir(self.multiprocess_dir)
+        except FileNotFoundError:
+            return snapshots
+        for filename in filenames:
+            match = SNAPSHOT_PATTERN.match(filename)
+            if not match:
+                continue
+            file_group, pid = int(match.group(1)), int(match.group(2))
+            path = os.path.join(self.multiprocess_dir, filename)
+            if file_group != group:
+                if not pid_alive(file_group) and not pid_alive(pid):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            if pid == own_pid:
+                continue # Live values are used instead
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append((pid, pid_alive(pid), json.load(f)["values"]))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Skipping unreadable metrics snapshot", path=path, error=str(e))
+        return snapshots
+
+    def _merged_values(self):
+        with self._lock:
+            merged = {}
+            for name, metric in self._families.items():
+                if self._pid == os.getpid():
+                    merged[name] = {key: (list(value) if isinstance(value, list) else value) for key, value in metric._values.items()}
+                else:
+                    merged[name] = {}
+        if not self.multiprocess_dir:
+            return merged
+        for _, alive, values in self._collect_snapshots():
+            for name, samples in values.items():
+                metric = self._families.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                target = merged[name]
+                for labelvalues, value in samples:
+                    key = tuple(labelvalues)
+                    if metric.kind == "histogram":
+                        current = target.get(key)
+                        if current is None or len(current) != len(value):
+                            target[key] = list(value) if current is None else current
+                        else:
+                            target[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = target.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        merged = self._merged_values()
+        lines = []
+        for name in sorted(self._families):
+            metric = self._families[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key in sorted(merged[name]):
+                value = merged[name][key]
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_format_labels(metric.labelnames, key)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric.buckets) + [math.inf], value[:-1]):
+                    cumulative += count
+                    labels = _format_labels(metric.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{name}_bucket{labels} {_format_value(cumulative)}")
+                lines.append(f"{name}_sum{_format_labels(metric.labelnames, key)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(metric.labelnames, key)} {_format_value(cumulative)}")
+        return "\n".join(lines) + "\n"
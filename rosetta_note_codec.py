@@ -0,0 +1,219 @@
+import gzip
+import os
+import threading
+
+from rosetta_logging import get_logger
+
+try:
+    import zstandard # Optional: needed for the "zstd" codec and to read .zst notes
+except ImportError:
+    zstandard = None
+
+logger = get_logger(__name__)
+
+# --- Compressed note files ---
+# The file note store can keep new notes compressed: "rosetta_note_..._MICU.txt" is stored as
+# "rosetta_note_..._MICU.txt.zst" (zstd) or ".txt.gz" (gzip). The API keeps using the .txt name;
+# the note index strips the suffix and every read decompresses by suffix, so a directory of old
+# plain files and new compressed ones works as one. Updates keep a note's existing format, and
+# `python rosetta_store.py recompress` converts existing notes in place.
+#
+# Clinical notes are short and alike, so a zstd dictionary trained on existing notes raises the
+# ratio of small notes considerably (`python rosetta_store.py train-dictionary`). Dictionaries
+# are saved in the notes directory (.dictionaries/zstd-<id>.dict) so backups carry them, and
+# every .zst frame names the dictionary it needs: retraining never makes older notes unreadable.
+#
+# Databases store note bodies the same way: encode_column() gives plain text (TEXT) or a
+# compressed frame (BLOB), and decode_column() tells the two apart by type and magic bytes, so
+# plain rows written before compression was turned on stay readable.
+
+CODEC_NONE = "none"
+CODEC_GZIP = "gzip"
+CODEC_ZSTD = "zstd"
+CODEC_SUFFIXES = {CODEC_GZIP: ".gz", CODEC_ZSTD: ".zst"}
+SUFFIX_CODECS = {suffix: codec for codec, suffix in CODEC_SUFFIXES.items()}
+NOTE_EXTENSION = ".txt"
+DICTIONARY_DIRECTORY = ".dictionaries"
+DICTIONARY_PATTERN = "zstd-{dict_id}.dict"
+DEFAULT_LEVELS = {CODEC_GZIP: 6, CODEC_ZSTD: 9}
+DEFAULT_DICTIONARY_BYTES = 112640 # zstd's default dictionary size (110 KB)
+# First bytes of a compressed frame, for database columns (which have no file suffix)
+FRAME_MAGIC = {b"\x1f\x8b": CODEC_SUFFIXES[CODEC_GZIP], b"\x28\xb5\x2f\xfd": CODEC_SUFFIXES[CODEC_ZSTD]}
+
+
+class NoteCodecError(OSError):
+    """
+    A note file could not be decoded (corrupt, or compressed with a codec that isn't available).
+    An OSError, so callers that skip unreadable files skip it too.
+    """
+
+
+def normalize_codec(name):
+    """
+    Returns a usable codec for a configured name: unknown names fall back to "none", and "zstd"
+    falls back to "gzip" when the zstandard package isn't installed.
+    """
+    name = (name or CODEC_NONE).strip().lower()
+    if name not in (CODEC_NONE, CODEC_GZIP, CODEC_ZSTD):
+        logger.warning("Unknown note compression; storing notes uncompressed", compression=name)
+        return CODEC_NONE
+    if name == CODEC_ZSTD and zstandard is None:
+        logger.warning("zstandard is not installed; compressing notes with gzip instead")
+        return CODEC_GZIP
+    return name
+
+
+def split_note_name(name):
+    """
+    ("rosetta_note_x.txt", ".zst") for a stored note file name, (name, "") for a plain note, or
+    None when `name` is not a note file.
+    """
+    for suffix in SUFFIX_CODECS:
+        if name.endswith(NOTE_EXTENSION + suffix):
+            return name[:-len(suffix)], suffix
+    if name.endswith(NOTE_EXTENSION):
+        return name, ""
+    return None
+
+
+class NoteCodec:
+    """
+    Encodes new note files with `codec` and decodes any stored format by its file suffix.
+    With `use_dictionary`, zstd uses the newest dictionary in `dictionary_directory`.
+    Compressor objects are kept per thread (zstandard's are not thread-safe).
+    """
+
+    def __init__(self, codec=CODEC_NONE, level=None, dictionary_directory=None, use_dictionary=False):
+        self.codec = normalize_codec(codec)
+        self.level = level if level is not None else DEFAULT_LEVELS.get(self.codec)
+        self.dictionary_directory = dictionary_directory
+        self.suffix = CODEC_SUFFIXES.get(self.codec, "")
+        self._local = threading.local()
+        self._dictionaries = {} # dict_id -> ZstdCompressionDict
+        self._lock = threading.Lock()
+        self.dictionary_id = None
+        if self.codec == CODEC_ZSTD and use_dictionary:
+            self.dictionary_id = self._newest_dictionary_id()
+            if self.dictionary_id is None:
+                logger.warning("No trained zstd dictionary found; compressing without one", directory=dictionary_directory)
+
+    # --- Dictionaries ---
+
+    def _newest_dictionary_id(self):
+        if not self.dictionary_directory or not os.path.isdir(self.dictionary_directory):
+            return None
+        newest = None
+        for name in os.listdir(self.dictionary_directory):
+            prefix, suffix = DICTIONARY_PATTERN.split("{dict_id}")
+            if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].isdigit():
+                mtime = os.stat(os.path.join(self.dictionary_directory, name)).st_mtime
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, int(name[len(prefix):-len(suffix)]))
+        return newest[1] if newest else None
+
+    def _dictionary(self, dict_id):
+        with self._lock:
+            dictionary = self._dictionaries.get(dict_id)
+            if dictionary is None:
+                try:
+                    with open(dictionary_path(self.dictionary_directory or "", dict_id), "rb") as f:
+                        dictionary = zstandard.ZstdCompressionDict(f.read())
+                except OSError as e:
+                    raise NoteCodecError(f"zstd dictionary {dict_id} is missing: {e}") from e
+                self._dictionaries[dict_id] = dictionary
+            return dictionary
+
+    # --- Encoding ---
+
+    def _zstd_compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            dictionary = self._dictionary(self.dictionary_id) if self.dictionary_id is not None else None
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            self._local.compressor = compressor
+        return compressor
+
+    def encode(self, text, suffix=None):
+        """
+        File contents for `text`: bytes in the format of `suffix` (default: this codec's), or
+        the text itself for plain notes.
+        """
+        suffix = self.suffix if suffix is None else suffix
+        if not suffix:
+            return text
+        data = text.encode("utf-8")
+        if suffix == CODEC_SUFFIXES[CODEC_GZIP]:
+            return gzip.compress(data, compresslevel=self.level if self.codec == CODEC_GZIP else DEFAULT_LEVELS[CODEC_GZIP], mtime=0)
+        if zstandard is None:
+            raise NoteCodecError("zstandard is not installed; cannot write a .zst note")
+        if self.codec == CODEC_ZSTD:
+            return self._zstd_compressor().compress(data)
+        return zstandard.ZstdCompressor(level=DEFAULT_LEVELS[CODEC_ZSTD]).compress(data)
+
+    def decode(self, data, suffix):
+        if not suffix:
+            return data.decode("utf-8")
+        try:
+            if suffix == CODEC_SUFFIXES[CODEC_GZIP]:
+                return gzip.decompress(data).decode("utf-8")
+            if zstandard is None:
+                raise NoteCodecError("zstandard is not installed; cannot read a .zst note")
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            decompressors = getattr(self._local, "decompressors", None)
+            if decompressors is None:
+                decompressors = self._local.decompressors = {}
+            decompressor = decompressors.get(dict_id)
+            if decompressor is None:
+                dictionary = self._dictionary(dict_id) if dict_id else None
+                decompressor = decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+            return decompressor.decompress(data).decode("utf-8")
+        except NoteCodecError:
+            raise
+        except Exception as e:
+            raise NoteCodecError(f"Could not decode a {suffix} note: {e}") from e
+
+    def encode_column(self, text):
+        """
+        A database column value for `text`: the text itself, or the compressed frame as bytes.
+        """
+        return self.encode(text)
+
+    def decode_column(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        for magic, suffix in FRAME_MAGIC.items():
+            if value.startswith(magic):
+                return self.decode(value, suffix)
+        raise NoteCodecError("Stored note body is not a gzip or zstd frame")
+
+    def read(self, path):
+        """
+        The text of a note file in any stored format.
+        """
+        _, suffix = split_note_name(os.path.basename(path)) or (None, "")
+        if not suffix:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        with open(path, "rb") as f:
+            return self.decode(f.read(), suffix)
+
+    def snapshot(self):
+        return {"codec": self.codec, "level": self.level, "dictionary_id": self.dictionary_id}
+
+
+# --- Dictionary training ---
+
+def dictionary_path(dictionary_directory, dict_id):
+    return os.path.join(dictionary_directory, DICTIONARY_PATTERN.format(dict_id=dict_id))
+
+
+def train_dictionary(samples, dictionary_bytes=DEFAULT_DICTIONARY_BYTES):
+    """
+    Trains a zstd dictionary on note texts. Returns (dict_id, dictionary bytes).
+    """
+    if zstandard is None:
+        raise RuntimeError("Training a dictionary needs the zstandard package.")
+    if len(samples) < 10:
+        raise ValueError(f"Need at least 10 notes to train a dictionary, got {len(samples)}.")
+    dictionary = zstandard.train_dictionary(dictionary_bytes, [sample.encode("utf-8") for sample in samples])
+    return dictionary.dict_id(), dictionary.as_bytes()
@@ -0,0 +1,311 @@
+import bisect
+import os
+import re
+import threading
+import time
+
+from rosetta_logging import get_logger
+from rosetta_note_codec import split_note_name
+
+logger = get_logger(__name__)
+
+# --- In-memory index of saved notes ---
+# Built from disk once, then kept current by the save/delete paths in rosetta_backend.py.
+# Directory mtimes are re-checked (at most every `revalidate_seconds`) so files added or
+# removed by other workers or by hand are picked up without a full listdir per request.
+# Listing is served from a sorted list with cursor pagination.
+# Compressed notes ("x.txt.zst", see rosetta_note_codec.py) are indexed under their .txt name.
+
+# rosetta_note_YYYYMMDD_HHMM_SERVICE.txt (see generate_filename)
+NOTE_FILENAME_PATTERN = re.compile(r"^rosetta_note_(\d{8})_(\d{4})_(.+?)(?:_\d+)?\.txt$") # _2, _3: same-minute duplicates
+SHARD_DIRNAME_PATTERN = re.compile(r"^\d{6}$")
+# Directory mtimes this close to "now" may not reflect a write landing in the same clock tick,
+# so such directories are rescanned on the next revalidation instead of being trusted.
+MTIME_SETTLE_NS = 1_000_000_000
+UNSETTLED_MTIME = -1
+
+
+def _settled_mtime(mtime_ns):
+    if mtime_ns is not None and time.time_ns() - mtime_ns < MTIME_SETTLE_NS:
+        return UNSETTLED_MTIME
+    return mtime_ns
+
+
+def shard_for_filename(filename):
+    """
+    Returns the YYYYMM shard directory name for a generated note filename, or "" for
+    filenames that don't follow the generated format (custom names stay at the top level).
+    """
+    match = NOTE_FILENAME_PATTERN.match(filename)
+    return match.group(1)[:6] if match else ""
+
+
+def service_for_filename(filename):
+    match = NOTE_FILENAME_PATTERN.match(filename)
+    return match.group(3) if match else ""
+
+
+class NoteIndex:
+    """
+    Sorted, thread-safe index of note filenames under `directory`.
+
+    With `sharded=True` new notes are written to `directory/YYYYMM/`; notes already at the
+    top level (and custom-named notes) stay where they are and are still indexed. Filenames
+    are unique across shards, so the index maps filename -> shard.
+    """
+
+    def __init__(self, directory, sharded=False, revalidate_seconds=2.0):
+        self.directory = directory
+        self.sharded = sharded
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.RLock()
+        self._sorted_names = []   # ascending; listings walk it backwards (newest first)
+        self._shard_by_name = {}  # filename -> shard ("" for the top level)
+        self._suffix_by_name = {} # filename -> ".gz"/".zst" for compressed notes
+        self._dir_mtimes = None   # shard -> st_mtime_ns at last scan; None until first build
+        self._last_revalidated = 0.0
+        self.stats = {"full_scans": 0, "dir_rescans": 0, "revalidations": 0}
+
+    # --- Paths ---
+
+    def _dir_for_shard(self, shard):
+        return os.path.join(self.directory, shard) if shard else self.directory
+
+    def _shard_for_new(self, filename):
+        with self._lock:
+            shard = self._shard_by_name.get(filename) # Overwrites stay where the note already is
+        if shard is None:
+            shard = shard_for_filename(filename) if self.sharded else ""
+        return shard
+
+    def path_for_new(self, filename):
+        """
+        Path a newly saved note should be written to.
+        """
+        return os.path.join(self._dir_for_shard(self._shard_for_new(filename)), filename)
+
+    def path_for_existing(self, filename):
+        """
+        Path of an existing note, or None if it isn't in the index (after revalidating).
+        """
+        self.revalidate()
+        with self._lock:
+            shard = self._shard_by_name.get(filename)
+            suffix = self._suffix_by_name.get(filename, "")
+        if shard is None:
+            return None
+        return os.path.join(self._dir_for_shard(shard), filename + suffix)
+
+    # --- Building and revalidation ---
+
+    def _scan_dir(self, shard):
+        # Returns (mtime_ns, {note filename: suffix}) for one directory, or (None, {}) if it is missing
+        path = self._dir_for_shard(shard)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            names = {}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    parts = split_note_name(entry.name)
+                    if parts and entry.is_file():
+                        filename, suffix = parts
+                        # Plain + compressed copy: an interrupted recompression, same text
+                        if suffix or filename not in names:
+                            names[filename] = suffix
+            return mtime_ns, names
+        except FileNotFoundError:
+            return None, {}
+
+    def _list_shards(self):
+        shards = [""]
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if SHARD_DIRNAME_PATTERN.match(entry.name) and entry.is_dir():
+                        shards.append(entry.name)
+        except FileNotFoundError:
+            pass
+        return shards
+
+    def _replace_shard(self, shard, names):
+        # Caller holds the lock
+        stale = [name for name, name_shard in self._shard_by_name.items() if name_shard == shard]
+        for name in stale:
+            del self._shard_by_name[name]
+            self._suffix_by_name.pop(name, None)
+        for name, suffix in names.items():
+            self._shard_by_name[name] = shard
+            if suffix:
+                self._suffix_by_name[name] = suffix
+        self._sorted_names = sorted(self._shard_by_name)
+
+    def rebuild(self):
+        """
+        Full scan of the notes directory and its shard directories.
+        """
+        with self._lock:
+            self._shard_by_name = {}
+            self._suffix_by_name = {}
+            self._dir_mtimes = {}
+            for shard in self._list_shards():
+                mtime_ns, names = self._scan_dir(shard)
+                if mtime_ns is None and shard:
+                    continue
+                self._dir_mtimes[shard] = _settled_mtime(mtime_ns) # The top level is always tracked, even if missing
+                for name, suffix in names.items():
+                    self._shard_by_name[name] = shard
+                    if suffix:
+                        self._suffix_by_name[name] = suffix
+            self._sorted_names = sorted(self._shard_by_name)
+            self._last_revalidated = time.time()
+            self.stats["full_scans"] += 1
+            logger.info("Indexed notes", notes=len(self._sorted_names), directory=self.directory, directories=len(self._dir_mtimes))
+
+    def revalidate(self, force=False):
+        """
+        Re-scans only the directories whose mtime changed since they were last scanned.
+        """
+        with self._lock:
+            if self._dir_mtimes is None:
+                self.rebuild()
+                return
+            now = time.time()
+            if not force and now - self._last_revalidated < self.revalidate_seconds:
+                return
+            self._last_revalidated = now
+            self.stats["revalidations"] += 1
+
+            try:
+                top_mtime_ns = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                top_mtime_ns = None
+            if top_mtime_ns != self._dir_mtimes.get(""):
+                # The top level changed: files there, or shard directories added/removed
+                known_shards = set(self._dir_mtimes) | {""}
+                current_shards = set(self._list_shards())
+                for shard in known_shards - current_shards:
+                    self._dir_mtimes.pop(shard, None)
+                    self._replace_shard(shard, {})
+                for shard in current_shards - known_shards:
+                    self._dir_mtimes[shard] = None # Forces the scan below
+
+            for shard in list(self._dir_mtimes):
+                try:
+                    mtime_ns = os.stat(self._dir_for_shard(shard)).st_mtime_ns
+                except FileNotFoundError:
+                    mtime_ns = None
+                if mtime_ns == self._dir_mtimes.get(shard):
+                    continue
+                mtime_ns, names = self._scan_dir(shard)
+                self._replace_shard(shard, names)
+                if mtime_ns is None and shard:
+                    self._dir_mtimes.pop(shard, None)
+                else:
+                    self._dir_mtimes[shard] = _settled_mtime(mtime_ns)
+                self.stats["dir_rescans"] += 1
+
+    # --- Write/delete hooks ---
+
+    def add(self, filename, suffix=""):
+        """
+        Records a note that was just written to path_for_new(filename) + suffix.
+        """
+        shard = self._shard_for_new(filename)
+        with self._lock:
+            if self._dir_mtimes is None:
+                self.rebuild() # First use; the scan already picks the new file up
+                return
+            if filename not in self._shard_by_name:
+                bisect.insort(self._sorted_names, filename)
+            self._shard_by_name[filename] = shard
+            if suffix:
+                self._suffix_by_name[filename] = suffix
+            else:
+                self._suffix_by_name.pop(filename, None)
+            self._refresh_dir_mtime(shard)
+
+    def remove(self, filename):
+        with self._lock:
+            shard = self._shard_by_name.pop(filename, None)
+            self._suffix_by_name.pop(filename, None)
+            if shard is None:
+                return
+            position = bisect.bisect_left(self._sorted_names, filename)
+            if position < len(self._sorted_names) and self._sorted_names[position] == filename:
+                del self._sorted_names[position]
+            self._refresh_dir_mtime(shard)
+
+    def _refresh_dir_mtime(self, shard):
+        # Caller holds the lock. Our own write changed the directory mtime; record it so the
+        # next revalidation doesn't rescan for a change we already applied.
+        if self._dir_mtimes is None:
+            return
+        try:
+            self._dir_mtimes[shard] = _settled_mtime(os.stat(self._dir_for_shard(shard)).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        if shard:
+            try:
+                self._dir_mtimes[""] = _settled_mtime(os.stat(self.directory).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+
+    def all_paths(self):
+        """
+        [(filename, path)] for every indexed note, after revalidating. `path` is the stored file
+        (with its compression suffix, if any).
+        """
+        self.revalidate(force=True)
+        with self._lock:
+            return [
+                (name, os.path.join(self._dir_for_shard(self._shard_by_name[name]), name + self._suffix_by_name.get(name, "")))
+                for name in self._sorted_names
+            ]
+
+    # --- Listing ---
+
+    def list_page(self, limit=None, cursor=None, service=None, date_prefix=None):
+        """
+        Returns (filenames, next_cursor), newest first.
+
+        `cursor` is the last filename of the previous page. `date_prefix` matches the start of
+        the YYYYMMDD part of generated filenames (e.g. "2025", "202506", "20250614").
+        `service` matches the service abbreviation exactly (case-insensitive).
+        `next_cursor` is None once the listing is exhausted.
+        """
+        self.revalidate()
+        service = service.upper() if service else None
+        with self._lock:
+            names = self._sorted_names
+            # Walk backwards from just below the cursor (or the end)
+            end = bisect.bisect_left(names, cursor) if cursor else len(names)
+            start = 0
+            if date_prefix:
+                # Generated names with this date prefix form one contiguous run
+                name_prefix = f"rosetta_note_{date_prefix}"
+                start = bisect.bisect_left(names, name_prefix)
+                end = min(end, bisect.bisect_left(names, name_prefix + "\uffff"))
+
+            # Collect one extra match to know whether another page exists
+            page = []
+            position = end - 1
+            while position >= start and (limit is None or len(page) <= limit):
+                name = names[position]
+                position -= 1
+                if service and service_for_filename(name).upper() != service:
+                    continue
+                page.append(name)
+
+            if limit is not None and len(page) > limit:
+                page = page[:limit]
+                return page, page[-1]
+            return page, None
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["notes"] = len(self._sorted_names)
+            stats["compressed_notes"] = len(self._suffix_by_name)
+            stats["directories"] = len(self._dir_mtimes or {})
+            stats["sharded"] = self.sharded
+            return stats
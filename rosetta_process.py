@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+
+# --- Per-process helpers ---
+# Several modules coordinate the gunicorn workers on a host through files or SQLite databases:
+# the note store and search index, the job queue, write-behind journals, single-flight locks
+# and metrics snapshots. They share the two helpers here: pid_alive() tells whether another
+# worker that left state behind is still running, and SqliteConnections hands each thread of
+# each process its own connection (a connection must not be used across fork()).
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, owned by someone else
+    return True
+
+
+class SqliteConnections:
+    """
+    One SQLite connection per thread and process for the database at `path`, in WAL mode
+    with synchronous=NORMAL (durable across app crashes; WAL makes this safe). Connections
+    use isolation_level=None, so transactions are the explicit ones of write_transaction().
+    `pragmas` are extra "PRAGMA ..." statements run on every new connection, and `functions`
+    maps names to one-argument Python functions registered as SQL functions on it.
+    """
+
+    def __init__(self, path, busy_timeout_seconds=10.0, row_factory=sqlite3.Row, pragmas=(), functions=None):
+        self.path = path
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.row_factory = row_factory
+        self.pragmas = tuple(pragmas)
+        self.functions = dict(functions or {})
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_seconds, isolation_level=None)
+            if self.row_factory is not None:
+                connection.row_factory = self.row_factory
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            for pragma in self.pragmas:
+                connection.execute(f"PRAGMA {pragma}")
+            for name, function in self.functions.items():
+                connection.create_function(name, 1, function, deterministic=True)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def write_transaction(self, work):
+        """
+        Runs work(connection) in a transaction and returns its result. BEGIN IMMEDIATE takes
+        the write lock up front, so a read-check-write in `work` can't interleave with another
+        writer (other threads or gunicorn workers).
+        """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
@@ -0,0 +1,339 @@
+import functools
+
+from rosetta_streaming import THOUGHTS_START_DELIM, THOUGHTS_END_DELIM
+
+# --- Prompt compiler ---
+# Every static piece of the Gemini prompt is built once at import time. The only
+# option-dependent piece (the "User-Selected Options" section) is memoized per
+# canonical set of enabled option IDs, so handle_generate_note no longer rebuilds
+# these strings on every request.
+
+# --- Preferred Shorthand Glossary ---
+PREFERRED_SHORTHAND_GLOSSARY = {
+    "patient": "pt",
+    "history": "hx",
+    "chief complaint": "CC",
+    "medication": "med",
+    "prescription": "Rx",
+    "diagnosis": "Dx",
+    "treatment": "Tx",
+    "symptoms": "s/s",
+    "signs and symptoms": "s/s",
+    "no known allergies": "NKA",
+    "as needed": "prn",
+    "by mouth": "PO",
+    "twice a day": "BID",
+    "three times a day": "TID",
+    "four times a day": "QID",
+    "every day": "daily", # Changed from QD for clarity, QD can be ambiguous
+    "every other day": "QOD",
+    "hour": "hr",
+    "hours": "hrs",
+    "immediately": "stat",
+    "complains of": "c/o",
+    "year old": "y/o",
+    "male": "M",
+    "female": "F",
+    "blood pressure": "BP",
+    "heart rate": "HR",
+    "temperature": "T",
+    "in the setting of": "iso",
+    "respiratory rate": "RR",
+    "oxygen saturation": "O2 sat",
+    "physical exam": "PE",
+    "review of systems": "ROS",
+    "past medical history": "PMH",
+    "family history": "FHx",
+    "social history": "SHx",
+    "assessment and plan": "A/P",
+    "differential diagnosis": "DDx",
+    "follow up": "f/u",
+    "range of motion": "ROM",
+    "activities of daily living": "ADLs",
+    "shortness of breath": "SOB",
+    "loss of consciousness": "LOC",
+    "motor vehicle accident": "MVA",
+    "gunshot wound": "GSW",
+    "intravenous": "IV",
+    "intramuscular": "IM",
+    "subcutaneous": "SQ",
+    "nothing by mouth": "NPO",
+    "with": "w/",
+    "without": "w/o",
+    "approximately": "approx",
+    "continue": "cont",
+    "discontinue": "d/c",
+    "evaluate": "eval",
+    "management": "mgmt",
+    "negative": "neg",
+    "positive": "pos",
+    "previous": "prev",
+    "significant": "sig",
+    "status post": "s/p",
+    "versus": "vs",
+    "within normal limits": "WNL",
+}
+
+# Core Rosetta Instructions - To be prepended by the backend (see STATIC_PROMPT_PREFIX)
+ROSETTA_SYSTEM_INSTRUCTION = """You are Rosetta, an attending physician AI assistant. Generate clinically precise, concise medical notes mimicking human attending physicians. Output plaintext only—no markdown, unless explicitly required by a user-provided template (e.g., EPIC SmartPhrases).
+
+Key Directives:
+
+Ensure accuracy and clinical realism. Do not fabricate or assume data. Explicitly state 'unknown' if data is missing or cannot be reasonably inferred from the provided context. If making a clinical inference, briefly state the basis for that inference.
+
+Prioritize PII redaction (names, MRNs, dates -> relative time).
+
+Follow user-specified formatting (SHN, VSHN, SOAP, H&P, etc.). Prioritize user-provided templates over standard formats if a template is given.
+
+Adhere to relevant clinical guidelines and pathophysiology when requested. Integrate guideline recommendations into the plan where appropriate, citing sources if possible (e.g., PMID, calculator name).
+
+Validate compliance with standard documentation norms (e.g., Joint Commission, CMS) where applicable.
+
+If input is ambiguous or inconsistent, identify the ambiguity/inconsistency and state how you have chosen to interpret it for the note, or if necessary, indicate that clarification is needed."""
+
+ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS = """For each request:
+
+New Patient: Generate questions in the form: Plan to ask about [X] to assess [Y]. Provide Impression & A&P.
+
+Updates: Integrate new data into appropriate note sections. Synthesize new data with existing information, commenting on the significance of key findings (e.g., abnormal labs, relevant physical exam findings) in the context of the patient's condition.
+
+Missing Data: Use phrases like Indicated to obtain [test] due to [reason] or Plan to further assess [symptom]. Explicitly state when information for a standard section (e.g., Allergies, Family History) is not available in the provided data.
+
+Note Structure:
+
+Impression: Provide a concise summary statement.
+
+Subjective: HPI, PMH, SHx, FHx, ROS. Qualify information based on source (e.g., "Patient reports...", "Per family...").
+
+Objective: Vitals, PE, Labs, Imaging. Include relevant positive and negative findings.
+
+Assessment & Plan (A&P):
+- Structure the A&P by problem if requested. Otherwise, group related issues logically.
+- For each problem/assessment:
+    - State the likely diagnosis or differential.
+    - Briefly justify the assessment based on subjective and objective findings.
+    - If requested, include relevant pathophysiology connected to the patient's case.
+- Plan:
+    - Use hyphenated lists (e.g., - Recommendation) for all plan actions.
+    - Ensure plans are specific, actionable, and appropriate (e.g., specify medication dosage/route/frequency if inferable, specify type of imaging/lab).
+    - Include follow-up plans and patient education points where relevant.
+    - Consider including brief contingency plans or warning signs to monitor for."""
+# The "IMPORTANT PREAMBLE" paragraph that used to close these instructions duplicated
+# THOUGHTS_INSTRUCTION below; its content now lives there only.
+
+# Instruction for the LLM to provide its "thoughts" before the note
+THOUGHTS_INSTRUCTION = (
+    "IMPORTANT PREAMBLE: Before generating the medical note based on the user's request that follows, "
+    "first provide your analytical thoughts, reasoning, and implications of the given patient information and selected options. "
+    "This 'thoughts' section should explain your high-level interpretation and any critical considerations before you proceed to construct the note, "
+    "including key diagnostic anchors, potential red flags, significant positive and negative findings, and any critical missing information that impacts your assessment and plan. "
+    "Delimit this entire 'thoughts' section clearly with the following markers:\n"
+    f"{THOUGHTS_START_DELIM}\n"
+    "[Your analytical thoughts and implications here]\n"
+    f"{THOUGHTS_END_DELIM}\n\n"
+    f"After the '{THOUGHTS_END_DELIM}' marker, then proceed to generate the complete medical note as requested by the main prompt below.\n\n"
+)
+
+# Everything that precedes the dynamic request in every prompt
+STATIC_PROMPT_PREFIX = (
+    f"{THOUGHTS_INSTRUCTION}"
+    f"{ROSETTA_SYSTEM_INSTRUCTION}\n\n"
+    f"{ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS}\n\n"
+)
+
+# Map option IDs from frontend to specific instructions for LLM
+OPTION_TO_INSTRUCTION_MAP = {
+    "genSHN": "- Output Format: Generate SHN (Short-hand Notation). Rephrase full note using standard clinical abbreviations while maintaining clarity. Prioritize abbreviations from the 'Preferred Shorthand Glossary' if provided.",
+    "genVSHN": "- Output Format: Generate VSHN (Very Short-hand Notation). Distill into ultra-concise, rapid-style shorthand. Omit non-critical detail. Use standard medical abbreviations where appropriate, prioritizing those from the 'Preferred Shorthand Glossary' if provided. Avoid uncommon abbreviations or excessive capitalization. DO NOT use underscores (_) to connect words; instead, use terse phrasing or standard abbreviations.",
+    "formatByProblem": "- A&P Structure: Format the Assessment & Plan section 'By Problem'. (Detailed instructions for 'By Problem' A&P will be appended if this is selected).",
+    "genAandPOnly": "- Output Content: Generate ONLY the Assessment & Plan section, structured 'By Problem'. Omit all other sections like Impression, Subjective (HPI, ROS, PMH, SHx, FHx), and Objective (Vitals, PE, Labs, Imaging). The 'By Problem' A&P formatting instructions still apply.",
+    "incPathophys": "- Reasoning Detail: Include full pathophysiologic reasoning in the Assessment & Plan.",
+    "incGuidelines": "- Reasoning Detail: Include guideline recommendations if relevant.",
+    "formatSOAP": "- Documentation Type: Use SOAP format (if no overriding template is provided).",
+    "formatHnP": "- Documentation Type: Use Full H&P format (if no overriding template is provided).",
+    "formatDischarge": "- Documentation Type: Use Discharge summary format (if no overriding template is provided).",
+    "formatPreOp": "- Documentation Type: Use Pre-op note format (if no overriding template is provided).",
+    # Updated Context Options
+    "specAnesthesia": "- Context: Anesthesia. Tailor questions, assessment, and plan accordingly.",
+    "specDerm": "- Context: Dermatology. Tailor questions, assessment, and plan accordingly.",
+    "specFM": "- Context: Family Medicine. Tailor questions, assessment, and plan accordingly.",
+    "specIM": "- Context: Internal Medicine. Tailor questions, assessment, and plan accordingly.",
+    "specNeuro": "- Context: Neurology. Tailer questions, assessment, and plan accordingly.",
+    "specOBGYN": "- Context: OBGYN. Tailer questions, assessment, and plan accordingly.",
+    "specPeds": "- Context: Pediatrics. Tailer questions, assessment, and plan accordingly.",
+    "specPsych": "- Context: Psychiatry. Tailer questions, assessment, and plan accordingly.",
+    "specSurgeryGen": "- Context: Surgery (General). Tailer questions, assessment, and plan accordingly.",
+    "incMissingData": "- Output Feature: Include a checklist of missing objective data that would be relevant.",
+    "genHistoryQuestions": "- Output Feature: Generate comprehensive history questions relevant to the patient's presentation. These should cover aspects of HPI (History of Present Illness), ROS (Review of Systems), PMH (Past Medical History), SHx (Social History), FHx (Family History), Medications, and Allergies as appropriate. Questions should be integrated into their respective sections within the note; if these sections do not exist, create them. Phrase questions naturally for a patient interview.",
+    "genPEManeuvers": "- Assistance Request: Suggest relevant physical exam maneuvers based on the provided patient information, including potential findings and reasoning.",
+    "genROSTemplate": "- Output Feature: Generate a Review of Systems (ROS) question template. These questions should be relevant to the patient's presentation (from input or existing note) and should be formatted to appear after the Subjective section of the main note.",
+    "genChartReview": "- Output Feature: Generate a 'Chart Review Checklist'. This checklist MUST be placed at the VERY BEGINNING of the entire note, before any other content (including Impression). The style should be concise, like a hurried checklist, but each item must be accurate, thoughtful, and include a brief explanation for why that piece of information is needed from the chart. This checklist takes precedence in placement over the standard note structure.",
+    "confirmDeidentified": "- Redaction: Confirm data is de-identified (this is a primary instruction; ensure PII is removed).",
+    "removeDates": "- Redaction: Remove specific dates and convert to relative time where appropriate (e.g., 'yesterday', 'last week').",
+    "stripNonStandardAbbr": "- Output Feature: Include all abbreviations from the input, including non-standard ones."
+}
+
+BY_PROBLEM_INSTRUCTIONS = "\n".join([
+    "\nDetailed Instructions for 'Assessment & Plan By Problem' (apply if 'A&P Only' or 'Assessment & Plan by problem' is selected):",
+    "Structure the Assessment and Plan (A&P) section 'By Problem'. For EACH problem identified, strictly follow this format:\n",
+    "#Problem Name (e.g., #Hypertension)",
+    "Assessment: [Concisely define the problem based on available lab/history/physical exam/presentation details. Include likely or possible etiologies for this patient. Describe the patient's current state or status regarding this problem.]",
+    "Plan:",
+    "- [Specific action/recommendation 1 for this problem]",
+    "- [Specific action/recommendation 2 for this problem]",
+    "  - [Sub-point or further detail for action 2, if any, indented]",
+    "- [Continue with more hyphenated plan items as needed for THIS problem, grouped logically as an attending physician would.]\n",
+    "General Rules for 'By Problem' A&P:",
+    "- Each problem MUST start with a '#' followed by the problem name.",
+    "- The 'Assessment:' part for each problem should be a comprehensive but concise paragraph.",
+    "- The 'Plan:' part for each problem MUST use hyphenated lists for actionable items.",
+    "- Ensure clinical reasoning is evident in the grouping and content of plan items.",
+])
+
+# Apply SHN/VSHN to the A&P content if those options are also selected
+AANDP_ONLY_VSHN_INSTRUCTION = "\nIMPORTANT FOR A&P Only + VSHN: Apply VSHN principles (ultra-concise, rapid-style shorthand) to the generated Assessment & Plan section. Prioritize abbreviations from the 'Preferred Shorthand Glossary'."
+AANDP_ONLY_SHN_INSTRUCTION = "\nIMPORTANT FOR A&P Only + SHN: Apply SHN principles (standard clinical abbreviations) to the generated Assessment & Plan section, prioritizing abbreviations from the 'Preferred Shorthand Glossary', while maintaining clarity."
+BY_PROBLEM_VSHN_INSTRUCTION = "\nIMPORTANT FOR VSHN + By Problem A&P: After structuring the A&P 'By Problem', apply VSHN principles (ultra-concise, rapid-style shorthand) to the ENTIRE note, including the content within each problem's Assessment and Plan. Prioritize abbreviations from the 'Preferred Shorthand Glossary'. Strive for maximum brevity while retaining the problem-oriented structure."
+BY_PROBLEM_SHN_INSTRUCTION = "\nIMPORTANT FOR SHN + By Problem A&P: After structuring the A&P 'By Problem', apply SHN principles (standard clinical abbreviations) to the ENTIRE note, including the content within each problem's Assessment and Plan, prioritizing abbreviations from the 'Preferred Shorthand Glossary', while maintaining clarity."
+
+def _build_glossary_instruction(glossary):
+    if not glossary: # Check if glossary is not empty
+        return ""
+    glossary_items_string = "\n".join([f"- '{full}': use '{abbr}'" for full, abbr in glossary.items()])
+    return (
+        "\n\nPreferred Shorthand Glossary (use these abbreviations when generating SHN/VSHN):\n"
+        "---------------------------------------------------------------------------------\n"
+        f"{glossary_items_string}\n"
+        "---------------------------------------------------------------------------------\n"
+        "If a term is not in this glossary, use standard clinical judgment for abbreviation, "
+        "but refer to this list first for consistency. Avoid inventing new or highly unusual abbreviations."
+    )
+
+GLOSSARY_INSTRUCTION = _build_glossary_instruction(PREFERRED_SHORTHAND_GLOSSARY)
+# Sent instead of the glossary when the backend applies it itself (rosetta_shorthand.py)
+GLOSSARY_APPLIED_LOCALLY_INSTRUCTION = (
+    "\n\nShorthand Glossary: The preferred glossary abbreviations (e.g. 'pt', 'w/', 's/p', 'f/u') are applied automatically "
+    "after generation. Use standard clinical abbreviations otherwise; avoid inventing new or highly unusual abbreviations."
+)
+
+def canonical_option_key(options):
+    """
+    Reduces a frontend options dict (e.g. {"genSHN": true, "incPathophys": false}) to the
+    frozenset of enabled, known option IDs. Unknown IDs never affected the prompt, so they
+    are dropped here too.
+    """
+    if not options:
+        return frozenset()
+    return frozenset(opt_id for opt_id, is_checked in options.items() if is_checked and opt_id in OPTION_TO_INSTRUCTION_MAP)
+
+@functools.lru_cache(maxsize=512)
+def _compile_options_section_cached(enabled_options, include_glossary=True):
+    selected_options_instructions = ["\nUser-Selected Options for this request:"]
+
+    # Conflict Resolution
+    # (1) User Template > (2) Documentation Type > (3) Notation Format > (4) Specialty Context > (5) Reasoning Detail
+
+    # Options are emitted in OPTION_TO_INSTRUCTION_MAP order so the same set always yields the same text
+    for opt_id, instruction in OPTION_TO_INSTRUCTION_MAP.items():
+        if opt_id not in enabled_options:
+            continue
+        # If genAandPOnly is selected, we don't want to add formatByProblem's basic instruction,
+        # as genAandPOnly's instruction already covers the "by problem" aspect.
+        # However, we DO want the *detailed* "By Problem" instructions later.
+        if opt_id == "formatByProblem" and "genAandPOnly" in enabled_options:
+            selected_options_instructions.append("- A&P Structure: (Using 'By Problem' structure as per 'A&P Only' request).") # Placeholder or confirmation
+            continue # Skip adding the generic formatByProblem instruction text
+        selected_options_instructions.append(instruction)
+
+    # If "A&P Only" is selected, it implies "formatByProblem" structure.
+    # Or if "formatByProblem" is selected independently.
+    if "genAandPOnly" in enabled_options or "formatByProblem" in enabled_options:
+        selected_options_instructions.append(BY_PROBLEM_INSTRUCTIONS)
+        if "genAandPOnly" in enabled_options: # If A&P Only is selected, these apply to the A&P section
+            if "genVSHN" in enabled_options:
+                selected_options_instructions.append(AANDP_ONLY_VSHN_INSTRUCTION)
+            elif "genSHN" in enabled_options:
+                selected_options_instructions.append(AANDP_ONLY_SHN_INSTRUCTION)
+        else: # If not A&P Only, but formatByProblem is selected, these apply to the whole note
+            if "genVSHN" in enabled_options:
+                selected_options_instructions.append(BY_PROBLEM_VSHN_INSTRUCTION)
+            elif "genSHN" in enabled_options:
+                selected_options_instructions.append(BY_PROBLEM_SHN_INSTRUCTION)
+
+    # Add the shorthand glossary if SHN or VSHN is selected
+    if ("genSHN" in enabled_options or "genVSHN" in enabled_options) and GLOSSARY_INSTRUCTION:
+        selected_options_instructions.append(GLOSSARY_INSTRUCTION if include_glossary else GLOSSARY_APPLIED_LOCALLY_INSTRUCTION)
+
+    if not enabled_options:
+        selected_options_instructions.append("- (Using default behaviors as per core instructions for non-specified options)")
+
+    return "\n".join(selected_options_instructions)
+
+def compile_options_section(options, include_glossary=True):
+    """
+    Returns the "User-Selected Options" section of the dynamic request for a frontend options dict.
+    Memoized on the canonical set of enabled option IDs. With include_glossary=False a one-line
+    note replaces the shorthand glossary (the caller applies it to the output instead).
+    """
+    return _compile_options_section_cached(canonical_option_key(options), include_glossary)
+
+# The static prefix is sent once as the model's system_instruction (see rosetta_gemini.py)
+ROSETTA_MODEL_SYSTEM_INSTRUCTION = STATIC_PROMPT_PREFIX.rstrip()
+
+def compose_request_prompt(dynamic_prompt_from_frontend):
+    """
+    The per-request part of the prompt: only the dynamic request, without the static prefix.
+    """
+    return f"Dynamic Request from Frontend:\n---\n{dynamic_prompt_from_frontend}\n---"
+
+def compose_full_prompt(dynamic_prompt_from_frontend):
+    """
+    Prepends the precompiled static prefix (thoughts instruction and core Rosetta instructions)
+    to the dynamic prompt. This is what the model effectively sees, and what cache keys hash.
+    """
+    return f"{STATIC_PROMPT_PREFIX}{compose_request_prompt(dynamic_prompt_from_frontend)}"
+
+# --- Prompt budget reporting ---
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token for English clinical text).
+    """
+    return (len(text) + 3) // 4
+
+def prompt_section_stats(token_counter=None):
+    """
+    Reports character and token counts for every precompiled prompt section, largest first.
+    `token_counter` may be a callable returning an exact token count (e.g. backed by the
+    Gemini count_tokens API); otherwise tokens are estimated.
+    """
+    sections = [
+        ("thoughts_instruction", THOUGHTS_INSTRUCTION),
+        ("system_instruction", ROSETTA_SYSTEM_INSTRUCTION),
+        ("core_operational_instructions", ROSETTA_CORE_OPERATIONAL_INSTRUCTIONS),
+        ("by_problem_instructions", BY_PROBLEM_INSTRUCTIONS),
+        ("shorthand_glossary", GLOSSARY_INSTRUCTION),
+        ("shorthand_glossary_applied_locally", GLOSSARY_APPLIED_LOCALLY_INSTRUCTION),
+    ]
+    sections.extend((f"option:{opt_id}", instruction) for opt_id, instruction in OPTION_TO_INSTRUCTION_MAP.items())
+
+    stats = []
+    for name, text in sections:
+        tokens = token_counter(text) if token_counter else estimate_tokens(text)
+        stats.append({"section": name, "chars": len(text), "tokens": tokens, "exact_tokens": token_counter is not None})
+    stats.sort(key=lambda entry: entry["chars"], reverse=True)
+    return stats
+
+def options_cache_info():
+    """
+    Hit/miss counters of the memoized options section (functools.lru_cache info as a dict).
+    """
+    return _compile_options_section_cached.cache_info()._asdict()
+
+
+if __name__ == "__main__":
+    # python rosetta_prompts.py -> print the prompt budget table
+    print(f"{'section':<40} {'chars':>8} {'~tokens':>8}")
+    for entry in prompt_section_stats():
+        print(f"{entry['section']:<40} {entry['chars']:>8} {entry['tokens']:>8}")
+    print(f"{'static prefix (sent with every request)':<40} {len(STATIC_PROMPT_PREFIX):>8} {estimate_tokens(STATIC_PROMPT_PREFIX):>8}")
@@ -0,0 +1,360 @@
+import html
+import os
+import re
+import threading
+import time
+
+from rosetta_logging import get_logger
+from rosetta_note_codec import NoteCodec
+from rosetta_process import SqliteConnections
+
+logger = get_logger(__name__)
+
+# --- Full-text note search ---
+# An SQLite FTS5 inverted index over note bodies. It is an external-content index on a
+# `notes` table (id, filename, service, note_date, body) kept current by triggers, so every
+# insert/update/delete of a note updates the index in the same transaction, whichever worker
+# process made it.
+#
+# The SQLite note store has that table already and keeps the index in its own database. The
+# file store mirrors its notes into a small separate database (FileSearchIndex) that is
+# updated on every save and synced with the directory on first use.
+#
+# Bodies may be stored compressed (NoteCodec.encode_column). The index reads them through the
+# note_body() SQL function, which every connection to these databases registers
+# (body_functions()); it returns plain text bodies unchanged.
+#
+# Query syntax (see parse_search_query): words are ANDed, "quoted phrases", prefix* terms,
+# OR between terms, and -word / -"phrase" to exclude.
+#
+# Service and date are indexed FTS columns too, so filters are part of the index lookup
+# instead of a join over every match. Each date is indexed as year, month and day tokens
+# (y2025 m202503 d20250314), so a date range becomes a few exact terms. bm25 ranking runs over the newest `rank_window` matches only, which
+# bounds the cost of broad queries ("continue", "ce*") on large corpora.
+
+# notes_fts reads its content through this view, which decodes bodies and adds the date tokens
+_DATE_TOKENS_SQL = "'y' || substr({0}, 1, 4) || ' m' || substr({0}, 1, 6) || ' d' || {0}"
+BODY_FUNCTION = "note_body"
+SEARCH_SCHEMA = f"""
+CREATE VIEW IF NOT EXISTS notes_fts_content AS
+    SELECT id, note_body(body) AS body, service, {_DATE_TOKENS_SQL.format('note_date')} AS note_date FROM notes;
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    body, service, note_date,
+    content='notes_fts_content', content_rowid='id',
+    tokenize="unicode61 remove_diacritics 2 tokenchars '_'",
+    prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts (rowid, body, service, note_date)
+    VALUES (new.id, note_body(new.body), new.service, {_DATE_TOKENS_SQL.format('new.note_date')});
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, body, service, note_date)
+    VALUES ('delete', old.id, note_body(old.body), old.service, {_DATE_TOKENS_SQL.format('old.note_date')});
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF body, service, note_date ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, body, service, note_date)
+    VALUES ('delete', old.id, note_body(old.body), old.service, {_DATE_TOKENS_SQL.format('old.note_date')});
+    INSERT INTO notes_fts (rowid, body, service, note_date)
+    VALUES (new.id, note_body(new.body), new.service, {_DATE_TOKENS_SQL.format('new.note_date')});
+END;
+"""
+# Databases created before bodies could be compressed read `body` directly; the index holds the
+# same tokens either way, so only the view and triggers are replaced
+_PLAIN_BODY_SCHEMA_OBJECTS = [
+    ("VIEW", "notes_fts_content"),
+    ("TRIGGER", "notes_fts_insert"),
+    ("TRIGGER", "notes_fts_delete"),
+    ("TRIGGER", "notes_fts_update"),
+]
+
+# The file store's mirror of its notes; `version` is the file's st_mtime_ns
+FILE_MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    service TEXT NOT NULL DEFAULT '',
+    note_date TEXT NOT NULL,
+    body TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_note_date ON notes (note_date);
+"""
+
+MAX_QUERY_TERMS = 32
+DEFAULT_RANK_WINDOW = 10000
+SNIPPET_TOKENS = 16
+_SNIPPET_OPEN = "\x02"
+_SNIPPET_CLOSE = "\x03"
+_QUERY_TOKEN_PATTERN = re.compile(r'(-?)"([^"]*)"(\*?)|(\S+)')
+_WORD_PATTERN = re.compile(r"\w+") # Same tokens as the index: "_" is a token character (MED_2)
+
+
+def body_functions(codec):
+    """
+    The SQL functions (SqliteConnections `functions`) a connection to a note database needs.
+    """
+    return {BODY_FUNCTION: codec.decode_column}
+
+
+def ensure_search_schema(connection):
+    """
+    Creates the FTS index and its triggers on a database that has a `notes` table. An index
+    added to a database that already holds notes is built from them once. The connection
+    must have the body_functions() registered.
+    """
+    is_new = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'").fetchone() is None
+    view = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'notes_fts_content'").fetchone()
+    drops = ""
+    if view is not None and f"{BODY_FUNCTION}(" not in view[0]:
+        drops = "".join(f"DROP {kind} IF EXISTS {name};\n" for kind, name in _PLAIN_BODY_SCHEMA_OBJECTS)
+    # One transaction: a worker saving a note meanwhile must not find the triggers missing
+    connection.executescript("BEGIN IMMEDIATE;\n" + drops + SEARCH_SCHEMA + "COMMIT;")
+    if is_new and connection.execute("SELECT 1 FROM notes LIMIT 1").fetchone():
+        start = time.perf_counter()
+        connection.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+        logger.info("Built the note search index", seconds=round(time.perf_counter() - start, 2))
+
+
+def _phrase(text, prefix=False):
+    words = _WORD_PATTERN.findall(text.lower())
+    if not words:
+        return None
+    return '"' + " ".join(words) + '"' + (" *" if prefix else "")
+
+
+def parse_search_query(query):
+    """
+    Translates a user query into an FTS5 MATCH expression. User input never reaches FTS5
+    syntax directly: every term is re-quoted from its word characters.
+
+        aki creatinine        both words
+        "chest pain"          exact phrase
+        cardio*               prefix
+        sepsis OR bacteremia  either
+        -covid                exclude
+
+    Raises ValueError for queries without any positive term.
+    """
+    groups = [] # ANDed groups of ORed FTS5 terms; OR binds tighter: "aki cr OR creatinine"
+    negatives = []
+    join_next = False
+    for match in _QUERY_TOKEN_PATTERN.finditer(query or ""):
+        negate, quoted, quoted_star, bare = match.groups()
+        if bare is not None:
+            if bare == "OR":
+                join_next = bool(groups)
+                continue
+            negate = "-" if bare.startswith("-") and len(bare) > 1 else ""
+            term = _phrase(bare.lstrip("-") if negate else bare, prefix=bare.endswith("*"))
+        else:
+            term = _phrase(quoted, prefix=bool(quoted_star))
+        if term is None:
+            continue
+        if negate:
+            negatives.append(term)
+        elif join_next:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        join_next = False
+        if sum(len(group) for group in groups) + len(negatives) > MAX_QUERY_TERMS:
+            raise ValueError(f"Search queries are limited to {MAX_QUERY_TERMS} terms.")
+    if not groups:
+        raise ValueError("The search query needs at least one word to look for.")
+
+    expression = " AND ".join(group[0] if len(group) == 1 else "(" + " OR ".join(group) + ")" for group in groups)
+    if negatives:
+        expression = f"({expression}) NOT ({' OR '.join(negatives)})"
+    return expression
+
+
+def normalize_date_bound(value, upper=False):
+    """
+    "2025", "2025-03" or "20250314" -> a YYYYMMDD bound (inclusive); None for empty input.
+    Raises ValueError for anything else.
+    """
+    if not value:
+        return None
+    digits = value.replace("-", "")
+    if not digits.isdigit() or len(digits) not in (4, 6, 8):
+        raise ValueError("Dates must be YYYY, YYYYMM or YYYYMMDD (dashes allowed).")
+    return digits.ljust(8, "9" if upper else "0")
+
+
+def _date_tokens(lower, upper):
+    """
+    Smallest set of year (yYYYY), month (mYYYYMM) and day (dYYYYMMDD) tokens covering the
+    inclusive YYYYMMDD range.
+    """
+    tokens = []
+    for year in range(int(lower[:4]), int(upper[:4]) + 1):
+        year_text = f"{year:04d}"
+        if lower <= year_text + "0000" and year_text + "9999" <= upper:
+            tokens.append("y" + year_text)
+            continue
+        for month in range(1, 13):
+            month_text = f"{year_text}{month:02d}"
+            if month_text + "99" < lower or month_text + "00" > upper:
+                continue
+            if lower <= month_text + "00" and month_text + "99" <= upper:
+                tokens.append("m" + month_text)
+                continue
+            tokens.extend(f"d{month_text}{day:02d}" for day in range(1, 32) if lower <= f"{month_text}{day:02d}" <= upper)
+    return tokens
+
+
+def _snippet_html(snippet):
+    # Note text is escaped; only the match markers become <mark> tags
+    return html.escape(snippet or "").replace(_SNIPPET_OPEN, "<mark>").replace(_SNIPPET_CLOSE, "</mark>")
+
+
+def search_notes(connection, query, service=None, date_from=None, date_to=None, limit=20, offset=0,
+                 rank_window=DEFAULT_RANK_WINDOW):
+    """
+    Runs a ranked search on a database set up by ensure_search_schema. Returns
+    (results, next_offset); results are dicts with filename, service, date, score (negated
+    bm25, higher is better) and an HTML-safe `snippet` with the matches in <mark> tags.
+    When more than `rank_window` notes match, only the newest `rank_window` are ranked.
+    """
+    # Query words may also hit the service/date columns, but those carry no bm25 weight and a
+    # body-only column filter would cost a position-list check per match
+    clauses = [f"({parse_search_query(query)})"]
+    if service:
+        service_token = "".join(c if c.isalnum() else "_" for c in service.strip().lower()) # As in generate_filename
+        clauses.append(f'service : "{service_token}"')
+    lower = normalize_date_bound(date_from)
+    upper = normalize_date_bound(date_to, upper=True)
+    if lower or upper:
+        if not (lower and upper):
+            # Open-ended range: bound it by the dates actually stored
+            first, last = connection.execute("SELECT MIN(note_date), MAX(note_date) FROM notes").fetchone()
+            if first is None:
+                return [], None
+            lower, upper = lower or first, upper or last
+        tokens = _date_tokens(lower, upper)
+        if not tokens:
+            return [], None
+        clauses.append("note_date : (" + " OR ".join(f'"{token}"' for token in tokens) + ")")
+    expression = " AND ".join(clauses)
+
+    # The newest matches stream out of the index in rowid order, so only the window is
+    # scored; note metadata and snippets are looked up for the page alone
+    ranked = connection.execute(
+        "SELECT rowid, score FROM ("
+        " SELECT rowid, bm25(notes_fts, 1.0, 0.0, 0.0) AS score FROM notes_fts WHERE notes_fts MATCH ?"
+        " ORDER BY rowid DESC LIMIT ?"
+        ") ORDER BY score, rowid DESC LIMIT ? OFFSET ?",
+        (expression, rank_window, limit + 1, offset),
+    ).fetchall()
+    next_offset = offset + limit if len(ranked) > limit else None
+    ranked = ranked[:limit]
+    if not ranked:
+        return [], None
+
+    rowids = [rowid for rowid, _ in ranked]
+    placeholders = ", ".join("?" * len(rowids))
+    notes = {row[0]: row[1:] for row in connection.execute(
+        f"SELECT id, filename, service, note_date FROM notes WHERE id IN ({placeholders})", rowids
+    )}
+    # One range scan for the page; a plain rowid IN (...) would re-run the MATCH (and re-merge
+    # prefix doclists) once per row. "+rowid" keeps the IN list out of the FTS lookup.
+    snippets = dict(connection.execute(
+        f"SELECT rowid, snippet(notes_fts, 0, '{_SNIPPET_OPEN}', '{_SNIPPET_CLOSE}', ' … ', {SNIPPET_TOKENS})"
+        f" FROM notes_fts WHERE notes_fts MATCH ? AND rowid BETWEEN ? AND ? AND +rowid IN ({placeholders})",
+        [expression, min(rowids), max(rowids)] + rowids,
+    ).fetchall())
+    results = []
+    for rowid, score in ranked:
+        filename, note_service, note_date = notes[rowid]
+        results.append({
+            "filename": filename,
+            "service": note_service or None,
+            "date": note_date,
+            "score": round(-score, 4),
+            "snippet": _snippet_html(snippets.get(rowid)),
+        })
+    return results, next_offset
+
+
+class FileSearchIndex:
+    """
+    Search index for the file store: a mirror of the note files in its own SQLite database.
+    Saves update it directly; sync() catches up with files written while it wasn't running.
+    Mirrored bodies are stored with `codec` (a NoteCodec, default plain text), so compressed
+    notes stay compressed in the mirror.
+    """
+
+    def __init__(self, path, busy_timeout_seconds=10.0, codec=None):
+        self.path = path
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.codec = codec or NoteCodec()
+        self._db = SqliteConnections(path, busy_timeout_seconds, row_factory=None, functions=body_functions(self.codec))
+        self._synced = False
+        self._sync_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._db.connection()
+        connection.executescript(FILE_MIRROR_SCHEMA)
+        ensure_search_schema(connection)
+
+    def index_note(self, filename, body, service, note_date, version):
+        self._db.connection().execute(
+            "INSERT INTO notes (filename, service, note_date, body, version) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (filename) DO UPDATE SET service = excluded.service, note_date = excluded.note_date,"
+            " body = excluded.body, version = excluded.version",
+            (filename, service, note_date, self.codec.encode_column(body), version),
+        )
+
+    def remove_notes(self, filenames):
+        self._db.write_transaction(
+            lambda connection: connection.executemany("DELETE FROM notes WHERE filename = ?", [(name,) for name in filenames])
+        )
+
+    def sync(self, note_files, describe, read=None):
+        """
+        Brings the mirror in line with `note_files` ((filename, path) pairs): changed and new
+        files are (re)indexed, vanished ones dropped. `describe(filename, path)` returns
+        (service, note_date); `read(path)` returns a note's text (default: a plain UTF-8 file).
+        Returns (indexed, removed).
+        """
+        connection = self._db.connection()
+        known = dict(connection.execute("SELECT filename, version FROM notes").fetchall())
+        changed = []
+        for filename, path in note_files:
+            try:
+                version = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if known.pop(filename, None) != version:
+                changed.append((filename, path, version))
+        def work(connection):
+            for filename, path, version in changed:
+                try:
+                    if read is not None:
+                        body = read(path)
+                    else:
+                        with open(path, "r", encoding="utf-8") as f:
+                            body = f.read()
+                except OSError as e:
+                    logger.warning("Search index: skipping unreadable note", path=path, error=str(e))
+                    continue
+                self.index_note(filename, body, *describe(filename, path), version)
+            connection.executemany("DELETE FROM notes WHERE filename = ?", [(name,) for name in known])
+
+        self._db.write_transaction(work)
+        return len(changed), len(known)
+
+    def sync_once(self, note_files, describe, read=None):
+        with self._sync_lock:
+            if not self._synced:
+                start = time.perf_counter()
+                indexed, removed = self.sync(note_files(), describe, read)
+                self._synced = True
+                logger.info("Search index synced with the notes directory", seconds=round(time.perf_counter() - start, 2), indexed=indexed, removed=removed)
+
+    def search(self, query, **filters):
+        return search_notes(self._db.connection(), query, **filters)
+
+    def snapshot(self):
+        connection = self._db.connection()
+        return {"path": self.path, "indexed_notes": connection.execute("SELECT COUNT(*) FROM notes").fetchone()[0]}
@@ -0,0 +1,239 @@
+import re
+
+from rosetta_logging import get_logger
+
+logger = get_logger(__name__)
+
+# --- Section-level note updates ---
+# Splits a saved note into its sections (Impression / Subjective / Objective / A&P and the
+# "#Problem" blocks the By-Problem instructions produce) so an update can send the model only
+# the sections the new information touches, and merge the sections it returns back into the
+# note. Sections keep their exact original text, so unchanged parts are saved byte-for-byte.
+
+SECTION_MARKER_FORMAT = "@@SECTION {}@@"
+SECTION_MARKER_PATTERN = re.compile(r"^[ \t]*@@SECTION ([\w\-]+)@@[ \t]*$", re.MULTILINE)
+NEW_PROBLEM_SECTION_ID = "new_problem"
+PREAMBLE_SECTION_ID = "preamble"
+AANDP_SECTION_ID = "assessment_and_plan"
+
+# Heading name (lowercase, as written in notes) -> section id
+SECTION_HEADINGS = {
+    "chart review checklist": "chart_review",
+    "chart review": "chart_review",
+    "impression": "impression",
+    "summary": "impression",
+    "subjective": "subjective",
+    "objective": "objective",
+    "review of systems": "review_of_systems",
+    "ros questions": "review_of_systems",
+    "ros": "review_of_systems", # SHN form
+    "assessment & plan": AANDP_SECTION_ID,
+    "assessment and plan": AANDP_SECTION_ID,
+    "assessment/plan": AANDP_SECTION_ID,
+    "a&p": AANDP_SECTION_ID,
+    "a/p": AANDP_SECTION_ID,
+}
+# A heading is a known name on its own line (optionally "# "-prefixed), or followed by ":"
+_HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?(" + "|".join(re.escape(name) for name in sorted(SECTION_HEADINGS, key=len, reverse=True)) + r")[ \t]*(?::|$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_PROBLEM_PATTERN = re.compile(r"^[ \t]*#(?!#)[ \t]*(\S[^\n]*)$", re.MULTILINE)
+_WORD_PATTERN = re.compile(r"[a-z][a-z0-9]{2,}")
+
+# Words that say nothing about which section new information belongs to
+_STOPWORDS = frozenset("""
+and the for with was were has have had not but are this that from into per will would should
+can could been being also than then there their they them its pt patient patients today
+yesterday overnight now currently continue plan assessment noted note notes reports states
+""".split())
+# Words matched on their first letters so "hypertensive" matches "#Hypertension"
+_STEM_CHARS = 6
+
+
+class NoteSection:
+    """
+    One section of a note. `text` is the exact original text, heading line included.
+    """
+
+    def __init__(self, section_id, heading, text):
+        self.section_id = section_id
+        self.heading = heading
+        self.text = text
+
+    @property
+    def is_problem(self):
+        return self.section_id.startswith("problem_")
+
+
+def _slugify(name):
+    slug = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+    return slug[:40] or "untitled"
+
+
+def parse_note_sections(note_text):
+    """
+    Returns the note as a list of NoteSection in order; "".join(s.text for s in sections) is
+    exactly `note_text`. Text before the first heading becomes a "preamble" section.
+    "#Problem" lines start problem sections inside the A&P, or anywhere in a note that has no
+    other headings (A&P-only notes).
+    """
+    boundaries = [] # (offset, section_id, heading)
+    for match in _HEADING_PATTERN.finditer(note_text):
+        boundaries.append((match.start(), SECTION_HEADINGS[match.group(1).lower()], match.group(0).strip()))
+    heading_offsets = {offset for offset, _, _ in boundaries}
+    aandp_start = next((offset for offset, section_id, _ in boundaries if section_id == AANDP_SECTION_ID), None)
+    problems_allowed_from = aandp_start if aandp_start is not None else (0 if not boundaries else None)
+    if problems_allowed_from is not None:
+        for match in _PROBLEM_PATTERN.finditer(note_text, problems_allowed_from):
+            if match.start() in heading_offsets:
+                continue # "# Objective"-style markdown headings
+            boundaries.append((match.start(), "problem_" + _slugify(match.group(1)), match.group(0).strip()))
+    boundaries.sort()
+
+    sections = []
+    if not boundaries or boundaries[0][0] > 0:
+        first_offset = boundaries[0][0] if boundaries else len(note_text)
+        sections.append(NoteSection(PREAMBLE_SECTION_ID, "", note_text[:first_offset]))
+    seen_ids = {}
+    for index, (offset, section_id, heading) in enumerate(boundaries):
+        end = boundaries[index + 1][0] if index + 1 < len(boundaries) else len(note_text)
+        # Repeated headings (two "#AKI" blocks) get distinct ids
+        count = seen_ids.get(section_id, 0) + 1
+        seen_ids[section_id] = count
+        unique_id = section_id if count == 1 else f"{section_id}_{count}"
+        sections.append(NoteSection(unique_id, heading, note_text[offset:end]))
+    if sections and sections[0].section_id == PREAMBLE_SECTION_ID and not sections[0].text.strip() and len(sections) > 1:
+        # Leading blank lines: keep them with the first real section
+        sections[1].text = sections[0].text + sections[1].text
+        sections.pop(0)
+    return sections
+
+
+def render_sections(sections):
+    return "".join(section.text for section in sections)
+
+
+def _stems(text):
+    return {word[:_STEM_CHARS] for word in _WORD_PATTERN.findall(text.lower()) if word not in _STOPWORDS}
+
+
+def select_sections_for_update(sections, new_information, requested_ids=None):
+    """
+    Returns the ids of the sections to send to the model for an update.
+
+    `requested_ids` (ids or heading names, case-insensitive) overrides the automatic choice.
+    Otherwise the Impression is always sent, the Objective whenever the new information
+    contains numbers (labs, vitals), and every other section that shares a word with it. A
+    problem is matched on its "#Problem" name or on at least two words of its body.
+    """
+    if requested_ids:
+        wanted = {str(value).strip().lower().lstrip("#").strip() for value in requested_ids}
+        return [
+            section.section_id for section in sections
+            if section.section_id in wanted or section.heading.lower().lstrip("#").rstrip(":").strip() in wanted
+        ]
+
+    new_stems = _stems(new_information)
+    has_numbers = any(char.isdigit() for char in new_information)
+    selected = []
+    for section in sections:
+        section_id = section.section_id
+        if section_id == PREAMBLE_SECTION_ID:
+            continue
+        if section_id.startswith("impression") or (section_id.startswith("objective") and has_numbers):
+            selected.append(section_id)
+        elif section.is_problem:
+            if _stems(section.heading) & new_stems or len(_stems(section.text) & new_stems) >= 2:
+                selected.append(section_id)
+        elif _stems(section.text) & new_stems:
+            selected.append(section_id)
+    return selected
+
+
+def build_section_update_prompt(sections, selected_ids):
+    """
+    The "existing note" part of a section-level update prompt: an outline of every section
+    and the full text of the selected ones, each behind its marker line.
+    """
+    selected = set(selected_ids)
+    outline = []
+    for section in sections:
+        first_line = section.heading or section.text.strip().split("\n", 1)[0][:80]
+        outline.append(f"- {section.section_id}: {first_line}{'' if section.section_id in selected else ' (unchanged, not shown)'}")
+    shown = "\n\n".join(
+        f"{SECTION_MARKER_FORMAT.format(section.section_id)}\n{section.text.strip()}"
+        for section in sections if section.section_id in selected
+    )
+    return (
+        "You are UPDATING an existing medical note SECTION BY SECTION. Only the sections the new information is likely to affect are shown; "
+        "the rest of the note stays exactly as it is.\n"
+        "1. The 'Dynamic Request from Frontend' (which follows the sections) contains NEW 'Patient Information'. Integrate it into the sections shown, "
+        "keeping the existing structure, formatting and line breaks (e.g., one line per exam system in 'Objective').\n"
+        "2. Return ONLY the sections you changed. Start each one with its marker line exactly as given (e.g. "
+        f"'{SECTION_MARKER_FORMAT.format('objective')}') followed by the COMPLETE new text of that section, including its heading line. "
+        "Do not return unchanged sections and do not add any text outside the marked sections.\n"
+        f"3. To add a new problem to the Assessment & Plan, return it after the marker line '{SECTION_MARKER_FORMAT.format(NEW_PROBLEM_SECTION_ID)}' "
+        "in the '#Problem' format (one marker per new problem).\n"
+        "4. Apply the 'User-Selected Options' to the sections you return, matching the style of the existing note.\n\n"
+        f"NOTE OUTLINE:\n{chr(10).join(outline)}\n\n"
+        f"SECTIONS TO UPDATE:\n---\n{shown}\n---\n\n"
+        "NOW, PROCESS THE FOLLOWING DYNAMIC REQUEST (CONTAINING NEW PATIENT INFO AND OPTIONS) AND RETURN ONLY THE CHANGED SECTIONS:"
+    )
+
+
+def parse_section_update(model_note_text):
+    """
+    Returns [(section_id, text)] for the marked sections in the model's output, in order.
+    Anything before the first marker is ignored.
+    """
+    matches = list(SECTION_MARKER_PATTERN.finditer(model_note_text))
+    updates = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(model_note_text)
+        updates.append((match.group(1), model_note_text[match.end():end].strip()))
+    return updates
+
+
+def _with_trailing_whitespace(new_text, old_text):
+    trailing = old_text[len(old_text.rstrip()):]
+    return new_text + (trailing or "\n\n")
+
+
+def merge_section_update(sections, updates, allowed_ids):
+    """
+    Applies parsed `updates` to `sections`. Only ids in `allowed_ids` (the sections that were
+    sent) are replaced; new problems are inserted after the last problem, or at the end of
+    the A&P, or at the end of the note. Returns (note_text, applied_ids).
+    """
+    merged = [NoteSection(section.section_id, section.heading, section.text) for section in sections]
+    by_id = {section.section_id: section for section in merged}
+    applied = []
+    new_problems = []
+    for section_id, text in updates:
+        if not text:
+            continue
+        if section_id == NEW_PROBLEM_SECTION_ID:
+            new_problems.append(text)
+        elif section_id in by_id and section_id in allowed_ids:
+            section = by_id[section_id]
+            section.text = _with_trailing_whitespace(text, section.text)
+            applied.append(section_id)
+        else:
+            logger.warning("Ignoring returned note section not sent for update", section_id=section_id)
+
+    if new_problems:
+        insert_at = len(merged)
+        for index, section in enumerate(merged):
+            if section.is_problem or section.section_id == AANDP_SECTION_ID:
+                insert_at = index + 1
+        if insert_at > 0 and not merged[insert_at - 1].text.endswith("\n\n"):
+            merged[insert_at - 1].text = merged[insert_at - 1].text.rstrip() + "\n\n"
+        for offset, text in enumerate(new_problems):
+            heading = text.split("\n", 1)[0].strip()
+            merged.insert(insert_at + offset, NoteSection("problem_" + _slugify(heading.lstrip("#")), heading, text + "\n\n"))
+            applied.append(NEW_PROBLEM_SECTION_ID)
+        if insert_at + len(new_problems) == len(merged):
+            merged[-1].text = merged[-1].text.rstrip() + "\n"
+
+    return render_sections(merged), applied
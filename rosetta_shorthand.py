@@ -0,0 +1,126 @@
+import re
+
+from rosetta_prompts import PREFERRED_SHORTHAND_GLOSSARY
+
+# --- Local shorthand (SHN/VSHN) rewriting ---
+# Applies PREFERRED_SHORTHAND_GLOSSARY deterministically, without a model call. The glossary is
+# compiled into one regex shaped like a character trie ("hour(?:s)?", "s(?:igns and
+# symptoms|ymptoms)"), so a single left-to-right pass finds the longest entry at each word
+# boundary: "signs and symptoms" wins over "symptoms", "hours" over "hour". Words inside a
+# phrase may be separated by spaces/tabs or a hyphen ("follow-up", "65-year-old").
+#
+# Used to serve SHN reformat-only requests locally and to post-process model output, so
+# the glossary no longer has to be shipped in every SHN/VSHN prompt.
+
+MODE_SHN = "shn"
+MODE_VSHN = "vshn"
+
+# VSHN additionally drops these (lowercase only: "Vitamin A", "Hepatitis A" stay)
+VSHN_DROPPED_WORDS = ("the", "a", "an")
+
+_PHRASE_SEPARATOR = r"(?:[ \t]+|-)"
+# Never rewritten: de-identification tokens, section markers, SmartLinks
+_PROTECTED_PATTERN = r"\[[A-Z_]+\]|@@[^@\n]*@@|@[A-Za-z0-9_.]+@"
+_SEPARATOR_RUN = re.compile(r"[ \t-]+")
+
+
+def _trie_pattern(node):
+    # Longest match: an entry ending here is the optional tail of the longer ones (greedy),
+    # and the trailing (?!\w) makes the engine back off to a shorter entry when needed
+    branches = []
+    for char in sorted(key for key in node if key != ""):
+        atom = _PHRASE_SEPARATOR if char == " " else re.escape(char)
+        branches.append(atom + _trie_pattern(node[char]))
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        return f"(?:{body})?" if len(branches) == 1 else body + "?"
+    return body
+
+
+def _compile_phrases(phrases):
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = True
+    # The first character is matched before the word-boundary lookbehind, so the regex engine
+    # can skip ahead to candidate first letters instead of trying every position
+    branches = []
+    for char in sorted(trie):
+        branches.append(re.escape(char) + r"(?<!\w.)" + _trie_pattern(trie[char]))
+    return "(?:" + "|".join(branches) + r")(?!\w)"
+
+
+class ShorthandRewriter:
+    """
+    Rewrites text with a {full phrase: abbreviation} glossary. Matching is case-insensitive;
+    lowercase abbreviations follow the case of the text they replace ("Patient" -> "Pt",
+    "PATIENT" -> "PT"), abbreviations with capitals are kept as written ("blood pressure" -> "BP").
+    """
+
+    def __init__(self, glossary, dropped_words=()):
+        self.glossary = {" ".join(full.lower().split()): abbreviation for full, abbreviation in glossary.items()}
+        pattern = f"(?P<protected>{_PROTECTED_PATTERN})|(?P<term>{_compile_phrases(self.glossary)})"
+        if dropped_words:
+            words = "|".join(
+                re.escape(word[0]) + r"(?<!\w.)" + re.escape(word[1:]) for word in sorted(dropped_words, key=len, reverse=True)
+            )
+            # Case-sensitive, and only before another word, so list labels like "a)" stay
+            pattern += rf"|(?P<drop>(?-i:{words})(?!\w)[ \t]+(?=\w))"
+        self.regex = re.compile(pattern, re.IGNORECASE)
+
+    def _replacement(self, match, counter=None):
+        if match.lastgroup == "protected":
+            return match.group(0)
+        if match.lastgroup == "drop":
+            return ""
+        if counter is not None:
+            counter[0] += 1
+        source = match.group(0)
+        abbreviation = self.glossary[_SEPARATOR_RUN.sub(" ", source.lower())]
+        if abbreviation != abbreviation.lower():
+            return abbreviation # Has its own capitalization (BP, Dx, NPO)
+        if source.isupper() and len(source) > 1:
+            return abbreviation.upper()
+        if source[0].isupper():
+            return abbreviation[0].upper() + abbreviation[1:]
+        return abbreviation
+
+    def rewrite(self, text):
+        return self.regex.sub(self._replacement, text)
+
+    def rewrite_with_count(self, text):
+        """
+        Returns (rewritten_text, number_of_glossary_replacements).
+        """
+        counter = [0]
+        rewritten = self.regex.sub(lambda match: self._replacement(match, counter), text)
+        return rewritten, counter[0]
+
+
+SHN_REWRITER = ShorthandRewriter(PREFERRED_SHORTHAND_GLOSSARY)
+VSHN_REWRITER = ShorthandRewriter(PREFERRED_SHORTHAND_GLOSSARY, dropped_words=VSHN_DROPPED_WORDS)
+REWRITERS = {MODE_SHN: SHN_REWRITER, MODE_VSHN: VSHN_REWRITER}
+
+
+def shorthand_mode_for_options(options):
+    """
+    MODE_VSHN / MODE_SHN for a frontend options dict with genVSHN / genSHN checked (VSHN wins,
+    as in the prompt), else None.
+    """
+    options = options or {}
+    if options.get("genVSHN"):
+        return MODE_VSHN
+    if options.get("genSHN"):
+        return MODE_SHN
+    return None
+
+
+def rewrite_shorthand(text, mode):
+    """
+    Returns (rewritten_text, number_of_replacements) for MODE_SHN or MODE_VSHN.
+    """
+    return REWRITERS[mode].rewrite_with_count(text)
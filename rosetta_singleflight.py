@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+from rosetta_logging import get_logger
+from rosetta_process import pid_alive
+
+logger = get_logger(__name__)
+
+# --- Single-flight request coalescing ---
+# Concurrent requests with the same key (hash of final prompt, model and generation config)
+# share one upstream Gemini call: the first caller runs it, the others wait for its result.
+# Errors reach every waiter, and a waiter gives up after its timeout without cancelling the
+# shared call. When an async leader is cancelled (its client disconnected), one of its waiters
+# makes the call instead. Unlike the response cache (rosetta_cache.py), nothing is kept after the call
+# finishes. A later identical request starts a new flight.
+#
+# Within a process the waiters are threads (SingleFlight) or coroutines (AsyncSingleFlight).
+# With a FileFlightCoordinator, gunicorn workers coordinate through lock files in a shared
+# local directory: one worker's leader makes the call and the other workers' leaders pick the
+# result up from a result file.
+
+LOCK_SUFFIX = ".lock"
+RESULT_SUFFIX = ".result.json"
+# A lock file still empty after this long belongs to a leader that died while creating it
+EMPTY_LOCK_STALE_SECONDS = 10.0
+
+
+class SingleFlightTimeout(Exception):
+    """
+    Raised in a waiter whose timeout expired before the shared call finished.
+    """
+
+
+class SingleFlightError(Exception):
+    """
+    The shared call failed in another worker; carries that error's type and message.
+    """
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.shared = False
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Thread-based single flight. do(key, fn, timeout) returns (value, shared), where `shared`
+    is True when the value came from a call started by another request.
+    """
+
+    def __init__(self, coordinator=None):
+        self.coordinator = coordinator
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._pid = os.getpid()
+        self.stats = {"leaders": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: flights in progress belong to the parent's threads
+                self._pid = os.getpid()
+                self._flights = {}
+                self.stats = dict.fromkeys(self.stats, 0)
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+
+        if not is_leader:
+            if not flight.done.wait(timeout):
+                self._count("timeouts")
+                raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for an identical request in flight.")
+            self._count("coalesced")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        self._count("leaders")
+        try:
+            if self.coordinator is not None:
+                flight.value, flight.shared = self.coordinator.run(key, fn, timeout)
+            else:
+                flight.value = fn()
+        except BaseException as e:
+            self._count("errors")
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.value, flight.shared
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._flights)
+        stats["cross_process"] = self.coordinator is not None
+        return stats
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight for the ASGI mode (one event loop per process).
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "timeouts": 0, "errors": 0, "restarts": 0}
+
+    async def do(self, key, coroutine_function, timeout=None):
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+        while True:
+            future = self._flights.get(key)
+            if future is None:
+                break
+            remaining = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+            try:
+                # shield: a waiter timing out (or disconnecting) must not cancel the shared call
+                value = await asyncio.wait_for(asyncio.shield(future), remaining)
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for an identical request in flight.")
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise # This waiter itself was cancelled
+                # The leader was cancelled (its client disconnected): the first waiter to get
+                # here leads a new call, the others wait on that one
+                self.stats["restarts"] += 1
+                continue
+            self.stats["coalesced"] += 1
+            return value, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        self.stats["leaders"] += 1
+        try:
+            value = await coroutine_function()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            self.stats["errors"] += 1
+            future.set_exception(e)
+            future.exception() # Retrieved here, so an unawaited future doesn't warn
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        return value, False
+
+
+class FileFlightCoordinator:
+    """
+    Cross-process single flight through a local directory shared by the workers of one host.
+    The process that creates `<key>.lock` makes the call and writes `<key>.result.json`;
+    the others poll for it. Values must be JSON-serializable. A lock whose owner died is
+    broken, and its waiters retry (one of them becomes the new leader).
+    """
+
+    def __init__(self, directory, poll_interval_seconds=0.05, result_ttl_seconds=10.0):
+        self.directory = directory
+        self.poll_interval_seconds = poll_interval_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + LOCK_SUFFIX, base + RESULT_SUFFIX
+
+    def _read_json(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None # Missing, or still being written
+
+    def _write_json(self, path, payload):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(temp_path, path)
+
+    def _remove_expired_results(self):
+        cutoff = time.time() - self.result_ttl_seconds
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(RESULT_SUFFIX) and entry.stat().st_mtime < cutoff:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+        except OSError as e:
+            logger.warning("Could not clean up single-flight results", directory=self.directory, error=str(e))
+
+    def _remove_result_later(self, result_path, flight_id):
+        # The result holds model output (patient text). Waiters poll every poll_interval_seconds,
+        # so it is deleted after result_ttl_seconds even if no later flight cleans up.
+        def remove():
+            result = self._read_json(result_path)
+            if result is not None and result.get("flight_id") == flight_id:
+                try:
+                    os.remove(result_path)
+                except OSError:
+                    pass
+
+        timer = threading.Timer(self.result_ttl_seconds, remove)
+        timer.daemon = True
+        timer.start()
+
+    def _lead(self, lock_fd, lock_path, result_path, fn):
+        flight_id = uuid.uuid4().hex
+        try:
+            with os.fdopen(lock_fd, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "flight_id": flight_id}, f)
+            self._remove_expired_results()
+            try:
+                value = fn()
+            except Exception as e:
+                self._write_json(result_path, {"flight_id": flight_id, "error": str(e), "error_type": type(e).__name__})
+                self._remove_result_later(result_path, flight_id)
+                raise
+            self._write_json(result_path, {"flight_id": flight_id, "value": value})
+            self._remove_result_later(result_path, flight_id)
+            return value
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+    def _empty_lock_is_stale(self, lock_path):
+        try:
+            if time.time() - os.stat(lock_path).st_mtime < EMPTY_LOCK_STALE_SECONDS:
+                return False
+            os.remove(lock_path)
+        except OSError:
+            pass
+        return True
+
+    def run(self, key, fn, timeout=None):
+        lock_path, result_path = self._paths(key)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                return self._lead(lock_fd, lock_path, result_path, fn), False
+
+            # Another worker leads: wait for its result, or for its lock to go away
+            lock = None
+            while True:
+                if lock is None:
+                    lock = self._read_json(lock_path)
+                    if lock is None and self._empty_lock_is_stale(lock_path):
+                        break
+                if lock is not None:
+                    result = self._read_json(result_path)
+                    if result is not None and result.get("flight_id") == lock.get("flight_id"):
+                        if "error" in result:
+                            raise SingleFlightError(f"{result.get('error_type', 'Error')}: {result['error']}")
+                        return result["value"], True
+                    if not pid_alive(lock.get("pid", 0)):
+                        logger.warning("Breaking stale single-flight lock", key=key[:12], pid=lock.get("pid"))
+                        try:
+                            os.remove(lock_path)
+                        except OSError:
+                            pass
+                        break
+                if not os.path.exists(lock_path):
+                    result = self._read_json(result_path)
+                    if lock is not None and result is not None and result.get("flight_id") == lock.get("flight_id"):
+                        continue # Finished between the two checks; picked up on the next pass
+                    break # Leader gone without a result for us: try to lead
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for an identical request in another worker.")
+                time.sleep(self.poll_interval_seconds)
@@ -0,0 +1,711 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from rosetta_logging import get_logger
+from rosetta_note_codec import CODEC_SUFFIXES, DICTIONARY_DIRECTORY, NoteCodec, dictionary_path, split_note_name, train_dictionary
+from rosetta_note_index import NoteIndex, service_for_filename
+from rosetta_process import SqliteConnections
+from rosetta_search import DEFAULT_RANK_WINDOW, FileSearchIndex, body_functions, ensure_search_schema, search_notes
+
+logger = get_logger(__name__)
+
+# --- Note storage backends ---
+# rosetta_backend.py talks to one NoteStore. FileNoteStore keeps the original layout (one .txt
+# per note in rosetta_outputs, optionally in YYYYMM shards) on top of the in-memory NoteIndex.
+# SqliteNoteStore keeps notes in one SQLite database in WAL mode (readers never block the
+# writer) with per-note metadata and a version history. Listing, lookup and deletion are
+# indexed queries there. Both stores keep a full-text search index (rosetta_search.py).
+#
+# Both stores never overwrite an existing note when creating one: a taken name gets a
+# _2, _3, ... suffix. Updates can pass the version they were based on; if the note changed
+# in the meantime NoteVersionConflict is raised instead of silently losing the other write.
+#
+# Note files are written atomically (atomic_write_text): the body goes to a temp file in the
+# same directory, which is fsynced and then linked/renamed into place before the directory is
+# fsynced. A crash leaves either the complete note or none, and readers never see a partial file.
+# Both stores can also keep new notes compressed (rosetta_note_codec.py): the file store as
+# .txt.gz/.txt.zst files, the SQLite store as compressed body values. Old plain notes stay
+# readable next to them.
+#
+# Import an existing notes directory into a database:
+#     python rosetta_store.py import --notes-dir rosetta_outputs --db rosetta_notes.db
+
+STORE_FILES = "files"
+STORE_SQLITE = "sqlite"
+
+
+class NoteVersionConflict(Exception):
+    """
+    The note was changed (or deleted) since the version the caller based its write on.
+    """
+
+
+def fsync_directory(directory):
+    """
+    Makes a rename/link in `directory` durable. No-op where directories can't be opened (Windows).
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass # Some filesystems don't support fsync on directories
+    finally:
+        os.close(fd)
+
+
+def atomic_write_text(path, text, exclusive=False, durable=True):
+    """
+    Writes `text` (str, or bytes written as is) to `path` via a temp file + rename, so the file
+    is either the old or the complete new content. With `exclusive`, raises FileExistsError instead of replacing an
+    existing file (hard link, which fails atomically if the name is taken). `durable` fsyncs
+    the file before and the directory after the rename.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.tmp-{os.getpid()}-{threading.get_ident()}")
+    try:
+        with (open(temp_path, "wb") if isinstance(text, bytes) else open(temp_path, "w", encoding="utf-8")) as f:
+            f.write(text)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        if not exclusive:
+            os.replace(temp_path, path)
+        else:
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Filesystem without hard links: reserve the name, then rename over the placeholder
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                os.replace(temp_path, path)
+    finally:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+    if durable:
+        fsync_directory(directory)
+
+
+def _candidate_filenames(filename):
+    yield filename
+    stem, extension = os.path.splitext(filename)
+    suffix = 2
+    while True:
+        yield f"{stem}_{suffix}{extension}"
+        suffix += 1
+
+
+def _note_date(filename, created_at):
+    # YYYYMMDD from a generated filename, else from the creation time
+    parts = filename.split("_")
+    if len(parts) >= 3 and parts[0] == "rosetta" and parts[1] == "note" and parts[2].isdigit():
+        return parts[2]
+    return time.strftime("%Y%m%d", time.localtime(created_at))
+
+
+class NoteStore:
+    """
+    Interface shared by the storage backends. Notes are addressed by filename.
+
+    Records returned by get() are dicts with filename, body, service, created_at, updated_at,
+    version, options, model and prompt_hash (metadata the backend doesn't keep is None).
+    """
+
+    kind = None
+
+    def get(self, filename, version=None):
+        raise NotImplementedError
+
+    def create(self, filename, body, metadata=None):
+        """
+        Saves a new note under `filename`, or a suffixed name if it is taken.
+        Returns (saved_filename, version).
+        """
+        raise NotImplementedError
+
+    def update(self, filename, body, metadata=None, expected_version=None):
+        """
+        Replaces the body of an existing note and returns its new version.
+        Raises NoteVersionConflict if the note is gone or (with `expected_version`) has changed.
+        """
+        raise NotImplementedError
+
+    def list_page(self, limit=None, cursor=None, service=None, date_prefix=None):
+        """
+        Returns (filenames, next_cursor), newest first; same contract as NoteIndex.list_page.
+        """
+        raise NotImplementedError
+
+    def history(self, filename):
+        """
+        Returns [{version, updated_at, model, prompt_hash, chars}] newest first, or None.
+        """
+        raise NotImplementedError
+
+    def delete_all(self):
+        """
+        Deletes every note. Returns (deleted_count, [error messages]).
+        """
+        raise NotImplementedError
+
+    def search(self, query, service=None, date_from=None, date_to=None, limit=20, offset=0, rank_window=DEFAULT_RANK_WINDOW):
+        """
+        Ranked full-text search; see rosetta_search.search_notes. Returns (results, next_offset).
+        Raises ValueError for unusable queries or dates.
+        """
+        raise NotImplementedError
+
+    def snapshot(self):
+        raise NotImplementedError
+
+
+class FileNoteStore(NoteStore):
+    """
+    Compatibility mode: the original one-file-per-note layout. Metadata is not persisted and
+    the version of a note is its file's st_mtime_ns. With `search_index_path`, notes are
+    mirrored into a FileSearchIndex for /search_notes. New notes are written in `codec`'s
+    format (default: plain text); every note is read in whatever format it was stored in.
+    """
+
+    kind = STORE_FILES
+
+    def __init__(self, directory, sharded=False, revalidate_seconds=2.0, search_index_path=None, fsync=True, codec=None):
+        self.directory = directory
+        self.fsync = fsync
+        self.codec = codec or NoteCodec(dictionary_directory=os.path.join(directory, DICTIONARY_DIRECTORY))
+        self.index = NoteIndex(directory, sharded=sharded, revalidate_seconds=revalidate_seconds)
+        self._write_lock = threading.Lock() # Makes the version check + write atomic within this process
+        self.search_index = FileSearchIndex(search_index_path, codec=self.codec) if search_index_path else None
+
+    def _index_for_search(self, filename, body, path):
+        if self.search_index is None:
+            return
+        try:
+            stat = os.stat(path)
+            self.search_index.index_note(
+                filename, body, service_for_filename(filename).upper(), _note_date(filename, stat.st_mtime), stat.st_mtime_ns
+            )
+        except Exception as e:
+            # The note itself is saved; the next sync() picks it up
+            logger.warning("Could not update the search index", filename=filename, error=str(e))
+
+    def _describe_for_search(self, filename, path):
+        return service_for_filename(filename).upper(), _note_date(filename, os.stat(path).st_mtime)
+
+    def _record(self, filename, path):
+        body = self.codec.read(path)
+        stat = os.stat(path)
+        return {
+            "filename": filename,
+            "body": body,
+            "service": service_for_filename(filename) or None,
+            "created_at": stat.st_mtime,
+            "updated_at": stat.st_mtime,
+            "version": stat.st_mtime_ns,
+            "options": None,
+            "model": None,
+            "prompt_hash": None,
+        }
+
+    def get(self, filename, version=None):
+        path = self.index.path_for_existing(filename)
+        if path is None:
+            return None
+        try:
+            record = self._record(filename, path)
+        except FileNotFoundError:
+            return None
+        if version is not None and record["version"] != version:
+            return None # Only the current version exists on disk
+        return record
+
+    def create(self, filename, body, metadata=None):
+        with self._write_lock:
+            for candidate in _candidate_filenames(filename):
+                if self.index.path_for_existing(candidate) is not None:
+                    continue
+                path = self.index.path_for_new(candidate)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if any(os.path.exists(path + suffix) for suffix in CODEC_SUFFIXES.values() if suffix != self.codec.suffix):
+                    continue # Saved by a worker with another compression setting
+                path += self.codec.suffix
+                try:
+                    # Exclusive: another worker process may have created the same name meanwhile
+                    atomic_write_text(path, self.codec.encode(body), exclusive=True, durable=self.fsync)
+                except FileExistsError:
+                    continue
+                self.index.add(candidate, self.codec.suffix)
+                self._index_for_search(candidate, body, path)
+                return candidate, os.stat(path).st_mtime_ns
+
+    def update(self, filename, body, metadata=None, expected_version=None):
+        with self._write_lock:
+            path = self.index.path_for_existing(filename)
+            if path is None or not os.path.isfile(path):
+                raise NoteVersionConflict(f"Note '{filename}' no longer exists.")
+            if expected_version is not None and os.stat(path).st_mtime_ns != expected_version:
+                raise NoteVersionConflict(f"Note '{filename}' was modified by another request.")
+            suffix = split_note_name(os.path.basename(path))[1]
+            atomic_write_text(path, self.codec.encode(body, suffix), durable=self.fsync) # Keeps the note's stored format
+            self.index.add(filename, suffix)
+            self._index_for_search(filename, body, path)
+            return os.stat(path).st_mtime_ns
+
+    def list_page(self, limit=None, cursor=None, service=None, date_prefix=None):
+        return self.index.list_page(limit=limit, cursor=cursor, service=service, date_prefix=date_prefix)
+
+    def history(self, filename):
+        record = self.get(filename)
+        if record is None:
+            return None
+        return [{
+            "version": record["version"],
+            "updated_at": record["updated_at"],
+            "model": None,
+            "prompt_hash": None,
+            "chars": len(record["body"]),
+        }]
+
+    def delete_all(self):
+        if not os.path.exists(self.directory):
+            return 0, []
+        deleted_count = 0
+        errors = []
+        for filename, filepath in self.index.all_paths(): # Includes notes in YYYYMM shards
+            try:
+                os.remove(filepath)
+                self.index.remove(filename)
+                deleted_count += 1
+                logger.info("Deleted note file", path=filepath)
+            except Exception as e:
+                logger.error("Error deleting note file", path=filepath, error=str(e))
+                errors.append(f"Could not delete {filename}: {str(e)}")
+        if self.search_index is not None:
+            # Drops the deleted notes; any that failed to delete stay searchable
+            self.search_index.sync(self.index.all_paths(), self._describe_for_search, self.codec.read)
+        return deleted_count, errors
+
+    def search(self, query, service=None, date_from=None, date_to=None, limit=20, offset=0, rank_window=DEFAULT_RANK_WINDOW):
+        if self.search_index is None:
+            raise ValueError("Search is not enabled for the file note store.")
+        # Files written while no worker was running are indexed on the first search
+        self.search_index.sync_once(self.index.all_paths, self._describe_for_search, self.codec.read)
+        return self.search_index.search(
+            query, service=service, date_from=date_from, date_to=date_to, limit=limit, offset=offset, rank_window=rank_window
+        )
+
+    def snapshot(self):
+        stats = self.index.snapshot()
+        stats["kind"] = self.kind
+        stats["compression"] = self.codec.snapshot()
+        if self.search_index is not None:
+            stats["search_index"] = self.search_index.snapshot()
+        return stats
+
+
+SQLITE_SCHEMA_VERSION = 3 # 2: notes_fts search index, 3: compressed bodies (note_body)
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    service TEXT NOT NULL DEFAULT '',
+    note_date TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    options TEXT,
+    model TEXT,
+    prompt_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS notes_service_filename ON notes (service, filename);
+CREATE INDEX IF NOT EXISTS notes_note_date ON notes (note_date);
+CREATE TABLE IF NOT EXISTS note_versions (
+    note_id INTEGER NOT NULL REFERENCES notes (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    options TEXT,
+    model TEXT,
+    prompt_hash TEXT,
+    PRIMARY KEY (note_id, version)
+);
+"""
+
+
+class SqliteNoteStore(NoteStore):
+    """
+    Notes in a SQLite database (WAL mode). One connection per thread and process.
+    Every update keeps the previous body in note_versions (at most `max_versions` per note).
+    The notes_fts search index lives in the same database and is maintained by triggers.
+    Bodies (current and previous versions) are stored with `codec` (a NoteCodec, default
+    plain text); rows in any format are read back.
+    """
+
+    kind = STORE_SQLITE
+
+    def __init__(self, path, max_versions=50, busy_timeout_seconds=10.0, codec=None):
+        self.path = path
+        self.max_versions = max_versions
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.codec = codec or NoteCodec()
+        self._db = SqliteConnections(path, busy_timeout_seconds, pragmas=["foreign_keys = ON"], functions=body_functions(self.codec))
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._db.connection()
+        connection.executescript(SQLITE_SCHEMA)
+        ensure_search_schema(connection)
+        connection.execute(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+        logger.info("Using SQLite note store", path=path)
+
+    @staticmethod
+    def _metadata_values(metadata):
+        metadata = metadata or {}
+        options = metadata.get("options")
+        return (
+            json.dumps(options, sort_keys=True) if options is not None else None,
+            metadata.get("model"),
+            metadata.get("prompt_hash"),
+        )
+
+    def _row_to_record(self, row, filename, service, created_at):
+        return {
+            "filename": filename,
+            "body": self.codec.decode_column(row["body"]),
+            "service": service or None,
+            "created_at": created_at,
+            "updated_at": row["updated_at"],
+            "version": row["version"],
+            "options": json.loads(row["options"]) if row["options"] else None,
+            "model": row["model"],
+            "prompt_hash": row["prompt_hash"],
+        }
+
+    def get(self, filename, version=None):
+        connection = self._db.connection()
+        note = connection.execute("SELECT * FROM notes WHERE filename = ?", (filename,)).fetchone()
+        if note is None:
+            return None
+        if version is None or version == note["version"]:
+            return self._row_to_record(note, filename, note["service"], note["created_at"])
+        old = connection.execute(
+            "SELECT * FROM note_versions WHERE note_id = ? AND version = ?", (note["id"], version)
+        ).fetchone()
+        if old is None:
+            return None
+        return self._row_to_record(old, filename, note["service"], note["created_at"])
+
+    def create(self, filename, body, metadata=None):
+        now = time.time()
+        service = ((metadata or {}).get("service") or service_for_filename(filename)).upper()
+        options, model, prompt_hash = self._metadata_values(metadata)
+
+        def work(connection):
+            for candidate in _candidate_filenames(filename):
+                if connection.execute("SELECT 1 FROM notes WHERE filename = ?", (candidate,)).fetchone():
+                    continue
+                connection.execute(
+                    "INSERT INTO notes (filename, service, note_date, body, created_at, updated_at, version, options, model, prompt_hash)"
+                    " VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?)",
+                    (candidate, service, _note_date(candidate, now), self.codec.encode_column(body), now, now, options, model, prompt_hash),
+                )
+                return candidate, 1
+
+        return self._db.write_transaction(work)
+
+    def update(self, filename, body, metadata=None, expected_version=None):
+        now = time.time()
+        options, model, prompt_hash = self._metadata_values(metadata)
+
+        def work(connection):
+            note = connection.execute("SELECT id, version FROM notes WHERE filename = ?", (filename,)).fetchone()
+            if note is None:
+                raise NoteVersionConflict(f"Note '{filename}' no longer exists.")
+            if expected_version is not None and note["version"] != expected_version:
+                raise NoteVersionConflict(
+                    f"Note '{filename}' was modified by another request (version {note['version']}, expected {expected_version})."
+                )
+            new_version = note["version"] + 1
+            connection.execute(
+                "INSERT INTO note_versions (note_id, version, body, updated_at, options, model, prompt_hash)"
+                " SELECT id, version, body, updated_at, options, model, prompt_hash FROM notes WHERE id = ?",
+                (note["id"],),
+            )
+            connection.execute(
+                "UPDATE notes SET body = ?, updated_at = ?, version = ?, options = ?, model = ?, prompt_hash = ? WHERE id = ?",
+                (self.codec.encode_column(body), now, new_version, options, model, prompt_hash, note["id"]),
+            )
+            if self.max_versions >= 0:
+                connection.execute(
+                    "DELETE FROM note_versions WHERE note_id = ? AND version < ?",
+                    (note["id"], new_version - self.max_versions),
+                )
+            return new_version
+
+        return self._db.write_transaction(work)
+
+    def list_page(self, limit=None, cursor=None, service=None, date_prefix=None):
+        clauses = []
+        params = []
+        if cursor:
+            clauses.append("filename < ?")
+            params.append(cursor)
+        if service:
+            clauses.append("service = ?")
+            params.append(service.upper())
+        if date_prefix:
+            # Generated names with this date prefix form one contiguous filename range
+            name_prefix = f"rosetta_note_{date_prefix}"
+            clauses.append("filename >= ? AND filename < ?")
+            params.extend([name_prefix, name_prefix + "\uffff"])
+        sql = "SELECT filename FROM notes"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY filename DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1) # One extra row tells whether another page exists
+        names = [row[0] for row in self._db.connection().execute(sql, params)]
+        if limit is not None and len(names) > limit:
+            names = names[:limit]
+            return names, names[-1]
+        return names, None
+
+    def history(self, filename):
+        connection = self._db.connection()
+        note = connection.execute(
+            "SELECT id, version, updated_at, model, prompt_hash, length(note_body(body)) AS chars FROM notes WHERE filename = ?", (filename,)
+        ).fetchone()
+        if note is None:
+            return None
+        rows = [note] + connection.execute(
+            "SELECT version, updated_at, model, prompt_hash, length(note_body(body)) AS chars FROM note_versions"
+            " WHERE note_id = ? ORDER BY version DESC",
+            (note["id"],),
+        ).fetchall()
+        return [
+            {key: row[key] for key in ("version", "updated_at", "model", "prompt_hash", "chars")}
+            for row in rows
+        ]
+
+    def delete_all(self):
+        def work(connection):
+            deleted_count = connection.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+            connection.execute("DELETE FROM note_versions")
+            connection.execute("DELETE FROM notes")
+            return deleted_count
+
+        return self._db.write_transaction(work), []
+
+    def import_notes(self, records, overwrite=False):
+        """
+        Bulk-inserts notes keeping their filenames (used by the directory import tool).
+        `records` yields dicts with filename, body and optionally service, created_at and
+        updated_at. Existing filenames are skipped unless `overwrite`. Returns the number written.
+        """
+        # An upsert rather than INSERT OR REPLACE: REPLACE deletes rows without firing the
+        # delete trigger, which would leave stale entries in the search index
+        conflict = (
+            " ON CONFLICT (filename) DO UPDATE SET service = excluded.service, note_date = excluded.note_date,"
+            " body = excluded.body, created_at = excluded.created_at, updated_at = excluded.updated_at"
+            if overwrite else " ON CONFLICT (filename) DO NOTHING"
+        )
+
+        def work(connection):
+            written = 0
+            for record in records:
+                filename = record["filename"]
+                created_at = record.get("created_at") or time.time()
+                cursor = connection.execute(
+                    "INSERT INTO notes (filename, service, note_date, body, created_at, updated_at, version)"
+                    f" VALUES (?, ?, ?, ?, ?, ?, 1){conflict}",
+                    (
+                        filename,
+                        (record.get("service") or service_for_filename(filename)).upper(),
+                        _note_date(filename, created_at),
+                        self.codec.encode_column(record["body"]),
+                        created_at,
+                        record.get("updated_at") or created_at,
+                    ),
+                )
+                written += cursor.rowcount
+            return written
+
+        return self._db.write_transaction(work)
+
+    def search(self, query, service=None, date_from=None, date_to=None, limit=20, offset=0, rank_window=DEFAULT_RANK_WINDOW):
+        return search_notes(
+            self._db.connection(), query, service=service, date_from=date_from, date_to=date_to, limit=limit, offset=offset,
+            rank_window=rank_window,
+        )
+
+    def snapshot(self):
+        connection = self._db.connection()
+        return {
+            "kind": self.kind,
+            "path": self.path,
+            "notes": connection.execute("SELECT COUNT(*) FROM notes").fetchone()[0],
+            "stored_versions": connection.execute("SELECT COUNT(*) FROM note_versions").fetchone()[0],
+            "journal_mode": connection.execute("PRAGMA journal_mode").fetchone()[0],
+            "compression": self.codec.snapshot(),
+        }
+
+
+def create_note_store(kind, notes_directory, sqlite_path, sharded=False, revalidate_seconds=2.0, max_versions=50,
+                      search_index_path=None, fsync=True, codec=None):
+    """
+    Builds the configured store. A new SQLite database is seeded from `notes_directory`, so
+    switching an existing deployment to SQLite keeps its notes (the files are left in place).
+    `search_index_path` is the file store's search database (SQLite keeps its index inline).
+    `fsync=False` skips the file store's fsyncs (writes stay atomic). `codec` (a NoteCodec)
+    compresses new notes in either store.
+    """
+    if kind == STORE_SQLITE:
+        is_new_database = not os.path.exists(sqlite_path)
+        store = SqliteNoteStore(sqlite_path, max_versions=max_versions, codec=codec)
+        if is_new_database and os.path.isdir(notes_directory):
+            written = store.import_notes(iter_note_files(notes_directory))
+            if written:
+                logger.info("Imported existing notes into the new note database", notes=written, directory=notes_directory)
+        return store
+    if kind != STORE_FILES:
+        logger.warning("Unknown note store; using the file store", store=kind)
+    return FileNoteStore(notes_directory, sharded=sharded, revalidate_seconds=revalidate_seconds, search_index_path=search_index_path,
+                         fsync=fsync, codec=codec)
+
+
+def iter_note_files(notes_directory):
+    """
+    Yields import records for every note file in `notes_directory` (including YYYYMM shards).
+    """
+    reader = NoteCodec(dictionary_directory=os.path.join(notes_directory, DICTIONARY_DIRECTORY))
+    for filename, path in NoteIndex(notes_directory).all_paths():
+        try:
+            body = reader.read(path)
+            mtime = os.stat(path).st_mtime
+        except OSError as e:
+            logger.warning("Skipping unreadable note file", path=path, error=str(e))
+            continue
+        yield {"filename": filename, "body": body, "created_at": mtime, "updated_at": mtime}
+
+
+def import_directory(notes_directory, sqlite_path, overwrite=False):
+    store = SqliteNoteStore(sqlite_path)
+    start = time.perf_counter()
+    written = store.import_notes(iter_note_files(notes_directory), overwrite=overwrite)
+    print(f"Imported {written} notes from {notes_directory} into {sqlite_path} in {time.perf_counter() - start:.2f}s.")
+    return written
+
+
+def train_note_dictionary(notes_directory, dictionary_bytes, max_samples=20000, seed=7):
+    """
+    Trains a zstd dictionary on up to `max_samples` notes of `notes_directory` and saves it to
+    its .dictionaries directory, where NoteCodec(use_dictionary=True) picks the newest one.
+    """
+    paths = [path for _, path in NoteIndex(notes_directory).all_paths()]
+    random.Random(seed).shuffle(paths)
+    reader = NoteCodec(dictionary_directory=os.path.join(notes_directory, DICTIONARY_DIRECTORY))
+    samples = []
+    for path in paths[:max_samples]:
+        try:
+            samples.append(reader.read(path))
+        except OSError as e:
+            logger.warning("Skipping unreadable note file", path=path, error=str(e))
+    dict_id, data = train_dictionary(samples, dictionary_bytes)
+    directory = os.path.join(notes_directory, DICTIONARY_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    path = dictionary_path(directory, dict_id)
+    atomic_write_text(path, data)
+    print(f"Trained zstd dictionary {dict_id} ({len(data)} bytes) on {len(samples)} notes: {path}")
+    return dict_id
+
+
+def recompress_directory(notes_directory, codec, dry_run=False):
+    """
+    Rewrites every note file in `notes_directory` (including YYYYMM shards) in `codec`'s format
+    ("none" decompresses). Each note is written next to the old file, which is then removed; an
+    interrupted run leaves two copies with the same text (the index reads the compressed one)
+    and the next run removes the old copy. File mtimes are kept, so note versions and dates
+    don't change. Safe while the server runs, apart from updates racing a note's conversion.
+    """
+    stats = {"notes": 0, "converted": 0, "errors": 0, "bytes_before": 0, "bytes_after": 0}
+    start = time.perf_counter()
+    for filename, path in NoteIndex(notes_directory).all_paths():
+        stats["notes"] += 1
+        try:
+            stat = os.stat(path)
+            stats["bytes_before"] += stat.st_size
+            if split_note_name(os.path.basename(path))[1] == codec.suffix:
+                stats["bytes_after"] += stat.st_size
+                continue
+            data = codec.encode(codec.read(path))
+            stats["bytes_after"] += len(data) if isinstance(data, bytes) else len(data.encode("utf-8"))
+            stats["converted"] += 1
+            if dry_run:
+                continue
+            new_path = os.path.join(os.path.dirname(path), filename + codec.suffix)
+            atomic_write_text(new_path, data)
+            os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.remove(path)
+        except OSError as e:
+            stats["errors"] += 1
+            logger.error("Could not recompress note file", path=path, error=str(e))
+    if not dry_run:
+        # Copies left by an interrupted run: the index already prefers the compressed file
+        for directory, _, names in os.walk(notes_directory):
+            for name in names:
+                parts = split_note_name(name)
+                if parts and parts[1] and parts[0] in names:
+                    os.remove(os.path.join(directory, parts[0]))
+    ratio = stats["bytes_before"] / stats["bytes_after"] if stats["bytes_after"] else 0
+    print(
+        f"{'Would convert' if dry_run else 'Converted'} {stats['converted']} of {stats['notes']} notes to {codec.codec} "
+        f"in {time.perf_counter() - start:.1f}s ({stats['errors']} errors): "
+        f"{stats['bytes_before'] / 1e6:.2f} MB -> {stats['bytes_after'] / 1e6:.2f} MB ({ratio:.1f}x)"
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rosetta note store tools")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    import_parser = subcommands.add_parser("import", help="Import a notes directory into a SQLite note store")
+    import_parser.add_argument("--notes-dir", default=os.path.join(os.environ.get("BASE_NOTES_PATH", "."), "rosetta_outputs"))
+    import_parser.add_argument("--db", default=os.path.join(os.environ.get("BASE_NOTES_PATH", "."), "rosetta_notes.db"))
+    import_parser.add_argument("--overwrite", action="store_true", help="Replace notes that already exist in the database")
+    stats_parser = subcommands.add_parser("stats", help="Print note store statistics")
+    stats_parser.add_argument("--db", default=os.path.join(os.environ.get("BASE_NOTES_PATH", "."), "rosetta_notes.db"))
+    recompress_parser = subcommands.add_parser("recompress", help="Rewrite every note file of a notes directory in one format")
+    recompress_parser.add_argument("--notes-dir", default=os.path.join(os.environ.get("BASE_NOTES_PATH", "."), "rosetta_outputs"))
+    recompress_parser.add_argument("--codec", choices=["none", "gzip", "zstd"], required=True)
+    recompress_parser.add_argument("--level", type=int)
+    recompress_parser.add_argument("--dictionary", action="store_true", help="Use the newest trained zstd dictionary")
+    recompress_parser.add_argument("--dry-run", action="store_true", help="Only report the sizes")
+    train_parser = subcommands.add_parser("train-dictionary", help="Train a zstd dictionary on a notes directory")
+    train_parser.add_argument("--notes-dir", default=os.path.join(os.environ.get("BASE_NOTES_PATH", "."), "rosetta_outputs"))
+    train_parser.add_argument("--size", type=int, default=112640, help="Dictionary size in bytes")
+    train_parser.add_argument("--max-samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        import_directory(args.notes_dir, args.db, overwrite=args.overwrite)
+    elif args.command == "recompress":
+        recompress_directory(args.notes_dir, NoteCodec(
+            args.codec,
+            level=args.level,
+            dictionary_directory=os.path.join(args.notes_dir, DICTIONARY_DIRECTORY),
+            use_dictionary=args.dictionary,
+        ), dry_run=args.dry_run)
+    elif args.command == "train-dictionary":
+        train_note_dictionary(args.notes_dir, args.size, args.max_samples)
+    else:
+        print(json.dumps(SqliteNoteStore(args.db).snapshot(), indent=2))
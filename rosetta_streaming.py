@@ -0,0 +1,100 @@
+import json
+
+# Markers the model is instructed to wrap its "thoughts" section with (see get_llm_response)
+THOUGHTS_START_DELIM = "===ROSETTA_MODEL_THOUGHTS_START==="
+THOUGHTS_END_DELIM = "===ROSETTA_MODEL_THOUGHTS_END==="
+
+# How much text we are willing to hold back while waiting for the start marker.
+# If the model never emits a thoughts section, everything is treated as note text.
+MAX_PRE_MARKER_BUFFER_CHARS = 2048
+
+
+def _partial_marker_suffix_length(text, marker):
+    """
+    Returns the length of the longest suffix of `text` that is also a prefix of `marker`.
+    That suffix must be held back because the rest of the marker may arrive in the next chunk.
+    """
+    max_len = min(len(text), len(marker) - 1)
+    for length in range(max_len, 0, -1):
+        if marker.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class ThoughtsNoteSplitter:
+    """
+    Incrementally sorts streamed LLM text into "thoughts" and "note" pieces.
+
+    Feed chunks as they arrive with feed(); each call returns a list of (event_name, text)
+    tuples that are safe to forward to the client. Markers split across chunk boundaries
+    are handled by holding back only the few characters that could still form a marker.
+    Call finish() once the stream ends to flush anything still buffered.
+    """
+
+    def __init__(self):
+        self.state = "before_thoughts"  # -> "in_thoughts" -> "in_note"
+        self.buffer = ""
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        self.buffer += chunk
+        events = []
+
+        while True:
+            if self.state == "before_thoughts":
+                start_idx = self.buffer.find(THOUGHTS_START_DELIM)
+                if start_idx != -1:
+                    # Anything before the start marker is discarded, matching the non-streaming split
+                    self.buffer = self.buffer[start_idx + len(THOUGHTS_START_DELIM):]
+                    self.state = "in_thoughts"
+                    continue
+                if len(self.buffer) > MAX_PRE_MARKER_BUFFER_CHARS:
+                    # No thoughts section coming; treat the whole output as the note
+                    self.state = "in_note"
+                    continue
+                break
+
+            if self.state == "in_thoughts":
+                end_idx = self.buffer.find(THOUGHTS_END_DELIM)
+                if end_idx != -1:
+                    if end_idx > 0:
+                        events.append(("thoughts", self.buffer[:end_idx]))
+                    self.buffer = self.buffer[end_idx + len(THOUGHTS_END_DELIM):]
+                    self.state = "in_note"
+                    continue
+                hold_back = _partial_marker_suffix_length(self.buffer, THOUGHTS_END_DELIM)
+                emit_upto = len(self.buffer) - hold_back
+                if emit_upto > 0:
+                    events.append(("thoughts", self.buffer[:emit_upto]))
+                    self.buffer = self.buffer[emit_upto:]
+                break
+
+            # in_note: everything after the end marker is note text
+            if self.buffer:
+                events.append(("note", self.buffer))
+                self.buffer = ""
+            break
+
+        return events
+
+    def finish(self):
+        """
+        Flushes whatever is still buffered at the end of the stream.
+        """
+        events = []
+        if self.buffer:
+            if self.state == "in_thoughts":
+                events.append(("thoughts", self.buffer))
+            else:
+                # Either already in the note, or the start marker never showed up
+                events.append(("note", self.buffer))
+            self.buffer = ""
+        return events
+
+
+def format_sse_event(event_name, payload):
+    """
+    Formats a single Server-Sent Events message with a JSON-encoded data field.
+    """
+    return f"event: {event_name}\ndata: {json.dumps(payload)}\n\n"
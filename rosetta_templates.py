@@ -0,0 +1,207 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+from rosetta_logging import get_logger
+from rosetta_sections import SECTION_HEADINGS
+
+logger = get_logger(__name__)
+
+# --- In-memory smartphrase template registry ---
+# Templates are read from SMARTPHRASE_TEMPLATES_DIR once and kept in memory with a content
+# ETag and pre-parsed placeholder/section metadata. The save/delete routes update the registry
+# directly; files changed by hand or by another worker are picked up by a scandir that runs at
+# most every `revalidate_seconds` and only re-reads files whose mtime or size changed.
+# /generate_note can then take a template ID instead of the full template body.
+
+TEMPLATE_EXTENSION = ".txt"
+# "***" blanks and "@NAME@" placeholders, as in Epic SmartPhrases
+BLANK_PATTERN = re.compile(r"\*\*\*")
+PLACEHOLDER_PATTERN = re.compile(r"@[A-Za-z][A-Za-z0-9_.]*@")
+# A heading is a line ending in ":" with nothing after it ("SUBJECTIVE:", "# Plan:"), or a
+# known note heading on its own line
+_TEMPLATE_HEADING_PATTERN = re.compile(r"^[ \t]*(?:#+[ \t]*)?([A-Za-z][A-Za-z0-9 &/()\-]{0,60}?)[ \t]*:[ \t]*$", re.MULTILINE)
+_KNOWN_HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?(" + "|".join(re.escape(name) for name in sorted(SECTION_HEADINGS, key=len, reverse=True)) + r")[ \t]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+# File mtimes this close to "now" may hide a second write in the same clock tick; such files
+# are re-read on the next revalidation
+MTIME_SETTLE_NS = 1_000_000_000
+
+
+def template_id_for_filename(filename):
+    return filename[:-len(TEMPLATE_EXTENSION)] if filename.endswith(TEMPLATE_EXTENSION) else filename
+
+
+def content_etag(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+def parse_template(content):
+    """
+    Returns {"placeholders": [...], "blanks": N, "sections": [...]} for a template body.
+    Placeholders are the distinct @NAME@ tokens in order of appearance; each section lists the
+    heading, its note section id when it is a known heading (see rosetta_sections.py), and the
+    placeholders and blanks under it.
+    """
+    headings = {}
+    for pattern in (_TEMPLATE_HEADING_PATTERN, _KNOWN_HEADING_PATTERN):
+        for match in pattern.finditer(content):
+            headings.setdefault(match.start(), match.group(1).strip())
+
+    placeholders = list(dict.fromkeys(PLACEHOLDER_PATTERN.findall(content)))
+    sections = []
+    offsets = sorted(headings)
+    for position, offset in enumerate(offsets):
+        end = offsets[position + 1] if position + 1 < len(offsets) else len(content)
+        body = content[offset:end]
+        heading = headings[offset]
+        sections.append({
+            "heading": heading,
+            "section_id": SECTION_HEADINGS.get(heading.lower()),
+            "placeholders": list(dict.fromkeys(PLACEHOLDER_PATTERN.findall(body))),
+            "blanks": len(BLANK_PATTERN.findall(body)),
+        })
+    return {"placeholders": placeholders, "blanks": len(BLANK_PATTERN.findall(content)), "sections": sections}
+
+
+class SmartphraseTemplate:
+    """
+    One cached template. `etag` is a hash of the content, so it only changes when the text does.
+    """
+
+    def __init__(self, filename, content, mtime_ns=None, size=None):
+        self.filename = filename
+        self.template_id = template_id_for_filename(filename)
+        self.content = content
+        self.etag = content_etag(content)
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.metadata = parse_template(content)
+
+    def to_dict(self, include_content=False):
+        result = {"id": self.template_id, "filename": self.filename, "etag": self.etag, "chars": len(self.content)}
+        result.update(self.metadata)
+        if include_content:
+            result["content"] = self.content
+        return result
+
+
+class TemplateRegistry:
+    """
+    Thread-safe cache of the .txt templates in `directory`, keyed by filename.
+    """
+
+    def __init__(self, directory, revalidate_seconds=2.0):
+        self.directory = directory
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.RLock()
+        self._templates = None # filename -> SmartphraseTemplate; None until the first scan
+        self._list_etag = None
+        self._last_revalidated = 0.0
+        self.stats = {"scans": 0, "file_reads": 0}
+
+    def _read(self, filename, mtime_ns, size):
+        with open(os.path.join(self.directory, filename), "r", encoding="utf-8") as f:
+            content = f.read()
+        self.stats["file_reads"] += 1
+        if time.time_ns() - mtime_ns < MTIME_SETTLE_NS:
+            mtime_ns = None # Unsettled: re-read next time
+        return SmartphraseTemplate(filename, content, mtime_ns, size)
+
+    def _refresh_list_etag(self):
+        # Caller holds the lock
+        digest = hashlib.sha256()
+        for filename in sorted(self._templates):
+            digest.update(f"{filename}\0{self._templates[filename].etag}\n".encode("utf-8"))
+        self._list_etag = digest.hexdigest()[:32]
+
+    def revalidate(self, force=False):
+        """
+        Picks up templates added, removed or edited on disk since the last scan. Raises
+        FileNotFoundError if the template directory doesn't exist.
+        """
+        with self._lock:
+            now = time.time()
+            if self._templates is not None and not force and now - self._last_revalidated < self.revalidate_seconds:
+                return
+            self._last_revalidated = now
+            self.stats["scans"] += 1
+            previous = self._templates or {}
+            current = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(TEMPLATE_EXTENSION) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    cached = previous.get(entry.name)
+                    if cached is not None and cached.mtime_ns == stat.st_mtime_ns and cached.size == stat.st_size:
+                        current[entry.name] = cached
+                        continue
+                    try:
+                        current[entry.name] = self._read(entry.name, stat.st_mtime_ns, stat.st_size)
+                    except FileNotFoundError:
+                        pass # Deleted between scandir and open
+                    except (OSError, UnicodeDecodeError) as e:
+                        logger.warning("Could not read template", filename=entry.name, error=str(e))
+            self._templates = current
+            self._refresh_list_etag()
+
+    # --- Lookups ---
+
+    def list_templates(self):
+        """
+        Returns ([SmartphraseTemplate] sorted by filename, list_etag).
+        """
+        self.revalidate()
+        with self._lock:
+            return [self._templates[name] for name in sorted(self._templates)], self._list_etag
+
+    def get(self, template_id):
+        """
+        Looks a template up by ID ("general_soap") or filename ("general_soap.txt"); None if unknown.
+        """
+        if not template_id:
+            return None
+        self.revalidate()
+        filename = template_id if template_id.endswith(TEMPLATE_EXTENSION) else template_id + TEMPLATE_EXTENSION
+        with self._lock:
+            return self._templates.get(filename)
+
+    # --- Write/delete hooks ---
+
+    def _stat(self, filename):
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+            if time.time_ns() - stat.st_mtime_ns < MTIME_SETTLE_NS:
+                return None, stat.st_size
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None, None
+
+    def put(self, filename, content):
+        """
+        Records a template that was just written to `directory/filename`.
+        """
+        mtime_ns, size = self._stat(filename)
+        with self._lock:
+            if self._templates is None:
+                self.revalidate(force=True) # First use; the scan picks the new file up
+                return
+            self._templates[filename] = SmartphraseTemplate(filename, content, mtime_ns, size)
+            self._refresh_list_etag()
+
+    def remove(self, filename):
+        with self._lock:
+            if self._templates is None or self._templates.pop(filename, None) is None:
+                return
+            self._refresh_list_etag()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["templates"] = len(self._templates or {})
+            return stats
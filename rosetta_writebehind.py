@@ -0,0 +1,346 @@
+import atexit
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from rosetta_logging import get_logger
+from rosetta_process import pid_alive
+from rosetta_store import _candidate_filenames, atomic_write_text, fsync_directory
+
+logger = get_logger(__name__)
+
+# --- Write-behind for new notes ---
+# WriteBehindNoteStore wraps a NoteStore so that creating a note does not wait for the store's
+# own write (file + directory fsync, or a SQLite commit). The request only waits for:
+#   1. a filename reservation: an O_EXCL marker in the spool directory, so the name returned to
+#      the client is the name the note gets, even with several gunicorn workers
+#   2. one append to this process's journal, fsynced. Concurrent requests share an fsync
+#      (group commit), so the cost per note stays at most one fsync on a slow disk.
+# A writer thread then applies the queued notes to the wrapped store in order. The journal is
+# truncated whenever the queue drains. After a crash, the next process to start on the host
+# replays the journals of dead processes, skipping notes that were already saved.
+#
+# The queue is bounded: when it is full, create() waits for room (backpressure) for up to
+# `enqueue_timeout_seconds`, then saves synchronously. Pending notes are flushed at exit.
+# Only creates are written behind. Updates carry a version check whose conflict has to reach the
+# client, so they wait for any pending create of the same note and then write synchronously.
+# A queued note can be opened at once through this process's store; listings and other workers
+# see it once the writer thread has saved it (normally milliseconds).
+
+JOURNAL_PATTERN = "journal-{host}-{pid}.jsonl"
+RESERVED_DIRECTORY = "reserved"
+# Reservations older than this belong to a note that was saved or lost long ago
+RESERVATION_STALE_SECONDS = 3600
+# A note the store keeps refusing is moved to failed-*.json in the spool directory
+WRITE_ATTEMPTS = 3
+WRITE_RETRY_SECONDS = 0.5
+
+
+class WriteBehindNoteStore:
+    """
+    NoteStore wrapper that writes new notes behind the request. Everything except create(),
+    get() (which also sees pending notes), update() and delete_all() (which flush first) is
+    passed through to `store`.
+    """
+
+    def __init__(self, store, spool_directory, max_queue=256, enqueue_timeout_seconds=5.0, fsync=True, on_event=None):
+        self.store = store
+        self.spool_directory = spool_directory
+        self.max_queue = max_queue
+        self.enqueue_timeout_seconds = enqueue_timeout_seconds
+        self.fsync = fsync
+        self.on_event = on_event
+        self.reserved_directory = os.path.join(spool_directory, RESERVED_DIRECTORY)
+        os.makedirs(self.reserved_directory, exist_ok=True)
+        self._host = socket.gethostname()
+        self._pid = None
+        self.stats = {"written_behind": 0, "synchronous_fallbacks": 0, "write_errors": 0, "replayed": 0}
+        self._reset_process_state()
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        # kind, list_page, history, search, snapshot, ...
+        return getattr(self.store, name)
+
+    def _reset_process_state(self):
+        # Fresh queue, journal and writer thread per process (also after fork)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._queue = deque()
+        self._pending = {} # filename -> (body, metadata) queued or being written
+        self._journal = None
+        self._journal_path = os.path.join(self.spool_directory, JOURNAL_PATTERN.format(host=self._host, pid=self._pid))
+        self._journal_written = 0 # Bytes appended / known to be on disk
+        self._journal_synced = 0
+        self._journal_sync_lock = threading.Lock()
+        self._closed = False
+        self._writer = None
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._reset_process_state()
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self.replay_orphaned_journals()
+                    self._writer = threading.Thread(target=self._write_loop, name="note-write-behind", daemon=True)
+                    self._writer.start()
+
+    def _emit(self, event, **details):
+        if self.on_event is not None:
+            try:
+                self.on_event(event, **details)
+            except Exception as e:
+                logger.warning("Write-behind event hook failed", write_event=event, error=str(e))
+
+    # --- Filename reservations ---
+
+    def _reserve(self, filename):
+        """
+        Returns a filename (the requested one or a _2, _3, ... variant) that is neither saved
+        nor pending in any worker, and marks it as taken.
+        """
+        for candidate in _candidate_filenames(filename):
+            if candidate in self._pending or self.store.get(candidate) is not None:
+                continue
+            marker = os.path.join(self.reserved_directory, candidate)
+            try:
+                fd = os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(marker).st_mtime < RESERVATION_STALE_SECONDS:
+                        continue
+                    os.remove(marker) # A stale reservation; try it again on the next pass
+                except OSError:
+                    pass
+                continue
+            os.write(fd, str(os.getpid()).encode("ascii"))
+            os.close(fd)
+            return candidate
+
+    def _release(self, filename):
+        try:
+            os.remove(os.path.join(self.reserved_directory, filename))
+        except OSError:
+            pass
+
+    # --- Journal ---
+
+    def _append_to_journal(self, entry):
+        # Caller holds the lock; the fsync happens outside it (see _sync_journal)
+        if self._journal is None:
+            self._journal = open(self._journal_path, "a", encoding="utf-8")
+            if self.fsync:
+                fsync_directory(self.spool_directory)
+        line = json.dumps(entry) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        self._journal_written += len(line.encode("utf-8"))
+        return self._journal_written
+
+    def _sync_journal(self, offset):
+        # Group commit: whoever gets the sync lock first fsyncs everything appended so far
+        if not self.fsync:
+            return
+        with self._journal_sync_lock:
+            if self._journal_synced >= offset:
+                return
+            with self._lock:
+                journal, target = self._journal, self._journal_written
+            if journal is not None:
+                os.fsync(journal.fileno())
+            self._journal_synced = target
+
+    def _truncate_journal(self):
+        # Caller holds the lock and the queue is empty: every journaled note has been saved
+        if self._journal is not None and self._journal_written:
+            self._journal.truncate(0)
+            self._journal.seek(0)
+            self._journal_written = 0
+            self._journal_synced = 0
+
+    def replay_orphaned_journals(self):
+        """
+        Saves the notes left in journals of dead processes on this host. A journal is claimed by
+        renaming it, so only one starting worker replays it.
+        """
+        pattern = os.path.join(self.spool_directory, JOURNAL_PATTERN.format(host=self._host, pid="*"))
+        for path in glob.glob(pattern):
+            pid = path[len(pattern) - len("*.jsonl"):-len(".jsonl")]
+            if not pid.isdigit() or int(pid) == os.getpid() or pid_alive(int(pid)):
+                continue
+            claimed_path = f"{path}.replaying-{os.getpid()}"
+            try:
+                os.rename(path, claimed_path)
+            except OSError:
+                continue # Another worker claimed it
+            replayed = 0
+            with open(claimed_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Torn last line: that request never got its response
+                    if self.store.get(entry["filename"]) is None:
+                        saved_filename, _ = self.store.create(entry["filename"], entry["body"], entry.get("metadata"))
+                        replayed += 1
+                        if saved_filename != entry["filename"]:
+                            logger.warning("Replayed note saved under a different name", filename=entry["filename"], saved_as=saved_filename)
+                    self._release(entry["filename"])
+            os.remove(claimed_path)
+            self.stats["replayed"] += replayed
+            logger.warning("Replayed write-behind journal of a dead process", pid=int(pid), notes=replayed)
+
+    # --- NoteStore interface ---
+
+    def create(self, filename, body, metadata=None):
+        self._ensure_started()
+        candidate = self._reserve(filename)
+        if candidate is None:
+            raise RuntimeError(f"Could not reserve a filename for '{filename}'.")
+        deadline = time.monotonic() + self.enqueue_timeout_seconds
+        with self._lock:
+            while len(self._queue) >= self.max_queue and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_full.wait(remaining)
+            queue_full = len(self._queue) >= self.max_queue or self._closed
+            if not queue_full:
+                offset = self._append_to_journal({"filename": candidate, "body": body, "metadata": metadata})
+                self._queue.append((candidate, body, metadata))
+                self._pending[candidate] = (body, metadata)
+                depth = len(self._queue)
+                self._not_empty.notify()
+        if queue_full:
+            # Backpressure ran out: save in the request thread
+            self.stats["synchronous_fallbacks"] += 1
+            self._emit("fallback")
+            logger.warning("Write-behind queue full; saving synchronously", filename=candidate, max_queue=self.max_queue)
+            try:
+                return self.store.create(candidate, body, metadata)
+            finally:
+                self._release(candidate)
+        self._sync_journal(offset)
+        self._emit("enqueued", depth=depth)
+        return candidate, None # Version is known once the writer has saved it
+
+    def get(self, filename, version=None):
+        with self._lock:
+            pending = self._pending.get(filename) if self._pid == os.getpid() else None
+        if pending is not None and version is None:
+            body, metadata = pending
+            now = time.time()
+            metadata = metadata or {}
+            return {
+                "filename": filename,
+                "body": body,
+                "service": metadata.get("service"),
+                "created_at": now,
+                "updated_at": now,
+                "version": None,
+                "options": metadata.get("options"),
+                "model": metadata.get("model"),
+                "prompt_hash": metadata.get("prompt_hash"),
+            }
+        return self.store.get(filename, version)
+
+    def update(self, filename, body, metadata=None, expected_version=None):
+        self.flush(filename)
+        return self.store.update(filename, body, metadata, expected_version)
+
+    def delete_all(self):
+        self.flush()
+        return self.store.delete_all()
+
+    # --- Writer ---
+
+    def _save(self, filename, body, metadata):
+        start = time.perf_counter()
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                saved_filename, _ = self.store.create(filename, body, metadata)
+                break
+            except Exception as e:
+                logger.error("Write-behind save failed", filename=filename, attempt=attempt, error=str(e), error_type=type(e).__name__)
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(WRITE_RETRY_SECONDS * attempt) # The note stays readable while pending
+        else:
+            # Keep the note where an operator can restore it instead of holding up the queue
+            self.stats["write_errors"] += 1
+            self._emit("error")
+            failed_path = os.path.join(self.spool_directory, f"failed-{int(time.time() * 1000)}-{filename}.json")
+            atomic_write_text(failed_path, json.dumps({"filename": filename, "body": body, "metadata": metadata}), durable=self.fsync)
+            logger.critical("Note could not be saved; kept in the write-behind spool", filename=filename, path=failed_path)
+            return
+        if saved_filename != filename:
+            logger.warning("Write-behind note saved under a different name", filename=filename, saved_as=saved_filename)
+        self.stats["written_behind"] += 1
+        self._emit("written", seconds=time.perf_counter() - start)
+
+    def _write_loop(self):
+        owner_pid = os.getpid()
+        while os.getpid() == owner_pid:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return # Closed and drained
+                filename, body, metadata = self._queue[0]
+            self._save(filename, body, metadata)
+            self._release(filename)
+            with self._lock:
+                self._queue.popleft()
+                self._pending.pop(filename, None)
+                if not self._queue:
+                    self._truncate_journal()
+                self._not_full.notify()
+                self._drained.notify_all()
+
+    def flush(self, filename=None, timeout=None):
+        """
+        Waits until every pending note (or just `filename`) has been saved. Returns False on timeout.
+        """
+        if self._pid != os.getpid() or self._writer is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while (filename in self._pending) if filename else self._queue:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._drained.wait(remaining)
+        return True
+
+    def close(self, timeout=30.0):
+        """
+        Flushes pending notes and stops the writer (registered with atexit).
+        """
+        if self._pid != os.getpid() or self._writer is None:
+            return
+        if not self.flush(timeout=timeout):
+            logger.error("Write-behind queue not drained at shutdown; the journal keeps the rest", pending=len(self._queue))
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            if self._journal is not None and not self._queue:
+                self._journal.close()
+                self._journal = None
+                try:
+                    os.remove(self._journal_path)
+                except OSError:
+                    pass
+
+    def snapshot(self):
+        stats = self.store.snapshot()
+        with self._lock:
+            stats["write_behind"] = dict(self.stats, queued=len(self._queue), max_queue=self.max_queue)
+        return stats
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The rosetta_* modules live at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+@pytest.fixture(scope="session")
+def backend(tmp_path_factory):
+    """
+    rosetta_backend imported once, configured from the environment at import time: a file
+    note store under a temporary BASE_NOTES_PATH and no response cache.
+    """
+    base = tmp_path_factory.mktemp("notes")
+    os.environ.update({
+        "BASE_NOTES_PATH": str(base),
+        "ROSETTA_NOTE_STORE": "files",
+        "ROSETTA_RESPONSE_CACHE": "0",
+        "ROSETTA_LOG_LEVEL": "ERROR",
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "unused"),
+    })
+    import rosetta_backend
+    return rosetta_backend
+
+
+@pytest.fixture
+def dead_pid():
+    """The pid of a process that has already exited."""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
@@ -0,0 +1,71 @@
+import asyncio
+import types
+
+import pytest
+
+LOOPING_CHUNKS = ["Impression: stable. "] + ["Continue current management. "] * 200
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = []
+
+
+class FakeAsyncStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+        self.prompt_feedback = None
+        self.usage_metadata = None
+        self.candidates = []
+
+    async def __aiter__(self):
+        for text in self.chunks:
+            self.sent += 1
+            yield Chunk(text)
+
+
+class FakeModel:
+    def __init__(self):
+        self.streams = []
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False, request_options=None):
+        assert stream, "the loop guard must stream under the hood"
+        self.streams.append(FakeAsyncStream(LOOPING_CHUNKS))
+        return self.streams[-1]
+
+
+@pytest.fixture
+def asgi(backend):
+    import rosetta_asgi
+    return rosetta_asgi
+
+
+def test_non_stream_call_goes_through_the_loop_guard(backend, asgi, monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(backend, "LOOP_GUARD_SYNC_ENABLED", True)
+    monkeypatch.setattr(asgi, "_llm_semaphore", None) # Bound to the event loop that first uses it
+    monkeypatch.setitem(backend.gemini_model_providers, backend.GEMINI_MODEL, types.SimpleNamespace(get_model=lambda: model))
+    llm_meta = {}
+
+    text_output, feedback = asyncio.run(asgi.generate_llm_response_async("Patient: 67M", True, llm_meta))
+
+    assert llm_meta["loop_detected"]
+    assert feedback == backend.LOOP_STOPPED_FEEDBACK
+    assert text_output.startswith("Impression: stable.")
+    assert model.streams[0].sent < len(LOOPING_CHUNKS) # Cancelled mid-generation
+
+
+def test_shared_response_assembly_reports_loop_detection(backend):
+    saved_filename, _ = backend.note_store.create("rosetta_note_20250101_0800_MED_asgi.txt", "old")
+    note_request = {
+        "output_filename": saved_filename,
+        "operation_type_message": "updated",
+        "is_update": True,
+        "local_output": None,
+    }
+    response, status = backend.finish_note_response(note_request, "A&P:\n#CHF\n- diuresis", "", {"loop_detected": True, "model": "m"})
+    assert status == 200
+    assert {"cache_hit", "loop_detected", "coalesced", "model"} <= set(response)
+    assert response["loop_detected"] is True
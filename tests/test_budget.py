@@ -0,0 +1,18 @@
+from rosetta_budget import DEFAULT_POLICIES, PromptBudgeter
+
+
+def assemble(sections):
+    return "\n\n".join(text for text in sections.values() if text)
+
+
+def test_existing_note_is_never_compacted():
+    existing_note = "\n".join(f"- 10/{day}: diuresed 1 L, creatinine stable, continue furosemide." for day in range(1, 29))
+    patient_input = "Overnight: no events.\n\n" + "Page 1 of 3\n" * 50
+    budgeter = PromptBudgeter(50, policies=DEFAULT_POLICIES)
+
+    sections, report = budgeter.fit({"patient_input": patient_input, "existing_note": existing_note}, assemble)
+
+    assert sections["existing_note"] == existing_note
+    assert all(entry["section"] != "existing_note" for entry in report["compactions"])
+    assert not report["within_budget"]
+
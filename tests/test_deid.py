@@ -0,0 +1,30 @@
+import pytest
+
+
+class FailingDeidentifier:
+    def deidentify(self, text):
+        raise RuntimeError("name dictionary unreadable")
+
+
+@pytest.fixture
+def client(backend, monkeypatch):
+    monkeypatch.setattr(backend, "local_deidentifier", FailingDeidentifier())
+    return backend.app.test_client()
+
+
+def test_local_failure_is_not_reported_as_dlp(client):
+    response = client.post("/api/deidentify_text", json={"text_content": "Pt John Smith", "deid_mode": "local"})
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "De-identification failed (mode=local).", "details": "name dictionary unreadable"}
+
+
+@pytest.mark.parametrize("mode", ["local", "local_then_dlp"])
+def test_batch_local_failure_is_reported_per_text(backend, client, monkeypatch, mode):
+    sent_to_dlp = []
+    monkeypatch.setattr(backend.dlp_deidentifier, "deidentify_texts", lambda texts, project: sent_to_dlp.extend(texts) or [])
+    response = client.post("/api/deidentify_texts", json={"texts": ["Pt John Smith"], "deid_mode": mode, "gcp_project_id": "test"})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["failed"] == 1
+    assert body["results"] == [{"error": f"De-identification failed (mode={mode}).", "details": "name dictionary unreadable"}]
+    assert sent_to_dlp == [] # Text the local pass failed on never reaches DLP
@@ -0,0 +1,129 @@
+import socket
+import time
+
+import pytest
+
+from rosetta_jobs import (
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    PRIORITIES,
+    JobQueue,
+    JobRunner,
+    JobStateError,
+    parse_service_limits,
+)
+
+REMOTE_WORKER = "other-host:1:aaaa" # Another host: only its lease expiry can free its jobs
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    def make(**options):
+        return JobQueue(str(tmp_path / "jobs.db"), **options)
+    return make
+
+
+def test_expired_lease_is_requeued_and_late_result_discarded(make_queue):
+    queue = make_queue(lease_seconds=0.05)
+    job_id = queue.submit({"n": 1})
+    assert queue.claim(REMOTE_WORKER)[0] == job_id
+    assert queue.claim("other-host:2:bbbb") is None # Lease still valid
+
+    time.sleep(0.1)
+    claimed = queue.claim("other-host:2:bbbb")
+    assert claimed == (job_id, {"n": 1}, 2)
+    assert not queue.complete(job_id, REMOTE_WORKER, JOB_SUCCEEDED, {"late": True}, 200)
+    assert queue.complete(job_id, "other-host:2:bbbb", JOB_SUCCEEDED, {"ok": True}, 200)
+    assert queue.get(job_id)["result"] == {"ok": True}
+
+
+def test_renewed_lease_is_not_requeued(make_queue):
+    queue = make_queue(lease_seconds=0.2)
+    job_id = queue.submit({})
+    queue.claim(REMOTE_WORKER)
+    for _ in range(3):
+        time.sleep(0.1)
+        queue.renew_leases(REMOTE_WORKER, [job_id])
+    assert queue.claim("other-host:2:bbbb") is None
+    assert queue.get(job_id)["status"] == JOB_RUNNING
+
+
+def test_job_of_dead_local_process_is_requeued_before_its_lease_expires(make_queue, dead_pid):
+    queue = make_queue(lease_seconds=3600)
+    job_id = queue.submit({})
+    queue.claim(f"{socket.gethostname()}:{dead_pid}:cccc")
+    assert queue.claim(queue.new_worker_id())[0] == job_id
+
+
+def test_job_fails_after_max_attempts(make_queue):
+    queue = make_queue(lease_seconds=0.01, max_attempts=2)
+    job_id = queue.submit({"patient_data": "PHI"})
+    for _ in range(2):
+        assert queue.claim(REMOTE_WORKER)[0] == job_id
+        time.sleep(0.03)
+
+    assert queue.claim(REMOTE_WORKER) is None
+    job = queue.get(job_id)
+    assert job["status"] == JOB_FAILED
+    assert job["status_code"] == 500
+    assert job["attempts"] == 2
+    assert "2 attempts" in job["error"]
+
+
+def test_service_limits_skip_full_services(make_queue):
+    queue = make_queue(service_limits=parse_service_limits("MICU=1,*=2"))
+    micu_first = queue.submit({}, service="micu")
+    micu_second = queue.submit({}, service="MICU")
+    cards = [queue.submit({}, service="CARDS") for _ in range(3)]
+
+    assert queue.claim(REMOTE_WORKER)[0] == micu_first
+    assert queue.claim(REMOTE_WORKER)[0] == cards[0] # MICU is at its limit
+    assert queue.claim(REMOTE_WORKER)[0] == cards[1]
+    assert queue.claim(REMOTE_WORKER) is None # CARDS at the "*" limit of 2
+
+    queue.complete(micu_first, REMOTE_WORKER, JOB_SUCCEEDED, {}, 200)
+    assert queue.claim(REMOTE_WORKER)[0] == micu_second
+
+
+def test_priority_then_age(make_queue):
+    queue = make_queue()
+    routine = queue.submit({}, priority=PRIORITIES["routine"])
+    stat = queue.submit({}, priority=PRIORITIES["stat"])
+    assert queue.get(routine)["queue_position"] == 1
+    assert queue.claim(REMOTE_WORKER)[0] == stat
+    assert queue.claim(REMOTE_WORKER)[0] == routine
+
+
+def test_only_queued_jobs_can_be_cancelled(make_queue):
+    queue = make_queue()
+    job_id = queue.submit({})
+    queue.claim(REMOTE_WORKER)
+    with pytest.raises(JobStateError):
+        queue.cancel(job_id)
+    other = queue.submit({})
+    queue.cancel(other)
+    assert queue.get(other)["status"] == "cancelled"
+
+
+def test_runner_records_results_and_failures(make_queue):
+    queue = make_queue()
+    events = []
+
+    def handler(payload):
+        if payload.get("raise"):
+            raise RuntimeError("boom")
+        return {"note": payload["n"]}, payload.get("status", 200)
+
+    runner = JobRunner(queue, handler, workers=2, poll_interval_seconds=0.05, on_event=lambda event, **_: events.append(event))
+    ok, bad, crash = queue.submit({"n": 1}), queue.submit({"n": 2, "status": 502}), queue.submit({"raise": True})
+    runner.start()
+
+    assert runner.wait(ok, 5)["result"] == {"note": 1}
+    assert runner.wait(bad, 5)["status"] == JOB_FAILED
+    crashed = runner.wait(crash, 5)
+    assert crashed["status"] == JOB_FAILED and "boom" in crashed["error"]
+    assert events.count("finished") == 3
+    assert queue.counts() == {JOB_SUCCEEDED: 1, JOB_FAILED: 2}
+    assert JOB_QUEUED not in queue.counts()
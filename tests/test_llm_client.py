@@ -0,0 +1,231 @@
+import asyncio
+import threading
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+from requests import exceptions as requests_exceptions
+
+import rosetta_llm_client
+from rosetta_llm_client import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilientLLMClient,
+    is_retryable,
+)
+from rosetta_note_codec import NoteCodecError
+
+
+class FakeClock:
+    """Stands in for the `time` module: sleeping advances the clock instantly."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class Attempts:
+    """An attempt function that plays back `outcomes` (exceptions are raised) and records the calls."""
+
+    def __init__(self, outcomes, clock=None, latency_seconds=None):
+        self.outcomes = list(outcomes)
+        self.clock = clock
+        self.latency_seconds = latency_seconds or {}
+        self.models = []
+
+    def __call__(self, model, timeout):
+        self.models.append(model)
+        if self.clock is not None:
+            self.clock.now += self.latency_seconds.get(model, 0.1)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rosetta_llm_client, "time", clock)
+    return clock
+
+
+def make_client(models=("gemini-pro", "gemini-flash"), events=None, **overrides):
+    settings = dict(max_attempts=3, backoff_base_seconds=0.5, attempt_timeout_seconds=30.0, breaker_failure_threshold=3, breaker_reset_seconds=30.0)
+    settings.update(overrides)
+    on_event = (lambda event, model, **details: events.append((event, model, details))) if events is not None else None
+    return ResilientLLMClient(list(models), on_event=on_event, **settings)
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (api_exceptions.ServiceUnavailable("overloaded"), True),
+    (api_exceptions.ResourceExhausted("quota"), True),
+    (requests_exceptions.ConnectionError("reset"), True),
+    (requests_exceptions.ReadTimeout("slow"), True),
+    (TimeoutError(), True),
+    (api_exceptions.InvalidArgument("bad prompt"), False),
+    (FileNotFoundError("notes/missing.txt"), False),
+    (PermissionError("notes/"), False),
+    (NoteCodecError("corrupt frame"), False),
+    (CircuitOpenError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) is retryable
+
+
+def test_transient_errors_are_retried_with_backoff(clock):
+    events = []
+    client = make_client(events=events)
+    attempts = Attempts([api_exceptions.ServiceUnavailable("overloaded"), requests_exceptions.ConnectionError("reset"), "note"])
+
+    value, info = client.call(attempts)
+
+    assert value == "note"
+    assert info == {"model": "gemini-pro", "attempts": 3, "hedged": False, "fallback_reason": None}
+    assert [event for event, _, _ in events] == ["retry", "retry"]
+    assert len(clock.slept) == 2 and all(0 <= delay <= 1.0 for delay in clock.slept)
+
+
+@pytest.mark.parametrize("error", [api_exceptions.InvalidArgument("bad prompt"), FileNotFoundError("notes/missing.txt")])
+def test_non_transient_errors_are_not_retried(clock, error):
+    client = make_client()
+    attempts = Attempts([error, "never reached"])
+
+    with pytest.raises(type(error)):
+        client.call(attempts)
+
+    assert attempts.models == ["gemini-pro"]
+    assert client._health["gemini-pro"].breaker.consecutive_failures == 0 # Not held against the model
+
+
+def test_retries_stop_at_the_deadline(clock):
+    client = make_client(max_attempts=10, backoff_base_seconds=4.0)
+    attempts = Attempts([api_exceptions.ServiceUnavailable("overloaded")] * 10, clock=clock, latency_seconds={"gemini-pro": 2.0})
+
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        client.call(attempts, deadline_seconds=5.0)
+
+    assert len(attempts.models) < 10
+
+
+def test_breaker_lets_one_probe_through_when_half_open(clock):
+    changes = []
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30.0, on_change=changes.append)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN and not breaker.allow()
+
+    clock.now += 30.0
+    assert breaker.allow() # The probe
+    assert breaker.state == BREAKER_HALF_OPEN
+    assert not breaker.allow() # Only one at a time
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN and not breaker.allow() # A failed probe re-opens it
+
+    clock.now += 30.0
+    assert breaker.allow()
+    breaker.release_probe() # No verdict (non-transient error): the next request probes instead
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == BREAKER_CLOSED
+    assert breaker.allow() and breaker.allow()
+    assert changes == [BREAKER_OPEN, BREAKER_HALF_OPEN, BREAKER_OPEN, BREAKER_HALF_OPEN, BREAKER_CLOSED]
+
+
+def test_open_breaker_falls_back_to_the_next_model(clock):
+    events = []
+    client = make_client(events=events, max_attempts=1, breaker_failure_threshold=1)
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        client.call(Attempts([api_exceptions.ServiceUnavailable("overloaded")]))
+
+    attempts = Attempts(["note"])
+    value, info = client.call(attempts)
+
+    assert value == "note"
+    assert attempts.models == ["gemini-flash"]
+    assert info["fallback_reason"] == "circuit_open"
+    assert ("fallback", "gemini-flash", {"reason": "circuit_open"}) in events
+
+
+def test_every_breaker_open_raises_circuit_open(clock):
+    client = make_client(models=["gemini-pro"], max_attempts=1, breaker_failure_threshold=1)
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        client.call(Attempts([api_exceptions.ServiceUnavailable("overloaded")]))
+    with pytest.raises(CircuitOpenError):
+        client.call(Attempts(["never reached"]))
+
+
+def test_slow_model_is_passed_over_for_the_latency_slo(clock):
+    client = make_client(latency_slo_seconds=10.0)
+    slow = Attempts(["note"], clock=clock, latency_seconds={"gemini-pro": 25.0})
+    assert client.call(slow)[1]["fallback_reason"] is None
+
+    attempts = Attempts(["note"], clock=clock)
+    _, info = client.call(attempts)
+    assert attempts.models == ["gemini-flash"]
+    assert info["fallback_reason"] == "latency_slo"
+
+    clock.now += 31.0 # Past breaker_reset_seconds the estimate is stale and the model gets another chance
+    attempts = Attempts(["note"], clock=clock)
+    _, info = client.call(attempts)
+    assert attempts.models == ["gemini-pro"]
+    assert info["fallback_reason"] is None
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    events = []
+    client = make_client(events=events, hedge_after_seconds=0.05)
+    first_call = threading.Event()
+    release = threading.Event()
+
+    def attempt(model, timeout):
+        if not first_call.is_set():
+            first_call.set()
+            release.wait(5) # The primary stalls
+            return "primary"
+        return "hedge"
+
+    try:
+        value, info = client.call(attempt)
+    finally:
+        release.set()
+
+    assert value == "hedge"
+    assert info["hedged"] is True
+    assert [event for event, _, _ in events] == ["hedge", "hedge_won"]
+
+
+def test_fast_call_is_not_hedged():
+    events = []
+    client = make_client(events=events, hedge_after_seconds=5.0)
+    value, info = client.call(lambda model, timeout: "note")
+    assert value == "note" and info["hedged"] is False
+    assert events == []
+
+
+def test_async_calls_retry_transient_errors(clock, monkeypatch):
+    client = make_client()
+    attempts = Attempts([api_exceptions.ServiceUnavailable("overloaded"), "note"])
+
+    async def attempt(model, timeout):
+        return attempts(model, timeout)
+
+    async def no_wait(seconds):
+        clock.sleep(seconds)
+
+    monkeypatch.setattr(rosetta_llm_client.asyncio, "sleep", no_wait)
+    value, info = asyncio.run(client.call_async(attempt))
+
+    assert value == "note"
+    assert info["attempts"] == 2
+    assert len(clock.slept) == 1
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+from rosetta_note_codec import NoteCodec
+from rosetta_search import SEARCH_SCHEMA
+from rosetta_store import SQLITE_SCHEMA, FileNoteStore, SqliteNoteStore
+
+NOTE = "Assessment: acute kidney injury, creatinine 2.1 from 1.0. Plan: hold lisinopril, IV fluids. " * 5
+
+
+def stored_bodies(path):
+    connection = sqlite3.connect(path)
+    try:
+        return [row[0] for row in connection.execute("SELECT body FROM notes")]
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd"])
+def test_sqlite_store_keeps_bodies_compressed_and_searchable(tmp_path, codec):
+    path = str(tmp_path / "notes.db")
+    store = SqliteNoteStore(path, codec=NoteCodec(codec))
+    filename, _ = store.create("rosetta_note_20250101_0800_MED_aki.txt", NOTE)
+    store.update(filename, NOTE + "Creatinine improving.")
+
+    body, = stored_bodies(path)
+    assert isinstance(body, bytes) and len(body) < len(NOTE)
+    assert store.get(filename)["body"] == NOTE + "Creatinine improving."
+    assert store.get(filename, version=1)["body"] == NOTE
+    assert [entry["chars"] for entry in store.history(filename)] == [len(NOTE) + 21, len(NOTE)]
+
+    results, _ = store.search("creatinine improving")
+    assert [result["filename"] for result in results] == [filename]
+    assert "<mark>improving</mark>" in results[0]["snippet"]
+    store.delete_all()
+    assert store.search("creatinine")[0] == []
+
+
+def test_plain_database_is_migrated_and_keeps_its_rows(tmp_path):
+    # A database written before bodies could be compressed: view and triggers read `body` directly
+    path = str(tmp_path / "notes.db")
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLITE_SCHEMA + SEARCH_SCHEMA.replace("note_body(", "("))
+    connection.execute(
+        "INSERT INTO notes (filename, service, note_date, body, created_at, updated_at) VALUES (?, 'MED', '20250101', ?, 0, 0)",
+        ("rosetta_note_20250101_0800_MED_old.txt", "Old plain note about sepsis."),
+    )
+    connection.commit()
+    connection.close()
+
+    store = SqliteNoteStore(path, codec=NoteCodec("gzip"))
+    store.create("rosetta_note_20250102_0800_MED_new.txt", "New compressed note about sepsis.")
+    store.update("rosetta_note_20250101_0800_MED_old.txt", "Old note, now about pneumonia.")
+
+    assert all(isinstance(body, bytes) for body in stored_bodies(path))
+    assert [result["filename"] for result in store.search("sepsis")[0]] == ["rosetta_note_20250102_0800_MED_new.txt"]
+    assert [result["filename"] for result in store.search("pneumonia")[0]] == ["rosetta_note_20250101_0800_MED_old.txt"]
+    assert store.get("rosetta_note_20250101_0800_MED_old.txt", version=1)["body"] == "Old plain note about sepsis."
+
+
+def test_file_store_search_mirror_is_compressed_too(tmp_path):
+    notes_dir = tmp_path / "notes"
+    notes_dir.mkdir()
+    index_path = str(tmp_path / "search.db")
+    store = FileNoteStore(str(notes_dir), revalidate_seconds=0, search_index_path=index_path, fsync=False, codec=NoteCodec("gzip"))
+    filename, _ = store.create("rosetta_note_20250101_0800_MED_aki.txt", NOTE)
+
+    body, = stored_bodies(index_path)
+    assert isinstance(body, bytes) and len(body) < len(NOTE)
+    results, _ = store.search("lisinopril")
+    assert [result["filename"] for result in results] == [filename]
+    assert "<mark>lisinopril</mark>" in results[0]["snippet"]
@@ -0,0 +1,37 @@
+import os
+import threading
+
+import pytest
+
+from rosetta_process import SqliteConnections, pid_alive
+
+
+def test_pid_alive(dead_pid):
+    assert pid_alive(os.getpid())
+    assert not pid_alive(dead_pid)
+
+
+def test_connections_are_per_thread(tmp_path):
+    db = SqliteConnections(str(tmp_path / "test.db"))
+    main = db.connection()
+    assert db.connection() is main
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not main
+    assert main.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_write_transaction_rolls_back_on_error(tmp_path):
+    db = SqliteConnections(str(tmp_path / "test.db"))
+    db.connection().execute("CREATE TABLE items (name TEXT)")
+
+    def insert_then_fail(connection):
+        connection.execute("INSERT INTO items VALUES ('lost')")
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        db.write_transaction(insert_then_fail)
+    assert db.write_transaction(lambda connection: connection.execute("INSERT INTO items VALUES ('kept')").rowcount) == 1
+    assert [row["name"] for row in db.connection().execute("SELECT name FROM items")] == ["kept"]
@@ -0,0 +1,173 @@
+import os
+
+import pytest
+
+from rosetta_sections import (
+    NEW_PROBLEM_SECTION_ID,
+    PREAMBLE_SECTION_ID,
+    SECTION_MARKER_FORMAT,
+    merge_section_update,
+    parse_note_sections,
+    parse_section_update,
+    render_sections,
+)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def marked(*sections):
+    """Model output in the section-update format: (section_id, text) pairs behind markers."""
+    return "\n".join(f"{SECTION_MARKER_FORMAT.format(section_id)}\n{text}" for section_id, text in sections)
+
+
+@pytest.fixture
+def golden_note():
+    return read_fixture("section_note.txt")
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "\n\n",
+    "Free text note with no headings\nsecond line\n",
+    "\n\nSubjective:\nleading blank lines\n",
+    "#AKI\n- A&P-only note\n\n#HTN\n- home meds\n",
+    "# Objective\nmarkdown heading\n\nA&P:\n#CHF\n- diuresis",
+    "A&P:\r\n#CHF\r\n- Windows line endings\r\n",
+])
+def test_round_trip_is_byte_for_byte(text):
+    assert render_sections(parse_note_sections(text)) == text
+
+
+def test_golden_note_sections(golden_note):
+    sections = parse_note_sections(golden_note)
+    assert render_sections(sections) == golden_note
+    assert [section.section_id for section in sections] == [
+        PREAMBLE_SECTION_ID,
+        "impression",
+        "subjective",
+        "objective",
+        "assessment_and_plan",
+        "problem_acute_on_chronic_systolic_heart_failure",
+        "problem_aki",
+        "problem_hypertension",
+        "problem_aki_2",
+        "problem_dispo",
+    ]
+    # Trailing spaces and tabs stay with their section
+    assert sections[0].text == "Hospital Day 4  \n\n"
+    assert "chest pain.\t\n" in sections[2].text
+
+
+def test_repeated_problem_ids_are_numbered_in_order(golden_note):
+    sections = {section.section_id: section for section in parse_note_sections(golden_note)}
+    assert sections["problem_aki"].text.startswith("#AKI\n- Cr 1.6 from 1.4")
+    assert sections["problem_aki_2"].text.startswith("#AKI\n- (duplicate block")
+    assert all(section.is_problem for section_id, section in sections.items() if section_id.startswith("problem_"))
+    assert not sections["objective"].is_problem
+
+
+def test_problem_lines_outside_the_aandp_are_not_sections():
+    sections = parse_note_sections("Subjective:\n#AKI mentioned in passing\n\nA&P:\n#AKI\n- trend Cr\n")
+    assert [section.section_id for section in sections] == ["subjective", "assessment_and_plan", "problem_aki"]
+
+
+def test_golden_merge(golden_note):
+    updates = parse_section_update(marked(
+        ("objective", "Objective:\nVitals: T 37.0 HR 80 BP 118/72 SpO2 97% RA\nLabs: Cr 1.4, K 4.1\n"),
+        ("problem_aki", "#AKI\n- Cr back to 1.4 baseline"),
+        ("subjective", "Subjective:\nSHOULD BE IGNORED"),
+        (NEW_PROBLEM_SECTION_ID, "#Hypokalemia\n- K 3.3, repleting"),
+    ))
+    merged, applied = merge_section_update(parse_note_sections(golden_note), updates, ["impression", "objective", "problem_aki"])
+    assert applied == ["objective", "problem_aki", NEW_PROBLEM_SECTION_ID]
+    assert merged == read_fixture("section_note_merged.txt")
+
+
+def test_sections_that_were_not_sent_are_ignored(golden_note):
+    sections = parse_note_sections(golden_note)
+    updates = parse_section_update(marked(
+        ("subjective", "Subjective:\nrewritten"),
+        ("problem_aki_2", "#AKI\n- rewritten"),
+        ("no_such_section", "made up"),
+    ))
+    merged, applied = merge_section_update(sections, updates, ["problem_aki"])
+    assert applied == []
+    assert merged == golden_note
+
+
+def test_empty_update_keeps_the_section(golden_note):
+    merged, applied = merge_section_update(parse_note_sections(golden_note), [("objective", "")], ["objective"])
+    assert applied == []
+    assert merged == golden_note
+
+
+def test_updated_section_keeps_its_trailing_blank_line(golden_note):
+    merged, _ = merge_section_update(parse_note_sections(golden_note), [("problem_hypertension", "#Hypertension\n- Restart lisinopril")], ["problem_hypertension"])
+    assert "#Hypertension\n- Restart lisinopril\n\n#AKI\n- (duplicate block" in merged
+
+
+def test_new_problem_goes_after_the_last_problem(golden_note):
+    merged, _ = merge_section_update(parse_note_sections(golden_note), [(NEW_PROBLEM_SECTION_ID, "#Gout\n- colchicine")], [])
+    assert merged.endswith("once euvolemic\n\n#Gout\n- colchicine\n")
+
+
+def test_new_problem_in_aandp_without_problems():
+    note = "Subjective:\nfeels well\n\nA&P:\nStable, continue current plan.\n"
+    merged, applied = merge_section_update(parse_note_sections(note), [(NEW_PROBLEM_SECTION_ID, "#Gout\n- colchicine")], [])
+    assert applied == [NEW_PROBLEM_SECTION_ID]
+    assert merged == note + "\n#Gout\n- colchicine\n"
+
+
+def test_new_problem_in_note_without_aandp():
+    note = "Subjective:\nfeels well\n"
+    merged, _ = merge_section_update(parse_note_sections(note), [(NEW_PROBLEM_SECTION_ID, "#Gout\n- colchicine")], [])
+    assert merged.startswith(note)
+    assert merged.rstrip().endswith("#Gout\n- colchicine")
+
+
+def test_parse_section_update_ignores_text_before_the_first_marker():
+    updates = parse_section_update("Here are the updated sections:\n" + marked(("objective", "Objective:\nBP 120/80\n"), ("problem_aki", "#AKI\n- better")))
+    assert updates == [("objective", "Objective:\nBP 120/80"), ("problem_aki", "#AKI\n- better")]
+    assert parse_section_update("A whole rewritten note without markers") == []
+
+
+def test_unmarked_model_output_fails_without_saving(backend):
+    filename = "rosetta_note_20250101_0800_MED_sections.txt"
+    saved_filename, version = backend.note_store.create(filename, "Subjective:\nold\n")
+    sections = parse_note_sections("Subjective:\nold\n")
+    note_request = {
+        "output_filename": saved_filename,
+        "operation_type_message": "updated",
+        "is_update": True,
+        "base_version": version,
+        "section_update": {"sections": sections, "sent_ids": ["subjective"]},
+    }
+
+    response, status = backend.finalize_note_output("Subjective:\nnew, but no markers", "", note_request)
+
+    assert status == 500
+    assert response["error"] == "The model did not return any marked note sections; the note was not changed."
+    assert response["llm_note_output"] == "Subjective:\nnew, but no markers"
+    assert backend.note_store.get(saved_filename)["body"] == "Subjective:\nold\n"
+
+
+def test_marked_model_output_is_merged_and_saved(backend):
+    saved_filename, version = backend.note_store.create("rosetta_note_20250101_0800_MED_merge.txt", "Subjective:\nold\n\nA&P:\n#AKI\n- trend Cr\n")
+    note_request = {
+        "output_filename": saved_filename,
+        "operation_type_message": "updated",
+        "is_update": True,
+        "base_version": version,
+        "section_update": {"sections": parse_note_sections(backend.note_store.get(saved_filename)["body"]), "sent_ids": ["problem_aki"]},
+    }
+
+    response, status = backend.finalize_note_output(marked(("problem_aki", "#AKI\n- Cr improving")), "", note_request)
+
+    assert status == 200
+    assert response["updated_sections"] == ["problem_aki"]
+    assert backend.note_store.get(saved_filename)["body"] == "Subjective:\nold\n\nA&P:\n#AKI\n- Cr improving"
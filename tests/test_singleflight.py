@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from rosetta_singleflight import (
+    EMPTY_LOCK_STALE_SECONDS,
+    AsyncSingleFlight,
+    FileFlightCoordinator,
+    SingleFlight,
+    SingleFlightError,
+    SingleFlightTimeout,
+)
+
+
+def start_thread(target, *args):
+    results = []
+
+    def run():
+        try:
+            results.append(("value", target(*args)))
+        except Exception as e:
+            results.append(("error", e))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, results
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_bypass_cache_requests_do_not_share_a_flight_with_cached_ones(backend):
+    plain = backend.make_flight_key("Patient: 67M, CHF", False, None)
+    assert backend.make_flight_key("Patient: 67M, CHF", False, None) == plain
+    assert backend.make_flight_key("Patient: 67M, CHF", True, None) != plain
+
+
+def test_async_waiters_take_over_when_the_leader_is_cancelled():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(asyncio.current_task())
+        await asyncio.sleep(0.05)
+        return "note"
+
+    async def scenario():
+        leader = asyncio.create_task(flights.do("key", call))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(flights.do("key", call, timeout=5)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel() # Client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*waiters)
+
+    results = asyncio.run(scenario())
+    assert sorted(results) == [("note", False), ("note", True)] # One waiter led the new call
+    assert len(calls) == 2
+    assert flights.stats["restarts"] == 2
+
+
+def test_cancelled_async_waiter_does_not_cancel_the_leader():
+    flights = AsyncSingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return "note"
+
+    async def scenario():
+        leader = asyncio.create_task(flights.do("key", call))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(flights.do("key", call))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(scenario()) == ("note", False)
+
+
+def test_result_file_is_deleted_after_its_ttl(tmp_path):
+    coordinator = FileFlightCoordinator(str(tmp_path), result_ttl_seconds=0.1)
+    assert coordinator.run("key", lambda: "note with patient text") == ("note with patient text", False)
+    assert os.listdir(tmp_path) == ["key.result.json"] # Kept for waiters in other workers
+    time.sleep(0.3)
+    assert os.listdir(tmp_path) == []
+
+
+def test_identical_calls_share_one_result():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "note"
+
+    leader, leader_result = start_thread(flights.do, "key", call)
+    wait_for(lambda: calls)
+    waiters = [start_thread(flights.do, "key", call) for _ in range(3)]
+    wait_for(lambda: flights.snapshot()["in_flight"] == 1)
+    time.sleep(0.05)
+    release.set()
+    for thread, _ in [(leader, leader_result)] + waiters:
+        thread.join(5)
+
+    assert leader_result == [("value", ("note", False))]
+    assert all(result == [("value", ("note", True))] for _, result in waiters)
+    assert len(calls) == 1
+    assert flights.stats["coalesced"] == 3
+
+
+def test_leader_error_reaches_every_waiter():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def call():
+        release.wait(5)
+        raise RuntimeError("Gemini returned 400")
+
+    leader, leader_result = start_thread(flights.do, "key", call)
+    wait_for(lambda: flights.snapshot()["in_flight"] == 1)
+    waiter, waiter_result = start_thread(flights.do, "key", call)
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    waiter.join(5)
+
+    assert leader_result[0][0] == "error" and str(leader_result[0][1]) == "Gemini returned 400"
+    assert waiter_result[0][0] == "error" and waiter_result[0][1] is leader_result[0][1]
+    assert flights.stats["errors"] == 1
+    assert flights.snapshot()["in_flight"] == 0 # The next identical request starts a new flight
+
+
+def test_waiter_timeout_leaves_the_leader_running():
+    flights = SingleFlight()
+    release = threading.Event()
+    leader, leader_result = start_thread(flights.do, "key", lambda: release.wait(5) and "note")
+    wait_for(lambda: flights.snapshot()["in_flight"] == 1)
+
+    with pytest.raises(SingleFlightTimeout):
+        flights.do("key", lambda: "never called", timeout=0.05)
+    release.set()
+    leader.join(5)
+
+    assert leader_result == [("value", ("note", False))]
+    assert flights.stats["timeouts"] == 1
+
+
+def test_other_workers_share_the_result_and_error(tmp_path):
+    leader_worker = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    other_worker = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    release = threading.Event()
+
+    leader, leader_result = start_thread(leader_worker.run, "ok", lambda: release.wait(5) and ["note", "", {}])
+    wait_for(lambda: os.path.exists(tmp_path / "ok.lock"))
+    waiter, waiter_result = start_thread(other_worker.run, "ok", lambda: ["should not run", "", {}])
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    waiter.join(5)
+    assert leader_result == [("value", (["note", "", {}], False))]
+    assert waiter_result == [("value", (["note", "", {}], True))]
+
+    def fail():
+        time.sleep(0.1)
+        raise ValueError("bad prompt")
+
+    leader, _ = start_thread(leader_worker.run, "bad", fail)
+    wait_for(lambda: os.path.exists(tmp_path / "bad.lock"))
+    with pytest.raises(SingleFlightError, match="ValueError: bad prompt"):
+        other_worker.run("bad", lambda: "should not run")
+    leader.join(5)
+
+
+def test_lock_of_a_dead_leader_is_broken(tmp_path, dead_pid):
+    (tmp_path / "key.lock").write_text(json.dumps({"pid": dead_pid, "flight_id": "gone"}))
+    coordinator = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    assert coordinator.run("key", lambda: "note", timeout=5) == ("note", False)
+    assert not (tmp_path / "key.lock").exists()
+
+
+def test_empty_lock_left_by_a_crash_is_broken(tmp_path):
+    lock_path = tmp_path / "key.lock"
+    lock_path.write_text("")
+    old = time.time() - EMPTY_LOCK_STALE_SECONDS - 1
+    os.utime(lock_path, (old, old))
+    coordinator = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    assert coordinator.run("key", lambda: "note", timeout=5) == ("note", False)
+
+
+def test_waiter_leads_when_the_leader_goes_away_without_a_result(tmp_path):
+    # A live leader (this process) whose lock disappears without writing our flight's result
+    lock_path = tmp_path / "key.lock"
+    lock_path.write_text(json.dumps({"pid": os.getpid(), "flight_id": "abandoned"}))
+    coordinator = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    waiter, result = start_thread(coordinator.run, "key", lambda: "note", 5)
+    time.sleep(0.1)
+    assert waiter.is_alive() # Still waiting on the live leader
+    os.remove(lock_path)
+    waiter.join(5)
+    assert result == [("value", ("note", False))]
+
+
+def test_file_waiter_times_out(tmp_path):
+    (tmp_path / "key.lock").write_text(json.dumps({"pid": os.getpid(), "flight_id": "busy"}))
+    coordinator = FileFlightCoordinator(str(tmp_path), poll_interval_seconds=0.01)
+    with pytest.raises(SingleFlightTimeout):
+        coordinator.run("key", lambda: "note", timeout=0.1)
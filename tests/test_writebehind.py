@@ -0,0 +1,119 @@
+import glob
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+from rosetta_store import FileNoteStore
+from rosetta_writebehind import RESERVED_DIRECTORY, WriteBehindNoteStore
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class GatedStore:
+    """Wraps a store; creating one of the `gated` filenames waits until `gate` is set."""
+
+    def __init__(self, store, gated=()):
+        self.store = store
+        self.gated = set(gated)
+        self.gate = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def create(self, filename, body, metadata=None):
+        if filename in self.gated:
+            self.gate.wait(10)
+        return self.store.create(filename, body, metadata)
+
+
+@pytest.fixture
+def notes_dir(tmp_path):
+    directory = tmp_path / "notes"
+    directory.mkdir()
+    return str(directory)
+
+
+@pytest.fixture
+def spool_dir(tmp_path):
+    return str(tmp_path / "spool")
+
+
+def test_journal_of_crashed_process_is_replayed(notes_dir, spool_dir):
+    # The child saves its first note, then dies while the writer is stuck on the second
+    child = textwrap.dedent(f"""
+        import os, sys, time
+        sys.path.insert(0, {REPO_ROOT!r})
+        from rosetta_store import FileNoteStore
+        from rosetta_writebehind import WriteBehindNoteStore
+
+        class StuckOnSecond(FileNoteStore):
+            def create(self, filename, body, metadata=None):
+                if filename.endswith("_second.txt"):
+                    time.sleep(60)
+                return super().create(filename, body, metadata)
+
+        store = WriteBehindNoteStore(StuckOnSecond({notes_dir!r}, fsync=False), {spool_dir!r}, fsync=True)
+        first, _ = store.create("rosetta_note_20250101_0800_MED_first.txt", "first note", {{"service": "MED"}})
+        store.flush(first)
+        store.create("rosetta_note_20250101_0800_MED_second.txt", "second note", {{"service": "MED"}})
+        os._exit(1)
+    """)
+    subprocess.run([sys.executable, "-c", child], check=False, timeout=30)
+    journals = glob.glob(os.path.join(spool_dir, "journal-*.jsonl"))
+    assert len(journals) == 1
+    with open(journals[0], "a", encoding="utf-8") as f:
+        f.write('{"filename": "rosetta_note_20250101_0800_MED_torn') # A write cut off by the crash
+
+    store = WriteBehindNoteStore(FileNoteStore(notes_dir, revalidate_seconds=0, fsync=False), spool_dir, fsync=False)
+    store.replay_orphaned_journals()
+
+    assert store.stats["replayed"] == 1 # The first note was already saved
+    assert store.store.get("rosetta_note_20250101_0800_MED_first.txt")["body"] == "first note"
+    assert store.store.get("rosetta_note_20250101_0800_MED_second.txt")["body"] == "second note"
+    assert glob.glob(os.path.join(spool_dir, "journal-*")) == []
+    assert os.listdir(os.path.join(spool_dir, RESERVED_DIRECTORY)) == []
+
+
+def test_full_queue_falls_back_to_a_synchronous_save(notes_dir, spool_dir):
+    events = []
+    gated = GatedStore(FileNoteStore(notes_dir, revalidate_seconds=0, fsync=False), gated=["rosetta_note_20250101_0800_MED_a.txt"])
+    store = WriteBehindNoteStore(
+        gated, spool_dir, max_queue=1, enqueue_timeout_seconds=0.05, fsync=False, on_event=lambda event, **_: events.append(event)
+    )
+    try:
+        queued, queued_version = store.create("rosetta_note_20250101_0800_MED_a.txt", "queued note")
+        saved, saved_version = store.create("rosetta_note_20250101_0800_MED_b.txt", "fallback note")
+
+        assert queued_version is None # Written behind
+        assert saved_version is not None # The queue was full: saved in the request thread
+        assert store.stats["synchronous_fallbacks"] == 1
+        assert "fallback" in events
+        assert gated.store.get(saved)["body"] == "fallback note"
+        assert gated.store.get(queued) is None
+        assert store.get(queued)["body"] == "queued note" # Pending notes are readable
+
+        gated.gate.set()
+        assert store.flush(timeout=10)
+        assert gated.store.get(queued)["body"] == "queued note"
+        assert os.listdir(os.path.join(spool_dir, RESERVED_DIRECTORY)) == []
+    finally:
+        gated.gate.set()
+        store.close()
+
+
+def test_backpressure_waits_for_room_before_falling_back(notes_dir, spool_dir):
+    gated = GatedStore(FileNoteStore(notes_dir, revalidate_seconds=0, fsync=False), gated=["rosetta_note_20250101_0800_MED_a.txt"])
+    store = WriteBehindNoteStore(gated, spool_dir, max_queue=1, enqueue_timeout_seconds=5, fsync=False)
+    try:
+        store.create("rosetta_note_20250101_0800_MED_a.txt", "first")
+        threading.Timer(0.1, gated.gate.set).start()
+        _, version = store.create("rosetta_note_20250101_0800_MED_b.txt", "second")
+        assert version is None
+        assert store.stats["synchronous_fallbacks"] == 0
+    finally:
+        gated.gate.set()
+        store.close()